@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 Taler Systems S.A.
+# 
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+
+# Compare two JMH result files, as written by "./gradlew util:jmh"
+# or "./gradlew nexus:jmh" (build/reports/jmh/results.json).
+
+import click
+import json
+
+
+def load_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    ret = {}
+    for r in results:
+        params = ",".join(
+            "{}={}".format(k, v) for k, v in sorted(r.get("params", {}).items())
+        )
+        key = r["benchmark"].split(".")[-2:]
+        key = ".".join(key) + ("[{}]".format(params) if params else "")
+        metric = r["primaryMetric"]
+        ret[key] = (metric["score"], metric["scoreError"], metric["scoreUnit"])
+    return ret
+
+
+@click.command()
+@click.option(
+    "--threshold",
+    default=10.0,
+    help="Percentage of slowdown that makes the comparison fail",
+)
+@click.argument("baseline")
+@click.argument("current")
+def compare(threshold, baseline, current):
+    old = load_results(baseline)
+    new = load_results(current)
+    regressions = 0
+    for key in sorted(set(old) | set(new)):
+        if key not in old:
+            print("{:<60} (new) {:>12.3f} {}".format(key, new[key][0], new[key][2]))
+            continue
+        if key not in new:
+            print("{:<60} (gone)".format(key))
+            continue
+        old_score, _, unit = old[key]
+        new_score, new_err, _ = new[key]
+        change = (new_score - old_score) / old_score * 100 if old_score else 0.0
+        # All the benchmarks measure average time: higher is worse.
+        mark = ""
+        if change > threshold and new_score - new_err > old_score:
+            mark = " REGRESSION"
+            regressions += 1
+        print(
+            "{:<60} {:>12.3f} -> {:>12.3f} {} ({:+.1f}%){}".format(
+                key, old_score, new_score, unit, change, mark
+            )
+        )
+    if regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    compare()
@@ -4,6 +4,11 @@
 ./test-ebics-highlevel.py
 ./test-ebics.py
 ./test-sandbox.py
+./test-sandbox.py --storage=memory
 ./test-taler-facade.py
 ./test-bankConnection.py
 ./test-ebics-double-payment-submission.py
+./test-ebics-replay.py
+./test-slow-bank.py
+./test-bank-faults.py
+./test-apply.py
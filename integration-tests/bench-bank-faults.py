@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Measures how nexus degrades when the bank is slow or flaky.
+#
+# Nexus talks to the sandbox through the fault injecting proxy
+# (faultproxy.py).  For every scenario, the proxy gets the
+# scenario's rules, and concurrent clients keep submitting
+# payments and fetching reports through nexus for a while.  The
+# report compares, scenario by scenario, the nexus throughput and
+# latency, the requests nexus kept in flight at the bank (its
+# queueing), and the retries it made, with the fault-free baseline.
+#
+# Usage:
+#   ./bench-bank-faults.py [--duration=20] [--workers=8]
+#                          [--scenarios=SCENARIOS_JSON_FILE]
+#                          [--bank-max-retries=N] [--bank-request-timeout=MS]
+#                          [--output=FILE]
+
+import argparse
+import base64
+import json
+import threading
+import time
+from requests import Session, get
+
+from faultproxy import distribution
+from util import (
+    startNexus,
+    startSandbox,
+    startFaultProxy,
+    fixtureSnapshots,
+    FAULT_PROXY_EBICS_URL,
+)
+
+USERNAME = "person"
+PASSWORD = "y"
+USER_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(b"person:y").decode("utf-8")
+)
+ADMIN_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(b"admin:x").decode("utf-8")
+)
+
+HOST_ID = "HOST01"
+PARTNER_ID = "PARTNER1"
+USER_ID = "USER1"
+EBICS_VERSION = "H004"
+
+SUBSCRIBER_IBAN = "GB33BUKB20201555555555"
+SUBSCRIBER_BIC = "BUKBGB22"
+SUBSCRIBER_NAME = "Oliver Smith"
+BANK_ACCOUNT_LABEL = "savings"
+
+NEXUS_DB = "bench-nexus.sqlite3"
+
+# One fetch every this many payments.
+FETCH_EVERY = 4
+
+# The first one is the baseline.
+SCENARIOS = [
+    dict(name="baseline", rules=[]),
+    dict(name="slow-bank", rules=[dict(latency=dict(dist="lognormal", medianMillis=150, sigma=0.8))]),
+    dict(name="narrow-link", rules=[dict(bandwidth=32 * 1024)]),
+    dict(name="flaky-5xx", rules=[dict(httpError=dict(rate=0.1, status=503))]),
+    dict(name="dropped-connections", rules=[dict(dropRequest=0.03, dropResponse=0.03)]),
+    dict(
+        name="ebics-errors",
+        rules=[dict(match=dict(phase="Initialisation"), ebicsError=dict(rate=0.1, code="091116"))],
+    ),
+    dict(
+        name="overloaded-bank",
+        bankConcurrency=1,
+        rules=[dict(latency=dict(dist="exponential", meanMillis=50))],
+    ),
+]
+
+FIXTURE = dict(
+    sandbox=dict(
+        url="http://localhost:5000",
+        hosts=[dict(hostID=HOST_ID, ebicsVersion=EBICS_VERSION)],
+        subscribers=[dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID)],
+        bankAccounts=[
+            dict(
+                subscriber=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID),
+                iban=SUBSCRIBER_IBAN,
+                bic=SUBSCRIBER_BIC,
+                name=SUBSCRIBER_NAME,
+                label=BANK_ACCOUNT_LABEL,
+            )
+        ],
+    ),
+    nexus=dict(
+        url="http://localhost:5001",
+        auth=dict(username="admin", password="x"),
+        users=[dict(username=USERNAME, password=PASSWORD)],
+        bankConnections=[
+            dict(
+                name="my-ebics",
+                owner=USERNAME,
+                ebicsURL=FAULT_PROXY_EBICS_URL,
+                hostID=HOST_ID,
+                partnerID=PARTNER_ID,
+                userID=USER_ID,
+                accounts=[BANK_ACCOUNT_LABEL],
+            )
+        ],
+    ),
+)
+
+
+def fail(msg):
+    print(msg)
+    exit(1)
+
+
+class Workload:
+    """Clients submitting payments and fetching reports through nexus until 'deadline'."""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.latencies = dict(submit=[], fetch=[])
+        self.failures = dict(submit=0, fetch=0)
+
+    def account(self, op, began, ok):
+        micros = int((time.monotonic() - began) * 1e6)
+        with self.lock:
+            if ok:
+                self.latencies[op].append(micros)
+            else:
+                self.failures[op] += 1
+
+    def submit(self, session, n):
+        began = time.monotonic()
+        resp = session.post(
+            f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations",
+            json=dict(
+                iban="FR7630006000011234567890189",
+                bic="AGRIFRPP",
+                name="Jacques La Fayette",
+                subject=f"benchmark payment {n}",
+                amount="EUR:1",
+            ),
+        )
+        if resp.status_code != 200:
+            fail(f"Could not prepare a payment: {resp.text}")
+        uuid = resp.json().get("uuid")
+        resp = session.post(
+            f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations/{uuid}/submit",
+            json=dict(),
+        )
+        self.account("submit", began, resp.status_code == 200)
+
+    def fetch(self, session):
+        began = time.monotonic()
+        resp = session.post(
+            f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/fetch-transactions",
+            json=dict(rangeType="latest", level="report"),
+        )
+        self.account("fetch", began, resp.status_code == 200)
+
+    def worker(self, index):
+        session = Session()
+        session.headers["Authorization"] = USER_AUTHORIZATION_HEADER
+        n = 0
+        while time.monotonic() < self.deadline:
+            if n % FETCH_EVERY == FETCH_EVERY - 1:
+                self.fetch(session)
+            else:
+                self.submit(session, f"{index}-{n}")
+            n += 1
+
+    def run(self, workers):
+        threads = [threading.Thread(target=self.worker, args=(i,)) for i in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+
+def bankMetrics():
+    resp = get(
+        "http://localhost:5001/bank-http-metrics",
+        headers=dict(Authorization=ADMIN_AUTHORIZATION_HEADER),
+    )
+    if resp.status_code != 200:
+        fail("Could not read the nexus bank metrics")
+    for h in resp.json().get("hosts"):
+        if h["host"] == "localhost:5002":
+            return h
+    return dict(requests=0, errors=0, retries=0)
+
+
+def runScenario(proxy, scenario, duration, workers):
+    proxy.setRules(scenario.get("rules", []))
+    proxy.setBankConcurrency(scenario.get("bankConcurrency"))
+    before = bankMetrics()
+    proxy.stats.reset()
+    began = time.monotonic()
+    workload = Workload(began + duration)
+    workload.run(workers)
+    elapsed = time.monotonic() - began
+    bank = proxy.stats.snapshot()
+    after = bankMetrics()
+    ops = {}
+    for op in ["submit", "fetch"]:
+        ok = workload.latencies[op]
+        ops[op] = dict(
+            succeeded=len(ok),
+            failed=workload.failures[op],
+            perSecond=len(ok) / elapsed,
+            latency=distribution(ok),
+        )
+    return dict(
+        name=scenario["name"],
+        elapsedSeconds=elapsed,
+        operations=ops,
+        bankRequestsPerSecond=bank["throughput"],
+        meanInFlight=bank["meanInFlight"],
+        maxInFlight=bank["maxInFlight"],
+        injectedFaults=bank["faults"],
+        nexusRetries=after["retries"] - before["retries"],
+        nexusBankErrors=after["errors"] - before["errors"],
+    )
+
+
+def report(results):
+    base = results[0]
+    print()
+    print(
+        "{:<22}{:>10}{:>8}{:>11}{:>11}{:>10}{:>9}{:>9}{:>9}{:>9}".format(
+            "scenario", "submit/s", "vs base", "submit p99", "fetch p99", "failed", "bank/s", "flight", "max", "retries"
+        )
+    )
+    for r in results:
+        submit = r["operations"]["submit"]
+        fetch = r["operations"]["fetch"]
+        ratio = submit["perSecond"] / base["operations"]["submit"]["perSecond"] if base["operations"]["submit"]["perSecond"] else 0
+        print(
+            "{:<22}{:>10.1f}{:>7.0f}%{:>9.0f}ms{:>9.0f}ms{:>10}{:>9.1f}{:>9.2f}{:>9}{:>9}".format(
+                r["name"],
+                submit["perSecond"],
+                ratio * 100,
+                submit["latency"]["p99Millis"],
+                fetch["latency"]["p99Millis"],
+                submit["failed"] + fetch["failed"],
+                r["bankRequestsPerSecond"],
+                r["meanInFlight"],
+                r["maxInFlight"],
+                r["nexusRetries"],
+            )
+        )
+    print()
+    print("flight: mean requests nexus had in flight at the bank; max: their maximum")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nexus throughput and queueing under bank faults")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per scenario")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent nexus clients")
+    parser.add_argument("--scenarios", help="JSON file with the scenarios, the first being the baseline")
+    parser.add_argument("--bank-max-retries", type=int, help="passed to nexus")
+    parser.add_argument("--bank-request-timeout", type=int, help="passed to nexus, in milliseconds")
+    parser.add_argument("--seed", type=int, default=1, help="makes the injected faults reproducible")
+    parser.add_argument("--output", help="where to store the results, as JSON")
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        with open(args.scenarios) as f:
+            scenarios = json.load(f)
+
+    nexusArgs = []
+    if args.bank_max_retries is not None:
+        nexusArgs.append(f"--bank-max-retries={args.bank_max_retries}")
+    if args.bank_request_timeout is not None:
+        nexusArgs.append(f"--bank-request-timeout={args.bank_request_timeout}")
+
+    # Started first: building the snapshots connects through it.
+    proxy = startFaultProxy(seed=args.seed)
+    snapshots = fixtureSnapshots(FIXTURE)
+    startNexus(NEXUS_DB, snapshot=snapshots.nexus, extraArgs=nexusArgs)
+    startSandbox(snapshot=snapshots.sandbox, extraArgs=["--allow-ebics-fault-injection"])
+
+    results = []
+    for scenario in scenarios:
+        print(f"Running scenario '{scenario['name']}' for {args.duration}s")
+        results.append(runScenario(proxy, scenario, args.duration, args.workers))
+        proxy.report()
+    report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+# Measures how the stages of a C53 fetch scale with the size
+# of the account history.
+#
+# For every history size N, a fresh sandbox subscriber gets
+# N bookings, the sandbox closes its statement, and nexus is
+# asked to fetch it.  The stage timings are read from the
+# "tech.libeufin.timing" log lines of both services, and for
+# every stage the exponent k
+# of time ~ N^k is estimated.  The benchmark fails if one stage
+# grows faster than in the stored baseline (or, without
+# baseline, faster than linearly).
+#
+# Usage:
+#   ./bench-history-scaling.py [--sizes=1000,10000,100000]
+#                              [--baseline=FILE] [--update-baseline]
+
+import argparse
+import base64
+import json
+import math
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from requests import post, get
+
+from util import startNexus, startSandbox
+
+USERNAME = "bench"
+PASSWORD = "bench"
+USER_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(f"{USERNAME}:{PASSWORD}".encode("utf-8")).decode("utf-8")
+)
+ADMIN_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(b"admin:x").decode("utf-8")
+)
+
+EBICS_URL = "http://localhost:5000/ebicsweb"
+HOST_ID = "HOST01"
+PARTNER_ID = "PARTNER1"
+EBICS_VERSION = "H004"
+
+NEXUS_DB = "bench-nexus.sqlite3"
+SANDBOX_DB = "bench-sandbox.sqlite3"
+NEXUS_LOG = "nexus-stderr.log"
+SANDBOX_LOG = "sandbox-stderr.log"
+
+DEFAULT_BASELINE = Path(__file__).parent / "history-scaling-baseline.json"
+
+TIMING_LINE = re.compile(r"tech\.libeufin\.timing - stage=(\S+) micros=(\d+)")
+
+# Stages as reported, derived from the raw timings logged by
+# logStageTiming().  Some raw stages nest into others.
+STAGES = [
+    "sandbox-statement-closing",
+    "ebics-transfer",
+    "ebics-decrypt",
+    "bank-message-store",
+    "camt-parse",
+    "camt-ingest",
+    "taler-ingest",
+    "total",
+]
+
+
+def fail(msg):
+    print(msg)
+    exit(1)
+
+
+def assertResponse(response):
+    if response.status_code != 200:
+        print("Benchmark failed on URL: {}".format(response.url))
+        print(response.text)
+        print("Check nexus-stderr.log and sandbox-stderr.log")
+        exit(1)
+    return response
+
+
+class LogTail:
+    """Collects the timing lines appended to a log file since the last call."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.offset = self.path.stat().st_size if self.path.exists() else 0
+
+    def collect(self):
+        timings = {}
+        with open(self.path, "r") as f:
+            f.seek(self.offset)
+            for line in f:
+                m = TIMING_LINE.search(line)
+                if m:
+                    stage, micros = m.group(1), int(m.group(2))
+                    timings[stage] = timings.get(stage, 0) + micros
+            self.offset = f.tell()
+        return timings
+
+
+def seedHistory(iban, n):
+    """Book n incoming payments for 'iban', directly into the sandbox database."""
+    db = sqlite3.connect(SANDBOX_DB)
+    with db:
+        row = db.execute("SELECT id FROM BankAccounts WHERE iban = ?", (iban,)).fetchone()
+        if row is None:
+            fail(f"bank account {iban} not found in sandbox")
+        now = int(time.time() * 1000)
+        db.executemany(
+            "INSERT INTO BankAccountTransactions (creditorIban, creditorBic, creditorName, "
+            "debitorIban, debitorBic, debitorName, subject, amount, currency, date, "
+            "pmtInfId, msgId, account) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    iban, "BUKBGB22", "Bench Owner",
+                    "FR7630006000011234567890189", "AGRIFRPP", "Jacques La Fayette",
+                    f"benchmark payment {i}", f"{1 + i % 100}.{i % 100:02d}", "EUR", now,
+                    f"seed-{i}", f"{n}", row[0],
+                )
+                for i in range(n)
+            ),
+        )
+    db.close()
+
+
+def prepareAccount(n):
+    """Make a subscriber with n bookings, and the matching nexus bank account."""
+    user_id = f"USER{n}"
+    iban = f"GB33BUKB{n:014d}"
+    label = f"bench-{n}"
+    assertResponse(
+        post(
+            "http://localhost:5000/admin/ebics/subscribers",
+            json=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=user_id),
+        )
+    )
+    assertResponse(
+        post(
+            "http://localhost:5000/admin/ebics/bank-accounts",
+            json=dict(
+                subscriber=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=user_id),
+                iban=iban,
+                bic="BUKBGB22",
+                name="Bench Owner",
+                label=label,
+            ),
+        )
+    )
+    seedHistory(iban, n)
+    connection = f"conn-{n}"
+    assertResponse(
+        post(
+            "http://localhost:5001/bank-connections",
+            json=dict(
+                name=connection,
+                source="new",
+                type="ebics",
+                data=dict(ebicsURL=EBICS_URL, hostID=HOST_ID, partnerID=PARTNER_ID, userID=user_id),
+            ),
+            headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+        )
+    )
+    assertResponse(
+        post(
+            f"http://localhost:5001/bank-connections/{connection}/connect",
+            json=dict(),
+            headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+        )
+    )
+    assertResponse(
+        post(
+            f"http://localhost:5001/bank-connections/{connection}/ebics/import-accounts",
+            json=dict(),
+            headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+        )
+    )
+    # The facade makes ingestTalerTransactions() look at the account.
+    assertResponse(
+        post(
+            "http://localhost:5001/facades",
+            json=dict(
+                name=f"facade-{n}",
+                type="taler-wire-gateway",
+                creator=USERNAME,
+                config=dict(
+                    bankAccount=label,
+                    bankConnection=connection,
+                    reserveTransferLevel="UNUSED",
+                    intervalIncremental="UNUSED",
+                ),
+            ),
+            headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+        )
+    )
+    return label
+
+
+def measureFetch(label, n, nexusLog, sandboxLog):
+    nexusLog.collect()
+    sandboxLog.collect()
+    # C53 serves the closed statements only.
+    assertResponse(post("http://localhost:5000/admin/statements/close"))
+    closing = sandboxLog.collect()
+    start = time.monotonic()
+    assertResponse(
+        post(
+            f"http://localhost:5001/bank-accounts/{label}/fetch-transactions",
+            json=dict(rangeType="all", level="statement"),
+            headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+        )
+    )
+    total = int((time.monotonic() - start) * 1000000)
+    raw = nexusLog.collect()
+    raw.update(sandboxLog.collect())
+
+    resp = assertResponse(
+        get(
+            f"http://localhost:5001/bank-accounts/{label}/transactions",
+            headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+        )
+    )
+    ingested = len(resp.json().get("transactions"))
+    if ingested != n:
+        fail(f"nexus ingested {ingested} transactions, expected {n}")
+
+    def r(stage):
+        return raw.get(stage, 0)
+
+    return {
+        "sandbox-statement-closing": closing.get("sandbox-statement-closing", 0),
+        "ebics-transfer": max(0, r("ebics-download") - r("ebics-decrypt")),
+        "ebics-decrypt": r("ebics-decrypt"),
+        "bank-message-store": r("bank-message-store"),
+        "camt-parse": r("camt-parse") + r("camt-stream-parse"),
+        "camt-ingest": max(0, r("camt-ingest") - r("camt-stream-parse")),
+        "taler-ingest": r("taler-ingest"),
+        "total": total,
+    }
+
+
+def scalingExponent(sizes, micros):
+    """Least-squares slope of log(time) over log(size)."""
+    points = [(math.log(n), math.log(t)) for n, t in zip(sizes, micros) if t > 0]
+    if len(points) < 2:
+        return None
+    mx = sum(p[0] for p in points) / len(points)
+    my = sum(p[1] for p in points) / len(points)
+    num = sum((x - mx) * (y - my) for x, y in points)
+    den = sum((x - mx) ** 2 for x, _ in points)
+    return num / den if den else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="History-size scaling benchmark for fetch and ingest")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated history sizes")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="baseline file with the stage exponents")
+    parser.add_argument("--update-baseline", action="store_true", help="store the measured exponents as baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed exponent increase over the baseline")
+    parser.add_argument(
+        "--min-millis",
+        type=float,
+        default=100,
+        help="stages faster than this at the largest size are too noisy to be checked",
+    )
+    parser.add_argument("--output", help="where to store the measurements, as JSON")
+    args = parser.parse_args()
+    sizes = sorted(int(x) for x in args.sizes.split(","))
+    if len(sizes) < 2:
+        fail("need at least two sizes")
+
+    startNexus(NEXUS_DB, logLevel="INFO")
+    startSandbox(SANDBOX_DB, logLevel="INFO")
+    nexusLog = LogTail(NEXUS_LOG)
+    sandboxLog = LogTail(SANDBOX_LOG)
+
+    assertResponse(
+        post(
+            "http://localhost:5000/admin/ebics/host",
+            json=dict(hostID=HOST_ID, ebicsVersion=EBICS_VERSION),
+        )
+    )
+    assertResponse(
+        post(
+            "http://localhost:5001/users",
+            headers=dict(Authorization=ADMIN_AUTHORIZATION_HEADER),
+            json=dict(username=USERNAME, password=PASSWORD),
+        )
+    )
+
+    measurements = {}
+    for n in sizes:
+        print(f"Seeding and fetching a history of {n} bookings")
+        label = prepareAccount(n)
+        measurements[n] = measureFetch(label, n, nexusLog, sandboxLog)
+
+    print()
+    print("{:<26}".format("stage") + "".join("{:>14}".format(f"N={n}") for n in sizes) + "{:>10}".format("k"))
+    exponents = {}
+    for stage in STAGES:
+        micros = [measurements[n][stage] for n in sizes]
+        k = scalingExponent(sizes, micros)
+        exponents[stage] = k
+        print(
+            "{:<26}".format(stage)
+            + "".join("{:>12.1f}ms".format(t / 1000) for t in micros)
+            + "{:>10}".format("-" if k is None else "{:.2f}".format(k))
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(sizes=sizes, micros=measurements, exponents=exponents), f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(dict(sizes=sizes, exponents=exponents), f, indent=2)
+        print(f"Baseline stored in {args.baseline}")
+        return
+
+    baseline = {}
+    if Path(args.baseline).exists():
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("exponents", {})
+    else:
+        print("No baseline found, checking against linear growth")
+
+    failed = []
+    for stage in STAGES:
+        k = exponents[stage]
+        if k is None or measurements[sizes[-1]][stage] / 1000 < args.min_millis:
+            continue
+        reference = baseline.get(stage)
+        if reference is None:
+            # No baseline for this stage: at most linear growth.
+            reference = 1.0
+        if k > reference + args.tolerance:
+            failed.append(f"{stage}: exponent {k:.2f}, reference {reference:.2f}")
+    if failed:
+        print("Faster growth than the reference detected:")
+        for f in failed:
+            print("  " + f)
+        exit(1)
+    print("Benchmark passed!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+
+# HTTP proxy that sits between nexus and the sandbox's EBICS endpoint,
+# and makes the bank slow or flaky on purpose.
+#
+# Every request is classified by its EBICS order type (HEV, INI, HIA,
+# HPB, C52, C53, CCT, ...) and transaction phase (Initialisation,
+# Transfer, Receipt; none for the key management requests).  The first
+# rule matching it decides what happens to it:
+#
+#   dict(
+#       match=dict(orderType="C53", phase="Transfer"),  # both optional
+#       latency=dict(dist="lognormal", medianMillis=200, sigma=0.5),
+#       bandwidth=64 * 1024,          # bytes per second, both directions
+#       dropRequest=0.05,             # the bank never sees the request
+#       dropResponse=0.05,            # the bank served it, the answer is lost
+#       httpError=dict(rate=0.1, status=503),
+#       ebicsError=dict(rate=0.1, code="091116"),
+#   )
+#
+# The fault rates are probabilities of mutually exclusive outcomes, so
+# they add up to at most 1.  EBICS responses are signed, so the proxy
+# cannot forge EBICS errors: it asks the sandbox for them through the
+# X-LibEuFin-Ebics-Fault header, which needs the sandbox to run with
+# --allow-ebics-fault-injection.
+#
+# Latency distributions, in milliseconds:
+#   dict(dist="fixed", millis=M)
+#   dict(dist="uniform", minMillis=A, maxMillis=B)
+#   dict(dist="exponential", meanMillis=M)
+#   dict(dist="lognormal", medianMillis=M, sigma=S)
+#   dict(dist="pareto", minMillis=M, alpha=A)
+#
+# The tests drive the proxy through util.startFaultProxy(); run alone,
+# it serves until interrupted and then prints its report:
+#   ./faultproxy.py [--port=5002] [--upstream=http://localhost:5000]
+#                   [--rules=RULES_JSON_FILE] [--seed=N]
+#                   [--bank-concurrency=N]
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+EBICS_FAULT_HEADER = "X-LibEuFin-Ebics-Fault"
+
+ROOT = re.compile(rb"<(?:[\w-]+:)?(ebics\w*Request)\b")
+TRANSACTION_ID = re.compile(rb"<(?:[\w-]+:)?TransactionID>\s*([^<\s]+)\s*</")
+TRANSACTION_PHASE = re.compile(rb"<(?:[\w-]+:)?TransactionPhase>\s*([^<\s]+)\s*</")
+ORDER_TYPE = re.compile(rb"<(?:[\w-]+:)?OrderType>\s*([^<\s]+)\s*</")
+
+# Not forwarded: they describe one connection, not the message.
+HOP_BY_HOP = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "content-length",
+    "host",
+}
+
+FAULTS = ["dropRequest", "httpError", "ebicsError", "dropResponse"]
+
+# Bytes written between two bandwidth pauses.
+THROTTLE_CHUNK = 4096
+
+
+class ProxyError(Exception):
+    pass
+
+
+def sampleLatency(spec, rng):
+    """Seconds to wait, drawn from the latency distribution 'spec'."""
+    if spec is None:
+        return 0
+    dist = spec.get("dist", "fixed")
+    if dist == "fixed":
+        millis = spec["millis"]
+    elif dist == "uniform":
+        millis = rng.uniform(spec["minMillis"], spec["maxMillis"])
+    elif dist == "exponential":
+        millis = rng.expovariate(1.0 / spec["meanMillis"])
+    elif dist == "lognormal":
+        millis = rng.lognormvariate(math.log(spec["medianMillis"]), spec["sigma"])
+    elif dist == "pareto":
+        millis = spec["minMillis"] * rng.paretovariate(spec["alpha"])
+    else:
+        raise ProxyError(f"unknown latency distribution '{dist}'")
+    return millis / 1000.0
+
+
+def faultRate(rule, fault):
+    value = rule.get(fault)
+    if isinstance(value, dict):
+        return value.get("rate", 0)
+    return value or 0
+
+
+def faultOption(rule, fault, key, default):
+    value = rule.get(fault)
+    if isinstance(value, dict):
+        return value.get(key, default)
+    return default
+
+
+def checkRules(rules):
+    for rule in rules:
+        unknown = set(rule) - {"match", "latency", "bandwidth", *FAULTS}
+        if unknown:
+            raise ProxyError(f"unknown rule fields: {', '.join(sorted(unknown))}")
+        if sum(faultRate(rule, f) for f in FAULTS) > 1:
+            raise ProxyError(f"fault rates add up to more than 1 in {rule}")
+        code = faultOption(rule, "ebicsError", "code", "091116")
+        if not re.fullmatch(r"[0-9]{6}", code):
+            raise ProxyError(f"EBICS return code '{code}' is not six digits")
+        sampleLatency(rule.get("latency"), random.Random(0))
+    return list(rules)
+
+
+def matches(rule, orderType, phase):
+    match = rule.get("match", {})
+
+    def accepts(wanted, actual):
+        if wanted is None:
+            return True
+        if isinstance(wanted, str):
+            return wanted == actual
+        return actual in wanted
+
+    return accepts(match.get("orderType"), orderType) and accepts(match.get("phase"), phase)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0
+    rank = max(1, math.ceil(p / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def distribution(micros):
+    values = sorted(micros)
+    return dict(
+        count=len(values),
+        p50Millis=percentile(values, 50) / 1000,
+        p90Millis=percentile(values, 90) / 1000,
+        p99Millis=percentile(values, 99) / 1000,
+        maxMillis=(values[-1] if values else 0) / 1000,
+    )
+
+
+class LabelStats:
+    def __init__(self):
+        self.requests = 0
+        self.faults = {f: 0 for f in FAULTS}
+        self.bankMicros = []
+        self.totalMicros = []
+        self.queueMicros = []
+
+
+class Stats:
+    """What the proxy saw.  Updated from the proxy thread, read from any."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.monotonic()
+            self.labels = {}
+            self.completed = []
+            # Requests in flight across a reset are still counted out.
+            self.inFlight = getattr(self, "inFlight", 0)
+            self.maxInFlight = self.inFlight
+            self.inFlightIntegral = 0.0
+            self.lastChange = self.start
+
+    def _gauge(self, delta):
+        now = time.monotonic()
+        self.inFlightIntegral += self.inFlight * (now - self.lastChange)
+        self.lastChange = now
+        self.inFlight += delta
+        self.maxInFlight = max(self.maxInFlight, self.inFlight)
+
+    def began(self, label):
+        with self.lock:
+            self.labels.setdefault(label, LabelStats()).requests += 1
+            self._gauge(1)
+
+    def finished(self, label, fault, totalMicros, bankMicros, queueMicros):
+        with self.lock:
+            self._gauge(-1)
+            s = self.labels.setdefault(label, LabelStats())
+            if fault is not None:
+                s.faults[fault] += 1
+            s.totalMicros.append(totalMicros)
+            if bankMicros is not None:
+                s.bankMicros.append(bankMicros)
+            if queueMicros is not None:
+                s.queueMicros.append(queueMicros)
+            self.completed.append(time.monotonic() - self.start)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.start
+            integral = self.inFlightIntegral + self.inFlight * (now - self.lastChange)
+            labels = {}
+            for label, s in sorted(self.labels.items()):
+                labels[label] = dict(
+                    requests=s.requests,
+                    faults=dict(s.faults),
+                    bank=distribution(s.bankMicros),
+                    total=distribution(s.totalMicros),
+                    queue=distribution(s.queueMicros),
+                )
+            seconds = {}
+            for t in self.completed:
+                seconds[int(t)] = seconds.get(int(t), 0) + 1
+            return dict(
+                elapsedSeconds=elapsed,
+                requests=sum(s.requests for s in self.labels.values()),
+                faults={f: sum(s.faults[f] for s in self.labels.values()) for f in FAULTS},
+                throughput=len(self.completed) / elapsed if elapsed else 0,
+                # Per second of the run, so that a throughput collapse shows.
+                completedPerSecond=[seconds.get(i, 0) for i in range(int(elapsed) + 1)],
+                inFlight=self.inFlight,
+                maxInFlight=self.maxInFlight,
+                meanInFlight=integral / elapsed if elapsed else 0,
+                labels=labels,
+            )
+
+
+async def readHttpMessage(reader, isResponse=False):
+    """
+    Start line, headers and body of one HTTP/1.1 message, or None if
+    the peer closed the connection before sending one.
+    """
+    startLine = await reader.readline()
+    if not startLine:
+        return None
+    headers = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers.append((name.strip(), value.strip()))
+    lowered = {name.lower(): value for name, value in headers}
+    if "chunked" in lowered.get("transfer-encoding", "").lower():
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Trailers, up to the empty line.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+        body = bytes(body)
+    elif "content-length" in lowered:
+        body = await reader.readexactly(int(lowered["content-length"]))
+    elif isResponse:
+        body = await reader.read()
+    else:
+        body = b""
+    return startLine.decode("latin-1").rstrip("\r\n"), headers, body
+
+
+def headerValue(headers, name):
+    for n, v in headers:
+        if n.lower() == name:
+            return v
+    return None
+
+
+async def writeThrottled(writer, data, bandwidth):
+    if not bandwidth:
+        writer.write(data)
+        await writer.drain()
+        return
+    for i in range(0, len(data), THROTTLE_CHUNK):
+        chunk = data[i:i + THROTTLE_CHUNK]
+        writer.write(chunk)
+        await writer.drain()
+        await asyncio.sleep(len(chunk) / bandwidth)
+
+
+class FaultProxy:
+    """
+    The proxy, serving from its own thread and event loop.  'bankConcurrency'
+    makes the bank serve that many requests at a time, the others queue
+    in the proxy.  Both it and the rules can be changed while the proxy
+    runs.
+    """
+
+    def __init__(self, port=5002, upstream="http://localhost:5000", rules=(), seed=None, bankConcurrency=None):
+        self.port = port
+        target = urlsplit(upstream)
+        self.upstreamHost = target.hostname
+        self.upstreamPort = target.port or 80
+        self.rules = checkRules(rules)
+        self.rng = random.Random(seed)
+        self.bankConcurrency = bankConcurrency
+        self.stats = Stats()
+        # Order type of the transactions in flight, learnt from the
+        # initialisation responses: later phases do not repeat it.
+        self.orderTypes = {}
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.semaphore = None
+        self.semaphoreSize = None
+
+    def setRules(self, rules):
+        self.rules = checkRules(rules)
+
+    def setBankConcurrency(self, bankConcurrency):
+        self.bankConcurrency = bankConcurrency
+
+    def bankSemaphore(self):
+        """Semaphore for the current bankConcurrency, made in the proxy thread."""
+        if self.bankConcurrency != self.semaphoreSize:
+            self.semaphore = asyncio.Semaphore(self.bankConcurrency) if self.bankConcurrency else None
+            self.semaphoreSize = self.bankConcurrency
+        return self.semaphore
+
+    def start(self):
+        ready = threading.Event()
+        failure = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_server(self.serveConnection, "127.0.0.1", self.port)
+                )
+            except Exception as e:
+                failure.append(e)
+                ready.set()
+                return
+            ready.set()
+            self.loop.run_forever()
+            self.server.close()
+            # The connections still open.
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name="fault-proxy", daemon=True)
+        self.thread.start()
+        ready.wait()
+        if failure:
+            raise failure[0]
+        print(f"Fault proxy listening on port {self.port}, forwarding to {self.upstreamHost}:{self.upstreamPort}")
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+
+    def classify(self, body):
+        root = ROOT.search(body)
+        root = root.group(1).decode() if root else None
+        if root == "ebicsHEVRequest":
+            return "HEV", None
+        orderType = ORDER_TYPE.search(body)
+        orderType = orderType.group(1).decode() if orderType else None
+        phase = TRANSACTION_PHASE.search(body)
+        phase = phase.group(1).decode() if phase else None
+        if orderType is None:
+            transactionId = TRANSACTION_ID.search(body)
+            if transactionId:
+                orderType = self.orderTypes.get(transactionId.group(1))
+        return orderType or root or "unknown", phase
+
+    def pickRule(self, orderType, phase):
+        for rule in self.rules:
+            if matches(rule, orderType, phase):
+                return rule
+        return {}
+
+    def pickFault(self, rule):
+        draw = self.rng.random()
+        for fault in FAULTS:
+            draw -= faultRate(rule, fault)
+            if draw < 0:
+                return fault
+        return None
+
+    async def serveConnection(self, reader, writer):
+        try:
+            while True:
+                request = await readHttpMessage(reader)
+                if request is None:
+                    break
+                keepAlive = await self.serveRequest(request, writer)
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Cancelled only when the proxy stops.
+            pass
+        finally:
+            writer.close()
+
+    async def serveRequest(self, request, writer):
+        """Answer one request; False if the connection must be closed."""
+        startLine, headers, body = request
+        began = time.monotonic()
+        orderType, phase = self.classify(body)
+        label = orderType if phase is None else f"{orderType}/{phase}"
+        rule = self.pickRule(orderType, phase)
+        fault = self.pickFault(rule)
+        bandwidth = rule.get("bandwidth")
+        self.stats.began(label)
+        bankMicros = None
+        queueMicros = None
+        try:
+            await asyncio.sleep(sampleLatency(rule.get("latency"), self.rng))
+            if fault == "dropRequest":
+                writer.transport.abort()
+                return False
+            if fault == "httpError":
+                status = faultOption(rule, "httpError", "status", 503)
+                text = b"Fault injected by the test proxy"
+                writer.write(
+                    f"HTTP/1.1 {status} Injected\r\nContent-Type: text/plain\r\n"
+                    f"Content-Length: {len(text)}\r\n\r\n".encode("latin-1") + text
+                )
+                await writer.drain()
+                return True
+
+            extra = []
+            if fault == "ebicsError":
+                extra.append((EBICS_FAULT_HEADER, faultOption(rule, "ebicsError", "code", "091116")))
+            queued = time.monotonic()
+            semaphore = self.bankSemaphore()
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                forwarded = time.monotonic()
+                queueMicros = int((forwarded - queued) * 1e6)
+                response = await self.forward(startLine, headers + extra, body, bandwidth)
+                bankMicros = int((time.monotonic() - forwarded) * 1e6)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+            if response is None:
+                writer.transport.abort()
+                return False
+            status, responseHeaders, responseBody = response
+            if phase == "Initialisation":
+                transactionId = TRANSACTION_ID.search(responseBody)
+                if transactionId:
+                    self.orderTypes[transactionId.group(1)] = orderType
+            elif phase == "Receipt":
+                transactionId = TRANSACTION_ID.search(body)
+                if transactionId:
+                    self.orderTypes.pop(transactionId.group(1), None)
+            if fault == "dropResponse":
+                writer.transport.abort()
+                return False
+            head = [status]
+            head += [f"{n}: {v}" for n, v in responseHeaders if n.lower() not in HOP_BY_HOP]
+            head.append(f"Content-Length: {len(responseBody)}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            await writeThrottled(writer, responseBody, bandwidth)
+            return (headerValue(headers, "connection") or "").lower() != "close"
+        finally:
+            self.stats.finished(label, fault, int((time.monotonic() - began) * 1e6), bankMicros, queueMicros)
+
+    async def forward(self, startLine, headers, body, bandwidth):
+        """The upstream's response, or None if it could not be had."""
+        try:
+            reader, writer = await asyncio.open_connection(self.upstreamHost, self.upstreamPort)
+        except OSError as e:
+            print(f"Fault proxy cannot reach the upstream: {e}")
+            return None
+        try:
+            head = [startLine, f"Host: {self.upstreamHost}:{self.upstreamPort}"]
+            head += [f"{n}: {v}" for n, v in headers if n.lower() not in HOP_BY_HOP]
+            head += [f"Content-Length: {len(body)}", "Connection: close"]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            await writeThrottled(writer, body, bandwidth)
+            return await readHttpMessage(reader, isResponse=True)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return None
+        finally:
+            writer.close()
+
+    def report(self):
+        """Print the statistics gathered since the start or the last stats.reset()."""
+        s = self.stats.snapshot()
+        print()
+        print(
+            "{:<22}{:>8}{:>8}{:>8}{:>8}{:>8}{:>11}{:>11}{:>11}".format(
+                "exchange", "count", "drop-rq", "http", "ebics", "drop-rs", "bank p50", "bank p99", "queue p99"
+            )
+        )
+        for label, l in s["labels"].items():
+            print(
+                "{:<22}{:>8}{:>8}{:>8}{:>8}{:>8}{:>9.1f}ms{:>9.1f}ms{:>9.1f}ms".format(
+                    label,
+                    l["requests"],
+                    l["faults"]["dropRequest"],
+                    l["faults"]["httpError"],
+                    l["faults"]["ebicsError"],
+                    l["faults"]["dropResponse"],
+                    l["bank"]["p50Millis"],
+                    l["bank"]["p99Millis"],
+                    l["queue"]["p99Millis"],
+                )
+            )
+        print(
+            "{} requests in {:.1f}s, {:.1f}/s; in flight: mean {:.2f}, max {}".format(
+                s["requests"], s["elapsedSeconds"], s["throughput"], s["meanInFlight"], s["maxInFlight"]
+            )
+        )
+        return s
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency- and fault-injecting proxy for the EBICS endpoint")
+    parser.add_argument("--port", type=int, default=5002)
+    parser.add_argument("--upstream", default="http://localhost:5000")
+    parser.add_argument("--rules", help="JSON file with the list of rules")
+    parser.add_argument("--seed", type=int, help="makes the injected faults reproducible")
+    parser.add_argument("--bank-concurrency", type=int, help="requests the bank serves at the same time")
+    args = parser.parse_args()
+    rules = []
+    if args.rules:
+        with open(args.rules) as f:
+            rules = json.load(f)
+    proxy = FaultProxy(args.port, args.upstream, rules, args.seed, args.bank_concurrency)
+    proxy.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    proxy.stop()
+    proxy.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Replays EBICS traffic recorded by 'nexus serve --record-ebics-traffic'
+# against a sandbox, and reports the latency distributions.
+#
+# The recorded requests are sent as they are: they are signed, so
+# nothing in them can be changed.  Therefore the sandbox must be in
+# the state it was in when the recording started (start both from
+# the same database snapshot), and it must run with
+# --derive-ebics-transaction-ids during the recording and the
+# replay, so that it hands out the recorded transaction IDs again.
+#
+# The exchanges of one EBICS transaction (initialisation, transfers,
+# receipt) always run in their recorded order.  Distinct transactions
+# run concurrently:
+#   --speed=1     at the recorded pace,
+#   --speed=10    ten times faster,
+#   --speed=max   as fast as --concurrency allows.
+#
+# The replay fails if a request gets a non-200 response, or EBICS
+# return codes other than the recorded ones.
+#
+# Usage:
+#   ./replay-ebics-traffic.py TRAFFIC_FILE [--url=URL] [--speed=max]
+#                             [--concurrency=N] [--sandbox-snapshot=FILE]
+
+import argparse
+import gzip
+import json
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from requests import Session
+
+from util import startSandbox
+
+TRAFFIC_FORMAT = "libeufin-ebics-traffic"
+
+ROOT = re.compile(r"<(?:[\w-]+:)?(ebics\w*Request)\b")
+TRANSACTION_ID = re.compile(r"<(?:[\w-]+:)?TransactionID>\s*([^<\s]+)\s*</")
+TRANSACTION_PHASE = re.compile(r"<(?:[\w-]+:)?TransactionPhase>\s*([^<\s]+)\s*</")
+ORDER_TYPE = re.compile(r"<(?:[\w-]+:)?OrderType>\s*([^<\s]+)\s*</")
+RETURN_CODE = re.compile(r"<(?:[\w-]+:)?ReturnCode>\s*([^<\s]+)\s*</")
+
+
+def fail(msg):
+    print(msg)
+    exit(1)
+
+
+def readRecording(path):
+    """The recorded exchanges; a recording cut short is read up to its last record."""
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            header = json.loads(f.readline())
+            if header.get("format") != TRAFFIC_FORMAT:
+                fail(f"{path} is not an EBICS traffic recording")
+            for line in f:
+                if line.endswith("\n"):
+                    records.append(json.loads(line))
+        except EOFError:
+            print("The recording was not closed, replaying its complete records")
+    return records
+
+
+def firstMatch(regex, text):
+    m = regex.search(text or "")
+    return m.group(1) if m else None
+
+
+class Exchange:
+    def __init__(self, record, label):
+        self.record = record
+        self.label = label
+        self.recordedCodes = RETURN_CODE.findall(record["response"] or "")
+        # Filled in by the replay.
+        self.latencyMicros = None
+        self.lagMicros = 0
+        self.status = None
+        self.codes = None
+
+
+def buildFlows(records):
+    """
+    Group the exchanges into flows that must run in order: one
+    EBICS transaction, or one request of the transaction-less kind
+    (HEV, key management).  Only final attempts that got a response
+    are replayed, retried ones would be sent twice otherwise.
+    """
+    flows = []
+    byTransaction = {}
+    skipped = 0
+    for record in records:
+        if record["response"] is None:
+            continue
+        request = record["request"]
+        root = firstMatch(ROOT, request) or "unknown"
+        transactionId = firstMatch(TRANSACTION_ID, request)
+        if transactionId is not None:
+            found = byTransaction.get(transactionId)
+            if found is None:
+                # Its transaction started before the recording.
+                skipped += 1
+                continue
+            flow, orderType = found
+            label = "{}/{}".format(orderType, firstMatch(TRANSACTION_PHASE, request))
+        else:
+            flow = []
+            flows.append(flow)
+            orderType = firstMatch(ORDER_TYPE, request)
+            if root == "ebicsRequest":
+                label = "{}/{}".format(orderType, firstMatch(TRANSACTION_PHASE, request))
+            else:
+                label = root if orderType is None else f"{root}:{orderType}"
+        flow.append(Exchange(record, label))
+        responseTransactionId = firstMatch(TRANSACTION_ID, record["response"])
+        if responseTransactionId is not None:
+            byTransaction[responseTransactionId] = (flow, orderType)
+    if skipped:
+        print(f"Skipped {skipped} exchanges of transactions started before the recording")
+    return flows
+
+
+class Replayer:
+    def __init__(self, url, speed):
+        self.url = url
+        self.speed = speed
+        self.sessions = threading.local()
+        self.start = None
+
+    def session(self):
+        s = getattr(self.sessions, "session", None)
+        if s is None:
+            s = Session()
+            self.sessions.session = s
+        return s
+
+    def runFlow(self, flow):
+        for exchange in flow:
+            if self.speed is not None:
+                target = self.start + exchange.record["offsetMicros"] / 1e6 / self.speed
+                now = time.monotonic()
+                if now < target:
+                    time.sleep(target - now)
+                exchange.lagMicros = max(0, int((time.monotonic() - target) * 1e6))
+            began = time.monotonic()
+            try:
+                resp = self.session().post(
+                    self.url or exchange.record["url"],
+                    data=exchange.record["request"].encode("utf-8"),
+                    headers={"Content-Type": "application/xml"},
+                )
+                exchange.status = resp.status_code
+                exchange.codes = RETURN_CODE.findall(resp.text)
+            except Exception as e:
+                print(f"{exchange.label}: {e}")
+                exchange.status = None
+                exchange.codes = []
+            exchange.latencyMicros = int((time.monotonic() - began) * 1e6)
+
+    def run(self, flows, concurrency):
+        self.start = time.monotonic()
+        ordered = sorted(flows, key=lambda f: f[0].record["offsetMicros"])
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(self.runFlow, f) for f in ordered]:
+                future.result()
+        return time.monotonic() - self.start
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0
+    rank = max(1, math.ceil(p / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(values):
+    values = sorted(values)
+    return dict(
+        count=len(values),
+        meanMillis=sum(values) / len(values) / 1000 if values else 0,
+        p50Millis=percentile(values, 50) / 1000,
+        p90Millis=percentile(values, 90) / 1000,
+        p99Millis=percentile(values, 99) / 1000,
+        maxMillis=(values[-1] if values else 0) / 1000,
+    )
+
+
+def report(exchanges, elapsed, timed):
+    byLabel = {}
+    for e in exchanges:
+        byLabel.setdefault(e.label, []).append(e)
+    rows = {}
+    print()
+    print(
+        "{:<34}{:>7}{:>10}{:>10}{:>10}{:>10}{:>14}".format(
+            "exchange", "count", "p50", "p90", "p99", "max", "recorded p50"
+        )
+    )
+    for label in sorted(byLabel):
+        group = byLabel[label]
+        replayed = summarize([e.latencyMicros for e in group])
+        recorded = summarize([e.record["latencyMicros"] for e in group])
+        rows[label] = dict(replayed=replayed, recorded=recorded)
+        print(
+            "{:<34}{:>7}{:>8.1f}ms{:>8.1f}ms{:>8.1f}ms{:>8.1f}ms{:>12.1f}ms".format(
+                label,
+                replayed["count"],
+                replayed["p50Millis"],
+                replayed["p90Millis"],
+                replayed["p99Millis"],
+                replayed["maxMillis"],
+                recorded["p50Millis"],
+            )
+        )
+    total = summarize([e.latencyMicros for e in exchanges])
+    print()
+    print(
+        "{} exchanges in {:.2f}s, {:.1f}/s, overall p50 {:.1f}ms p99 {:.1f}ms".format(
+            len(exchanges), elapsed, len(exchanges) / elapsed if elapsed else 0, total["p50Millis"], total["p99Millis"]
+        )
+    )
+    lag = None
+    if timed:
+        lag = summarize([e.lagMicros for e in exchanges])
+        print("Schedule lag: p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+            lag["p50Millis"], lag["p99Millis"], lag["maxMillis"]
+        ))
+    return dict(elapsedSeconds=elapsed, total=total, lag=lag, exchanges=rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded EBICS traffic against a sandbox")
+    parser.add_argument("recording", help="file written by 'nexus serve --record-ebics-traffic'")
+    parser.add_argument("--url", help="EBICS URL to replay to, instead of the recorded one")
+    parser.add_argument("--speed", default="1", help="multiple of the recorded pace, or 'max'")
+    parser.add_argument("--concurrency", type=int, default=16, help="EBICS transactions replayed at the same time")
+    parser.add_argument(
+        "--sandbox-snapshot",
+        help="start a sandbox from this database snapshot (with --derive-ebics-transaction-ids) and replay to it",
+    )
+    parser.add_argument("--output", help="where to store the latency report, as JSON")
+    parser.add_argument("--max-p99-millis", type=float, help="fail if the overall p99 latency exceeds this")
+    args = parser.parse_args()
+
+    if args.speed == "max":
+        speed = None
+    else:
+        speed = float(args.speed)
+        if speed <= 0:
+            fail("--speed must be positive, or 'max'")
+
+    flows = buildFlows(readRecording(args.recording))
+    exchanges = [e for f in flows for e in f]
+    if not exchanges:
+        fail("Nothing to replay")
+    print(f"Replaying {len(exchanges)} exchanges in {len(flows)} flows")
+
+    if args.sandbox_snapshot:
+        startSandbox(
+            "replay-sandbox.sqlite3",
+            snapshot=Path(args.sandbox_snapshot),
+            extraArgs=["--derive-ebics-transaction-ids"],
+        )
+
+    elapsed = Replayer(args.url, speed).run(flows, args.concurrency)
+    result = report(exchanges, elapsed, speed is not None)
+
+    failures = []
+    for e in exchanges:
+        if e.status != 200:
+            failures.append(f"{e.label} (seq {e.record['seq']}): HTTP status {e.status}")
+        elif e.codes != e.recordedCodes:
+            failures.append(
+                f"{e.label} (seq {e.record['seq']}): return codes {e.codes}, recorded {e.recordedCodes}"
+            )
+    if args.max_p99_millis is not None and result["total"]["p99Millis"] > args.max_p99_millis:
+        failures.append("p99 latency {:.1f}ms above {:.1f}ms".format(result["total"]["p99Millis"], args.max_p99_millis))
+    result["failures"] = failures
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if failures:
+        print("Replay diverged from the recording:")
+        for f in failures[:20]:
+            print("  " + f)
+        if len(failures) > 20:
+            print(f"  ... and {len(failures) - 20} more")
+        exit(1)
+    print("Replay passed!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Sets up sandbox and nexus with 'libeufin-cli apply', then
+# applies the same environment again: the second run must
+# find everything in place and create nothing.
+
+import base64
+import json
+from subprocess import run, PIPE
+from requests import get
+
+from util import startNexus, startSandbox
+
+NUM_SUBSCRIBERS = 20
+ENV_FILE = "apply-env.yaml"
+USER_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(b"person:y").decode("utf-8")
+)
+
+
+def fail(msg):
+    print(msg)
+    exit(1)
+
+
+def assertResponse(response):
+    if response.status_code != 200:
+        print("Test failed on URL: {}".format(response.url))
+        print(response.text)
+        exit(1)
+    return response
+
+
+def makeEnv():
+    subscribers = []
+    accounts = []
+    connections = []
+    for i in range(NUM_SUBSCRIBERS):
+        subscriber = dict(hostID="HOST01", partnerID="PARTNER1", userID=f"USER{i}")
+        subscribers.append(subscriber)
+        accounts.append(
+            dict(
+                label=f"account{i}",
+                iban=f"GB33BUKB{i:014d}",
+                bic="BUKBGB22",
+                name=f"Owner {i}",
+                subscriber=subscriber,
+            )
+        )
+        connections.append(
+            dict(name=f"conn{i}", owner="person", accounts=[f"account{i}"], **subscriber)
+        )
+    return dict(
+        sandbox=dict(
+            url="http://localhost:5000",
+            hosts=[dict(hostID="HOST01", ebicsVersion="H004")],
+            subscribers=subscribers,
+            bankAccounts=accounts,
+        ),
+        nexus=dict(
+            url="http://localhost:5001",
+            auth=dict(username="admin", password="x"),
+            users=[dict(username="person", password="y")],
+            bankConnections=connections,
+            facades=[
+                dict(name="taler", owner="person", bankAccount="account0", bankConnection="conn0")
+            ],
+            schedules=[
+                dict(
+                    name="fetch-reports", owner="person", bankAccount="account1",
+                    cronspec="0 */5 *", params=dict(level="report")
+                )
+            ],
+        ),
+    )
+
+
+def apply():
+    result = run(
+        ["../cli/libeufin-cli", "apply", "--jobs=8", ENV_FILE],
+        stdout=PIPE, universal_newlines=True
+    )
+    print(result.stdout)
+    if result.returncode != 0:
+        fail("apply failed")
+    return result.stdout.strip().splitlines()[-1]
+
+
+startNexus("apply-nexus.sqlite3")
+startSandbox("apply-sandbox.sqlite3")
+
+# JSON is YAML too.
+with open(ENV_FILE, "w") as f:
+    json.dump(makeEnv(), f)
+
+apply()
+resp = assertResponse(
+    get("http://localhost:5001/bank-accounts", headers=dict(Authorization=USER_AUTHORIZATION_HEADER))
+)
+if len(resp.json().get("accounts")) != NUM_SUBSCRIBERS:
+    fail("not all the bank accounts were imported")
+
+summary = apply()
+if "created" in summary:
+    fail(f"second apply created resources again: {summary}")
+
+print("Test passed!")
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Checks how nexus copes with a flaky bank, putting the fault
+# injecting proxy between nexus and the sandbox.
+#
+# 0 Every HEV gets a 503: nexus must retry it, then give up.
+# 1 The CCT initialisation gets an EBICS error: the submission
+#   fails, and nothing else of the upload reaches the bank.
+# 2 The bank is slow but healthy: the same payment goes through.
+
+import base64
+from requests import post
+
+from util import (
+    startNexus,
+    startSandbox,
+    startFaultProxy,
+    fixtureSnapshots,
+    FAULT_PROXY_EBICS_URL,
+)
+
+# Nexus user details
+USERNAME = "person"
+PASSWORD = "y"
+USER_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(b"person:y").decode("utf-8")
+)
+
+HOST_ID = "HOST01"
+PARTNER_ID = "PARTNER1"
+USER_ID = "USER1"
+EBICS_VERSION = "H004"
+
+# Subscriber's bank account
+SUBSCRIBER_IBAN = "GB33BUKB20201555555555"
+SUBSCRIBER_BIC = "BUKBGB22"
+SUBSCRIBER_NAME = "Oliver Smith"
+BANK_ACCOUNT_LABEL = "savings"
+
+NEXUS_DB = "test-nexus.sqlite3"
+
+MAX_RETRIES = 2
+LATENCY_MS = 200
+
+
+def fail(msg):
+    print(msg)
+    exit(1)
+
+
+def assertResponse(response):
+    if response.status_code != 200:
+        print("Test failed on URL: {}".format(response.url))
+        print("Check nexus-stderr.log and sandbox-stderr.log")
+        exit(1)
+    return response
+
+# The bank connection goes through the proxy.
+FIXTURE = dict(
+    sandbox=dict(
+        url="http://localhost:5000",
+        hosts=[dict(hostID=HOST_ID, ebicsVersion=EBICS_VERSION)],
+        subscribers=[dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID)],
+        bankAccounts=[
+            dict(
+                subscriber=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID),
+                iban=SUBSCRIBER_IBAN,
+                bic=SUBSCRIBER_BIC,
+                name=SUBSCRIBER_NAME,
+                label=BANK_ACCOUNT_LABEL,
+            )
+        ],
+    ),
+    nexus=dict(
+        url="http://localhost:5001",
+        auth=dict(username="admin", password="x"),
+        users=[dict(username=USERNAME, password=PASSWORD)],
+        bankConnections=[
+            dict(
+                name="my-ebics",
+                owner=USERNAME,
+                ebicsURL=FAULT_PROXY_EBICS_URL,
+                hostID=HOST_ID,
+                partnerID=PARTNER_ID,
+                userID=USER_ID,
+                accounts=[BANK_ACCOUNT_LABEL],
+            )
+        ],
+    ),
+)
+
+# Started first: building the snapshots connects through it.
+proxy = startFaultProxy(seed=1)
+snapshots = fixtureSnapshots(FIXTURE)
+startNexus(NEXUS_DB, snapshot=snapshots.nexus, extraArgs=[f"--bank-max-retries={MAX_RETRIES}"])
+startSandbox(snapshot=snapshots.sandbox, extraArgs=["--allow-ebics-fault-injection"])
+
+# 0
+proxy.setRules([dict(match=dict(orderType="HEV"), httpError=dict(rate=1, status=503))])
+proxy.stats.reset()
+resp = post(
+    "http://localhost:5001/bank-connection-protocols/ebics/test-host",
+    json=dict(ebicsBaseUrl=FAULT_PROXY_EBICS_URL, ebicsHostId=HOST_ID),
+)
+if resp.status_code == 200:
+    fail("HEV succeeded despite the bank failing it")
+hev = proxy.stats.snapshot()["labels"].get("HEV")
+if hev is None or hev["requests"] != MAX_RETRIES + 1 or hev["faults"]["httpError"] != MAX_RETRIES + 1:
+    fail(f"expected {MAX_RETRIES + 1} failed HEV attempts, the proxy saw {hev}")
+
+# 1
+proxy.setRules(
+    [
+        dict(
+            match=dict(orderType="CCT", phase="Initialisation"),
+            ebicsError=dict(rate=1, code="091116"),
+        )
+    ]
+)
+proxy.stats.reset()
+resp = assertResponse(
+    post(
+        f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations",
+        json=dict(
+            iban="FR7630006000011234567890189",
+            bic="AGRIFRPP",
+            name="Jacques La Fayette",
+            subject="integration test",
+            amount="EUR:1",
+        ),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+PREPARED_PAYMENT_UUID = resp.json().get("uuid")
+if PREPARED_PAYMENT_UUID == None:
+    fail("Payment UUID not received")
+SUBMIT_URL = f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations/{PREPARED_PAYMENT_UUID}/submit"
+resp = post(SUBMIT_URL, json=dict(), headers=dict(Authorization=USER_AUTHORIZATION_HEADER))
+if resp.status_code == 200:
+    fail("Payment submitted despite the bank failing its initialisation")
+stats = proxy.stats.snapshot()
+if stats["faults"]["ebicsError"] != 1 or "CCT/Transfer" in stats["labels"]:
+    fail(f"unexpected upload traffic: {stats['labels']}")
+
+# 2
+proxy.setRules([dict(latency=dict(dist="fixed", millis=LATENCY_MS))])
+proxy.stats.reset()
+assertResponse(post(SUBMIT_URL, json=dict(), headers=dict(Authorization=USER_AUTHORIZATION_HEADER)))
+stats = proxy.report()
+cct = stats["labels"].get("CCT/Transfer")
+if cct is None or cct["total"]["p50Millis"] < LATENCY_MS:
+    fail(f"the upload did not go through the slowed down proxy: {stats['labels']}")
+
+print("Test passed!")
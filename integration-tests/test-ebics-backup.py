@@ -167,4 +167,30 @@ assertResponse(
     )
 )
 
+print("bulk export and restore")
+
+resp = assertResponse(
+    post(
+        "http://localhost:5001/bank-connections/export-backups",
+        json=dict(passphrase="secret"),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+archive = resp.json().get("bankConnections")
+if sorted(c["name"] for c in archive) != ["my-ebics", "my-ebics-restored"]:
+    fail("unexpected connections in the archive")
+
+# Existing connections are skipped, the new names are restored.
+archive.append(dict(name="my-ebics-copy", data=archive[0]["data"]))
+resp = assertResponse(
+    post(
+        "http://localhost:5001/bank-connections/restore-backups",
+        json=dict(passphrase="secret", bankConnections=archive, parallelism=2),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+statuses = {r["name"]: r["status"] for r in resp.json().get("results")}
+if statuses != {"my-ebics": "skipped", "my-ebics-restored": "skipped", "my-ebics-copy": "restored"}:
+    fail("unexpected restore results: {}".format(statuses))
+
 print("Test passed!")
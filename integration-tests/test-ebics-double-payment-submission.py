@@ -7,7 +7,7 @@ import os
 import hashlib
 import base64
 
-from util import startNexus, startSandbox
+from util import startNexus, startSandbox, fixtureSnapshots
 
 # Nexus user details
 USERNAME = "person"
@@ -53,70 +53,45 @@ def assertResponse(response):
     # Allows for finer grained checks.
     return response
 
-startNexus(NEXUS_DB)
-startSandbox()
-
-assertResponse(
-    post(
-        "http://localhost:5000/admin/ebics/host",
-        json=dict(hostID=HOST_ID, ebicsVersion=EBICS_VERSION),
-    )
-)
-assertResponse(
-    post(
-        "http://localhost:5000/admin/ebics/subscribers",
-        json=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID),
-    )
-)
-assertResponse(
-    post(
-        "http://localhost:5000/admin/ebics/bank-accounts",
-        json=dict(
-            subscriber=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID),
-            iban=SUBSCRIBER_IBAN,
-            bic=SUBSCRIBER_BIC,
-            name=SUBSCRIBER_NAME,
-            label=BANK_ACCOUNT_LABEL,
-        ),
-    )
-)
-assertResponse(
-    post(
-        "http://localhost:5001/users",
-        headers=dict(Authorization=ADMIN_AUTHORIZATION_HEADER),
-        json=dict(username=USERNAME, password=PASSWORD),
-    )
-)
-print("creating bank connection")
-assertResponse(
-    post(
-        "http://localhost:5001/bank-connections",
-        json=dict(
-            name="my-ebics",
-            source="new",
-            type="ebics",
-            data=dict(
-                ebicsURL=EBICS_URL, hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID
-            ),
-        ),
-        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
-    )
-)
-print("connecting")
-assertResponse(
-    post(
-        "http://localhost:5001/bank-connections/my-ebics/connect",
-        json=dict(),
-        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
-    )
-)
-assertResponse(
-    post(
-        "http://localhost:5001/bank-connections/my-ebics/ebics/import-accounts",
-        json=dict(),
-        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
-    )
+# Sandbox and nexus with the subscriber connected and its
+# bank account imported.
+FIXTURE = dict(
+    sandbox=dict(
+        url="http://localhost:5000",
+        hosts=[dict(hostID=HOST_ID, ebicsVersion=EBICS_VERSION)],
+        subscribers=[dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID)],
+        bankAccounts=[
+            dict(
+                subscriber=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID),
+                iban=SUBSCRIBER_IBAN,
+                bic=SUBSCRIBER_BIC,
+                name=SUBSCRIBER_NAME,
+                label=BANK_ACCOUNT_LABEL,
+            )
+        ],
+    ),
+    nexus=dict(
+        url="http://localhost:5001",
+        auth=dict(username="admin", password="x"),
+        users=[dict(username=USERNAME, password=PASSWORD)],
+        bankConnections=[
+            dict(
+                name="my-ebics",
+                owner=USERNAME,
+                ebicsURL=EBICS_URL,
+                hostID=HOST_ID,
+                partnerID=PARTNER_ID,
+                userID=USER_ID,
+                accounts=[BANK_ACCOUNT_LABEL],
+            )
+        ],
+    ),
 )
+
+snapshots = fixtureSnapshots(FIXTURE)
+startNexus(NEXUS_DB, snapshot=snapshots.nexus)
+startSandbox(snapshot=snapshots.sandbox)
+
 resp = assertResponse(
     post(
         "http://localhost:5001/bank-accounts/{}/payment-initiations".format(
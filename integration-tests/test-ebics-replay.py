@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Records the EBICS traffic of a payment submission and a
+# statement download, and replays it against a sandbox that
+# starts again from the same snapshot.
+
+from subprocess import call
+from requests import post
+from pathlib import Path
+import base64
+
+from util import startNexus, startSandbox, fixtureSnapshots, kill, waitPortFree
+
+# Nexus user details
+USERNAME = "person"
+PASSWORD = "y"
+USER_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(b"person:y").decode("utf-8")
+)
+
+# EBICS details
+EBICS_URL = "http://localhost:5000/ebicsweb"
+HOST_ID = "HOST01"
+PARTNER_ID = "PARTNER1"
+USER_ID = "USER1"
+EBICS_VERSION = "H004"
+
+# Subscriber's bank account
+SUBSCRIBER_IBAN = "GB33BUKB20201555555555"
+SUBSCRIBER_BIC = "BUKBGB22"
+SUBSCRIBER_NAME = "Oliver Smith"
+BANK_ACCOUNT_LABEL = "savings"
+
+# Databases
+NEXUS_DB = "test-nexus.sqlite3"
+
+TRAFFIC_FILE = Path.cwd() / "ebics-traffic.jsonl.gz"
+
+
+def fail(msg):
+    print(msg)
+    exit(1)
+
+
+def assertResponse(response):
+    if response.status_code != 200:
+        print("Test failed on URL: {}".format(response.url))
+        # stdout/stderr from both services is A LOT of text.
+        # Confusing to dump all that to console.
+        print("Check nexus.log and sandbox.log, probably under /tmp")
+        exit(1)
+    # Allows for finer grained checks.
+    return response
+
+# Sandbox and nexus with the subscriber connected and its
+# bank account imported.
+FIXTURE = dict(
+    sandbox=dict(
+        url="http://localhost:5000",
+        hosts=[dict(hostID=HOST_ID, ebicsVersion=EBICS_VERSION)],
+        subscribers=[dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID)],
+        bankAccounts=[
+            dict(
+                subscriber=dict(hostID=HOST_ID, partnerID=PARTNER_ID, userID=USER_ID),
+                iban=SUBSCRIBER_IBAN,
+                bic=SUBSCRIBER_BIC,
+                name=SUBSCRIBER_NAME,
+                label=BANK_ACCOUNT_LABEL,
+            )
+        ],
+    ),
+    nexus=dict(
+        url="http://localhost:5001",
+        auth=dict(username="admin", password="x"),
+        users=[dict(username=USERNAME, password=PASSWORD)],
+        bankConnections=[
+            dict(
+                name="my-ebics",
+                owner=USERNAME,
+                ebicsURL=EBICS_URL,
+                hostID=HOST_ID,
+                partnerID=PARTNER_ID,
+                userID=USER_ID,
+                accounts=[BANK_ACCOUNT_LABEL],
+            )
+        ],
+    ),
+)
+
+snapshots = fixtureSnapshots(FIXTURE)
+TRAFFIC_FILE.unlink(missing_ok=True)
+nexus = startNexus(
+    NEXUS_DB,
+    snapshot=snapshots.nexus,
+    extraArgs=[f"--record-ebics-traffic={TRAFFIC_FILE}"],
+)
+sandbox = startSandbox(
+    snapshot=snapshots.sandbox,
+    extraArgs=["--derive-ebics-transaction-ids"],
+)
+
+resp = assertResponse(
+    post(
+        f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations",
+        json=dict(
+            iban="FR7630006000011234567890189",
+            bic="AGRIFRPP",
+            name="Jacques La Fayette",
+            subject="integration test",
+            amount="EUR:1",
+        ),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+PREPARED_PAYMENT_UUID = resp.json().get("uuid")
+if PREPARED_PAYMENT_UUID == None:
+    fail("Payment UUID not received")
+
+assertResponse(
+    post(
+        f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations/{PREPARED_PAYMENT_UUID}/submit",
+        json=dict(),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+assertResponse(
+    post(
+        f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/fetch-transactions",
+        json=dict(rangeType="all", level="report"),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+
+# Stopping nexus closes the recording.
+kill("nexus", nexus)
+kill("sandbox", sandbox)
+waitPortFree(5000)
+
+if not TRAFFIC_FILE.exists():
+    fail("No EBICS traffic was recorded")
+
+# The replay starts its own sandbox from the snapshot.
+if call(
+    [
+        "./replay-ebics-traffic.py",
+        str(TRAFFIC_FILE),
+        f"--sandbox-snapshot={snapshots.sandbox}",
+        "--speed=max",
+        "--concurrency=1",
+    ]
+) != 0:
+    fail("Replay of the recorded EBICS traffic failed")
+
+print("Test passed!")
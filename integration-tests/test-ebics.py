@@ -78,7 +78,8 @@ def assertResponse(response):
     return response
 
 startSandbox()
-startNexus(NEXUS_DB)
+# Small segments, so that the payment upload takes several of them.
+startNexus(NEXUS_DB, extraArgs=["--ebics-upload-segment-size=256"])
 
 
 # 0.a
@@ -223,6 +224,16 @@ PREPARED_PAYMENT_UUID = resp.json().get("uuid")
 if PREPARED_PAYMENT_UUID == None:
     fail("Payment UUID not received")
 
+resp = assertResponse(
+    get(
+        f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations",
+        params=dict(submitted="false"),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+if [p["paymentInitiationId"] for p in resp.json().get("initiatedPayments")] != [str(PREPARED_PAYMENT_UUID)]:
+    fail("prepared payment not listed as pending")
+
 # 5.b, submit prepared statement
 assertResponse(
     post(
@@ -251,4 +262,22 @@ resp = assertResponse(
 if len(resp.json().get("transactions")) != 1:
     fail("Unexpected number of transactions; should be 1")
 
+resp = assertResponse(
+    get(
+        f"http://localhost:5001/bank-accounts/{BANK_ACCOUNT_LABEL}/payment-initiations",
+        params=dict(submitted="false"),
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER),
+    )
+)
+if len(resp.json().get("initiatedPayments")) != 0:
+    fail("submitted payment still listed as pending")
+
+# 7, all the EBICS transactions completed, so the reaper leaves nothing behind
+resp = assertResponse(post("http://localhost:5000/admin/ebics/transactions/reap"))
+sizes = resp.json().get("tableSizes")
+if sizes.get("downloadTransactions") != 0 or sizes.get("uploadTransactions") != 0:
+    fail(f"completed EBICS transactions not reaped: {sizes}")
+if sizes.get("orderSignatures") != 0:
+    fail(f"order signatures of completed uploads not reaped: {sizes}")
+
 print("Test passed!")
@@ -4,6 +4,7 @@ from requests import post, get
 from subprocess import call, Popen, PIPE
 from time import sleep
 import os
+import sys
 import socket
 import hashlib
 import base64
@@ -38,7 +39,8 @@ def assertResponse(response):
     # Allows for finer grained checks.
     return response
 
-startSandbox()
+# Extra arguments go to 'sandbox serve', e.g. --storage=memory.
+startSandbox(extraArgs=sys.argv[1:])
 
 # Create a Ebics host.
 assertResponse(
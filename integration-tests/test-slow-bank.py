@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Checks that nexus gives up on a bank that answers too slowly,
+# retries the idempotent EBICS requests, and accounts the failed
+# attempts in its per-host metrics.
+#
+# 0 Start the sandbox with an artificial delay on every EBICS
+#   request, larger than the nexus request timeout.
+# 1 Ask nexus for a HEV to the sandbox: this must fail after
+#   the configured retries.
+# 2 Check the bank HTTP metrics.
+
+import base64
+from requests import post, get
+
+from util import startNexus, startSandbox
+
+ADMIN_AUTHORIZATION_HEADER = "basic {}".format(
+    base64.b64encode(b"admin:x").decode("utf-8")
+)
+
+EBICS_URL = "http://localhost:5000/ebicsweb"
+HOST_ID = "HOST01"
+EBICS_VERSION = "H004"
+
+NEXUS_DB = "test-nexus.sqlite3"
+
+EBICS_DELAY_MS = 2000
+REQUEST_TIMEOUT_MS = 500
+MAX_RETRIES = 2
+
+
+def fail(msg):
+    print(msg)
+    exit(1)
+
+
+def assertResponse(response):
+    if response.status_code != 200:
+        print("Test failed on URL: {}".format(response.url))
+        print("Check nexus-stderr.log and sandbox-stderr.log")
+        exit(1)
+    return response
+
+
+startNexus(
+    NEXUS_DB,
+    extraArgs=[
+        f"--bank-request-timeout={REQUEST_TIMEOUT_MS}",
+        f"--bank-max-retries={MAX_RETRIES}",
+    ],
+)
+startSandbox(extraArgs=[f"--ebics-delay={EBICS_DELAY_MS}"])
+
+# 0
+assertResponse(
+    post(
+        "http://localhost:5000/admin/ebics/host",
+        json=dict(hostID=HOST_ID, ebicsVersion=EBICS_VERSION),
+    )
+)
+
+# 1
+resp = post(
+    "http://localhost:5001/bank-connection-protocols/ebics/test-host",
+    json=dict(ebicsBaseUrl=EBICS_URL, ebicsHostId=HOST_ID),
+)
+if resp.status_code == 200:
+    fail("HEV succeeded despite the bank being slower than the timeout")
+
+# 2
+resp = assertResponse(
+    get(
+        "http://localhost:5001/bank-http-metrics",
+        headers=dict(Authorization=ADMIN_AUTHORIZATION_HEADER),
+    )
+)
+hosts = {h["host"]: h for h in resp.json().get("hosts")}
+sandbox = hosts.get("localhost:5000")
+if sandbox is None:
+    fail("no metrics for the sandbox host")
+if sandbox["requests"] != MAX_RETRIES + 1:
+    fail("expected {} attempts, got {}".format(MAX_RETRIES + 1, sandbox["requests"]))
+if sandbox["errors"] != MAX_RETRIES + 1 or sandbox["retries"] != MAX_RETRIES:
+    fail("unexpected error/retry counts: {}".format(sandbox))
+
+print("Test passed!")
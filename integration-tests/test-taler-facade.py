@@ -155,20 +155,43 @@ assertResponse(
 
 # todo: call /transfer + call /history/outgoing
 
-assertResponse(
+FIRST_TRANSFER = dict(
+    request_uid="0",
+    amount="EUR:1",
+    exchange_base_url="http//url",
+    wtid="nice",
+    credit_account="payto://iban/THEBIC/THEIBAN?receiver-name=theName"
+)
+
+resp = assertResponse(
     post(
         "http://localhost:5001/facades/my-facade/taler/transfer",
-        json=dict(
-            request_uid="0",
-            amount="EUR:1",
-            exchange_base_url="http//url",
-            wtid="nice",
-            credit_account="payto://iban/THEBIC/THEIBAN?receiver-name=theName"
-        ),
+        json=FIRST_TRANSFER,
         headers=dict(Authorization=USER_AUTHORIZATION_HEADER)
     )
 
 )
+firstRowId = resp.json().get("row_id")
+
+# Replaying the request gives back the same transfer.
+resp = assertResponse(
+    post(
+        "http://localhost:5001/facades/my-facade/taler/transfer",
+        json=FIRST_TRANSFER,
+        headers=dict(Authorization=USER_AUTHORIZATION_HEADER)
+    )
+)
+if resp.json().get("row_id") != firstRowId:
+    fail("Replayed transfer got a new row id")
+
+# Reusing the request_uid for a different transfer is a conflict.
+resp = post(
+    "http://localhost:5001/facades/my-facade/taler/transfer",
+    json=dict(FIRST_TRANSFER, amount="EUR:3"),
+    headers=dict(Authorization=USER_AUTHORIZATION_HEADER)
+)
+if resp.status_code != 409:
+    fail("Conflicting transfer was not rejected: {}".format(resp.status_code))
 
 assertResponse(
     post(
@@ -5,9 +5,16 @@ import socket
 from requests import post, get
 from time import sleep
 import atexit
+import hashlib
+import json
+import os
+import shutil
+from collections import namedtuple
 from pathlib import Path
 import sys
 
+from faultproxy import FaultProxy
+
 
 def checkPort(port):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -27,13 +34,30 @@ def kill(name, s):
     print("terminated!")
 
 
-def startSandbox(dbname="sandbox-test.sqlite3"):
+def restoreSnapshot(snapshot, db_full_path):
+    """Start 'db_full_path' as a copy of 'snapshot', sharing its
+    blocks where the file system can do that.  The WAL and shared
+    memory files of the previous run would otherwise get applied
+    on top of the snapshot."""
+    check_call(["rm", "-f", "--", db_full_path, db_full_path + "-wal", db_full_path + "-shm"])
+    check_call(["cp", "--reflink=auto", "--", str(snapshot), db_full_path])
+
+
+def startSandbox(dbname="sandbox-test.sqlite3", logLevel=None, extraArgs=(), snapshot=None):
     db_full_path = str(Path.cwd() / dbname)
-    check_call(["rm", "-f", db_full_path])
+    if snapshot:
+        restoreSnapshot(snapshot, db_full_path)
+    else:
+        check_call(["rm", "-f", db_full_path])
     check_call(["../gradlew", "-p", "..", "sandbox:assemble"])
     checkPort(5000)
+    args = "serve --db-name={}".format(db_full_path)
+    if logLevel:
+        args += " --log-level={}".format(logLevel)
+    for arg in extraArgs:
+        args += " {}".format(arg)
     sandbox = Popen(
-        ["../gradlew", "-p", "..", "sandbox:run", "--console=plain", "--args=serve --db-name={}".format(db_full_path)],
+        ["../gradlew", "-p", "..", "sandbox:run", "--console=plain", "--args={}".format(args)],
         stdin=DEVNULL,
         stdout=open("sandbox-stdout.log", "w"),
         stderr=open("sandbox-stderr.log", "w"),
@@ -51,25 +75,35 @@ def startSandbox(dbname="sandbox-test.sqlite3"):
             sleep(2)
             continue
         break
+    return sandbox
 
 
-def startNexus(dbname="nexus-test.sqlite3"):
+def startNexus(dbname="nexus-test.sqlite3", logLevel=None, extraArgs=(), snapshot=None):
     db_full_path = str(Path.cwd() / dbname)
-    check_call(["rm", "-f", "--", db_full_path])
     check_call(
         ["../gradlew", "-p", "..", "nexus:assemble",]
     )
-    check_call(
-        [
-            "../gradlew",
-            "-p",
-            "..",
-            "nexus:run",
-            "--console=plain",
-            "--args=superuser admin --password x --db-name={}".format(db_full_path),
-        ]
-    )
+    if snapshot:
+        # The snapshot has the superuser already.
+        restoreSnapshot(snapshot, db_full_path)
+    else:
+        check_call(["rm", "-f", "--", db_full_path])
+        check_call(
+            [
+                "../gradlew",
+                "-p",
+                "..",
+                "nexus:run",
+                "--console=plain",
+                "--args=superuser admin --password x --db-name={}".format(db_full_path),
+            ]
+        )
     checkPort(5001)
+    args = "serve --db-name={}".format(db_full_path)
+    if logLevel:
+        args += " --log-level={}".format(logLevel)
+    for arg in extraArgs:
+        args += " {}".format(arg)
     nexus = Popen(
         [
             "../gradlew",
@@ -77,7 +111,7 @@ def startNexus(dbname="nexus-test.sqlite3"):
             "..",
             "nexus:run",
             "--console=plain",
-            "--args=serve --db-name={}".format(db_full_path),
+            "--args={}".format(args),
         ],
         stdin=DEVNULL,
         stdout=open("nexus-stdout.log", "w"),
@@ -96,3 +130,90 @@ def startNexus(dbname="nexus-test.sqlite3"):
             continue
         break
     return nexus
+
+
+def startFaultProxy(rules=(), port=5002, seed=None, bankConcurrency=None):
+    """
+    Start the fault-injecting proxy in front of the sandbox, see
+    faultproxy.py for the rules.  Nexus goes through it when its
+    bank connections use FAULT_PROXY_EBICS_URL.
+    """
+    checkPort(port)
+    proxy = FaultProxy(port, "http://localhost:5000", rules, seed, bankConcurrency)
+    proxy.start()
+    atexit.register(proxy.stop)
+    return proxy
+
+
+FAULT_PROXY_EBICS_URL = "http://localhost:5002/ebicsweb"
+
+
+# Database snapshots of a sandbox and nexus pair, as 'fixtureSnapshots' builds them.
+Snapshots = namedtuple("Snapshots", ["sandbox", "nexus"])
+
+SNAPSHOTS_DIR = Path(__file__).parent / ".snapshots"
+
+# The files defining the database schemas: snapshots taken
+# with another schema are not used.
+SCHEMA_FILES = [
+    Path(__file__).parent / "../sandbox/src/main/kotlin/tech/libeufin/sandbox/DB.kt",
+    Path(__file__).parent / "../nexus/src/main/kotlin/tech/libeufin/nexus/DB.kt",
+]
+
+
+def waitPortFree(port):
+    for i in range(30):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("0.0.0.0", port))
+            return
+        except OSError:
+            sleep(1)
+        finally:
+            s.close()
+    print(f"Port {port} still busy")
+    exit(77)
+
+
+def fixtureKey(env):
+    h = hashlib.sha256()
+    for f in SCHEMA_FILES:
+        h.update(f.read_bytes())
+    h.update(json.dumps(env, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def fixtureSnapshots(env):
+    """
+    Snapshots of a sandbox and a nexus set up as 'env' describes
+    (in the format of 'libeufin-cli apply').  They are built the
+    first time, with the nexus superuser admin:x, and reused until
+    'env' or the database schemas change.
+    """
+    target = SNAPSHOTS_DIR / fixtureKey(env)
+    snapshots = Snapshots(target / "sandbox.sqlite3", target / "nexus.sqlite3")
+    if target.exists():
+        return snapshots
+
+    print("Building the database snapshots in {}".format(target))
+    building = SNAPSHOTS_DIR / "building-{}".format(os.getpid())
+    building.mkdir(parents=True)
+    envFile = building / "env.json"
+    # JSON is YAML too.
+    envFile.write_text(json.dumps(env))
+    nexus = startNexus(str(building / "nexus.sqlite3"))
+    sandbox = startSandbox(str(building / "sandbox.sqlite3"))
+    check_call([str(Path(__file__).parent / "../cli/libeufin-cli"), "apply", str(envFile)])
+    # Stopped, so that everything is written to the files.
+    kill("nexus", nexus)
+    kill("sandbox", sandbox)
+    waitPortFree(5000)
+    waitPortFree(5001)
+    envFile.unlink()
+    try:
+        building.rename(target)
+    except OSError:
+        # Built by another test meanwhile.
+        shutil.rmtree(building)
+    return snapshots
@@ -0,0 +1,158 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.nexus
+
+import tech.libeufin.nexus.iso20022.NexusPaymentInitiationData
+
+/**
+ * Generate a camt.053 statement with [numEntries] booked entries,
+ * alternating between incoming SCT credits and batched debits
+ * (the two shapes seen most often from real banks).  Statements
+ * with different [docIndex] have distinct message IDs and entries.
+ */
+fun generateCamt053(numEntries: Int, docIndex: Int = 1): String {
+    val firstEntry = (docIndex - 1) * numEntries
+    val s = StringBuilder()
+    s.append("""
+        <?xml version="1.0" encoding="UTF-8"?>
+        <Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">
+          <BkToCstmrStmt>
+            <GrpHdr>
+              <MsgId>bench-msg-${"%03d".format(docIndex)}</MsgId>
+              <CreDtTm>2020-07-03T12:44:40+05:30</CreDtTm>
+            </GrpHdr>
+            <Stmt>
+              <Id>bench-stmt-001</Id>
+              <CreDtTm>2020-07-03T11:00:40+05:30</CreDtTm>
+              <Acct><Id><IBAN>DE54123456784713474163</IBAN></Id></Acct>
+              <Bal>
+                <Tp><CdOrPrtry><Cd>PRCD</Cd></CdOrPrtry></Tp>
+                <Amt Ccy="EUR">500</Amt>
+                <CdtDbtInd>CRDT</CdtDbtInd>
+                <Dt><Dt>2020-07-03</Dt></Dt>
+              </Bal>
+    """.trimIndent())
+    for (i in firstEntry until firstEntry + numEntries) {
+        if (i % 2 == 0) s.append(creditEntry(i)) else s.append(batchedDebitEntry(i))
+    }
+    s.append("""
+            </Stmt>
+          </BkToCstmrStmt>
+        </Document>
+    """.trimIndent())
+    return s.toString()
+}
+
+private fun creditEntry(i: Int): String = """
+    <Ntry>
+      <Amt Ccy="EUR">${i % 1000}.50</Amt>
+      <CdtDbtInd>CRDT</CdtDbtInd>
+      <Sts>BOOK</Sts>
+      <BookgDt><Dt>2020-07-02</Dt></BookgDt>
+      <ValDt><Dt>2020-07-04</Dt></ValDt>
+      <AcctSvcrRef>acctsvcrref-$i</AcctSvcrRef>
+      <BkTxCd>
+        <Domn><Cd>PMNT</Cd><Fmly><Cd>RCDT</Cd><SubFmlyCd>ESCT</SubFmlyCd></Fmly></Domn>
+        <Prtry><Cd>166</Cd><Issr>DK</Issr></Prtry>
+      </BkTxCd>
+      <NtryDtls>
+        <TxDtls>
+          <Refs><EndToEndId>e2e-$i</EndToEndId></Refs>
+          <BkTxCd>
+            <Domn><Cd>PMNT</Cd><Fmly><Cd>RCDT</Cd><SubFmlyCd>ESCT</SubFmlyCd></Fmly></Domn>
+            <Prtry><Cd>NTRF+166</Cd><Issr>DK</Issr></Prtry>
+          </BkTxCd>
+          <RltdPties>
+            <Dbtr><Nm>Debtor $i</Nm></Dbtr>
+            <DbtrAcct><Id><IBAN>DE52123456789473323175</IBAN></Id></DbtrAcct>
+            <Cdtr><Nm>Account Owner</Nm></Cdtr>
+          </RltdPties>
+          <RmtInf><Ustrd>Reserve public key KX2TXS6C0H5BX7PCNXR0C4G8E9Q5X5MH5W1WXD5EW7N8ZE7A8ZP0 number $i</Ustrd></RmtInf>
+        </TxDtls>
+      </NtryDtls>
+      <AddtlNtryInf>SEPA GUTSCHRIFT</AddtlNtryInf>
+    </Ntry>
+"""
+
+private fun batchedDebitEntry(i: Int): String = """
+    <Ntry>
+      <Amt Ccy="EUR">46.30</Amt>
+      <CdtDbtInd>DBIT</CdtDbtInd>
+      <Sts>BOOK</Sts>
+      <BookgDt><Dt>2020-07-07</Dt></BookgDt>
+      <ValDt><Dt>2020-07-07</Dt></ValDt>
+      <AcctSvcrRef>acctsvcrref-$i</AcctSvcrRef>
+      <BkTxCd>
+        <Domn><Cd>PMNT</Cd><Fmly><Cd>ICDT</Cd><SubFmlyCd>ESCT</SubFmlyCd></Fmly></Domn>
+      </BkTxCd>
+      <NtryDtls>
+        <Btch>
+          <MsgId>leuf-mp1-$i</MsgId>
+          <PmtInfId>leuf-p-$i</PmtInfId>
+          <NbOfTxs>2</NbOfTxs>
+          <TtlAmt Ccy="EUR">46.30</TtlAmt>
+          <CdtDbtInd>DBIT</CdtDbtInd>
+        </Btch>
+        <TxDtls>
+          <AmtDtls><TxAmt><Amt Ccy="EUR">23.10</Amt></TxAmt></AmtDtls>
+          <BkTxCd><Domn><Cd>PMNT</Cd><Fmly><Cd>ICDT</Cd><SubFmlyCd>ESCT</SubFmlyCd></Fmly></Domn></BkTxCd>
+          <RltdPties>
+            <Cdtr><Nm>Creditor $i</Nm></Cdtr>
+            <CdtrAcct><Id><IBAN>DE32733516350012345678</IBAN></Id></CdtrAcct>
+          </RltdPties>
+          <RltdAgts><CdtrAgt><FinInstnId><BIC>BYLADEM1ALR</BIC></FinInstnId></CdtrAgt></RltdAgts>
+        </TxDtls>
+        <TxDtls>
+          <AmtDtls><TxAmt><Amt Ccy="EUR">23.20</Amt></TxAmt></AmtDtls>
+          <BkTxCd><Domn><Cd>PMNT</Cd><Fmly><Cd>ICDT</Cd><SubFmlyCd>ESCT</SubFmlyCd></Fmly></Domn></BkTxCd>
+          <RltdPties>
+            <Cdtr><Nm>Other creditor $i</Nm></Cdtr>
+            <CdtrAcct><Id><IBAN>AT071100000012345678</IBAN></Id></CdtrAcct>
+          </RltdPties>
+          <RltdAgts><CdtrAgt><FinInstnId><BIC>BKAUATWW</BIC></FinInstnId></CdtrAgt></RltdAgts>
+        </TxDtls>
+      </NtryDtls>
+      <AddtlNtryInf>Order</AddtlNtryInf>
+    </Ntry>
+"""
+
+/**
+ * Payment initiations as they would be prepared by a busy
+ * exchange before a "submit" task runs.
+ */
+fun generatePaymentInitiations(num: Int): List<NexusPaymentInitiationData> {
+    return (0 until num).map {
+        NexusPaymentInitiationData(
+            debtorIban = "DE54123456784713474163",
+            debtorBic = "BUKBGB33",
+            debtorName = "Account Owner",
+            messageId = "leuf-mp1-$it",
+            paymentInformationId = "leuf-p-$it",
+            endToEndId = "leuf-e-$it",
+            amount = "${it % 1000}.25",
+            currency = "EUR",
+            subject = "Wire transfer $it to the exchange",
+            preparationTimestamp = 1593775480000L + it,
+            creditorName = "Creditor $it",
+            creditorIban = "DE32733516350012345678",
+            instructionId = "leuf-i-$it"
+        )
+    }
+}
@@ -0,0 +1,100 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.nexus
+
+import kotlinx.coroutines.runBlocking
+import org.jetbrains.exposed.sql.deleteAll
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.openjdk.jmh.annotations.*
+import tech.libeufin.nexus.bankaccount.storeAndIngestCamtZip
+import tech.libeufin.util.zip
+import java.io.File
+import java.util.concurrent.TimeUnit
+
+/**
+ * Storage and ingestion of a C53 download carrying hundreds of
+ * statements, as done after the EBICS transfer.  Runs against a
+ * scratch SQLite database, which is emptied before every call.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.AverageTime)
+@OutputTimeUnit(TimeUnit.MILLISECONDS)
+@Warmup(iterations = 2, time = 10)
+@Measurement(iterations = 5, time = 10)
+@Fork(value = 1, jvmArgs = ["-Xmx2g"])
+open class CamtZipBenchmark {
+    @Param("100", "500")
+    @JvmField
+    var numDocuments: Int = 0
+
+    @Param("20")
+    @JvmField
+    var entriesPerDocument: Int = 0
+
+    private lateinit var zip: ByteArray
+    private lateinit var dbFile: File
+
+    @Setup(Level.Trial)
+    fun setup() {
+        zip = (1..numDocuments).map {
+            generateCamt053(entriesPerDocument, it).toByteArray(Charsets.UTF_8)
+        }.zip()
+        dbFile = File.createTempFile("libeufin-bench-", ".sqlite3")
+        dbCreateTables(dbFile.path)
+        transaction {
+            val user = NexusUserEntity.new("bench") {
+                passwordHash = ""
+                superuser = false
+            }
+            val conn = NexusBankConnectionEntity.new("bench-connection") {
+                owner = user
+                type = "ebics"
+            }
+            NexusBankAccountEntity.new("bench-account") {
+                iban = "DE54123456784713474163"
+                bankCode = "BENCHDEXX"
+                accountHolder = "Bench Owner"
+                defaultBankConnection = conn
+                highestSeenBankMessageId = 0
+            }
+        }
+    }
+
+    @Setup(Level.Invocation)
+    fun emptyAccount() {
+        transaction {
+            NexusBankTransactionsTable.deleteAll()
+            NexusBankMessagesTable.deleteAll()
+            NexusBankAccountEntity["bench-account"].highestSeenBankMessageId = 0
+        }
+    }
+
+    @TearDown(Level.Trial)
+    fun teardown() {
+        dbFile.delete()
+    }
+
+    @Benchmark
+    fun storeAndIngest() {
+        runBlocking {
+            storeAndIngestCamtZip("bench-connection", "bench-account", "C53", zip)
+        }
+    }
+}
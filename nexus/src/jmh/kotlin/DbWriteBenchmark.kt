@@ -0,0 +1,128 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.nexus
+
+import kotlinx.coroutines.runBlocking
+import org.jetbrains.exposed.exceptions.ExposedSQLException
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.openjdk.jmh.annotations.*
+import tech.libeufin.nexus.bankaccount.addPaymentInitiation
+import tech.libeufin.nexus.server.Pain001Data
+import java.io.File
+import java.math.BigDecimal
+import java.util.concurrent.TimeUnit
+
+/**
+ * Writes that failed, reported by JMH next to the throughput.
+ */
+@State(Scope.Thread)
+@AuxCounters(AuxCounters.Type.EVENTS)
+open class WriteFailures {
+    @JvmField
+    var failedWrites: Long = 0
+
+    @Setup(Level.Iteration)
+    fun reset() {
+        failedWrites = 0
+    }
+}
+
+/**
+ * Small write transactions from many concurrent callers, as made by
+ * the Taler /transfer requests: each one prepares a payment.  Compares
+ * the default SQLite journal with WAL, without and with group commits.
+ * The throughput is in commits per second; the sample time is the
+ * latency of one commit, from the caller's point of view.  Writes
+ * failing (with SQLITE_BUSY, after the retries) are counted apart,
+ * see WriteFailures.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.Throughput, Mode.SampleTime)
+@OutputTimeUnit(TimeUnit.MILLISECONDS)
+@Warmup(iterations = 2, time = 10)
+@Measurement(iterations = 5, time = 10)
+@Fork(value = 1, jvmArgs = ["-Xmx1g"])
+@Threads(16)
+open class DbWriteBenchmark {
+    @Param("default", "wal", "wal-group-commit")
+    @JvmField
+    var sqliteMode: String = ""
+
+    private lateinit var dbFile: File
+
+    @Setup(Level.Trial)
+    fun setup() {
+        dbFile = File.createTempFile("libeufin-bench-", ".sqlite3")
+        val wal = sqliteMode != "default"
+        NexusDb.groupCommit = sqliteMode == "wal-group-commit"
+        dbCreateTables(dbFile.path, SqliteConfig(wal = wal))
+        transaction {
+            val user = NexusUserEntity.new("bench") {
+                passwordHash = ""
+                superuser = false
+            }
+            val conn = NexusBankConnectionEntity.new("bench-connection") {
+                owner = user
+                type = "ebics"
+            }
+            NexusBankAccountEntity.new("bench-account") {
+                iban = "DE54123456784713474163"
+                bankCode = "BENCHDEXX"
+                accountHolder = "Bench Owner"
+                defaultBankConnection = conn
+                highestSeenBankMessageId = 0
+            }
+        }
+    }
+
+    @TearDown(Level.Trial)
+    fun teardown() {
+        logger.info("$sqliteMode: ${DbMetrics.snapshot()}")
+        dbFile.delete()
+        File(dbFile.path + "-wal").delete()
+        File(dbFile.path + "-shm").delete()
+    }
+
+    @Benchmark
+    fun preparePayment(failures: WriteFailures): Long {
+        return try {
+            runBlocking { preparePaymentInDb() }
+        } catch (e: ExposedSQLException) {
+            failures.failedWrites++
+            -1
+        }
+    }
+
+    private suspend fun preparePaymentInDb(): Long {
+        return dbWriteTransaction {
+            addPaymentInitiation(
+                Pain001Data(
+                    creditorIban = "DE21500105174751659277",
+                    creditorBic = "INGDDEFFXXX",
+                    creditorName = "Bench Creditor",
+                    sum = BigDecimal("1.50"),
+                    currency = "EUR",
+                    subject = "bench payment"
+                ),
+                NexusBankAccountEntity["bench-account"]
+            ).id.value
+        }
+    }
+}
@@ -0,0 +1,130 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.nexus
+
+import org.openjdk.jmh.annotations.*
+import org.openjdk.jmh.infra.Blackhole
+import org.w3c.dom.Document
+import tech.libeufin.nexus.iso20022.CamtParseResult
+import tech.libeufin.nexus.iso20022.CamtStreamReader
+import tech.libeufin.nexus.iso20022.NexusPaymentInitiationData
+import tech.libeufin.nexus.iso20022.createPain001document
+import tech.libeufin.nexus.iso20022.parseCamtMessage
+import tech.libeufin.util.XMLUtil
+import java.io.ByteArrayInputStream
+import java.util.concurrent.TimeUnit
+
+/**
+ * Benchmarks for parsing camt.053 statements.  1000 entries
+ * amount to roughly 1.5 MB of XML, 5000 entries to 7.5 MB.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.AverageTime)
+@OutputTimeUnit(TimeUnit.MILLISECONDS)
+@Warmup(iterations = 3, time = 5)
+@Measurement(iterations = 5, time = 5)
+@Fork(value = 1, jvmArgs = ["-Xmx2g"])
+open class CamtBenchmark {
+    @Param("100", "1000", "5000")
+    @JvmField
+    var numEntries: Int = 0
+
+    private lateinit var camtString: String
+    private lateinit var camtDoc: Document
+    private lateinit var camtBytes: ByteArray
+
+    @Setup
+    fun setup() {
+        camtString = generateCamt053(numEntries)
+        camtDoc = XMLUtil.parseStringIntoDom(camtString)
+        camtBytes = camtString.toByteArray()
+    }
+
+    @Benchmark
+    fun parseStringIntoDom(): Document {
+        return XMLUtil.parseStringIntoDom(camtString)
+    }
+
+    @Benchmark
+    fun parseCamt(): CamtParseResult {
+        return parseCamtMessage(camtDoc)
+    }
+
+    @Benchmark
+    fun parseCamtFromString(): CamtParseResult {
+        return parseCamtMessage(XMLUtil.parseStringIntoDom(camtString))
+    }
+
+    /**
+     * What nexus does for every stored camt message: the
+     * entries are streamed and never held all together.
+     */
+    @Benchmark
+    fun streamCamtEntries(bh: Blackhole) {
+        CamtStreamReader(ByteArrayInputStream(camtBytes)).use { reader ->
+            reader.entries().forEach { bh.consume(it) }
+        }
+    }
+
+    @Benchmark
+    fun validateCamt(): Boolean {
+        return XMLUtil.validateFromString(camtString)
+    }
+}
+
+/**
+ * Benchmarks for preparing pain.001 documents.  Nexus creates one
+ * document per payment initiation, so a batch of 1000 payments
+ * is measured as one operation.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.AverageTime)
+@OutputTimeUnit(TimeUnit.MILLISECONDS)
+@Warmup(iterations = 3, time = 5)
+@Measurement(iterations = 5, time = 5)
+@Fork(1)
+open class PainBenchmark {
+    @Param("1000")
+    @JvmField
+    var numPayments: Int = 0
+
+    private lateinit var payments: List<NexusPaymentInitiationData>
+    private lateinit var painStrings: List<String>
+
+    @Setup
+    fun setup() {
+        payments = generatePaymentInitiations(numPayments)
+        painStrings = payments.map { createPain001document(it) }
+    }
+
+    @Benchmark
+    fun createPain001(bh: Blackhole) {
+        for (p in payments) {
+            bh.consume(createPain001document(p))
+        }
+    }
+
+    @Benchmark
+    fun validatePain001(bh: Blackhole) {
+        for (s in painStrings) {
+            bh.consume(XMLUtil.validateFromString(s))
+        }
+    }
+}
@@ -0,0 +1,183 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * HTTP client used to talk to the banks: connection pool,
+ * timeouts, retry policy and per-host metrics.
+ */
+package tech.libeufin.nexus
+
+import io.ktor.client.HttpClient
+import io.ktor.client.engine.apache.Apache
+import io.ktor.util.AttributeKey
+import tech.libeufin.nexus.server.BankHostMetricsJson
+import tech.libeufin.nexus.server.BankHttpMetricsJson
+import tech.libeufin.util.EBICS_MAX_SEGMENT_SIZE
+import java.net.URI
+import java.util.concurrent.ConcurrentHashMap
+import java.util.concurrent.atomic.AtomicLong
+import kotlin.random.Random
+
+/**
+ * All the durations are in milliseconds.
+ *
+ * @param connectTimeout time allowed to open the TCP (and TLS) connection.
+ * @param readTimeout longest silence tolerated on an open connection.
+ * @param requestTimeout upper bound for one whole request/response exchange,
+ *        including the wait for a free pooled connection.
+ * @param maxConnections connections kept open to all the banks together.
+ * @param maxConnectionsPerHost connections kept open to one single bank.
+ * @param maxRetries how many times an idempotent request is repeated
+ *        after a network error, a timeout or a 5xx response.
+ * @param retryBaseDelay backoff before the first retry, doubled at each
+ *        further attempt.
+ * @param retryMaxDelay cap for the backoff.
+ * @param ebicsUploadSegmentSize Base64 characters of encrypted order
+ *        data sent in one EBICS upload request; larger orders are
+ *        segmented.
+ * @param trafficLog if given, every exchange with the banks is
+ *        recorded to this file, see EbicsTrafficRecorder.
+ */
+data class BankHttpConfig(
+    val connectTimeout: Int = 10000,
+    val readTimeout: Int = 30000,
+    val requestTimeout: Long = 120000,
+    val maxConnections: Int = 50,
+    val maxConnectionsPerHost: Int = 4,
+    val maxRetries: Int = 3,
+    val retryBaseDelay: Long = 500,
+    val retryMaxDelay: Long = 10000,
+    val ebicsUploadSegmentSize: Int = EBICS_MAX_SEGMENT_SIZE,
+    val trafficLog: String? = null
+)
+
+private val bankHttpConfigKey = AttributeKey<BankHttpConfig>("BankHttpConfig")
+private val trafficRecorderKey = AttributeKey<EbicsTrafficRecorder>("EbicsTrafficRecorder")
+
+/**
+ * Make the client that posts to the banks.  Connections are kept alive
+ * and reused, up to the limits given in the configuration.
+ */
+fun makeBankHttpClient(config: BankHttpConfig = BankHttpConfig()): HttpClient {
+    val client = HttpClient(Apache) {
+        expectSuccess = false // this way, it does not throw exceptions on != 200 responses.
+        engine {
+            connectTimeout = config.connectTimeout
+            socketTimeout = config.readTimeout
+            // Waiting for a pooled connection counts against the request timeout.
+            connectionRequestTimeout = config.requestTimeout.toInt()
+            customizeClient {
+                setMaxConnTotal(config.maxConnections)
+                setMaxConnPerRoute(config.maxConnectionsPerHost)
+            }
+        }
+    }
+    client.attributes.put(bankHttpConfigKey, config)
+    if (config.trafficLog != null) {
+        val recorder = EbicsTrafficRecorder(config.trafficLog)
+        // Writes the end of the gzip stream.
+        Runtime.getRuntime().addShutdownHook(Thread { recorder.close() })
+        client.attributes.put(trafficRecorderKey, recorder)
+    }
+    return client
+}
+
+/**
+ * Configuration the client was made with; clients not made
+ * by makeBankHttpClient() get the defaults.
+ */
+val HttpClient.bankHttpConfig: BankHttpConfig
+    get() = this.attributes.getOrNull(bankHttpConfigKey) ?: BankHttpConfig()
+
+val HttpClient.ebicsTrafficRecorder: EbicsTrafficRecorder?
+    get() = this.attributes.getOrNull(trafficRecorderKey)
+
+/**
+ * Backoff before the retry number 'attempt' (starting at 1).  The
+ * exponential delay is capped, and then jittered into [delay/2, delay]
+ * so that clients failing together do not retry together.
+ */
+fun bankRetryBackoff(attempt: Int, config: BankHttpConfig, random: Random = Random.Default): Long {
+    val exp = config.retryBaseDelay shl (attempt - 1).coerceIn(0, 30)
+    val capped = if (exp <= 0 || exp > config.retryMaxDelay) config.retryMaxDelay else exp
+    val half = capped / 2
+    return half + random.nextLong(capped - half + 1)
+}
+
+/**
+ * Identifies a bank in the metrics: host and port of its EBICS URL.
+ */
+fun bankHostOf(url: String): String {
+    return try {
+        URI(url).authority ?: url
+    } catch (e: Exception) {
+        url
+    }
+}
+
+private class BankHostCounters {
+    val requests = AtomicLong()
+    val errors = AtomicLong()
+    val retries = AtomicLong()
+    val latencySumMicros = AtomicLong()
+    val latencyMaxMicros = AtomicLong()
+}
+
+/**
+ * Latency and error counters for every bank host, since startup.
+ */
+object BankHttpMetrics {
+    private val hosts = ConcurrentHashMap<String, BankHostCounters>()
+
+    private fun countersOf(host: String): BankHostCounters {
+        return hosts.computeIfAbsent(host) { BankHostCounters() }
+    }
+
+    /**
+     * Account for one attempt; failed attempts are network
+     * errors, timeouts and 5xx responses.
+     */
+    fun recordAttempt(host: String, micros: Long, failed: Boolean) {
+        val counters = countersOf(host)
+        counters.requests.incrementAndGet()
+        if (failed) counters.errors.incrementAndGet()
+        counters.latencySumMicros.addAndGet(micros)
+        counters.latencyMaxMicros.accumulateAndGet(micros) { a, b -> maxOf(a, b) }
+    }
+
+    fun recordRetry(host: String) {
+        countersOf(host).retries.incrementAndGet()
+    }
+
+    fun snapshot(): BankHttpMetricsJson {
+        return BankHttpMetricsJson(
+            hosts.entries.sortedBy { it.key }.map { (host, counters) ->
+                val requests = counters.requests.get()
+                BankHostMetricsJson(
+                    host = host,
+                    requests = requests,
+                    errors = counters.errors.get(),
+                    retries = counters.retries.get(),
+                    meanLatencyMillis = if (requests == 0L) 0.0 else counters.latencySumMicros.get() / 1000.0 / requests,
+                    maxLatencyMillis = counters.latencyMaxMicros.get() / 1000.0
+                )
+            }
+        )
+    }
+}
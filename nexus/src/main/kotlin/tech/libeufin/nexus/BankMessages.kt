@@ -0,0 +1,169 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Storage of the raw messages downloaded from the banks: they are
+ * kept compressed, next to their size and hash, so that listing
+ * them never needs to read the messages themselves.
+ */
+package tech.libeufin.nexus
+
+import io.ktor.http.HttpStatusCode
+import org.jetbrains.exposed.dao.id.EntityID
+import org.jetbrains.exposed.sql.*
+import org.jetbrains.exposed.sql.statements.api.ExposedBlob
+import org.jetbrains.exposed.sql.transactions.transaction
+import tech.libeufin.nexus.server.BankMessageInfo
+import tech.libeufin.util.toHexString
+import java.io.ByteArrayOutputStream
+import java.io.InputStream
+import java.security.MessageDigest
+import java.time.Instant
+import java.util.zip.DeflaterOutputStream
+import java.util.zip.InflaterInputStream
+
+const val BANK_MESSAGE_UNCOMPRESSED = "none"
+const val BANK_MESSAGE_DEFLATE = "deflate"
+
+/**
+ * Rows compressed per transaction when migrating old databases;
+ * every row of the batch is held in memory.
+ */
+private const val BANK_MESSAGE_MIGRATION_BATCH_SIZE = 100
+
+/**
+ * A bank message ready to be stored.  Compressing and hashing do
+ * not need the database, so they can run before the transaction.
+ */
+class CompressedBankMessage(
+    val content: ByteArray,
+    val size: Long,
+    val hash: String
+)
+
+fun compressBankMessage(message: ByteArray): CompressedBankMessage {
+    val out = ByteArrayOutputStream(message.size / 4 + 64)
+    DeflaterOutputStream(out).use { it.write(message) }
+    return CompressedBankMessage(
+        out.toByteArray(),
+        message.size.toLong(),
+        MessageDigest.getInstance("SHA-256").digest(message).toHexString()
+    )
+}
+
+/**
+ * Needs to be called within a transaction block.
+ */
+fun storeBankMessage(
+    conn: NexusBankConnectionEntity,
+    code: String,
+    messageId: String,
+    compressed: CompressedBankMessage
+): NexusBankMessageEntity {
+    return NexusBankMessageEntity.new {
+        this.bankConnection = conn
+        this.code = code
+        this.messageId = messageId
+        this.message = ExposedBlob(compressed.content)
+        this.compression = BANK_MESSAGE_DEFLATE
+        this.messageSize = compressed.size
+        this.storedSize = compressed.content.size.toLong()
+        this.messageHash = compressed.hash
+        this.creationTime = Instant.now().toEpochMilli()
+    }
+}
+
+/**
+ * The message content, decompressed while it is read.  Only the
+ * compressed form is held in memory.
+ */
+fun NexusBankMessageEntity.openContent(): InputStream {
+    return openBankMessage(this.message.bytes, this.compression)
+}
+
+fun openBankMessage(stored: ByteArray, compression: String): InputStream {
+    return when (compression) {
+        BANK_MESSAGE_DEFLATE -> InflaterInputStream(stored.inputStream())
+        BANK_MESSAGE_UNCOMPRESSED -> stored.inputStream()
+        else -> throw NexusError(
+            HttpStatusCode.InternalServerError,
+            "unknown bank message compression '$compression'"
+        )
+    }
+}
+
+/**
+ * Metadata of the messages of one bank connection, by increasing id,
+ * starting after the id 'start'.  The messages themselves are not read.
+ * Needs to be called within a transaction block.
+ */
+fun findBankMessageInfos(connId: EntityID<String>, start: Long?, limit: Int): List<BankMessageInfo> {
+    val t = NexusBankMessagesTable
+    return t.slice(t.id, t.messageId, t.code, t.messageSize, t.storedSize, t.messageHash, t.creationTime).select {
+        var cond: Op<Boolean> = t.bankConnection eq connId
+        if (start != null) {
+            cond = cond and (t.id greater start.toInt())
+        }
+        cond
+    }.orderBy(t.id to SortOrder.ASC).limit(limit).map {
+        BankMessageInfo(
+            id = it[t.id].value.toLong(),
+            messageId = it[t.messageId],
+            code = it[t.code],
+            length = it[t.messageSize],
+            storedLength = it[t.storedSize],
+            hash = it[t.messageHash],
+            creationTime = it[t.creationTime]
+        )
+    }
+}
+
+/**
+ * Compress the messages stored uncompressed by older versions, and
+ * fill in their size and hash.  Runs in batches, so an interrupted
+ * migration just resumes at the next start.
+ */
+fun migrateBankMessages() {
+    val t = NexusBankMessagesTable
+    var migrated = 0
+    while (true) {
+        val n = transaction {
+            val rows = t.slice(t.id, t.message).select {
+                t.compression eq BANK_MESSAGE_UNCOMPRESSED
+            }.orderBy(t.id to SortOrder.ASC).limit(BANK_MESSAGE_MIGRATION_BATCH_SIZE).toList()
+            for (row in rows) {
+                val compressed = compressBankMessage(row[t.message].bytes)
+                t.update({ t.id eq row[t.id] }) {
+                    it[message] = ExposedBlob(compressed.content)
+                    it[compression] = BANK_MESSAGE_DEFLATE
+                    it[messageSize] = compressed.size
+                    it[storedSize] = compressed.content.size.toLong()
+                    it[messageHash] = compressed.hash
+                }
+            }
+            rows.size
+        }
+        migrated += n
+        if (n < BANK_MESSAGE_MIGRATION_BATCH_SIZE) break
+    }
+    if (migrated > 0) {
+        // SQLite keeps the freed pages until VACUUM.
+        logger.info("Compressed $migrated bank messages; VACUUM the database to reclaim the space")
+    }
+}
@@ -40,7 +40,14 @@ import java.sql.Connection
  */
 object TalerRequestedPayments : LongIdTable() {
     val preparedPayment = reference("payment", PaymentInitiationsTable)
-    val requestUId = text("request_uid")
+    val requestUId = text("request_uid").uniqueIndex()
+
+    /**
+     * Hash of the whole transfer request, see talerTransferRequestHash().
+     * Empty for the rows stored before the column existed, until
+     * migrateTalerRequestedPayments() fills it in.
+     */
+    val requestHash = text("request_hash").default("")
     val amount = text("amount")
     val exchangeBaseUrl = text("exchange_base_url")
     val wtid = text("wtid")
@@ -52,6 +59,7 @@ class TalerRequestedPaymentEntity(id: EntityID<Long>) : LongEntity(id) {
 
     var preparedPayment by PaymentInitiationEntity referencedOn TalerRequestedPayments.preparedPayment
     var requestUId by TalerRequestedPayments.requestUId
+    var requestHash by TalerRequestedPayments.requestHash
     var amount by TalerRequestedPayments.amount
     var exchangeBaseUrl by TalerRequestedPayments.exchangeBaseUrl
     var wtid by TalerRequestedPayments.wtid
@@ -85,9 +93,19 @@ object NexusBankMessagesTable : IntIdTable() {
     val bankConnection = reference("bankConnection", NexusBankConnectionsTable)
 
     // Unique identifier for the message within the bank connection
-    val messageId = text("messageId")
+    val messageId = text("messageId").index()
     val code = text("code")
+    // The message, compressed as 'compression' says.
     val message = blob("message")
+    // "deflate", or "none" for rows not migrated yet.
+    val compression = text("compression").default(BANK_MESSAGE_UNCOMPRESSED)
+    // Size of the message, and of what the 'message' column holds.
+    val messageSize = long("messageSize").default(0)
+    val storedSize = long("storedSize").default(0)
+    // Hex-encoded SHA-256 of the (uncompressed) message.
+    val messageHash = text("messageHash").nullable()
+    // Null for the messages stored before the column existed.
+    val creationTime = long("creationTime").nullable()
 }
 
 class NexusBankMessageEntity(id: EntityID<Int>) : IntEntity(id) {
@@ -97,6 +115,11 @@ class NexusBankMessageEntity(id: EntityID<Int>) : IntEntity(id) {
     var messageId by NexusBankMessagesTable.messageId
     var code by NexusBankMessagesTable.code
     var message by NexusBankMessagesTable.message
+    var compression by NexusBankMessagesTable.compression
+    var messageSize by NexusBankMessagesTable.messageSize
+    var storedSize by NexusBankMessagesTable.storedSize
+    var messageHash by NexusBankMessagesTable.messageHash
+    var creationTime by NexusBankMessagesTable.creationTime
 }
 
 /**
@@ -180,11 +203,23 @@ object PaymentInitiationsTable : LongIdTable() {
     val creditorName = text("creditorName")
     val submitted = bool("submitted").default(false)
 
+    /**
+     * Node submitting the payment right now, and until when its
+     * claim holds (see claimPaymentSubmission()).
+     */
+    val submissionClaimOwner = text("submissionClaimOwner").nullable()
+    val submissionClaimExpirationSec = long("submissionClaimExpirationSec").nullable()
+
     /**
      * Points at the raw transaction witnessing that this
      * initiated payment was successfully performed.
      */
     val confirmationTransaction = reference("rawConfirmation", NexusBankTransactionsTable).nullable()
+
+    init {
+        // Serves the listings of pending payments, and the submitter.
+        index(false, bankAccount, submitted)
+    }
 }
 
 class PaymentInitiationEntity(id: EntityID<Long>) : LongEntity(id) {
@@ -367,6 +402,13 @@ object NexusScheduledTasksTable : IntIdTable() {
     val taskParams = text("taskParams")
     val nextScheduledExecutionSec = long("nextScheduledExecutionSec").nullable()
     val prevScheduledExecutionSec = long("lastScheduledExecutionSec").nullable()
+
+    /**
+     * Node running the task, and until when its lease holds
+     * (see claimScheduledTask()).
+     */
+    val leaseOwner = text("leaseOwner").nullable()
+    val leaseExpirationSec = long("leaseExpirationSec").nullable()
 }
 
 class NexusScheduledTaskEntity(id: EntityID<Int>) : IntEntity(id) {
@@ -380,10 +422,67 @@ class NexusScheduledTaskEntity(id: EntityID<Int>) : IntEntity(id) {
     var taskParams by NexusScheduledTasksTable.taskParams
     var nextScheduledExecutionSec by NexusScheduledTasksTable.nextScheduledExecutionSec
     var prevScheduledExecutionSec by NexusScheduledTasksTable.prevScheduledExecutionSec
+    var leaseOwner by NexusScheduledTasksTable.leaseOwner
+    var leaseExpirationSec by NexusScheduledTasksTable.leaseExpirationSec
+}
+
+/**
+ * The nexus nodes sharing the database, with the time they
+ * last showed to be alive.
+ */
+object NexusNodesTable : IdTable<String>() {
+    override val id = text("id").entityId()
+    val lastSeenSec = long("lastSeenSec")
 }
 
-fun dbCreateTables(dbName: String) {
-    Database.connect("jdbc:sqlite:${dbName}", "org.sqlite.JDBC")
+/**
+ * How long a node waits for the database lock before failing.
+ */
+const val DB_BUSY_TIMEOUT_MS = 10000
+
+/**
+ * Settings of the SQLite connections.
+ *
+ * @param wal journal in write-ahead log mode: the readers do not block
+ *        the writer, nor the writer the readers.
+ * @param synchronous how often SQLite waits for the disk (OFF, NORMAL
+ *        or FULL).  Null means NORMAL in WAL mode, where it only risks
+ *        the last commits on a power loss, and the SQLite default
+ *        (FULL) otherwise.
+ * @param cacheKib page cache of each connection, null for the SQLite
+ *        default.
+ * @param busyTimeoutMs how long a connection waits for the database
+ *        lock before failing.
+ */
+data class SqliteConfig(
+    val wal: Boolean = false,
+    val synchronous: String? = null,
+    val cacheKib: Int? = null,
+    val busyTimeoutMs: Int = DB_BUSY_TIMEOUT_MS
+) {
+    fun pragmas(): List<String> {
+        val pragmas = mutableListOf("PRAGMA busy_timeout = $busyTimeoutMs")
+        if (wal) {
+            pragmas.add("PRAGMA journal_mode = WAL")
+        }
+        val sync = synchronous ?: if (wal) "NORMAL" else null
+        if (sync != null) {
+            pragmas.add("PRAGMA synchronous = $sync")
+        }
+        if (cacheKib != null) {
+            // Negative sizes are in KiB, positive ones in pages.
+            pragmas.add("PRAGMA cache_size = -$cacheKib")
+        }
+        return pragmas
+    }
+}
+
+fun dbCreateTables(dbName: String, sqliteConfig: SqliteConfig = SqliteConfig()) {
+    val pragmas = sqliteConfig.pragmas()
+    Database.connect("jdbc:sqlite:${dbName}", "org.sqlite.JDBC", setupConnection = {
+        // Other nexus nodes may hold the database lock for a while.
+        it.createStatement().use { s -> pragmas.forEach { pragma -> s.execute(pragma) } }
+    })
     TransactionManager.manager.defaultIsolationLevel = Connection.TRANSACTION_SERIALIZABLE
     transaction {
         addLogger(StdOutSqlLogger)
@@ -400,7 +499,22 @@ fun dbCreateTables(dbName: String) {
             FacadesTable,
             TalerFacadeStateTable,
             NexusScheduledTasksTable,
-            OfferedBankAccountsTable
+            OfferedBankAccountsTable,
+            NexusNodesTable
+        )
+        // The unique request_uid index cannot be added while older
+        // databases still hold one request_uid more than once.
+        renameDuplicateTalerRequests()
+        // Databases made before the bank messages were compressed,
+        // before the leases, or before the Taler request hashes, lack
+        // some of their columns and indices.
+        SchemaUtils.createMissingTablesAndColumns(
+            NexusBankMessagesTable,
+            NexusScheduledTasksTable,
+            PaymentInitiationsTable,
+            TalerRequestedPayments
         )
     }
+    migrateBankMessages()
+    migrateTalerRequestedPayments()
 }
@@ -0,0 +1,221 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Database access from coroutines.  Exposed transactions block their
+ * thread, so the handlers and the background jobs do not open them
+ * on the Ktor (or GlobalScope) threads: all the database work runs on
+ * one bounded dispatcher, whose size caps the concurrent transactions.
+ * The time spent waiting for it and running on it is accounted per
+ * HTTP request and in DbMetrics.
+ */
+package tech.libeufin.nexus
+
+import kotlinx.coroutines.ExecutorCoroutineDispatcher
+import kotlinx.coroutines.asCoroutineDispatcher
+import kotlinx.coroutines.withContext
+import org.jetbrains.exposed.sql.Transaction
+import org.jetbrains.exposed.sql.transactions.TransactionManager
+import org.jetbrains.exposed.sql.transactions.experimental.newSuspendedTransaction
+import tech.libeufin.nexus.server.DbMetricsJson
+import java.util.concurrent.Executors
+import java.util.concurrent.ThreadFactory
+import java.util.concurrent.atomic.AtomicInteger
+import java.util.concurrent.atomic.AtomicLong
+import kotlin.coroutines.AbstractCoroutineContextElement
+import kotlin.coroutines.CoroutineContext
+import kotlin.coroutines.coroutineContext
+
+const val DEFAULT_DB_MAX_CONCURRENCY = 4
+
+object NexusDb {
+    /**
+     * Database operations running at the same time; the others queue.
+     * Only settable before the first database access.
+     */
+    var maxConcurrency: Int = DEFAULT_DB_MAX_CONCURRENCY
+        set(value) {
+            require(value > 0) { "database concurrency must be positive" }
+            check(!started) { "database dispatcher already running" }
+            field = value
+        }
+
+    /**
+     * Queue the writes to one writer, that commits them in groups
+     * (see DbWriter.kt).  Meant for SQLite in WAL mode.
+     */
+    @Volatile
+    var groupCommit: Boolean = false
+
+    /**
+     * Most transactions committed together.
+     */
+    @Volatile
+    var maxGroupSize: Int = DEFAULT_DB_MAX_GROUP_SIZE
+
+    @Volatile
+    private var started = false
+
+    val dispatcher: ExecutorCoroutineDispatcher by lazy {
+        started = true
+        val counter = AtomicInteger()
+        val factory = ThreadFactory { runnable ->
+            Thread(runnable, "nexus-db-${counter.incrementAndGet()}").apply { isDaemon = true }
+        }
+        Executors.newFixedThreadPool(maxConcurrency, factory).asCoroutineDispatcher()
+    }
+}
+
+/**
+ * Database time of one HTTP request, summed over its transactions.
+ */
+class DbCallTiming : AbstractCoroutineContextElement(DbCallTiming) {
+    companion object Key : CoroutineContext.Key<DbCallTiming>
+
+    val operations = AtomicLong()
+    val waitMicros = AtomicLong()
+    val runMicros = AtomicLong()
+}
+
+private class DbCounters {
+    val operations = AtomicLong()
+    val waitSumMicros = AtomicLong()
+    val waitMaxMicros = AtomicLong()
+    val runSumMicros = AtomicLong()
+    val runMaxMicros = AtomicLong()
+    val calls = AtomicLong()
+    val callSumMicros = AtomicLong()
+    val callMaxMicros = AtomicLong()
+    val groups = AtomicLong()
+    val groupedTransactions = AtomicLong()
+    val groupMaxSize = AtomicLong()
+    val groupFailures = AtomicLong()
+    val groupSumMicros = AtomicLong()
+    val groupMaxMicros = AtomicLong()
+}
+
+/**
+ * Database counters since startup.
+ */
+object DbMetrics {
+    private val counters = DbCounters()
+
+    fun recordOperation(waitMicros: Long, runMicros: Long) {
+        counters.operations.incrementAndGet()
+        counters.waitSumMicros.addAndGet(waitMicros)
+        counters.waitMaxMicros.accumulateAndGet(waitMicros) { a, b -> maxOf(a, b) }
+        counters.runSumMicros.addAndGet(runMicros)
+        counters.runMaxMicros.accumulateAndGet(runMicros) { a, b -> maxOf(a, b) }
+    }
+
+    /**
+     * Account for one group commit of 'size' transactions; a failed
+     * group was rolled back, and its transactions run one by one.
+     */
+    fun recordGroup(size: Int, micros: Long, committed: Boolean) {
+        counters.groups.incrementAndGet()
+        counters.groupedTransactions.addAndGet(size.toLong())
+        counters.groupMaxSize.accumulateAndGet(size.toLong()) { a, b -> maxOf(a, b) }
+        if (!committed) counters.groupFailures.incrementAndGet()
+        counters.groupSumMicros.addAndGet(micros)
+        counters.groupMaxMicros.accumulateAndGet(micros) { a, b -> maxOf(a, b) }
+    }
+
+    /**
+     * Account for the database time of one HTTP request.
+     */
+    fun recordCall(timing: DbCallTiming) {
+        val micros = timing.waitMicros.get() + timing.runMicros.get()
+        counters.calls.incrementAndGet()
+        counters.callSumMicros.addAndGet(micros)
+        counters.callMaxMicros.accumulateAndGet(micros) { a, b -> maxOf(a, b) }
+    }
+
+    fun snapshot(): DbMetricsJson {
+        val operations = counters.operations.get()
+        val calls = counters.calls.get()
+        val groups = counters.groups.get()
+        fun mean(sum: AtomicLong, n: Long) = if (n == 0L) 0.0 else sum.get() / 1000.0 / n
+        return DbMetricsJson(
+            maxConcurrency = NexusDb.maxConcurrency,
+            operations = operations,
+            meanWaitMillis = mean(counters.waitSumMicros, operations),
+            maxWaitMillis = counters.waitMaxMicros.get() / 1000.0,
+            meanRunMillis = mean(counters.runSumMicros, operations),
+            maxRunMillis = counters.runMaxMicros.get() / 1000.0,
+            calls = calls,
+            meanCallDbMillis = mean(counters.callSumMicros, calls),
+            maxCallDbMillis = counters.callMaxMicros.get() / 1000.0,
+            groupCommit = NexusDb.groupCommit,
+            groupCommits = groups,
+            failedGroupCommits = counters.groupFailures.get(),
+            meanGroupSize = if (groups == 0L) 0.0 else counters.groupedTransactions.get().toDouble() / groups,
+            maxGroupSize = counters.groupMaxSize.get(),
+            meanGroupCommitMillis = mean(counters.groupSumMicros, groups),
+            maxGroupCommitMillis = counters.groupMaxMicros.get() / 1000.0
+        )
+    }
+}
+
+internal suspend inline fun <T> timedDbOperation(block: (() -> Unit) -> T): T {
+    val timing = coroutineContext[DbCallTiming]
+    val queued = System.nanoTime()
+    var started = 0L
+    val result = block { started = System.nanoTime() }
+    val waitMicros = (started - queued) / 1000
+    val runMicros = (System.nanoTime() - started) / 1000
+    DbMetrics.recordOperation(waitMicros, runMicros)
+    if (timing != null) {
+        timing.operations.incrementAndGet()
+        timing.waitMicros.addAndGet(waitMicros)
+        timing.runMicros.addAndGet(runMicros)
+    }
+    return result
+}
+
+/**
+ * Run a transaction on the database dispatcher, suspending the
+ * caller until it is done.  Within a transaction already open on
+ * this thread, the statement just joins it.
+ */
+suspend fun <T> dbTransaction(statement: Transaction.() -> T): T {
+    val current = TransactionManager.currentOrNull()
+    if (current != null) {
+        return current.statement()
+    }
+    return timedDbOperation { onStart ->
+        newSuspendedTransaction(NexusDb.dispatcher) {
+            onStart()
+            statement()
+        }
+    }
+}
+
+/**
+ * Run on the database dispatcher a blocking routine that opens
+ * its own transactions.
+ */
+suspend fun <T> dbWork(block: () -> T): T {
+    return timedDbOperation { onStart ->
+        withContext(NexusDb.dispatcher) {
+            onStart()
+            block()
+        }
+    }
+}
@@ -0,0 +1,208 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Single writer for SQLite.  SQLite lets one connection write at a time,
+ * and concurrent writers keep failing with SQLITE_BUSY, or waiting on the
+ * busy timeout.  With group commits enabled, all the writes of this nexus
+ * are queued to one writer thread instead: the small transactions found
+ * in the queue are run together, and committed at once.  The reads keep
+ * running concurrently on the database dispatcher (in WAL mode they do not
+ * block the writer).
+ */
+package tech.libeufin.nexus
+
+import kotlinx.coroutines.CompletableDeferred
+import kotlinx.coroutines.CoroutineStart
+import kotlinx.coroutines.GlobalScope
+import kotlinx.coroutines.asCoroutineDispatcher
+import kotlinx.coroutines.channels.Channel
+import kotlinx.coroutines.launch
+import org.jetbrains.exposed.sql.Transaction
+import org.jetbrains.exposed.sql.transactions.TransactionManager
+import org.jetbrains.exposed.sql.transactions.transaction
+import java.util.concurrent.Executors
+
+const val DEFAULT_DB_MAX_GROUP_SIZE = 64
+
+private sealed class DbWrite(val onStart: () -> Unit) {
+    abstract val result: CompletableDeferred<*>
+
+    fun fail(e: Throwable) {
+        result.completeExceptionally(e)
+    }
+}
+
+/**
+ * One transaction, that can be committed together with others.
+ */
+private class GroupedWrite<T>(
+    val statement: Transaction.() -> T,
+    onStart: () -> Unit
+) : DbWrite(onStart) {
+    override val result = CompletableDeferred<T>()
+    private var value: Any? = null
+
+    fun runIn(t: Transaction) {
+        value = t.statement()
+    }
+
+    @Suppress("UNCHECKED_CAST")
+    fun complete() {
+        result.complete(value as T)
+    }
+
+    fun runAlone() {
+        try {
+            value = transaction { statement() }
+            complete()
+        } catch (e: Throwable) {
+            fail(e)
+        }
+    }
+}
+
+/**
+ * A blocking routine that opens its own transactions, and has
+ * the writer for itself while it runs.
+ */
+private class ExclusiveWrite<T>(
+    val block: () -> T,
+    onStart: () -> Unit
+) : DbWrite(onStart) {
+    override val result = CompletableDeferred<T>()
+
+    fun run() {
+        try {
+            onStart()
+            result.complete(block())
+        } catch (e: Throwable) {
+            fail(e)
+        }
+    }
+}
+
+private object DbWriter {
+    private val queue = Channel<DbWrite>(Channel.UNLIMITED)
+
+    private val writer = run {
+        val thread = Executors.newSingleThreadExecutor { runnable ->
+            Thread(runnable, "nexus-db-writer").apply { isDaemon = true }
+        }
+        GlobalScope.launch(thread.asCoroutineDispatcher(), start = CoroutineStart.LAZY) { runWriter() }
+    }
+
+    fun submit(write: DbWrite) {
+        writer.start()
+        queue.offer(write)
+    }
+
+    private suspend fun runWriter() {
+        while (true) {
+            val first = queue.receive()
+            if (first is ExclusiveWrite<*>) {
+                first.run()
+                continue
+            }
+            val group = mutableListOf(first as GroupedWrite<*>)
+            var next: ExclusiveWrite<*>? = null
+            while (group.size < NexusDb.maxGroupSize) {
+                val write = queue.poll() ?: break
+                if (write is ExclusiveWrite<*>) {
+                    // Runs after the group, keeping the queue order.
+                    next = write
+                    break
+                }
+                group.add(write as GroupedWrite<*>)
+            }
+            commitGroup(group)
+            next?.run()
+        }
+    }
+
+    /**
+     * Run the group in one transaction.  If any of its transactions
+     * fails, the group is rolled back, and each of them is run again
+     * on its own: the failure goes to the one that caused it only.
+     * An Error fails the whole group instead, and the writer goes on
+     * with the next writes.
+     */
+    private fun commitGroup(group: List<GroupedWrite<*>>) {
+        try {
+            group.forEach { it.onStart() }
+            if (group.size == 1) {
+                group[0].runAlone()
+                return
+            }
+            val start = System.nanoTime()
+            val committed = try {
+                // A failing group is not retried as a whole.
+                transaction(TransactionManager.manager.defaultIsolationLevel, 1) {
+                    group.forEach { it.runIn(this) }
+                }
+                true
+            } catch (e: Exception) {
+                logger.debug("Group commit of ${group.size} transactions failed, running them one by one: $e")
+                false
+            }
+            DbMetrics.recordGroup(group.size, (System.nanoTime() - start) / 1000, committed)
+            if (committed) {
+                group.forEach { it.complete() }
+            } else {
+                group.forEach { it.runAlone() }
+            }
+        } catch (e: Throwable) {
+            logger.error("Group commit of ${group.size} transactions failed: $e")
+            // Completed writes are left alone.
+            group.forEach { it.fail(e) }
+        }
+    }
+}
+
+/**
+ * Like dbTransaction(), for a transaction that writes.  With group
+ * commits enabled, it is queued to the writer, and may be committed
+ * together with other ones.  As with transaction(), the statement
+ * may run more than once: it must not have other side effects.
+ */
+suspend fun <T> dbWriteTransaction(statement: Transaction.() -> T): T {
+    if (!NexusDb.groupCommit || TransactionManager.currentOrNull() != null) {
+        return dbTransaction(statement)
+    }
+    return timedDbOperation { onStart ->
+        val write = GroupedWrite(statement, onStart)
+        DbWriter.submit(write)
+        write.result.await()
+    }
+}
+
+/**
+ * Like dbWork(), for a blocking routine that writes.  With group
+ * commits enabled, it runs on the writer, between two groups.
+ */
+suspend fun <T> dbWriteWork(block: () -> T): T {
+    if (!NexusDb.groupCommit) {
+        return dbWork(block)
+    }
+    return timedDbOperation { onStart ->
+        val write = ExclusiveWrite(block, onStart)
+        DbWriter.submit(write)
+        write.result.await()
+    }
+}
@@ -0,0 +1,130 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Opt-in recording of the EBICS exchanges between nexus and the
+ * banks, so that their shape and timing can be replayed later
+ * (see integration-tests/replay-ebics-traffic.py).
+ */
+package tech.libeufin.nexus
+
+import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
+import java.io.Closeable
+import java.io.File
+import java.io.OutputStreamWriter
+import java.io.Writer
+import java.time.Instant
+import java.util.zip.GZIPOutputStream
+
+const val EBICS_TRAFFIC_FORMAT = "libeufin-ebics-traffic"
+const val EBICS_TRAFFIC_VERSION = 1
+
+/**
+ * First line of a recording.
+ */
+data class EbicsTrafficHeader(
+    val format: String,
+    val version: Int,
+    val startedAt: Long
+)
+
+/**
+ * One attempt to post a document to a bank.  'offsetMicros' is
+ * when the attempt started, counted from the start of the recording.
+ * 'status' and 'response' are null when no response came.
+ */
+data class EbicsTrafficRecord(
+    val seq: Long,
+    val offsetMicros: Long,
+    val latencyMicros: Long,
+    val url: String,
+    val attempt: Int,
+    val status: Int?,
+    val request: String,
+    val response: String?
+)
+
+/**
+ * Writes the exchanges as JSON lines to a gzip file.  Every record
+ * is flushed through the compressor, so that a recording cut short
+ * by a crash is still readable up to its last record.
+ */
+class EbicsTrafficRecorder(path: String) : Closeable {
+    private val startNanos = System.nanoTime()
+    private val mapper = jacksonObjectMapper()
+    private val out: Writer = OutputStreamWriter(
+        GZIPOutputStream(File(path).outputStream(), true),
+        Charsets.UTF_8
+    )
+    private var seq = 0L
+    private var closed = false
+
+    init {
+        writeLine(EbicsTrafficHeader(EBICS_TRAFFIC_FORMAT, EBICS_TRAFFIC_VERSION, Instant.now().toEpochMilli()))
+        logger.info("Recording the EBICS traffic to $path")
+    }
+
+    @Synchronized
+    private fun writeLine(value: Any) {
+        if (closed) return
+        out.write(mapper.writeValueAsString(value))
+        out.write("\n")
+        out.flush()
+    }
+
+    /**
+     * 'attemptStartNanos' is the System.nanoTime() at which the attempt started.
+     */
+    fun record(
+        url: String,
+        attempt: Int,
+        attemptStartNanos: Long,
+        latencyMicros: Long,
+        status: Int?,
+        request: String,
+        response: String?
+    ) {
+        try {
+            synchronized(this) {
+                writeLine(
+                    EbicsTrafficRecord(
+                        seq++,
+                        (attemptStartNanos - startNanos) / 1000,
+                        latencyMicros,
+                        url,
+                        attempt,
+                        status,
+                        request,
+                        response
+                    )
+                )
+            }
+        } catch (e: Exception) {
+            // Recording must never break the traffic itself.
+            logger.error("Could not record an EBICS exchange", e)
+        }
+    }
+
+    @Synchronized
+    override fun close() {
+        if (closed) return
+        closed = true
+        out.close()
+    }
+}
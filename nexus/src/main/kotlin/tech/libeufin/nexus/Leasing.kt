@@ -0,0 +1,239 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Coordination of the nexus nodes sharing one database.  Every node
+ * announces itself in NexusNodesTable, and runs scheduled tasks and
+ * submits payments only under a lease it holds in the database.  A
+ * live node keeps renewing its leases; those of a dead node expire,
+ * and the other nodes take its work over.
+ */
+package tech.libeufin.nexus
+
+import kotlinx.coroutines.GlobalScope
+import kotlinx.coroutines.launch
+import kotlinx.coroutines.time.delay
+import org.jetbrains.exposed.sql.*
+import org.jetbrains.exposed.sql.transactions.transaction
+import java.lang.management.ManagementFactory
+import java.time.Duration
+import java.time.Instant
+
+const val DEFAULT_LEASE_SECONDS = 60L
+
+object NexusNode {
+    /**
+     * Identifies this process among the nodes sharing the database.
+     */
+    var id: String = ManagementFactory.getRuntimeMXBean().name
+
+    /**
+     * How long the leases of this node outlive its last renewal.
+     */
+    var leaseSeconds: Long = DEFAULT_LEASE_SECONDS
+}
+
+/**
+ * Record that this node is alive, and extend all the leases it holds.
+ */
+fun renewNodeLeases(nowSec: Long = Instant.now().epochSecond) {
+    val expiration = nowSec + NexusNode.leaseSeconds
+    transaction {
+        val seen = NexusNodesTable.update({ NexusNodesTable.id eq NexusNode.id }) {
+            it[lastSeenSec] = nowSec
+        }
+        if (seen == 0) {
+            NexusNodesTable.insert {
+                it[NexusNodesTable.id] = NexusNode.id
+                it[lastSeenSec] = nowSec
+            }
+        }
+        NexusScheduledTasksTable.update({ NexusScheduledTasksTable.leaseOwner eq NexusNode.id }) {
+            it[leaseExpirationSec] = expiration
+        }
+        PaymentInitiationsTable.update({ PaymentInitiationsTable.submissionClaimOwner eq NexusNode.id }) {
+            it[submissionClaimExpirationSec] = expiration
+        }
+        // Nodes gone for long are forgotten.
+        NexusNodesTable.deleteWhere {
+            NexusNodesTable.lastSeenSec less nowSec - 10 * NexusNode.leaseSeconds
+        }
+    }
+}
+
+/**
+ * Drop the leases a previous process with the same node ID left
+ * behind: renewing them would keep their work from ever being done.
+ */
+fun releaseNodeLeases() {
+    transaction {
+        NexusScheduledTasksTable.update({ NexusScheduledTasksTable.leaseOwner eq NexusNode.id }) {
+            it[leaseOwner] = null
+            it[leaseExpirationSec] = null
+        }
+        PaymentInitiationsTable.update({ PaymentInitiationsTable.submissionClaimOwner eq NexusNode.id }) {
+            it[submissionClaimOwner] = null
+            it[submissionClaimExpirationSec] = null
+        }
+    }
+}
+
+/**
+ * Renew the leases of this node, three times per lease period, and
+ * again after a second when a renewal fails.  The renewals do not
+ * queue to the group-committing writer, where they could wait behind
+ * a long ingestion until the leases expire: they run in a transaction
+ * of their own, which waits on the database lock for the busy timeout
+ * at most.
+ */
+fun startNodeHeartbeat() {
+    releaseNodeLeases()
+    renewNodeLeases()
+    GlobalScope.launch {
+        var renewed = true
+        while (true) {
+            delay(if (renewed) Duration.ofSeconds(maxOf(1L, NexusNode.leaseSeconds / 3)) else Duration.ofSeconds(1))
+            renewed = try {
+                dbWork { renewNodeLeases() }
+                true
+            } catch (e: Exception) {
+                logger.error("Could not renew the leases of node ${NexusNode.id}", e)
+                false
+            }
+        }
+    }
+}
+
+/**
+ * IDs of the nodes that renewed their leases recently, sorted.
+ * Needs to be called within a transaction block.
+ */
+fun findLiveNexusNodes(nowSec: Long): List<String> {
+    return NexusNodesTable.slice(NexusNodesTable.id).select {
+        NexusNodesTable.lastSeenSec greaterEq nowSec - NexusNode.leaseSeconds
+    }.map { it[NexusNodesTable.id].value }.sorted()
+}
+
+/**
+ * The tasks among 'claimable' (the same list for all the nodes) that
+ * node 'me' tries to claim: an equal share for each of the live
+ * 'nodes', taken at an offset given by the node's rank.  The shares
+ * are disjoint, so the nodes don't contend for the same tasks.
+ */
+fun pickFairShare(claimable: List<Int>, nodes: List<String>, me: String): List<Int> {
+    if (claimable.isEmpty()) {
+        return listOf()
+    }
+    val ranked = if (nodes.contains(me)) nodes else (nodes + me).sorted()
+    val share = (claimable.size + ranked.size - 1) / ranked.size
+    val offset = ranked.indexOf(me) * share
+    return claimable.drop(offset).take(share)
+}
+
+/**
+ * Condition on the due tasks that no live lease covers.
+ */
+private fun SqlExpressionBuilder.claimableTaskOp(nowSec: Long): Op<Boolean> {
+    return (NexusScheduledTasksTable.nextScheduledExecutionSec lessEq nowSec) and
+            (NexusScheduledTasksTable.leaseOwner.isNull() or
+                    (NexusScheduledTasksTable.leaseExpirationSec less nowSec))
+}
+
+/**
+ * IDs of the due tasks this node should claim now: its fair share,
+ * plus those left overdue for a whole lease period because their
+ * node is alive but not claiming.  Needs to be called within a
+ * transaction block.
+ */
+fun findTasksToClaim(nowSec: Long): List<Int> {
+    val claimable = NexusScheduledTasksTable.slice(
+        NexusScheduledTasksTable.id,
+        NexusScheduledTasksTable.nextScheduledExecutionSec
+    ).select { claimableTaskOp(nowSec) }.orderBy(NexusScheduledTasksTable.id to SortOrder.ASC).map {
+        Pair(it[NexusScheduledTasksTable.id].value, it[NexusScheduledTasksTable.nextScheduledExecutionSec]!!)
+    }
+    val share = pickFairShare(claimable.map { it.first }, findLiveNexusNodes(nowSec), NexusNode.id)
+    val overdue = claimable.filter { it.second < nowSec - NexusNode.leaseSeconds }.map { it.first }
+    return (share + overdue).distinct()
+}
+
+/**
+ * Lease the due task 'taskId' to this node; false if another node
+ * holds a live lease on it, or already ran it.  Needs to be called
+ * within a transaction block.
+ */
+fun claimScheduledTask(taskId: Int, nowSec: Long): Boolean {
+    return NexusScheduledTasksTable.update({
+        (NexusScheduledTasksTable.id eq taskId) and claimableTaskOp(nowSec)
+    }) {
+        it[leaseOwner] = NexusNode.id
+        it[leaseExpirationSec] = nowSec + NexusNode.leaseSeconds
+    } == 1
+}
+
+/**
+ * Record that this node ran the task 'taskId' scheduled at
+ * 'scheduledSec', and give its lease back.  Does nothing if
+ * the lease was lost meanwhile.
+ */
+fun completeScheduledTask(taskId: Int, scheduledSec: Long) {
+    transaction {
+        NexusScheduledTasksTable.update({
+            (NexusScheduledTasksTable.id eq taskId) and (NexusScheduledTasksTable.leaseOwner eq NexusNode.id)
+        }) {
+            // Makes the scheduler compute the next execution time.
+            it[nextScheduledExecutionSec] = null
+            it[prevScheduledExecutionSec] = scheduledSec
+            it[leaseOwner] = null
+            it[leaseExpirationSec] = null
+        }
+    }
+}
+
+/**
+ * Claim the right to submit the payment initiation 'paymentInitiationId'
+ * for this node, so that no other node or request submits it at the
+ * same time.  False if it was submitted already, or is being submitted.
+ */
+fun claimPaymentSubmission(paymentInitiationId: Long): Boolean {
+    val nowSec = Instant.now().epochSecond
+    return transaction {
+        PaymentInitiationsTable.update({
+            (PaymentInitiationsTable.id eq paymentInitiationId) and
+                    (PaymentInitiationsTable.submitted eq false) and
+                    (PaymentInitiationsTable.submissionClaimOwner.isNull() or
+                            (PaymentInitiationsTable.submissionClaimExpirationSec less nowSec))
+        }) {
+            it[submissionClaimOwner] = NexusNode.id
+            it[submissionClaimExpirationSec] = nowSec + NexusNode.leaseSeconds
+        } == 1
+    }
+}
+
+fun releasePaymentSubmission(paymentInitiationId: Long) {
+    transaction {
+        PaymentInitiationsTable.update({
+            (PaymentInitiationsTable.id eq paymentInitiationId) and
+                    (PaymentInitiationsTable.submissionClaimOwner eq NexusNode.id)
+        }) {
+            it[submissionClaimOwner] = null
+            it[submissionClaimExpirationSec] = null
+        }
+    }
+}
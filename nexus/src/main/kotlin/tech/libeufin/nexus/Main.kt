@@ -26,8 +26,13 @@ import com.github.ajalt.clikt.core.subcommands
 import com.github.ajalt.clikt.output.CliktHelpFormatter
 import com.github.ajalt.clikt.parameters.arguments.argument
 import com.github.ajalt.clikt.parameters.options.default
+import com.github.ajalt.clikt.parameters.options.flag
 import com.github.ajalt.clikt.parameters.options.option
 import com.github.ajalt.clikt.parameters.options.prompt
+import com.github.ajalt.clikt.parameters.types.choice
+import com.github.ajalt.clikt.parameters.types.int
+import com.github.ajalt.clikt.parameters.types.long
+import com.github.ajalt.clikt.parameters.types.restrictTo
 import org.jetbrains.exposed.sql.transactions.transaction
 import org.slf4j.Logger
 import org.slf4j.LoggerFactory
@@ -35,6 +40,9 @@ import tech.libeufin.nexus.server.serverMain
 import tech.libeufin.util.CryptoUtil.hashpw
 import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
 import tech.libeufin.nexus.iso20022.parseCamtMessage
+import tech.libeufin.util.EBICS_MAX_SEGMENT_SIZE
+import tech.libeufin.util.RsaKeyPairPool
+import tech.libeufin.util.RsaKeyPairs
 import tech.libeufin.util.XMLUtil
 import tech.libeufin.util.setLogLevel
 import java.io.File
@@ -53,10 +61,80 @@ class Serve : CliktCommand("Run nexus HTTP server") {
     }
     private val dbName by option().default("libeufin-nexus.sqlite3")
     private val host by option().default("127.0.0.1")
+    private val port by option().int().default(5001)
+    private val nodeId by option(
+        help = "identifies this nexus among those sharing the database [default: pid@hostname]"
+    )
+    private val leaseSeconds by option(
+        help = "how long a dead nexus keeps its scheduled tasks and payment submissions from the others"
+    ).long().restrictTo(min = 3L).default(DEFAULT_LEASE_SECONDS)
+    private val dbMaxConcurrency by option(
+        help = "database operations run at the same time, the others wait for a free slot"
+    ).int().restrictTo(min = 1).default(DEFAULT_DB_MAX_CONCURRENCY)
+    private val sqliteWal by option(
+        help = "journal in WAL mode, and commit the writes in groups from a single writer"
+    ).flag()
+    private val sqliteSynchronous by option(
+        help = "SQLite synchronous setting [default: NORMAL with --sqlite-wal, else FULL]"
+    ).choice("OFF", "NORMAL", "FULL")
+    private val sqliteCacheKib by option(
+        help = "SQLite page cache of each database connection [default: SQLite's]"
+    ).int().restrictTo(min = 1)
+    private val dbBusyTimeout by option(
+        help = "milliseconds a database connection waits for the lock"
+    ).int().restrictTo(min = 0).default(DB_BUSY_TIMEOUT_MS)
+    private val dbMaxGroupSize by option(
+        help = "most write transactions committed together, with --sqlite-wal"
+    ).int().restrictTo(min = 1).default(DEFAULT_DB_MAX_GROUP_SIZE)
     private val logLevel by option()
+    private val bankConnectTimeout by option(help = "milliseconds").int().default(BankHttpConfig().connectTimeout)
+    private val bankReadTimeout by option(help = "milliseconds").int().default(BankHttpConfig().readTimeout)
+    private val bankRequestTimeout by option(help = "milliseconds").long().default(BankHttpConfig().requestTimeout)
+    private val bankMaxConnections by option().int().default(BankHttpConfig().maxConnections)
+    private val bankMaxConnectionsPerHost by option().int().default(BankHttpConfig().maxConnectionsPerHost)
+    private val bankMaxRetries by option(
+        help = "retries of idempotent EBICS requests"
+    ).int().default(BankHttpConfig().maxRetries)
+    private val ebicsUploadSegmentSize by option(
+        help = "Base64 characters of order data per EBICS upload request, at most 1 MiB"
+    ).int().restrictTo(4, EBICS_MAX_SEGMENT_SIZE).default(BankHttpConfig().ebicsUploadSegmentSize)
+    private val recordEbicsTraffic by option(
+        help = "record every exchange with the banks to this gzip file, for replaying it"
+    )
+    private val rsaKeyPoolSize by option(
+        help = "RSA key pairs generated in advance, for new bank connections"
+    ).int().default(6)
+    private val rsaKeyPoolThreads by option(
+        help = "background threads generating the RSA key pairs"
+    ).int().default(maxOf(1, Runtime.getRuntime().availableProcessors() / 2))
+    private val rsaKeySeed by option(
+        help = "generate the RSA key pairs deterministically from this seed, only for tests"
+    ).long()
     override fun run() {
         setLogLevel(logLevel)
-        serverMain(dbName, host)
+        RsaKeyPairs.pool = RsaKeyPairPool(rsaKeyPoolSize, rsaKeyPoolThreads, seed = rsaKeySeed)
+        nodeId?.let { NexusNode.id = it }
+        NexusNode.leaseSeconds = leaseSeconds
+        NexusDb.maxConcurrency = dbMaxConcurrency
+        NexusDb.groupCommit = sqliteWal
+        NexusDb.maxGroupSize = dbMaxGroupSize
+        val sqliteConfig = SqliteConfig(
+            wal = sqliteWal,
+            synchronous = sqliteSynchronous,
+            cacheKib = sqliteCacheKib,
+            busyTimeoutMs = dbBusyTimeout
+        )
+        val bankHttpConfig = BankHttpConfig(
+            connectTimeout = bankConnectTimeout,
+            readTimeout = bankReadTimeout,
+            requestTimeout = bankRequestTimeout,
+            maxConnections = bankMaxConnections,
+            maxConnectionsPerHost = bankMaxConnectionsPerHost,
+            maxRetries = bankMaxRetries,
+            ebicsUploadSegmentSize = ebicsUploadSegmentSize,
+            trafficLog = recordEbicsTraffic
+        )
+        serverMain(dbName, host, bankHttpConfig, port, sqliteConfig)
     }
 }
 
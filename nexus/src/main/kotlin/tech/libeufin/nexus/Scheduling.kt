@@ -22,12 +22,13 @@ package tech.libeufin.nexus
 import com.cronutils.model.definition.CronDefinitionBuilder
 import com.cronutils.model.time.ExecutionTime
 import com.cronutils.parser.CronParser
+import com.fasterxml.jackson.databind.JsonNode
+import com.fasterxml.jackson.databind.node.ObjectNode
 import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
 import io.ktor.client.HttpClient
 import kotlinx.coroutines.GlobalScope
 import kotlinx.coroutines.launch
 import kotlinx.coroutines.time.delay
-import org.jetbrains.exposed.sql.transactions.transaction
 import tech.libeufin.nexus.bankaccount.fetchBankAccountTransactions
 import tech.libeufin.nexus.bankaccount.submitAllPaymentInitiations
 import tech.libeufin.nexus.server.FetchSpecJson
@@ -45,6 +46,19 @@ private data class TaskSchedule(
     val params: String
 )
 
+/**
+ * Read the fetch spec of a scheduled task.  Scheduled fetches
+ * are incremental ("since-last") unless they give a range type.
+ */
+fun parseScheduledFetchSpec(params: JsonNode): FetchSpecJson {
+    val spec = if (params is ObjectNode && !params.has("rangeType")) {
+        params.deepCopy().put("rangeType", "since-last")
+    } else {
+        params
+    }
+    return jacksonObjectMapper().treeToValue(spec, FetchSpecJson::class.java)
+}
+
 private suspend fun runTask(client: HttpClient, sched: TaskSchedule) {
     logger.info("running task $sched")
     try {
@@ -54,7 +68,7 @@ private suspend fun runTask(client: HttpClient, sched: TaskSchedule) {
                 when (sched.type) {
                     "fetch" -> {
                         @Suppress("BlockingMethodInNonBlockingContext")
-                        val fetchSpec = jacksonObjectMapper().readValue(sched.params, FetchSpecJson::class.java)
+                        val fetchSpec = parseScheduledFetchSpec(jacksonObjectMapper().readTree(sched.params))
                         fetchBankAccountTransactions(client, fetchSpec, sched.resourceId)
                     }
                     "submit" -> {
@@ -87,13 +101,17 @@ object NexusCron {
     }
 }
 
+/**
+ * Run the scheduled tasks that are due.  Several nexus nodes may share
+ * the database: each task is run by the one node that leased it.
+ */
 fun startOperationScheduler(httpClient: HttpClient) {
     GlobalScope.launch {
         while (true) {
             logger.info("running schedule loop")
 
             // First, assign next execution time stamps to all tasks that need them
-            transaction {
+            dbWriteTransaction {
                 NexusScheduledTaskEntity.find {
                     NexusScheduledTasksTable.nextScheduledExecutionSec.isNull()
                 }.forEach {
@@ -112,10 +130,10 @@ fun startOperationScheduler(httpClient: HttpClient) {
             }
 
             val nowSec = Instant.now().epochSecond
-            // Second, find tasks that are due
-            val dueTasks = transaction {
-                NexusScheduledTaskEntity.find {
-                    NexusScheduledTasksTable.nextScheduledExecutionSec lessEq nowSec
+            // Second, lease this node's share of the due tasks
+            val dueTasks = dbWriteTransaction {
+                findTasksToClaim(nowSec).filter { claimScheduledTask(it, nowSec) }.mapNotNull {
+                    NexusScheduledTaskEntity.findById(it)
                 }.map {
                     TaskSchedule(it.id.value, it.taskName, it.taskType, it.resourceType, it.resourceId, it.taskParams)
                 }
@@ -124,14 +142,7 @@ fun startOperationScheduler(httpClient: HttpClient) {
             // Execute those due tasks
             dueTasks.forEach {
                 runTask(httpClient, it)
-                transaction {
-                    val t = NexusScheduledTaskEntity.findById(it.taskId)
-                    if (t != null) {
-                        // Reset next scheduled execution
-                        t.nextScheduledExecutionSec = null
-                        t.prevScheduledExecutionSec = nowSec
-                    }
-                }
+                dbWriteWork { completeScheduledTask(it.taskId, nowSec) }
             }
 
             // Wait a bit
@@ -36,6 +36,7 @@ import io.ktor.routing.get
 import io.ktor.routing.post
 import org.jetbrains.exposed.dao.Entity
 import org.jetbrains.exposed.dao.id.IdTable
+import org.jetbrains.exposed.exceptions.ExposedSQLException
 import org.jetbrains.exposed.sql.*
 import org.jetbrains.exposed.sql.transactions.transaction
 import tech.libeufin.nexus.bankaccount.addPaymentInitiation
@@ -47,10 +48,13 @@ import tech.libeufin.nexus.server.Pain001Data
 import tech.libeufin.nexus.server.authenticateRequest
 import tech.libeufin.nexus.server.expectNonNull
 import tech.libeufin.nexus.server.expectUrlParameter
+import tech.libeufin.nexus.server.nexusObjectMapper
+import tech.libeufin.nexus.server.respondJsonStream
 import tech.libeufin.util.CryptoUtil
 import tech.libeufin.util.EbicsProtocolError
 import tech.libeufin.util.parseAmount
 import tech.libeufin.util.parsePayto
+import tech.libeufin.util.toHexString
 import kotlin.math.abs
 import kotlin.math.min
 
@@ -191,7 +195,7 @@ fun handleStartArgument(start: String?, delta: Int): Long {
  * string (what this function does), and use the simpler respondText method.
  */
 fun customConverter(body: Any): String {
-    return jacksonObjectMapper().writeValueAsString(body)
+    return nexusObjectMapper.writeValueAsString(body)
 }
 
 /**
@@ -237,52 +241,116 @@ private fun getTalerFacadeBankAccount(fcid: String): NexusBankAccountEntity {
 }
 
 /**
- * Handle a Taler Wire Gateway /transfer request.
+ * Hash of the fields that define a transfer request: replays of
+ * one request must agree on all of them.
+ */
+fun talerTransferRequestHash(req: TalerTransferRequest): String {
+    val fields = listOf(req.amount, req.exchange_base_url, req.wtid, req.credit_account)
+    return CryptoUtil.hashStringSHA256(jacksonObjectMapper().writeValueAsString(fields)).toHexString()
+}
+
+/**
+ * Give every transfer request but the first one of a request_uid a
+ * new, unique request_uid.  Older versions could store one request_uid
+ * more than once.  Needs to be called within a transaction block.
+ */
+fun renameDuplicateTalerRequests() {
+    val t = TalerRequestedPayments
+    val duplicated = t.slice(t.requestUId).selectAll().groupBy(t.requestUId).having {
+        t.id.count() greater 1L
+    }.map { it[t.requestUId] }
+    for (uid in duplicated) {
+        val ids = t.slice(t.id).select { t.requestUId eq uid }.orderBy(t.id to SortOrder.ASC).map { it[t.id].value }
+        for (id in ids.drop(1)) {
+            t.update({ t.id eq id }) { it[requestUId] = "$uid-duplicate-$id" }
+        }
+        logger.warn("Renamed ${ids.size - 1} duplicate(s) of the Taler request_uid $uid")
+    }
+}
+
+/**
+ * Fill in the request hash of the transfers requested before it was stored.
+ */
+fun migrateTalerRequestedPayments() {
+    transaction {
+        val rows = TalerRequestedPaymentEntity.find { TalerRequestedPayments.requestHash eq "" }.toList()
+        for (row in rows) {
+            row.requestHash = talerTransferRequestHash(
+                TalerTransferRequest(row.requestUId, row.amount, row.exchangeBaseUrl, row.wtid, row.creditAccount)
+            )
+        }
+    }
+}
+
+/**
+ * Row id of the transfer already requested under the same request_uid,
+ * or null if there is none.  Throws a conflict if that transfer differs
+ * from 'req'.  Needs to be called within a transaction block.
+ */
+private fun findReplayedTransfer(req: TalerTransferRequest, requestHash: String): Long? {
+    val previous = TalerRequestedPaymentEntity.find {
+        TalerRequestedPayments.requestUId eq req.request_uid
+    }.firstOrNull() ?: return null
+    if (previous.requestHash != requestHash) {
+        throw NexusError(
+            HttpStatusCode.Conflict,
+            "This uid (${req.request_uid}) belongs to a different payment already"
+        )
+    }
+    return previous.id.value
+}
+
+/**
+ * Handle a Taler Wire Gateway /transfer request.  Exchanges retry it until
+ * they get an answer: a replay gets the row id of the original transfer,
+ * and does not prepare a second payment.
  */
 private suspend fun talerTransfer(call: ApplicationCall) {
     val transferRequest = call.receive<TalerTransferRequest>()
     val amountObj = parseAmount(transferRequest.amount)
-    val creditorObj = parsePayto(transferRequest.credit_account)
-    val opaque_row_id = transaction {
-        val exchangeUser = authenticateRequest(call.request)
-        val creditorData = parsePayto(transferRequest.credit_account)
-        /** Checking the UID has the desired characteristics */
-        TalerRequestedPaymentEntity.find {
-            TalerRequestedPayments.requestUId eq transferRequest.request_uid
-        }.forEach {
-            if (
-                (it.amount != transferRequest.amount) or
-                (it.creditAccount != transferRequest.exchange_base_url) or
-                (it.wtid != transferRequest.wtid)
-            ) {
-                throw NexusError(
-                    HttpStatusCode.Conflict,
-                    "This uid (${transferRequest.request_uid}) belongs to a different payment already"
-                )
+    val creditorData = parsePayto(transferRequest.credit_account)
+    val requestHash = talerTransferRequestHash(transferRequest)
+    val exchangeBankAccountId = dbTransaction {
+        authenticateRequest(call.request)
+        getTalerFacadeBankAccount(expectNonNull(call.parameters["fcid"])).id
+    }
+    val opaque_row_id = try {
+        // Only the replay lookup and the inserts go to the writer.
+        dbWriteTransaction {
+            val replayed = findReplayedTransfer(transferRequest, requestHash)
+            if (replayed != null) {
+                logger.debug("Taler replays payment request ${transferRequest.request_uid}")
+                return@dbWriteTransaction replayed
             }
+            val exchangeBankAccount = NexusBankAccountEntity[exchangeBankAccountId]
+            // Joins this transaction: the payment and its request are stored together.
+            val pain001 = addPaymentInitiation(
+                Pain001Data(
+                    creditorIban = creditorData.iban,
+                    creditorBic = creditorData.bic,
+                    creditorName = creditorData.name,
+                    subject = transferRequest.wtid,
+                    sum = amountObj.amount,
+                    currency = amountObj.currency
+                ),
+                exchangeBankAccount
+            )
+            logger.debug("Taler requests payment: ${transferRequest.wtid}")
+            val row = TalerRequestedPaymentEntity.new {
+                preparedPayment = pain001 // not really used/needed, just here to silence warnings
+                exchangeBaseUrl = transferRequest.exchange_base_url
+                requestUId = transferRequest.request_uid
+                this.requestHash = requestHash
+                amount = transferRequest.amount
+                wtid = transferRequest.wtid
+                creditAccount = transferRequest.credit_account
+            }
+            row.id.value
         }
-        val exchangeBankAccount = getTalerFacadeBankAccount(expectNonNull(call.parameters["fcid"]))
-        val pain001 = addPaymentInitiation(
-            Pain001Data(
-                creditorIban = creditorData.iban,
-                creditorBic = creditorData.bic,
-                creditorName = creditorData.name,
-                subject = transferRequest.wtid,
-                sum = amountObj.amount,
-                currency = amountObj.currency
-            ),
-            exchangeBankAccount
-        )
-        logger.debug("Taler requests payment: ${transferRequest.wtid}")
-        val row = TalerRequestedPaymentEntity.new {
-            preparedPayment = pain001 // not really used/needed, just here to silence warnings
-            exchangeBaseUrl = transferRequest.exchange_base_url
-            requestUId = transferRequest.request_uid
-            amount = transferRequest.amount
-            wtid = transferRequest.wtid
-            creditAccount = transferRequest.credit_account
-        }
-        row.id.value
+    } catch (e: ExposedSQLException) {
+        // A concurrent request with the same request_uid was stored first:
+        // answer as for a replay of it, which rolled this one back.
+        dbTransaction { findReplayedTransfer(transferRequest, requestHash) } ?: throw e
     }
     return call.respond(
         TextContent(
@@ -307,12 +375,12 @@ private suspend fun talerTransfer(call: ApplicationCall) {
 private suspend fun talerAddIncoming(call: ApplicationCall, httpClient: HttpClient): Unit {
     val addIncomingData = call.receive<TalerAdminAddIncoming>()
     val debtor = parsePayto(addIncomingData.debit_account)
-    val res = transaction {
+    val res = dbTransaction {
         val user = authenticateRequest(call.request)
         val facadeID = expectNonNull(call.parameters["fcid"])
         val facadeState = getTalerFacadeState(facadeID)
         val facadeBankAccount = getTalerFacadeBankAccount(facadeID)
-        return@transaction object {
+        return@dbTransaction object {
             val facadeLastSeen = facadeState.highestSeenMsgID
             val facadeIban = facadeBankAccount.iban
             val facadeBic = facadeBankAccount.bankCode
@@ -461,7 +529,7 @@ private suspend fun historyOutgoing(call: ApplicationCall) {
     val startCmpOp = getComparisonOperator(delta, start, TalerRequestedPayments)
     /* retrieve database elements */
     val history = TalerOutgoingHistory()
-    transaction {
+    dbTransaction {
         val user = authenticateRequest(call.request)
 
         /** Retrieve all the outgoing payments from the _clean Taler outgoing table_ */
@@ -495,7 +563,7 @@ private suspend fun historyOutgoing(call: ApplicationCall) {
             }
         }
     }
-    call.respond(TextContent(customConverter(history), ContentType.Application.Json))
+    call.respondJsonStream(history)
 }
 
 /**
@@ -511,7 +579,7 @@ private suspend fun historyIncoming(call: ApplicationCall): Unit {
     val start: Long = handleStartArgument(call.request.queryParameters["start"], delta)
     val history = TalerIncomingHistory()
     val startCmpOp = getComparisonOperator(delta, start, TalerIncomingPayments)
-    transaction {
+    dbTransaction {
         val orderedPayments = TalerIncomingPaymentEntity.find {
             startCmpOp
         }.orderTaler(delta)
@@ -535,7 +603,7 @@ private suspend fun historyIncoming(call: ApplicationCall): Unit {
             }
         }
     }
-    return call.respond(TextContent(customConverter(history), ContentType.Application.Json))
+    return call.respondJsonStream(history)
 }
 
 fun talerFacadeRoutes(route: Route, httpClient: HttpClient) {
@@ -23,19 +23,30 @@ import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
 import io.ktor.application.ApplicationCall
 import io.ktor.client.HttpClient
 import io.ktor.http.HttpStatusCode
+import kotlinx.coroutines.Dispatchers
+import kotlinx.coroutines.async
+import kotlinx.coroutines.awaitAll
+import kotlinx.coroutines.coroutineScope
+import kotlinx.coroutines.sync.Semaphore
+import kotlinx.coroutines.sync.withPermit
 import org.jetbrains.exposed.sql.*
 import org.jetbrains.exposed.sql.transactions.transaction
-import org.w3c.dom.Document
 import tech.libeufin.nexus.*
 import tech.libeufin.nexus.ebics.fetchEbicsBySpec
 import tech.libeufin.nexus.ebics.submitEbicsPaymentInitiation
+import tech.libeufin.nexus.iso20022.CamtBankAccountEntry
+import tech.libeufin.nexus.iso20022.CamtParseResult
 import tech.libeufin.nexus.iso20022.CamtParsingError
+import tech.libeufin.nexus.iso20022.CamtStreamReader
 import tech.libeufin.nexus.iso20022.CreditDebitIndicator
-import tech.libeufin.nexus.iso20022.parseCamtMessage
+import tech.libeufin.nexus.server.FetchAllResultJson
 import tech.libeufin.nexus.server.FetchSpecJson
 import tech.libeufin.nexus.server.Pain001Data
 import tech.libeufin.nexus.server.requireBankConnection
-import tech.libeufin.util.XMLUtil
+import tech.libeufin.util.logStageTiming
+import tech.libeufin.util.unzipBytesWithLambda
+import java.io.ByteArrayInputStream
+import java.io.InputStream
 import java.time.Instant
 import java.time.ZonedDateTime
 import java.time.format.DateTimeFormatter
@@ -54,7 +65,7 @@ fun requireBankAccount(call: ApplicationCall, parameterKey: String): NexusBankAc
 
 
 suspend fun submitPaymentInitiation(httpClient: HttpClient, paymentInitiationId: Long) {
-    val r = transaction {
+    val r = dbTransaction {
         val paymentInitiation = PaymentInitiationEntity.findById(paymentInitiationId)
         if (paymentInitiation == null) {
             throw NexusError(HttpStatusCode.NotFound, "prepared payment not found")
@@ -67,12 +78,87 @@ suspend fun submitPaymentInitiation(httpClient: HttpClient, paymentInitiationId:
     if (r.submitted) {
         return
     }
-    when (r.type) {
-        null -> throw NexusError(HttpStatusCode.NotFound, "no default bank connection")
-        "ebics" -> submitEbicsPaymentInitiation(httpClient, paymentInitiationId)
+    if (r.type == null) {
+        throw NexusError(HttpStatusCode.NotFound, "no default bank connection")
+    }
+    // Other nodes, or concurrent requests, may try to submit it too.
+    if (!dbWriteWork { claimPaymentSubmission(paymentInitiationId) }) {
+        val submitted = dbTransaction { PaymentInitiationEntity.findById(paymentInitiationId)?.submitted }
+        if (submitted == true) {
+            return
+        }
+        throw NexusError(HttpStatusCode.Conflict, "payment initiation is being submitted already")
+    }
+    try {
+        when (r.type) {
+            "ebics" -> submitEbicsPaymentInitiation(httpClient, paymentInitiationId)
+        }
+    } finally {
+        dbWriteWork { releasePaymentSubmission(paymentInitiationId) }
     }
 }
 
+/**
+ * Which payment initiations of one bank account to list.  Null
+ * filters let everything through.
+ *
+ * @param preparedFrom earliest preparation time, in milliseconds, included.
+ * @param preparedTo latest preparation time, in milliseconds, excluded.
+ * @param start only payment initiations with a greater id are listed, so
+ *        that the next page starts after the last id of the current one.
+ * @param limit page size.
+ */
+data class PaymentInitiationFilter(
+    val submitted: Boolean? = null,
+    val confirmed: Boolean? = null,
+    val preparedFrom: Long? = null,
+    val preparedTo: Long? = null,
+    val start: Long? = null,
+    val limit: Int = 100
+)
+
+/**
+ * Payment initiations of the bank account matching 'filter', by
+ * increasing id.  Needs to be called within a transaction block.
+ */
+fun findPaymentInitiations(
+    bankAccountId: String,
+    filter: PaymentInitiationFilter
+): SizedIterable<PaymentInitiationEntity> {
+    return PaymentInitiationEntity.find {
+        var cond: Op<Boolean> = PaymentInitiationsTable.bankAccount eq bankAccountId
+        if (filter.submitted != null) {
+            cond = cond and (PaymentInitiationsTable.submitted eq filter.submitted)
+        }
+        when (filter.confirmed) {
+            true -> cond = cond and PaymentInitiationsTable.confirmationTransaction.isNotNull()
+            false -> cond = cond and PaymentInitiationsTable.confirmationTransaction.isNull()
+        }
+        if (filter.preparedFrom != null) {
+            cond = cond and (PaymentInitiationsTable.preparationDate greaterEq filter.preparedFrom)
+        }
+        if (filter.preparedTo != null) {
+            cond = cond and (PaymentInitiationsTable.preparationDate less filter.preparedTo)
+        }
+        if (filter.start != null) {
+            cond = cond and (PaymentInitiationsTable.id greater filter.start)
+        }
+        cond
+    }.orderBy(PaymentInitiationsTable.id to SortOrder.ASC)
+        .limit(filter.limit)
+}
+
+/**
+ * Payment initiations of the bank account that were not submitted
+ * yet, by increasing id.  Needs to be called within a transaction block.
+ */
+fun findPendingPaymentInitiations(bankAccountId: String): SizedIterable<PaymentInitiationEntity> {
+    return PaymentInitiationEntity.find {
+        (PaymentInitiationsTable.bankAccount eq bankAccountId) and
+                (PaymentInitiationsTable.submitted eq false)
+    }.orderBy(PaymentInitiationsTable.id to SortOrder.ASC)
+}
+
 /**
  * Submit all pending prepared payments.
  */
@@ -82,10 +168,8 @@ suspend fun submitAllPaymentInitiations(httpClient: HttpClient, accountid: Strin
     )
     logger.debug("auto-submitter started")
     val workQueue = mutableListOf<Submission>()
-    transaction {
-        PaymentInitiationEntity.find {
-            PaymentInitiationsTable.submitted eq false
-        }.forEach {
+    dbTransaction {
+        findPendingPaymentInitiations(accountid).forEach {
             val defaultBankConnectionId = it.bankAccount.defaultBankConnection?.id ?: throw NexusError(
                 HttpStatusCode.BadRequest,
                 "needs default bank connection"
@@ -102,27 +186,50 @@ suspend fun submitAllPaymentInitiations(httpClient: HttpClient, accountid: Strin
         }
     }
     workQueue.forEach {
-        submitPaymentInitiation(httpClient, it.id)
+        try {
+            submitPaymentInitiation(httpClient, it.id)
+        } catch (e: NexusError) {
+            if (e.statusCode != HttpStatusCode.Conflict) {
+                throw e
+            }
+            logger.info("Payment initiation ${it.id} is being submitted elsewhere, skipping it")
+        }
     }
 }
 
 
 /**
- * Check if the transaction is already found in the database.
+ * Number of camt entries that are parsed, checked for duplicates
+ * and stored together.  Bounds the memory used by the ingestion,
+ * and stays below the SQLite limit of 999 query parameters.
  */
-private fun findDuplicate(bankAccountId: String, acctSvcrRef: String): NexusBankTransactionEntity? {
+const val CAMT_INGEST_BATCH_SIZE = 500
+
+/**
+ * Among the given account servicer references, return those whose
+ * transaction is already found in the database.
+ */
+private fun findDuplicates(bankAccountId: String, acctSvcrRefs: List<String>): MutableSet<String> {
     // FIXME: make this generic depending on transaction identification scheme
-    val ati = "AcctSvcrRef:$acctSvcrRef"
+    if (acctSvcrRefs.isEmpty()) {
+        return mutableSetOf()
+    }
+    val atis = acctSvcrRefs.map { "AcctSvcrRef:$it" }
     return transaction {
-        NexusBankTransactionEntity.find {
-            (NexusBankTransactionsTable.accountTransactionId eq ati) and (NexusBankTransactionsTable.bankAccount eq bankAccountId)
-        }.firstOrNull()
+        NexusBankTransactionsTable.slice(NexusBankTransactionsTable.accountTransactionId).select {
+            (NexusBankTransactionsTable.accountTransactionId inList atis) and
+                    (NexusBankTransactionsTable.bankAccount eq bankAccountId)
+        }.map { it[NexusBankTransactionsTable.accountTransactionId].removePrefix("AcctSvcrRef:") }.toMutableSet()
     }
 }
 
+/**
+ * Store the entries of a camt message in the database.  The message
+ * is parsed while it is read, CAMT_INGEST_BATCH_SIZE entries at a time.
+ */
 fun processCamtMessage(
     bankAccountId: String,
-    camtDoc: Document,
+    camtStream: InputStream,
     code: String
 ) {
     logger.info("processing CAMT message")
@@ -131,45 +238,77 @@ fun processCamtMessage(
         if (acct == null) {
             throw NexusError(HttpStatusCode.NotFound, "user not found")
         }
-        val res = try {
-            parseCamtMessage(camtDoc)
+        try {
+            CamtStreamReader(camtStream).use {
+                ingestCamtEntries(acct, it.creationDateTime, it.entries().iterator(), code)
+            }
         } catch (e: CamtParsingError) {
             throw NexusError(
                 HttpStatusCode.BadGateway,
                 "Invalid CAMT received from bank"
             )
         }
-        val stamp = ZonedDateTime.parse(res.creationDateTime, DateTimeFormatter.ISO_DATE_TIME).toInstant().toEpochMilli()
-        when (code) {
-            "C52" -> {
-                val s = acct.lastReportCreationTimestamp
-                if (s != null && stamp > s) {
-                    acct.lastReportCreationTimestamp = stamp
-                }
-            }
-            "C53" -> {
-                val s = acct.lastStatementCreationTimestamp
-                if (s != null && stamp > s) {
-                    acct.lastStatementCreationTimestamp = stamp
-                }
-            }
+    }
+}
+
+/**
+ * Like processCamtMessage(), for a message that was parsed already.
+ * Needs to be called within a transaction block.
+ */
+fun processParsedCamtMessage(acct: NexusBankAccountEntity, camt: CamtParseResult, code: String) {
+    ingestCamtEntries(acct, camt.creationDateTime, camt.reports.flatMap { it.entries }.iterator(), code)
+}
+
+private fun ingestCamtEntries(
+    acct: NexusBankAccountEntity,
+    creationDateTime: String,
+    entries: Iterator<CamtBankAccountEntry>,
+    code: String
+) {
+    val stamp = ZonedDateTime.parse(creationDateTime, DateTimeFormatter.ISO_DATE_TIME).toInstant().toEpochMilli()
+    // The watermarks only move forward, and are written in the same
+    // database transaction as the entries of the message.
+    when (code) {
+        "C52" -> {
+            acct.lastReportCreationTimestamp = maxOf(acct.lastReportCreationTimestamp ?: stamp, stamp)
         }
+        "C53" -> {
+            acct.lastStatementCreationTimestamp = maxOf(acct.lastStatementCreationTimestamp ?: stamp, stamp)
+        }
+    }
 
-        val entries = res.reports.map { it.entries }.flatten()
-        logger.info("found ${entries.size} transactions")
-        txloop@ for (tx in entries) {
+    var numEntries = 0
+    var numNewEntries = 0
+    while (true) {
+        val batch = logStageTiming("camt-stream-parse") {
+            val ret = mutableListOf<CamtBankAccountEntry>()
+            while (ret.size < CAMT_INGEST_BATCH_SIZE && entries.hasNext()) {
+                ret.add(entries.next())
+            }
+            ret
+        }
+        if (batch.isEmpty()) {
+            break
+        }
+        numEntries += batch.size
+        // Grows with the references stored below, so that an entry
+        // repeated within the batch is caught as well.
+        val knownRefs = findDuplicates(acct.id.value, batch.mapNotNull { it.accountServicerRef })
+        for (tx in batch) {
             val acctSvcrRef = tx.accountServicerRef
             if (acctSvcrRef == null) {
                 // FIXME(dold): Report this!
                 logger.error("missing account servicer reference in transaction")
                 continue
             }
-            val duplicate = findDuplicate(bankAccountId, acctSvcrRef)
-            if (duplicate != null) {
+            if (!knownRefs.add(acctSvcrRef)) {
+                // Fetch windows overlap, so already known entries are
+                // expected; the new ones may come after them.
                 // FIXME(dold): See if an old transaction needs to be superseded by this one
                 // https://bugs.gnunet.org/view.php?id=6381
-                break
+                continue
             }
+            numNewEntries++
 
             val rawEntity = NexusBankTransactionEntity.new {
                 bankAccount = acct
@@ -200,6 +339,7 @@ fun processCamtMessage(
             }
         }
     }
+    logger.info("found $numEntries transactions, $numNewEntries of them new")
 }
 
 /**
@@ -225,14 +365,92 @@ fun ingestBankMessagesIntoAccount(
                     (NexusBankMessagesTable.id greater acct.highestSeenBankMessageId)
         }.orderBy(Pair(NexusBankMessagesTable.id, SortOrder.ASC)).forEach {
             // FIXME: check if it's CAMT first!
-            val doc = XMLUtil.parseStringIntoDom(it.message.bytes.toString(Charsets.UTF_8))
-            processCamtMessage(bankAccountId, doc, it.code)
+            // Includes the "camt-stream-parse" stage.
+            logStageTiming("camt-ingest") {
+                it.openContent().use { content -> processCamtMessage(bankAccountId, content, it.code) }
+            }
             lastId = it.id.value
         }
         acct.highestSeenBankMessageId = lastId
     }
 }
 
+/**
+ * Number of camt documents of one download that are parsed in
+ * parallel, and then stored and ingested in one transaction.
+ */
+const val CAMT_STORE_BATCH_SIZE = 32
+
+private fun parseCamtDocument(document: ByteArray): CamtParseResult {
+    return try {
+        CamtStreamReader(ByteArrayInputStream(document)).use { it.readAll() }
+    } catch (e: CamtParsingError) {
+        throw NexusError(
+            HttpStatusCode.BadGateway,
+            "Invalid CAMT received from bank"
+        )
+    }
+}
+
+/**
+ * Store the camt documents of a downloaded ZIP file as bank messages,
+ * and ingest them into the account.  Each document is parsed only once.
+ * The documents are parsed and compressed in parallel, CAMT_STORE_BATCH_SIZE
+ * at a time, and then stored and ingested in their original order, one
+ * transaction per batch.  Documents whose message ID is known already are
+ * skipped.
+ */
+suspend fun storeAndIngestCamtZip(
+    bankConnectionId: String,
+    bankAccountId: String,
+    code: String,
+    zip: ByteArray
+) {
+    // The account's watermark only moves forward: messages
+    // stored earlier must be ingested first.
+    dbWriteWork { ingestBankMessagesIntoAccount(bankConnectionId, bankAccountId) }
+    val documents = mutableListOf<ByteArray>()
+    zip.unzipBytesWithLambda { documents.add(it.second) }
+    for (batch in documents.chunked(CAMT_STORE_BATCH_SIZE)) {
+        val parsed = logStageTiming("camt-parse") {
+            coroutineScope {
+                batch.map { document ->
+                    async(Dispatchers.Default) {
+                        Pair(compressBankMessage(document), parseCamtDocument(document))
+                    }
+                }.awaitAll()
+            }
+        }
+        dbWriteTransaction {
+            val conn = NexusBankConnectionEntity.findById(bankConnectionId) ?: throw NexusError(
+                HttpStatusCode.InternalServerError,
+                "bank connection missing"
+            )
+            val acct = NexusBankAccountEntity.findById(bankAccountId) ?: throw NexusError(
+                HttpStatusCode.InternalServerError,
+                "account not found"
+            )
+            val stored = logStageTiming("bank-message-store") {
+                val knownIds = NexusBankMessagesTable.slice(NexusBankMessagesTable.messageId).select {
+                    NexusBankMessagesTable.messageId inList parsed.map { it.second.messageId }
+                }.map { it[NexusBankMessagesTable.messageId] }.toMutableSet()
+                parsed.filter { knownIds.add(it.second.messageId) }.map { (compressed, camt) ->
+                    logger.info("msg id ${camt.messageId}")
+                    val msg = storeBankMessage(conn, code, camt.messageId, compressed)
+                    Pair(msg, camt)
+                }
+            }
+            // Includes the "camt-stream-parse" stage.
+            logStageTiming("camt-ingest") {
+                for ((msg, camt) in stored) {
+                    processParsedCamtMessage(acct, camt, code)
+                    acct.highestSeenBankMessageId = msg.id.value
+                }
+            }
+        }
+    }
+}
+
 /**
  * Retrieve payment initiation from database, raising exception if not found.
  */
@@ -276,12 +494,32 @@ fun addPaymentInitiation(paymentData: Pain001Data, debitorAccount: NexusBankAcco
     }
 }
 
+/**
+ * Outcome of fetching the transactions of one bank account.
+ *
+ * @param newTransactions number of transactions the fetch added.
+ * @param errors one description for each part of the fetch that
+ *        failed, empty on success.
+ */
+data class FetchOutcome(
+    val newTransactions: Int,
+    val errors: List<String>
+)
+
+private fun countBankAccountTransactions(accountId: String): Int {
+    return transaction {
+        NexusBankTransactionsTable.select {
+            NexusBankTransactionsTable.bankAccount eq accountId
+        }.count().toInt()
+    }
+}
+
 suspend fun fetchBankAccountTransactions(
     client: HttpClient,
     fetchSpec: FetchSpecJson,
     accountId: String
-) {
-    val res = transaction {
+): FetchOutcome {
+    val res = dbTransaction {
         val acct = NexusBankAccountEntity.findById(accountId)
         if (acct == null) {
             throw NexusError(
@@ -296,12 +534,13 @@ suspend fun fetchBankAccountTransactions(
                 "No default bank connection (explicit connection not yet supported)"
             )
         }
-        return@transaction object {
+        return@dbTransaction object {
             val connectionType = conn.type
             val connectionName = conn.id.value
         }
     }
-    when (res.connectionType) {
+    val numTransactionsBefore = dbWork { countBankAccountTransactions(accountId) }
+    val errors = when (res.connectionType) {
         "ebics" -> {
             fetchEbicsBySpec(
                 fetchSpec,
@@ -315,8 +554,97 @@ suspend fun fetchBankAccountTransactions(
             "Connection type '${res.connectionType}' not implemented"
         )
     }
-    ingestBankMessagesIntoAccount(res.connectionName, accountId)
-    ingestTalerTransactions()
+    dbWriteWork {
+        ingestBankMessagesIntoAccount(res.connectionName, accountId)
+        logStageTiming("taler-ingest") {
+            ingestTalerTransactions()
+        }
+    }
+    val numTransactionsAfter = dbWork { countBankAccountTransactions(accountId) }
+    return FetchOutcome(numTransactionsAfter - numTransactionsBefore, errors)
+}
+
+/**
+ * Bank host an account is fetched from, used to cap the number of
+ * concurrent fetches per bank.  Needs to be called within a
+ * transaction block.
+ */
+private fun bankHostOfAccount(acct: NexusBankAccountEntity): String {
+    val conn = acct.defaultBankConnection ?: return "none"
+    return when (conn.type) {
+        "ebics" -> {
+            val subscriber = EbicsSubscriberEntity.find {
+                EbicsSubscribersTable.nexusBankConnection eq conn.id
+            }.firstOrNull()
+            subscriber?.let { bankHostOf(it.ebicsURL) } ?: conn.id.value
+        }
+        else -> conn.type
+    }
+}
+
+/**
+ * Ids of the bank accounts whose default bank connection belongs
+ * to 'userId', sorted.  Needs to be called within a transaction block.
+ */
+fun findUserBankAccountIds(userId: String): List<String> {
+    val accounts = NexusBankAccountsTable
+    val connections = NexusBankConnectionsTable
+    return Join(accounts, connections, JoinType.INNER, accounts.defaultBankConnection, connections.id)
+        .slice(accounts.id)
+        .select { connections.owner eq userId }
+        .orderBy(accounts.id to SortOrder.ASC)
+        .map { it[accounts.id].value }
+}
+
+/**
+ * Fetch the transactions of several bank accounts.  At most
+ * 'maxConcurrency' accounts are fetched at the same time, and at most
+ * 'maxConcurrencyPerBankHost' of them from the same bank.  A failing
+ * account does not stop the others.
+ */
+suspend fun fetchBankAccountsTransactions(
+    client: HttpClient,
+    fetchSpec: FetchSpecJson,
+    accountIds: List<String>,
+    maxConcurrency: Int,
+    maxConcurrencyPerBankHost: Int
+): List<FetchAllResultJson> {
+    val hosts = dbTransaction {
+        accountIds.associateWith { accountId ->
+            NexusBankAccountEntity.findById(accountId)?.let { bankHostOfAccount(it) } ?: "none"
+        }
+    }
+    val permits = Semaphore(maxConcurrency)
+    val hostPermits = hosts.values.distinct().associateWith { Semaphore(maxConcurrencyPerBankHost) }
+    return coroutineScope {
+        accountIds.map { accountId ->
+            async(Dispatchers.IO) {
+                // The bank host permit is taken first, so that accounts
+                // waiting for a busy bank do not hold a global slot.
+                hostPermits.getValue(hosts.getValue(accountId)).withPermit {
+                    permits.withPermit {
+                        val start = System.nanoTime()
+                        val outcome = try {
+                            fetchBankAccountTransactions(client, fetchSpec, accountId)
+                        } catch (e: NexusError) {
+                            FetchOutcome(0, listOf(e.reason))
+                        } catch (e: Exception) {
+                            logger.error("Fetching transactions of '$accountId' failed", e)
+                            FetchOutcome(0, listOf(e.toString()))
+                        }
+                        FetchAllResultJson(
+                            bankAccount = accountId,
+                            bankHost = hosts.getValue(accountId),
+                            succeeded = outcome.errors.isEmpty(),
+                            newTransactions = outcome.newTransactions,
+                            errors = outcome.errors,
+                            durationMillis = (System.nanoTime() - start) / 1000000
+                        )
+                    }
+                }
+            }
+        }.awaitAll()
+    }
 }
 
 fun importBankAccount(call: ApplicationCall, offeredBankAccountId: String, nexusBankAccountId: String) {
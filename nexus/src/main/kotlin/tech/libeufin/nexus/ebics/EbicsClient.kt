@@ -24,29 +24,79 @@ package tech.libeufin.nexus.ebics
 
 import io.ktor.client.HttpClient
 import io.ktor.client.request.post
+import io.ktor.client.statement.HttpResponse
+import io.ktor.client.statement.readText
 import io.ktor.http.HttpStatusCode
+import kotlinx.coroutines.CancellationException
+import kotlinx.coroutines.TimeoutCancellationException
+import kotlinx.coroutines.delay
+import kotlinx.coroutines.withTimeout
+import tech.libeufin.nexus.BankHttpMetrics
 import tech.libeufin.nexus.NexusError
+import tech.libeufin.nexus.bankHostOf
+import tech.libeufin.nexus.bankHttpConfig
+import tech.libeufin.nexus.bankRetryBackoff
+import tech.libeufin.nexus.ebicsTrafficRecorder
 import tech.libeufin.util.*
 import java.util.*
 
-private suspend inline fun HttpClient.postToBank(url: String, body: String): String {
+/**
+ * Post one EBICS document to the bank.  Requests marked as 'idempotent'
+ * (HEV, download transfer segments) are retried with jittered exponential
+ * backoff on network errors, timeouts and 5xx responses, according to the
+ * client's BankHttpConfig.  Every attempt is accounted in BankHttpMetrics,
+ * and recorded if the client has an EbicsTrafficRecorder.
+ */
+private suspend fun HttpClient.postToBank(url: String, body: String, idempotent: Boolean = false): String {
     logger.debug("Posting: $body")
     if (!XMLUtil.validateFromString(body)) throw NexusError(
         HttpStatusCode.InternalServerError, "EBICS (outgoing) document is invalid"
     )
-    val response: String = try {
-        this.post<String>(
-            urlString = url,
-            block = {
-                this.body = body
+    val config = this.bankHttpConfig
+    val host = bankHostOf(url)
+    val recorder = this.ebicsTrafficRecorder
+    val maxAttempts = if (idempotent) config.maxRetries + 1 else 1
+    var attempt = 0
+    while (true) {
+        attempt++
+        val start = System.nanoTime()
+        val response: HttpResponse? = try {
+            withTimeout(config.requestTimeout) {
+                this@postToBank.post<HttpResponse>(
+                    urlString = url,
+                    block = {
+                        this.body = body
+                    }
+                )
             }
-        )
-    } catch (e: Exception) {
-        logger.warn("Exception during request", e)
-        throw NexusError(HttpStatusCode.InternalServerError, "Cannot reach the bank")
+        } catch (e: TimeoutCancellationException) {
+            logger.warn("Request to $host timed out after ${config.requestTimeout}ms (attempt $attempt/$maxAttempts)")
+            null
+        } catch (e: CancellationException) {
+            throw e
+        } catch (e: Exception) {
+            logger.warn("Exception during request to $host (attempt $attempt/$maxAttempts)", e)
+            null
+        }
+        val failed = response == null || response.status.value >= 500
+        val micros = (System.nanoTime() - start) / 1000
+        BankHttpMetrics.recordAttempt(host, micros, failed)
+        if (!failed || attempt >= maxAttempts) {
+            if (response == null) {
+                recorder?.record(url, attempt, start, micros, null, body, null)
+                throw NexusError(HttpStatusCode.InternalServerError, "Cannot reach the bank")
+            }
+            val responseText = response.readText()
+            recorder?.record(url, attempt, start, micros, response.status.value, body, responseText)
+            logger.debug("Receiving: $responseText")
+            return responseText
+        }
+        recorder?.record(url, attempt, start, micros, response?.status?.value, body, null)
+        val backoff = bankRetryBackoff(attempt, config)
+        logger.info("Retrying request to $host in ${backoff}ms")
+        BankHttpMetrics.recordRetry(host)
+        delay(backoff)
     }
-    logger.debug("Receiving: $response")
-    return response
 }
 
 sealed class EbicsDownloadResult
@@ -127,7 +177,7 @@ suspend fun doEbicsDownloadTransaction(
     for (x in 2 .. numSegments) {
         val transferReqStr =
             createEbicsRequestForDownloadTransferPhase(subscriberDetails, transactionID, x, numSegments)
-        val transferResponseStr = client.postToBank(subscriberDetails.ebicsUrl, transferReqStr)
+        val transferResponseStr = client.postToBank(subscriberDetails.ebicsUrl, transferReqStr, idempotent = true)
         val transferResponse = parseAndValidateEbicsResponse(subscriberDetails, transferResponseStr)
         when (transferResponse.technicalReturnCode) {
             EbicsReturnCode.EBICS_OK -> {
@@ -157,7 +207,9 @@ suspend fun doEbicsDownloadTransaction(
         payloadChunks.add(transferOrderDataEncChunk)
     }
 
-    val respPayload = decryptAndDecompressResponse(subscriberDetails, encryptionInfo, payloadChunks)
+    val respPayload = logStageTiming("ebics-decrypt") {
+        decryptAndDecompressResponse(subscriberDetails, encryptionInfo, payloadChunks)
+    }
 
     // Acknowledgement phase
 
@@ -188,7 +240,11 @@ suspend fun doEbicsUploadTransaction(
     if (subscriberDetails.bankEncPub == null) {
         throw NexusError(HttpStatusCode.BadRequest, "bank encryption key unknown, request HPB first")
     }
-    val preparedUploadData = prepareUploadPayload(subscriberDetails, payload)
+    val preparedUploadData = prepareUploadPayload(
+        subscriberDetails,
+        payload,
+        client.bankHttpConfig.ebicsUploadSegmentSize
+    )
     val req = createEbicsRequestForUploadInitialization(subscriberDetails, orderType, orderParams, preparedUploadData)
     val responseStr = client.postToBank(subscriberDetails.ebicsUrl, req)
 
@@ -204,34 +260,35 @@ suspend fun doEbicsUploadTransaction(
         )
 
     logger.debug("INIT phase passed!")
-    /* now send actual payload */
-
-    val tmp = createEbicsRequestForUploadTransferPhase(
-        subscriberDetails,
-        transactionID,
-        preparedUploadData,
-        0
-    )
+    /* now send actual payload, one segment per request */
+    for (chunkIndex in 0 until preparedUploadData.numSegments) {
+        val tmp = createEbicsRequestForUploadTransferPhase(
+            subscriberDetails,
+            transactionID,
+            preparedUploadData,
+            chunkIndex
+        )
 
-    val txRespStr = client.postToBank(
-        subscriberDetails.ebicsUrl,
-        tmp
-    )
+        val txRespStr = client.postToBank(
+            subscriberDetails.ebicsUrl,
+            tmp
+        )
 
-    val txResp = parseAndValidateEbicsResponse(subscriberDetails, txRespStr)
+        val txResp = parseAndValidateEbicsResponse(subscriberDetails, txRespStr)
 
-    when (txResp.technicalReturnCode) {
-        EbicsReturnCode.EBICS_OK -> {
-        }
-        else -> {
-            throw NexusError(HttpStatusCode.InternalServerError, "unexpected return code")
+        when (txResp.technicalReturnCode) {
+            EbicsReturnCode.EBICS_OK -> {
+            }
+            else -> {
+                throw NexusError(HttpStatusCode.InternalServerError, "unexpected return code")
+            }
         }
     }
 }
 
 suspend fun doEbicsHostVersionQuery(client: HttpClient, ebicsBaseUrl: String, ebicsHostId: String): EbicsHevDetails {
     val ebicsHevRequest = makeEbicsHEVRequestRaw(ebicsHostId)
-    val resp = client.postToBank(ebicsBaseUrl, ebicsHevRequest)
+    val resp = client.postToBank(ebicsBaseUrl, ebicsHevRequest, idempotent = true)
     val versionDetails = parseEbicsHEVResponse(resp)
     return versionDetails
 }
@@ -23,6 +23,7 @@
  */
 package tech.libeufin.nexus.ebics
 
+import com.fasterxml.jackson.core.JsonProcessingException
 import com.fasterxml.jackson.databind.JsonNode
 import com.fasterxml.jackson.databind.ObjectMapper
 import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
@@ -40,10 +41,14 @@ import io.ktor.response.respond
 import io.ktor.response.respondText
 import io.ktor.routing.Route
 import io.ktor.routing.post
+import kotlinx.coroutines.async
+import kotlinx.coroutines.awaitAll
+import kotlinx.coroutines.coroutineScope
 import org.jetbrains.exposed.sql.insert
 import org.jetbrains.exposed.sql.statements.api.ExposedBlob
 import org.jetbrains.exposed.sql.transactions.transaction
 import tech.libeufin.nexus.*
+import tech.libeufin.nexus.bankaccount.storeAndIngestCamtZip
 import tech.libeufin.nexus.iso20022.NexusPaymentInitiationData
 import tech.libeufin.nexus.iso20022.createPain001document
 import tech.libeufin.nexus.logger
@@ -54,6 +59,7 @@ import tech.libeufin.util.ebics_h004.HTDResponseOrderData
 import java.io.ByteArrayOutputStream
 import java.security.interfaces.RSAPrivateCrtKey
 import java.security.interfaces.RSAPublicKey
+import java.time.Duration
 import java.time.Instant
 import java.time.LocalDateTime
 import java.time.ZoneOffset
@@ -68,14 +74,22 @@ private data class EbicsFetchSpec(
     val orderParams: EbicsOrderParams
 )
 
+/**
+ * Fetch the C52 / C53 messages asked by 'fetchSpec' and ingest them into
+ * the account.  The order types are downloaded concurrently, but stored
+ * and ingested one after the other, in the order C52, C53.  A failing
+ * order type does not stop the others.
+ *
+ * @return one description for each order type that failed.
+ */
 suspend fun fetchEbicsBySpec(
     fetchSpec: FetchSpecJson,
     client: HttpClient,
     bankConnectionId: String,
     accountId: String
-) {
-    val subscriberDetails = transaction { getEbicsSubscriberDetails(bankConnectionId) }
-    val lastTimes = transaction {
+): List<String> {
+    val subscriberDetails = dbTransaction { getEbicsSubscriberDetails(bankConnectionId) }
+    val lastTimes = dbTransaction {
         val acct = NexusBankAccountEntity.findById(accountId)
         if (acct == null) {
             throw NexusError(
@@ -124,22 +138,9 @@ suspend fun fetchEbicsBySpec(
             addForLevel(fetchSpec.level, p)
         }
         is FetchSpecSinceLastJson -> {
-            val pRep = EbicsStandardOrderParams(
-                EbicsDateRange(
-                    lastTimes.lastReport ?: ZonedDateTime.ofInstant(
-                        Instant.EPOCH,
-                        ZoneOffset.UTC
-                    ), ZonedDateTime.now(ZoneOffset.UTC)
-                )
-            )
-            val pStmt = EbicsStandardOrderParams(
-                EbicsDateRange(
-                    lastTimes.lastStatement ?: ZonedDateTime.ofInstant(
-                        Instant.EPOCH,
-                        ZoneOffset.UTC
-                    ), ZonedDateTime.now(ZoneOffset.UTC)
-                )
-            )
+            val now = ZonedDateTime.now(ZoneOffset.UTC)
+            val pRep = EbicsStandardOrderParams(EbicsDateRange(sinceLastStart(lastTimes.lastReport), now))
+            val pStmt = EbicsStandardOrderParams(EbicsDateRange(sinceLastStart(lastTimes.lastStatement), now))
             when (fetchSpec.level) {
                 FetchLevel.ALL -> {
                     specs.add(EbicsFetchSpec("C52", pRep))
@@ -154,31 +155,90 @@ suspend fun fetchEbicsBySpec(
             }
         }
     }
-    for (spec in specs) {
+    val downloads = downloadConcurrently(specs, { it.orderType }) { spec ->
+        downloadEbicsC5x(spec.orderType, client, spec.orderParams, subscriberDetails)
+    }
+    val errors = mutableListOf<String>()
+    for ((spec, download) in specs.zip(downloads)) {
+        val (orderData, error) = download
+        if (error != null) {
+            errors.add(error)
+            continue
+        }
+        if (orderData == null) {
+            continue
+        }
         try {
-            fetchEbicsC5x(spec.orderType, client, bankConnectionId, spec.orderParams, subscriberDetails)
+            storeAndIngestCamtZip(bankConnectionId, accountId, spec.orderType, orderData)
         } catch (e: Exception) {
             logger.warn("Ingestion failed for $spec", e)
+            errors.add("${spec.orderType}: ${describeFetchError(e)}")
         }
     }
+    return errors
 }
 
 /**
- * Fetch EBICS C5x and store it locally, but do not update bank accounts.
+ * Run the downloads of 'specs' concurrently.  Each one yields its
+ * order data (null if the bank had none), or the description of its
+ * failure prefixed by 'name': a failing download does not stop the
+ * others.  The results are in the order of 'specs'.
+ */
+internal suspend fun <S> downloadConcurrently(
+    specs: List<S>,
+    name: (S) -> String,
+    download: suspend (S) -> ByteArray?
+): List<Pair<ByteArray?, String?>> {
+    return coroutineScope {
+        specs.map { spec ->
+            async {
+                try {
+                    Pair(download(spec), null)
+                } catch (e: Exception) {
+                    logger.warn("Download failed for $spec", e)
+                    Pair(null, "${name(spec)}: ${describeFetchError(e)}")
+                }
+            }
+        }.awaitAll()
+    }
+}
+
+/**
+ * Bookings that the bank was still committing when it created the last
+ * message may carry an earlier date: the next window starts a bit before
+ * the creation time, and the entries fetched twice are skipped at ingestion.
+ */
+private val SINCE_LAST_OVERLAP = Duration.ofMinutes(10)
+
+/**
+ * Start of a "since-last" window, given the creation time of the newest
+ * message ingested so far (null if none was).
  */
-private suspend fun fetchEbicsC5x(
+private fun sinceLastStart(last: ZonedDateTime?): ZonedDateTime {
+    if (last == null) {
+        return ZonedDateTime.ofInstant(Instant.EPOCH, ZoneOffset.UTC)
+    }
+    return last.minus(SINCE_LAST_OVERLAP)
+}
+
+private fun describeFetchError(e: Exception): String {
+    return when (e) {
+        is NexusError -> e.reason
+        is EbicsProtocolError -> e.reason
+        else -> e.toString()
+    }
+}
+
+/**
+ * Download EBICS C5x, and return the ZIP file with its camt documents,
+ * or null if the bank has no data for the requested range.
+ */
+private suspend fun downloadEbicsC5x(
     historyType: String,
     client: HttpClient,
-    bankConnectionId: String,
     orderParams: EbicsOrderParams,
     subscriberDetails: EbicsClientSubscriberDetails
-) {
-    val response = doEbicsDownloadTransaction(
-        client,
-        subscriberDetails,
-        historyType,
-        orderParams
-    )
+): ByteArray? {
     when (historyType) {
         "C52" -> {
         }
@@ -188,31 +248,20 @@ private suspend fun fetchEbicsC5x(
             throw NexusError(HttpStatusCode.BadRequest, "history type '$historyType' not supported")
         }
     }
-    when (response) {
-        is EbicsDownloadSuccessResult -> {
-            response.orderData.unzipWithLambda {
-                logger.debug("Camt entry: ${it.second}")
-                val camt53doc = XMLUtil.parseStringIntoDom(it.second)
-                val msgId = camt53doc.pickStringWithRootNs("/*[1]/*[1]/root:GrpHdr/root:MsgId")
-                logger.info("msg id $msgId")
-                transaction {
-                    val conn = NexusBankConnectionEntity.findById(bankConnectionId)
-                    if (conn == null) {
-                        throw NexusError(HttpStatusCode.InternalServerError, "bank connection missing")
-                    }
-                    val oldMsg = NexusBankMessageEntity.find { NexusBankMessagesTable.messageId eq msgId }.firstOrNull()
-                    if (oldMsg == null) {
-                        NexusBankMessageEntity.new {
-                            this.bankConnection = conn
-                            this.code = historyType
-                            this.messageId = msgId
-                            this.message = ExposedBlob(it.second.toByteArray(Charsets.UTF_8))
-                        }
-                    }
-                }
-            }
-        }
+    val response = logStageTiming("ebics-download") {
+        doEbicsDownloadTransaction(
+            client,
+            subscriberDetails,
+            historyType,
+            orderParams
+        )
+    }
+    return when (response) {
+        is EbicsDownloadSuccessResult -> response.orderData
         is EbicsDownloadBankErrorResult -> {
+            if (response.returnCode == EbicsReturnCode.EBICS_NO_DOWNLOAD_DATA_AVAILABLE) {
+                return null
+            }
             throw NexusError(
                 HttpStatusCode.BadGateway,
                 response.returnCode.errorCode
@@ -222,52 +271,74 @@ private suspend fun fetchEbicsC5x(
 }
 
 
-fun createEbicsBankConnectionFromBackup(
-    bankConnectionName: String,
-    user: NexusUserEntity,
-    passphrase: String?,
-    backup: JsonNode
-) {
-    if (passphrase === null) {
-        throw NexusError(HttpStatusCode.BadRequest, "EBICS backup needs passphrase")
-    }
-    val bankConn = NexusBankConnectionEntity.new(bankConnectionName) {
-        owner = user
-        type = "ebics"
-    }
-    val ebicsBackup = jacksonObjectMapper().treeToValue(backup, EbicsKeysBackupJson::class.java)
-    val (authKey, encKey, sigKey) = try {
-        Triple(
-            CryptoUtil.decryptKey(
+/**
+ * EBICS backup whose keys were unlocked with the passphrase.
+ */
+class DecryptedEbicsBackup(
+    val backup: EbicsKeysBackupJson,
+    val authKey: RSAPrivateCrtKey,
+    val encKey: RSAPrivateCrtKey,
+    val sigKey: RSAPrivateCrtKey
+)
+
+/**
+ * Unlock the keys of an EBICS backup.  Does not touch the database,
+ * so that many backups can be decrypted in parallel.
+ */
+fun decryptEbicsBackup(passphrase: String, backup: JsonNode): DecryptedEbicsBackup {
+    val ebicsBackup = try {
+        jacksonObjectMapper().treeToValue(backup, EbicsKeysBackupJson::class.java)
+    } catch (e: JsonProcessingException) {
+        throw NexusError(HttpStatusCode.BadRequest, "Bad backup given")
+    }
+    return try {
+        DecryptedEbicsBackup(
+            ebicsBackup,
+            authKey = CryptoUtil.decryptKey(
                 EncryptedPrivateKeyInfo(base64ToBytes(ebicsBackup.authBlob)),
                 passphrase
             ),
-            CryptoUtil.decryptKey(
+            encKey = CryptoUtil.decryptKey(
                 EncryptedPrivateKeyInfo(base64ToBytes(ebicsBackup.encBlob)),
                 passphrase
             ),
-            CryptoUtil.decryptKey(
+            sigKey = CryptoUtil.decryptKey(
                 EncryptedPrivateKeyInfo(base64ToBytes(ebicsBackup.sigBlob)),
                 passphrase
             )
         )
     } catch (e: Exception) {
-        e.printStackTrace()
-        logger.info("Restoring keys failed, probably due to wrong passphrase")
+        logger.info("Restoring keys failed, probably due to wrong passphrase", e)
         throw NexusError(
             HttpStatusCode.BadRequest,
             "Bad backup given"
         )
     }
+}
+
+/**
+ * Make the bank connection of a decrypted backup.  Needs to be
+ * called within a transaction block.
+ */
+fun createEbicsBankConnectionFromDecryptedBackup(
+    bankConnectionName: String,
+    user: NexusUserEntity,
+    decrypted: DecryptedEbicsBackup
+) {
+    val bankConn = NexusBankConnectionEntity.new(bankConnectionName) {
+        owner = user
+        type = "ebics"
+    }
+    val ebicsBackup = decrypted.backup
     try {
         EbicsSubscriberEntity.new {
             ebicsURL = ebicsBackup.ebicsURL
             hostID = ebicsBackup.hostID
             partnerID = ebicsBackup.partnerID
             userID = ebicsBackup.userID
-            signaturePrivateKey = ExposedBlob(sigKey.encoded)
-            encryptionPrivateKey = ExposedBlob((encKey.encoded))
-            authenticationPrivateKey = ExposedBlob((authKey.encoded))
+            signaturePrivateKey = ExposedBlob(decrypted.sigKey.encoded)
+            encryptionPrivateKey = ExposedBlob((decrypted.encKey.encoded))
+            authenticationPrivateKey = ExposedBlob((decrypted.authKey.encoded))
             nexusBankConnection = bankConn
             ebicsIniState = EbicsInitState.UNKNOWN
             ebicsHiaState = EbicsInitState.UNKNOWN
@@ -278,7 +349,18 @@ fun createEbicsBankConnectionFromBackup(
             "exception: $e"
         )
     }
-    return
+}
+
+fun createEbicsBankConnectionFromBackup(
+    bankConnectionName: String,
+    user: NexusUserEntity,
+    passphrase: String?,
+    backup: JsonNode
+) {
+    if (passphrase === null) {
+        throw NexusError(HttpStatusCode.BadRequest, "EBICS backup needs passphrase")
+    }
+    createEbicsBankConnectionFromDecryptedBackup(bankConnectionName, user, decryptEbicsBackup(passphrase, backup))
 }
 
 private fun getEbicsSubscriberDetailsInternal(subscriber: EbicsSubscriberEntity): EbicsClientSubscriberDetails {
@@ -327,7 +409,7 @@ private fun getEbicsSubscriberDetails(bankConnectionId: String): EbicsClientSubs
 }
 
 suspend fun ebicsFetchAccounts(connId: String, client: HttpClient) {
-    val subscriberDetails = transaction {
+    val subscriberDetails = dbTransaction {
         getEbicsSubscriberDetails(connId)
     }
     val response = doEbicsDownloadTransaction(
@@ -344,7 +426,7 @@ suspend fun ebicsFetchAccounts(connId: String, client: HttpClient) {
             val payload = XMLUtil.convertStringToJaxb<HTDResponseOrderData>(
                 response.orderData.toString(Charsets.UTF_8)
             )
-            transaction {
+            dbWriteTransaction {
                 payload.value.partnerInfo.accountInfoList?.forEach { accountInfo ->
                     OfferedBankAccountsTable.insert { newRow ->
                         newRow[accountHolder] = accountInfo.accountHolder ?: "NOT GIVEN"
@@ -378,7 +460,7 @@ fun Route.ebicsBankProtocolRoutes(client: HttpClient) {
 
 fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
     post("/send-ini") {
-        val subscriber = transaction {
+        val subscriber = dbTransaction {
             val conn = requireBankConnection(call, "connid")
             if (conn.type != "ebics") {
                 throw NexusError(
@@ -393,7 +475,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
     }
 
     post("/send-hia") {
-        val subscriber = transaction {
+        val subscriber = dbTransaction {
             val conn = requireBankConnection(call, "connid")
             if (conn.type != "ebics") {
                 throw NexusError(HttpStatusCode.BadRequest, "bank connection is not of type 'ebics'")
@@ -405,7 +487,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
     }
 
     post("/send-hev") {
-        val subscriber = transaction {
+        val subscriber = dbTransaction {
             val conn = requireBankConnection(call, "connid")
             if (conn.type != "ebics") {
                 throw NexusError(HttpStatusCode.BadRequest, "bank connection is not of type 'ebics'")
@@ -417,7 +499,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
     }
 
     post("/send-hpb") {
-        val subscriberDetails = transaction {
+        val subscriberDetails = dbTransaction {
             val conn = requireBankConnection(call, "connid")
             if (conn.type != "ebics") {
                 throw NexusError(HttpStatusCode.BadRequest, "bank connection is not of type 'ebics'")
@@ -425,7 +507,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
             getEbicsSubscriberDetails(conn.id.value)
         }
         val hpbData = doEbicsHpbRequest(client, subscriberDetails)
-        transaction {
+        dbWriteTransaction {
             val conn = requireBankConnection(call, "connid")
             val subscriber =
                 EbicsSubscriberEntity.find { EbicsSubscribersTable.nexusBankConnection eq conn.id }.first()
@@ -439,7 +521,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
      * Directly import accounts.  Used for testing.
      */
     post("/import-accounts") {
-        val subscriberDetails = transaction {
+        val subscriberDetails = dbTransaction {
             authenticateRequest(call.request)
             val conn = requireBankConnection(call, "connid")
             if (conn.type != "ebics") {
@@ -461,7 +543,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
                 val payload = XMLUtil.convertStringToJaxb<HTDResponseOrderData>(
                     response.orderData.toString(Charsets.UTF_8)
                 )
-                transaction {
+                dbWriteTransaction {
                     val conn = requireBankConnection(call, "connid")
                     payload.value.partnerInfo.accountInfoList?.forEach {
                         NexusBankAccountEntity.new(id = it.id) {
@@ -497,7 +579,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
         } else {
             paramsJson.toOrderParams()
         }
-        val subscriberDetails = transaction {
+        val subscriberDetails = dbTransaction {
             val conn = requireBankConnection(call, "connid")
             if (conn.type != "ebics") {
                 throw NexusError(HttpStatusCode.BadRequest, "bank connection is not of type 'ebics'")
@@ -533,7 +615,7 @@ fun Route.ebicsBankConnectionRoutes(client: HttpClient) {
     }
 }
 
-fun exportEbicsKeyBackup(bankConnectionId: String, passphrase: String): Any {
+fun exportEbicsKeyBackup(bankConnectionId: String, passphrase: String): EbicsKeysBackupJson {
     val subscriber = transaction { getEbicsSubscriberDetails(bankConnectionId) }
     return EbicsKeysBackupJson(
         type = "ebics",
@@ -584,14 +666,14 @@ fun getEbicsConnectionDetails(conn: NexusBankConnectionEntity): Any {
  * Return true when the tentative HPB request succeeded, and thus key initialization is done.
  */
 private suspend fun tentativeHpb(client: HttpClient, connId: String): Boolean {
-    val subscriber = transaction { getEbicsSubscriberDetails(connId) }
+    val subscriber = dbTransaction { getEbicsSubscriberDetails(connId) }
     val hpbData = try {
         doEbicsHpbRequest(client, subscriber)
     } catch (e: EbicsProtocolError) {
         logger.info("failed tentative hpb request", e)
         return false
     }
-    transaction {
+    dbWriteTransaction {
         val conn = NexusBankConnectionEntity.findById(connId)
         if (conn == null) {
             throw NexusError(HttpStatusCode.NotFound, "bank connection '$connId' not found")
@@ -608,7 +690,7 @@ private suspend fun tentativeHpb(client: HttpClient, connId: String): Boolean {
 }
 
 suspend fun connectEbics(client: HttpClient, connId: String) {
-    val subscriber = transaction { getEbicsSubscriberDetails(connId) }
+    val subscriber = dbTransaction { getEbicsSubscriberDetails(connId) }
     if (subscriber.bankAuthPub != null && subscriber.bankEncPub != null) {
         return
     }
@@ -637,7 +719,7 @@ suspend fun connectEbics(client: HttpClient, connId: String) {
         logger.warn("failed hpb request", e)
         null
     }
-    transaction {
+    dbWriteTransaction {
         val conn = NexusBankConnectionEntity.findById(connId)
         if (conn == null) {
             throw NexusError(HttpStatusCode.NotFound, "bank connection '$connId' not found")
@@ -738,7 +820,7 @@ fun getEbicsKeyLetterPdf(conn: NexusBankConnectionEntity): ByteArray {
 }
 
 suspend fun submitEbicsPaymentInitiation(httpClient: HttpClient, paymentInitiationId: Long) {
-    val r = transaction {
+    val r = dbTransaction {
         val paymentInitiation = PaymentInitiationEntity.findById(paymentInitiationId)
             ?: throw NexusError(HttpStatusCode.NotFound, "payment initiation not found")
         val connId = paymentInitiation.bankAccount.defaultBankConnection?.id
@@ -761,7 +843,7 @@ suspend fun submitEbicsPaymentInitiation(httpClient: HttpClient, paymentInitiati
                 endToEndId = paymentInitiation.endToEndId
             )
         )
-        if (!XMLUtil.validateFromString(painMessage)) throw NexusError(
+        if (!XMLUtil.validateFromString(painMessage, XmlSchemaFamily.PAIN_001)) throw NexusError(
             HttpStatusCode.InternalServerError, "Pain.001 message is invalid."
         )
         object {
@@ -776,7 +858,7 @@ suspend fun submitEbicsPaymentInitiation(httpClient: HttpClient, paymentInitiati
         r.painMessage.toByteArray(Charsets.UTF_8),
         EbicsStandardOrderParams()
     )
-    transaction {
+    dbWriteTransaction {
         val paymentInitiation = PaymentInitiationEntity.findById(paymentInitiationId)
             ?: throw NexusError(HttpStatusCode.NotFound, "payment initiation not found")
         paymentInitiation.submitted = true
@@ -791,9 +873,9 @@ fun createEbicsBankConnection(bankConnectionName: String, user: NexusUserEntity,
         type = "ebics"
     }
     val newTransportData = jacksonObjectMapper().treeToValue(data, EbicsNewTransport::class.java)
-    val pairA = CryptoUtil.generateRsaKeyPair(2048)
-    val pairB = CryptoUtil.generateRsaKeyPair(2048)
-    val pairC = CryptoUtil.generateRsaKeyPair(2048)
+    val pairA = RsaKeyPairs.take()
+    val pairB = RsaKeyPairs.take()
+    val pairC = RsaKeyPairs.take()
     EbicsSubscriberEntity.new {
         ebicsURL = newTransportData.ebicsURL
         hostID = newTransportData.hostID
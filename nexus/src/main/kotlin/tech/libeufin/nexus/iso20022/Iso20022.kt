@@ -25,13 +25,21 @@ package tech.libeufin.nexus.iso20022
 import com.fasterxml.jackson.annotation.JsonInclude
 import com.fasterxml.jackson.annotation.JsonValue
 import org.w3c.dom.Document
+import org.w3c.dom.Element
 import tech.libeufin.nexus.server.CurrencyAmount
 import tech.libeufin.util.*
+import java.io.Closeable
+import java.io.InputStream
 import java.math.BigDecimal
 import java.time.Instant
 import java.time.ZoneId
 import java.time.ZonedDateTime
 import java.time.format.DateTimeFormatter
+import javax.xml.parsers.DocumentBuilderFactory
+import javax.xml.stream.XMLInputFactory
+import javax.xml.stream.XMLStreamConstants
+import javax.xml.stream.XMLStreamException
+import javax.xml.stream.XMLStreamReader
 
 enum class CreditDebitIndicator {
     DBIT, CRDT
@@ -821,7 +829,80 @@ private fun XmlElementDestructor.extractInnerBkTxCd(creditDebitIndicator: Credit
 }
 
 
+private fun XmlElementDestructor.extractEntry(): CamtBankAccountEntry {
+    val amount = extractCurrencyAmount()
+    val status = requireUniqueChildNamed("Sts") { focusElement.textContent }.let {
+        EntryStatus.valueOf(it)
+    }
+    val creditDebitIndicator = requireUniqueChildNamed("CdtDbtInd") { focusElement.textContent }.let {
+        CreditDebitIndicator.valueOf(it)
+    }
+    val btc = requireUniqueChildNamed("BkTxCd") {
+        extractInnerBkTxCd(creditDebitIndicator)
+    }
+    val acctSvcrRef = maybeUniqueChildNamed("AcctSvcrRef") { focusElement.textContent }
+    val entryRef = maybeUniqueChildNamed("NtryRef") { focusElement.textContent }
+
+    val numInnerTxs = mapEachChildNamed("NtryDtls") {
+        mapEachChildNamed("TxDtls") { Unit }
+    }.flatten().count()
+
+    val numBatches = mapEachChildNamed("NtryDtls") {
+        mapEachChildNamed("Btch") { Unit }
+    }.flatten().count()
+
+    val isBatch = numBatches > 0 || numInnerTxs > 1
+
+    val currencyExchange = maybeUniqueChildNamed("AmtDtls") {
+        val cxCntrVal = maybeUniqueChildNamed("CntrValAmt") { extractMaybeCurrencyExchange() }
+        val cxTx = maybeUniqueChildNamed("TxAmt") { extractMaybeCurrencyExchange() }
+        val cxInstr = maybeUniqueChildNamed("InstrAmt") { extractMaybeCurrencyExchange() }
+        cxCntrVal ?: cxTx ?: cxInstr
+    }
+
+    val counterValueAmount = maybeUniqueChildNamed("AmtDtls") {
+        maybeUniqueChildNamed("CntrValAmt") { extractCurrencyAmount() }
+    }
+
+    val instructedAmount = maybeUniqueChildNamed("AmtDtls") {
+        maybeUniqueChildNamed("InstdAmt") { extractCurrencyAmount() }
+    }
+
+    // For now, only support account servicer reference as id
+
+    return CamtBankAccountEntry(
+        amount = amount,
+        status = status,
+        currencyExchange = currencyExchange,
+        counterValueAmount = counterValueAmount,
+        instructedAmount = instructedAmount,
+        creditDebitIndicator = creditDebitIndicator,
+        bankTransactionCode = btc,
+        details = if (isBatch) {
+            null
+        } else {
+            extractSingleDetails(amount, creditDebitIndicator)
+        },
+        batches = if (isBatch) {
+            extractBatches(amount, creditDebitIndicator)
+        } else {
+            null
+        },
+        bookingDate = maybeUniqueChildNamed("BookgDt") { extractDateOrDateTime() },
+        valueDate = maybeUniqueChildNamed("ValDt") { extractDateOrDateTime() },
+        accountServicerRef = acctSvcrRef,
+        entryRef = entryRef
+    )
+}
+
 private fun XmlElementDestructor.extractInnerTransactions(): CamtReport {
+    return extractReport(mapEachChildNamed("Ntry") { extractEntry() })
+}
+
+/**
+ * Extract a report (or statement), given its already extracted entries.
+ */
+private fun XmlElementDestructor.extractReport(entries: List<CamtBankAccountEntry>): CamtReport {
     val account = requireUniqueChildNamed("Acct") { extractAccount() }
 
     val balances = mapEachChildNamed("Bal") {
@@ -850,71 +931,6 @@ private fun XmlElementDestructor.extractInnerTransactions(): CamtReport {
         )
     }
 
-    val entries = mapEachChildNamed("Ntry") {
-        val amount = extractCurrencyAmount()
-        val status = requireUniqueChildNamed("Sts") { focusElement.textContent }.let {
-            EntryStatus.valueOf(it)
-        }
-        val creditDebitIndicator = requireUniqueChildNamed("CdtDbtInd") { focusElement.textContent }.let {
-            CreditDebitIndicator.valueOf(it)
-        }
-        val btc = requireUniqueChildNamed("BkTxCd") {
-            extractInnerBkTxCd(creditDebitIndicator)
-        }
-        val acctSvcrRef = maybeUniqueChildNamed("AcctSvcrRef") { focusElement.textContent }
-        val entryRef = maybeUniqueChildNamed("NtryRef") { focusElement.textContent }
-
-        val numInnerTxs = mapEachChildNamed("NtryDtls") {
-            mapEachChildNamed("TxDtls") { Unit }
-        }.flatten().count()
-
-        val numBatches = mapEachChildNamed("NtryDtls") {
-            mapEachChildNamed("Btch") { Unit }
-        }.flatten().count()
-
-        val isBatch = numBatches > 0 || numInnerTxs > 1
-
-        val currencyExchange = maybeUniqueChildNamed("AmtDtls") {
-            val cxCntrVal = maybeUniqueChildNamed("CntrValAmt") { extractMaybeCurrencyExchange() }
-            val cxTx = maybeUniqueChildNamed("TxAmt") { extractMaybeCurrencyExchange() }
-            val cxInstr = maybeUniqueChildNamed("InstrAmt") { extractMaybeCurrencyExchange() }
-            cxCntrVal ?: cxTx ?: cxInstr
-        }
-
-        val counterValueAmount = maybeUniqueChildNamed("AmtDtls") {
-            maybeUniqueChildNamed("CntrValAmt") { extractCurrencyAmount() }
-        }
-
-        val instructedAmount = maybeUniqueChildNamed("AmtDtls") {
-            maybeUniqueChildNamed("InstdAmt") { extractCurrencyAmount() }
-        }
-
-        // For now, only support account servicer reference as id
-
-        CamtBankAccountEntry(
-            amount = amount,
-            status = status,
-            currencyExchange = currencyExchange,
-            counterValueAmount = counterValueAmount,
-            instructedAmount = instructedAmount,
-            creditDebitIndicator = creditDebitIndicator,
-            bankTransactionCode = btc,
-            details = if (isBatch) {
-                null
-            } else {
-                extractSingleDetails(amount, creditDebitIndicator)
-            },
-            batches = if (isBatch) {
-                extractBatches(amount, creditDebitIndicator)
-            } else {
-                null
-            },
-            bookingDate = maybeUniqueChildNamed("BookgDt") { extractDateOrDateTime() },
-            valueDate = maybeUniqueChildNamed("ValDt") { extractDateOrDateTime() },
-            accountServicerRef = acctSvcrRef,
-            entryRef = entryRef
-        )
-    }
     return CamtReport(
         account = account,
         entries = entries,
@@ -983,3 +999,203 @@ fun parseCamtMessage(doc: Document): CamtParseResult {
         }
     }
 }
+
+private val camtInputFactory: XMLInputFactory = XMLInputFactory.newInstance().apply {
+    setProperty(XMLInputFactory.IS_NAMESPACE_AWARE, true)
+    setProperty(XMLInputFactory.IS_COALESCING, true)
+    setProperty(XMLInputFactory.SUPPORT_DTD, false)
+    setProperty(XMLInputFactory.IS_SUPPORTING_EXTERNAL_ENTITIES, false)
+}
+
+/**
+ * Pull parser for camt.052 / camt.053 messages, meant for documents too
+ * large to be held in memory as a whole.
+ *
+ * The document is read with StAX.  Every entry, and every other child of
+ * a report, is cut out as a small detached DOM element and destructured
+ * by the same code as parseCamtMessage(), so both give the same results.
+ * The group header is read when the reader is created; the reports can
+ * then be consumed once, either with entries() or with readAll().
+ */
+class CamtStreamReader(private val input: InputStream) : Closeable {
+    private val reader: XMLStreamReader = xmlStep { camtInputFactory.createXMLStreamReader(input) }
+    private val scratchDoc: Document = DocumentBuilderFactory.newInstance().apply {
+        isNamespaceAware = true
+    }.newDocumentBuilder().newDocument()
+    private var messageEnded = false
+
+    val messageType: CashManagementResponseType
+    val messageId: String
+    val creationDateTime: String
+
+    init {
+        if (!nextChildElement() || reader.localName != "Document") {
+            throw CamtParsingError("expected 'Document' tag")
+        }
+        if (!nextChildElement()) {
+            throw CamtParsingError("expected statement or report")
+        }
+        messageType = when (reader.localName) {
+            "BkToCstmrAcctRpt" -> CashManagementResponseType.Report
+            "BkToCstmrStmt" -> CashManagementResponseType.Statement
+            else -> throw CamtParsingError("expected statement or report")
+        }
+        if (!nextChildElement() || reader.localName != "GrpHdr") {
+            throw CamtParsingError("expected group header")
+        }
+        val groupHeader = readElement()
+        messageId = destructXmlElement(groupHeader) {
+            requireUniqueChildNamed("MsgId") { focusElement.textContent }
+        }
+        creationDateTime = destructXmlElement(groupHeader) {
+            requireUniqueChildNamed("CreDtTm") { focusElement.textContent }
+        }
+    }
+
+    /**
+     * Entries of all the reports, in document order.  They are
+     * parsed only as the sequence is iterated, and only once.
+     */
+    fun entries(): Sequence<CamtBankAccountEntry> = sequence {
+        while (nextReport() != null) {
+            while (true) {
+                val child = nextReportChild() ?: break
+                if (child.localName == "Ntry") {
+                    yield(destructXmlElement(child) { extractEntry() })
+                }
+            }
+        }
+    }
+
+    /**
+     * Read the (rest of the) message into the same
+     * result that parseCamtMessage() gives.
+     */
+    fun readAll(): CamtParseResult {
+        val reports = mutableListOf<CamtReport>()
+        while (true) {
+            val report = nextReport() ?: break
+            val entries = mutableListOf<CamtBankAccountEntry>()
+            while (true) {
+                val child = nextReportChild() ?: break
+                if (child.localName == "Ntry") {
+                    entries.add(destructXmlElement(child) { extractEntry() })
+                } else {
+                    report.appendChild(child)
+                }
+            }
+            reports.add(destructXmlElement(report) { extractReport(entries) })
+        }
+        return CamtParseResult(
+            reports = reports,
+            messageId = messageId,
+            messageType = messageType,
+            creationDateTime = creationDateTime
+        )
+    }
+
+    override fun close() {
+        reader.close()
+        input.close()
+    }
+
+    private inline fun <T> xmlStep(f: () -> T): T {
+        try {
+            return f()
+        } catch (e: XMLStreamException) {
+            throw CamtParsingError("malformed XML: ${e.message}")
+        }
+    }
+
+    /**
+     * Move to the next child of the current element.  Returns false,
+     * after having consumed the end of the current element, if
+     * there is none.  Previous children must have been consumed.
+     */
+    private fun nextChildElement(): Boolean = xmlStep {
+        while (reader.hasNext()) {
+            when (reader.next()) {
+                XMLStreamConstants.START_ELEMENT -> return@xmlStep true
+                XMLStreamConstants.END_ELEMENT -> return@xmlStep false
+            }
+        }
+        throw CamtParsingError("unexpected end of document")
+    }
+
+    /**
+     * Move to the next report and return an empty element standing
+     * for it, or null when the message has no more reports.
+     */
+    private fun nextReport(): Element? {
+        val reportTag = when (messageType) {
+            CashManagementResponseType.Report -> "Rpt"
+            else -> "Stmt"
+        }
+        if (messageEnded) {
+            return null
+        }
+        while (nextChildElement()) {
+            if (reader.localName == reportTag) {
+                return createElement()
+            }
+            readElement()
+        }
+        messageEnded = true
+        return null
+    }
+
+    private fun nextReportChild(): Element? {
+        if (!nextChildElement()) {
+            return null
+        }
+        return readElement()
+    }
+
+    private fun createElement(): Element {
+        val prefix = reader.prefix
+        val element = scratchDoc.createElementNS(
+            reader.namespaceURI?.ifEmpty { null },
+            if (prefix.isNullOrEmpty()) reader.localName else "$prefix:${reader.localName}"
+        )
+        for (i in 0 until reader.attributeCount) {
+            val attrPrefix = reader.getAttributePrefix(i)
+            val attrName = reader.getAttributeLocalName(i)
+            element.setAttributeNS(
+                reader.getAttributeNamespace(i)?.ifEmpty { null },
+                if (attrPrefix.isNullOrEmpty()) attrName else "$attrPrefix:$attrName",
+                reader.getAttributeValue(i)
+            )
+        }
+        return element
+    }
+
+    /**
+     * Consume the element the reader is on, and return it as a
+     * detached DOM element.
+     */
+    private fun readElement(): Element = xmlStep {
+        val root = createElement()
+        var current: Element = root
+        var depth = 1
+        while (depth > 0) {
+            when (reader.next()) {
+                XMLStreamConstants.START_ELEMENT -> {
+                    val child = createElement()
+                    current.appendChild(child)
+                    current = child
+                    depth++
+                }
+                XMLStreamConstants.END_ELEMENT -> {
+                    depth--
+                    if (depth > 0) {
+                        current = current.parentNode as Element
+                    }
+                }
+                XMLStreamConstants.CHARACTERS, XMLStreamConstants.CDATA, XMLStreamConstants.SPACE -> {
+                    current.appendChild(scratchDoc.createTextNode(reader.text))
+                }
+            }
+        }
+        root
+    }
+}
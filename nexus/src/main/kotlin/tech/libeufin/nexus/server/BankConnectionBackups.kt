@@ -0,0 +1,111 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Export and restore of all the bank connections of one user at once.
+ */
+package tech.libeufin.nexus.server
+
+import com.fasterxml.jackson.core.JsonGenerator
+import io.ktor.http.HttpStatusCode
+import kotlinx.coroutines.Dispatchers
+import kotlinx.coroutines.async
+import kotlinx.coroutines.awaitAll
+import kotlinx.coroutines.coroutineScope
+import kotlinx.coroutines.sync.Semaphore
+import kotlinx.coroutines.sync.withPermit
+import org.jetbrains.exposed.sql.and
+import org.jetbrains.exposed.sql.transactions.transaction
+import tech.libeufin.nexus.*
+import tech.libeufin.nexus.ebics.createEbicsBankConnectionFromDecryptedBackup
+import tech.libeufin.nexus.ebics.decryptEbicsBackup
+import tech.libeufin.nexus.ebics.exportEbicsKeyBackup
+
+/**
+ * Write the backup of every EBICS connection owned by 'userId' to 'gen',
+ * one BankConnectionBackupJson at a time.  Connections of other types
+ * have no keys to back up, and are left out.
+ */
+fun writeBankConnectionBackups(gen: JsonGenerator, userId: String, passphrase: String) {
+    val connectionIds = transaction {
+        NexusBankConnectionEntity.find {
+            (NexusBankConnectionsTable.owner eq userId) and (NexusBankConnectionsTable.type eq "ebics")
+        }.map { it.id.value }.sorted()
+    }
+    for (connectionId in connectionIds) {
+        val backup = exportEbicsKeyBackup(connectionId, passphrase)
+        gen.writeObject(BankConnectionBackupJson(connectionId, nexusObjectMapper.valueToTree(backup)))
+    }
+    logger.info("Exported ${connectionIds.size} bank connections of '$userId'")
+}
+
+/**
+ * Restore the backups of 'request' as connections owned by 'userId'.  The
+ * keys are decrypted by up to 'request.parallelism' workers, and every
+ * connection is stored in its own transaction: a bad backup does not stop
+ * the others.  Connections that exist already are left untouched.
+ */
+suspend fun restoreBankConnectionBackups(
+    userId: String,
+    request: RestoreBackupsRequestJson
+): List<RestoreBackupResultJson> {
+    val workers = Semaphore(request.parallelism)
+    return coroutineScope {
+        request.bankConnections.map { backup ->
+            async(Dispatchers.Default) {
+                workers.withPermit { restoreBankConnectionBackup(userId, request.passphrase, backup) }
+            }
+        }.awaitAll()
+    }
+}
+
+private suspend fun restoreBankConnectionBackup(
+    userId: String,
+    passphrase: String,
+    backup: BankConnectionBackupJson
+): RestoreBackupResultJson {
+    fun exists() = NexusBankConnectionEntity.findById(backup.name) != null
+    try {
+        // Saves the decryption, in the common case of a restore that is run again.
+        if (dbTransaction { exists() }) {
+            return RestoreBackupResultJson(backup.name, "skipped")
+        }
+        val type = backup.data.get("type")?.textValue()
+        if (type != "ebics") {
+            throw NexusError(HttpStatusCode.BadRequest, "backup type '$type' not supported")
+        }
+        val decrypted = decryptEbicsBackup(passphrase, backup.data)
+        val created = dbWriteTransaction {
+            if (exists()) {
+                return@dbWriteTransaction false
+            }
+            val user = NexusUserEntity.findById(userId) ?: throw NexusError(
+                HttpStatusCode.NotFound, "user '$userId' not found"
+            )
+            createEbicsBankConnectionFromDecryptedBackup(backup.name, user, decrypted)
+            true
+        }
+        return RestoreBackupResultJson(backup.name, if (created) "restored" else "skipped")
+    } catch (e: NexusError) {
+        return RestoreBackupResultJson(backup.name, "failed", e.reason)
+    } catch (e: Exception) {
+        logger.error("Restoring bank connection '${backup.name}' failed", e)
+        return RestoreBackupResultJson(backup.name, "failed", e.toString())
+    }
+}
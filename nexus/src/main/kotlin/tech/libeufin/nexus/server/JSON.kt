@@ -225,6 +225,10 @@ data class EbicsNewTransport(
 data class PaymentStatus(
     val paymentInitiationId: String,
     val submitted: Boolean,
+    /**
+     * Whether the payment was found in the account history.
+     */
+    val confirmed: Boolean,
     val creditorIban: String,
     val creditorBic: String?,
     val creditorName: String,
@@ -306,10 +310,29 @@ data class BankMessageList(
     val bankMessages: MutableList<BankMessageInfo> = mutableListOf()
 )
 
+/**
+ * 'length' is the size of the message, 'storedLength' the size
+ * it takes compressed in the database.  'creationTime' is missing
+ * for the messages stored by older versions.
+ */
 data class BankMessageInfo(
+    val id: Long,
     val messageId: String,
     val code: String,
-    val length: Long
+    val length: Long,
+    val storedLength: Long,
+    val hash: String?,
+    val creationTime: Long?
+)
+
+data class FacadeShowInfo(
+    val name: String,
+    val type: String,
+    val creator: String
+)
+
+data class FacadesList(
+    val facades: MutableList<FacadeShowInfo> = mutableListOf()
 )
 
 data class FacadeInfo(
@@ -401,3 +424,94 @@ data class AccountEntryItemJson(
 data class InitiatedPayments(
     val initiatedPayments: MutableList<PaymentStatus> = mutableListOf()
 )
+
+data class BankHostMetricsJson(
+    val host: String,
+    val requests: Long,
+    val errors: Long,
+    val retries: Long,
+    val meanLatencyMillis: Double,
+    val maxLatencyMillis: Double
+)
+
+/**
+ * Response of GET /bank-http-metrics.
+ */
+data class BankHttpMetricsJson(
+    val hosts: List<BankHostMetricsJson>
+)
+
+/**
+ * Response of GET /db-metrics.  Operations are the transactions (and
+ * blocking database routines) run on the database dispatcher or on the
+ * writer; calls are the HTTP requests, with all their operations summed
+ * up.  Group commits are the runs of the writer with several queued
+ * transactions, when enabled.
+ */
+data class DbMetricsJson(
+    val maxConcurrency: Int,
+    val operations: Long,
+    val meanWaitMillis: Double,
+    val maxWaitMillis: Double,
+    val meanRunMillis: Double,
+    val maxRunMillis: Double,
+    val calls: Long,
+    val meanCallDbMillis: Double,
+    val maxCallDbMillis: Double,
+    val groupCommit: Boolean,
+    val groupCommits: Long,
+    val failedGroupCommits: Long,
+    val meanGroupSize: Double,
+    val maxGroupSize: Long,
+    val meanGroupCommitMillis: Double,
+    val maxGroupCommitMillis: Double
+)
+
+/**
+ * Request body of POST /bank-accounts/fetch-all.
+ */
+data class FetchAllRequestJson(
+    val fetchSpec: FetchSpecJson? = null,
+    val maxConcurrency: Int = 8,
+    val maxConcurrencyPerBankHost: Int = 2
+)
+
+data class FetchAllResultJson(
+    val bankAccount: String,
+    val bankHost: String,
+    val succeeded: Boolean,
+    val newTransactions: Int,
+    val errors: List<String>,
+    val durationMillis: Long
+)
+
+data class FetchAllResponseJson(
+    val results: List<FetchAllResultJson>
+)
+
+/**
+ * One element of the archive made by POST /bank-connections/export-backups.
+ *
+ * @param data backup as made by POST /bank-connections/{connid}/export-backup.
+ */
+data class BankConnectionBackupJson(
+    val name: String,
+    val data: JsonNode
+)
+
+data class RestoreBackupsRequestJson(
+    val passphrase: String,
+    val bankConnections: List<BankConnectionBackupJson>,
+    val parallelism: Int = Runtime.getRuntime().availableProcessors()
+)
+
+data class RestoreBackupResultJson(
+    val name: String,
+    // One of "restored", "skipped" (already existing) and "failed".
+    val status: String,
+    val error: String? = null
+)
+
+data class RestoreBackupsResponseJson(
+    val results: List<RestoreBackupResultJson>
+)
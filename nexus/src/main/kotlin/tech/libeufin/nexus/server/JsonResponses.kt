@@ -0,0 +1,125 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.nexus.server
+
+import com.fasterxml.jackson.core.JsonEncoding
+import com.fasterxml.jackson.core.JsonGenerator
+import com.fasterxml.jackson.core.util.DefaultIndenter
+import com.fasterxml.jackson.core.util.DefaultPrettyPrinter
+import com.fasterxml.jackson.databind.ObjectMapper
+import com.fasterxml.jackson.module.kotlin.KotlinModule
+import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
+import io.ktor.application.ApplicationCall
+import io.ktor.features.ContentConverter
+import io.ktor.http.ContentType
+import io.ktor.http.HttpStatusCode
+import io.ktor.http.content.TextContent
+import io.ktor.http.withCharset
+import io.ktor.jackson.JacksonConverter
+import io.ktor.request.ApplicationReceiveRequest
+import io.ktor.response.respondOutputStream
+import io.ktor.util.pipeline.PipelineContext
+import java.io.OutputStream
+
+/**
+ * Object mapper used for every JSON response of nexus.  Output is compact,
+ * pretty-printing is only done when the client asks for it with "?pretty".
+ */
+val nexusObjectMapper: ObjectMapper = jacksonObjectMapper().apply {
+    registerModule(KotlinModule(nullisSameAsDefault = true))
+}
+
+private val prettyPrinter = DefaultPrettyPrinter().apply {
+    indentArraysWith(DefaultPrettyPrinter.FixedSpaceIndenter.instance)
+    indentObjectsWith(DefaultIndenter("  ", "\n"))
+}
+
+fun ApplicationCall.wantsPrettyJson(): Boolean {
+    val pretty = request.queryParameters.getAll("pretty") ?: return false
+    return pretty.all { it != "false" && it != "no" && it != "0" }
+}
+
+/**
+ * Converter for the ContentNegotiation feature; like the stock
+ * Jackson converter, but honours "?pretty".
+ */
+class NexusJsonConverter : ContentConverter {
+    private val receiver = JacksonConverter(nexusObjectMapper)
+
+    override suspend fun convertForSend(
+        context: PipelineContext<Any, ApplicationCall>,
+        contentType: ContentType,
+        value: Any
+    ): Any? {
+        val writer = if (context.context.wantsPrettyJson()) {
+            nexusObjectMapper.writer(prettyPrinter)
+        } else {
+            nexusObjectMapper.writer()
+        }
+        return TextContent(writer.writeValueAsString(value), contentType.withCharset(Charsets.UTF_8))
+    }
+
+    override suspend fun convertForReceive(context: PipelineContext<ApplicationReceiveRequest, ApplicationCall>): Any? {
+        return receiver.convertForReceive(context)
+    }
+}
+
+private fun ApplicationCall.makeJsonGenerator(out: OutputStream): JsonGenerator {
+    val gen = nexusObjectMapper.factory.createGenerator(out, JsonEncoding.UTF8).setCodec(nexusObjectMapper)
+    if (wantsPrettyJson()) {
+        gen.setPrettyPrinter(prettyPrinter.createInstance())
+    }
+    return gen
+}
+
+/**
+ * Serialize [value] straight onto the response channel, without building
+ * the whole document in memory first.  The Content-Type carries no charset
+ * parameter, as some clients (the Taler exchange) reject it.
+ */
+suspend fun ApplicationCall.respondJsonStream(value: Any, status: HttpStatusCode? = null) {
+    respondOutputStream(ContentType.Application.Json, status) {
+        makeJsonGenerator(this).use { it.writeObject(value) }
+    }
+}
+
+/**
+ * Respond with a JSON object having [fieldName] as its only field, and the
+ * elements written by [writeElements] as its array value.  [writeElements]
+ * runs on an IO thread while the response is being sent, so it can iterate
+ * over database rows and write each element as soon as it's read.
+ *
+ * Anything that can fail with a proper error response (authentication,
+ * parameter checks) must be done before calling this.
+ */
+suspend fun ApplicationCall.respondJsonArrayStream(
+    fieldName: String,
+    writeElements: (JsonGenerator) -> Unit
+) {
+    respondOutputStream(ContentType.Application.Json) {
+        makeJsonGenerator(this).use { gen ->
+            gen.writeStartObject()
+            gen.writeArrayFieldStart(fieldName)
+            writeElements(gen)
+            gen.writeEndArray()
+            gen.writeEndObject()
+        }
+    }
+}
@@ -19,28 +19,28 @@
 
 package tech.libeufin.nexus.server
 
-import com.fasterxml.jackson.core.util.DefaultIndenter
-import com.fasterxml.jackson.core.util.DefaultPrettyPrinter
+import com.fasterxml.jackson.core.JsonProcessingException
 import com.fasterxml.jackson.databind.JsonNode
-import com.fasterxml.jackson.databind.SerializationFeature
 import com.fasterxml.jackson.databind.exc.MismatchedInputException
-import com.fasterxml.jackson.module.kotlin.KotlinModule
 import com.fasterxml.jackson.module.kotlin.MissingKotlinParameterException
 import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
 import io.ktor.application.ApplicationCall
 import io.ktor.application.ApplicationCallPipeline
 import io.ktor.application.call
 import io.ktor.application.install
-import io.ktor.client.HttpClient
 import io.ktor.features.CallLogging
+import io.ktor.features.Compression
 import io.ktor.features.ContentNegotiation
 import io.ktor.features.StatusPages
+import io.ktor.features.deflate
+import io.ktor.features.gzip
+import io.ktor.features.minimumSize
 import io.ktor.http.ContentType
 import io.ktor.http.HttpStatusCode
-import io.ktor.jackson.jackson
 import io.ktor.request.*
 import io.ktor.response.respond
 import io.ktor.response.respondBytes
+import io.ktor.response.respondOutputStream
 import io.ktor.response.respondText
 import io.ktor.routing.*
 import io.ktor.server.engine.embeddedServer
@@ -48,6 +48,7 @@ import io.ktor.server.netty.Netty
 import io.ktor.utils.io.ByteReadChannel
 import io.ktor.utils.io.jvm.javaio.toByteReadChannel
 import io.ktor.utils.io.jvm.javaio.toInputStream
+import kotlinx.coroutines.withContext
 import org.jetbrains.exposed.sql.and
 import org.jetbrains.exposed.sql.select
 import org.jetbrains.exposed.sql.transactions.transaction
@@ -65,6 +66,7 @@ import tech.libeufin.util.*
 import tech.libeufin.nexus.logger
 import java.lang.IllegalArgumentException
 import java.net.URLEncoder
+import java.time.format.DateTimeParseException
 import java.util.zip.InflaterInputStream
 
 
@@ -81,6 +83,22 @@ fun ensureLong(param: String?): Long {
     )
 }
 
+/**
+ * Page size given by the 'limit' query parameter, 'default' when absent.
+ * The range is checked before narrowing, so that too large numbers do
+ * not wrap around into it.
+ */
+fun ensurePageLimit(param: String?, max: Int, default: Int = 100): Int {
+    if (param == null) {
+        return default
+    }
+    val limit = ensureLong(param)
+    if (limit !in 1L..max) {
+        throw NexusError(HttpStatusCode.BadRequest, "limit must be between 1 and $max")
+    }
+    return limit.toInt()
+}
+
 fun <T> expectNonNull(param: T?): T {
     return param ?: throw NexusError(
         HttpStatusCode.BadRequest,
@@ -156,6 +174,54 @@ fun ApplicationCall.expectUrlParameter(name: String): String {
         ?: throw NexusError(HttpStatusCode.BadRequest, "Parameter '$name' not provided in URI")
 }
 
+/**
+ * Value of an optional "true" / "false" query parameter.
+ */
+fun ApplicationCall.optionalBooleanParameter(name: String): Boolean? {
+    return when (val value = this.request.queryParameters[name]) {
+        null -> null
+        "true" -> true
+        "false" -> false
+        else -> throw NexusError(HttpStatusCode.BadRequest, "Parameter '$name' must be true or false, not '$value'")
+    }
+}
+
+/**
+ * Milliseconds at the start of a YYYY-MM-DD date given as query parameter.
+ */
+private fun parseDateParameter(date: String): Long {
+    return try {
+        parseDashedDate(date).millis()
+    } catch (e: DateTimeParseException) {
+        throw NexusError(HttpStatusCode.BadRequest, "Bad date: $date")
+    }
+}
+
+const val PAYMENT_INITIATIONS_MAX_PAGE = 1000
+const val BANK_MESSAGES_MAX_PAGE = 1000
+
+/**
+ * Needs to be called within a transaction block.
+ */
+fun PaymentInitiationEntity.toPaymentStatus(): PaymentStatus {
+    val sd = this.submissionDate
+    return PaymentStatus(
+        paymentInitiationId = this.id.value.toString(),
+        submitted = this.submitted,
+        // Reads the column only, instead of loading the confirming transaction.
+        confirmed = this.readValues[PaymentInitiationsTable.confirmationTransaction] != null,
+        creditorIban = this.creditorIban,
+        creditorName = this.creditorName,
+        creditorBic = this.creditorBic,
+        amount = "${this.currency}:${this.sum}",
+        subject = this.subject,
+        submissionDate = if (sd != null) {
+            importDateFromMillis(sd).toDashedDate()
+        } else null,
+        preparationDate = importDateFromMillis(this.preparationDate).toDashedDate()
+    )
+}
+
 suspend inline fun <reified T : Any> ApplicationCall.receiveJson(): T {
     try {
         return this.receive<T>()
@@ -182,14 +248,20 @@ fun createLoopbackBankConnection(bankConnectionName: String, user: NexusUserEnti
     }
 }
 
+/**
+ * Needs to be called within a transaction block.
+ */
 fun requireBankConnectionInternal(connId: String): NexusBankConnectionEntity {
-    val conn = transaction { NexusBankConnectionEntity.findById(connId) }
+    val conn = NexusBankConnectionEntity.findById(connId)
     if (conn == null) {
         throw NexusError(HttpStatusCode.NotFound, "bank connection '$connId' not found")
     }
     return conn
 }
 
+/**
+ * Needs to be called within a transaction block.
+ */
 fun requireBankConnection(call: ApplicationCall, parameterKey: String): NexusBankConnectionEntity {
     val name = call.parameters[parameterKey]
     if (name == null) {
@@ -200,25 +272,32 @@ fun requireBankConnection(call: ApplicationCall, parameterKey: String): NexusBan
     return requireBankConnectionInternal(name)
 }
 
-fun serverMain(dbName: String, host: String) {
-    dbCreateTables(dbName)
-    val client = HttpClient {
-        expectSuccess = false // this way, it does not throw exceptions on != 200 responses.
-    }
-    val server = embeddedServer(Netty, port = 5001, host = host) {
+fun serverMain(
+    dbName: String,
+    host: String,
+    bankHttpConfig: BankHttpConfig = BankHttpConfig(),
+    port: Int = 5001,
+    sqliteConfig: SqliteConfig = SqliteConfig()
+) {
+    dbCreateTables(dbName, sqliteConfig)
+    val client = makeBankHttpClient(bankHttpConfig)
+    val server = embeddedServer(Netty, port = port, host = host) {
         install(CallLogging) {
             this.level = Level.DEBUG
             this.logger = tech.libeufin.nexus.logger
         }
         install(ContentNegotiation) {
-            jackson {
-                enable(SerializationFeature.INDENT_OUTPUT)
-                setDefaultPrettyPrinter(DefaultPrettyPrinter().apply {
-                    indentArraysWith(DefaultPrettyPrinter.FixedSpaceIndenter.instance)
-                    indentObjectsWith(DefaultIndenter("  ", "\n"))
-                })
-                registerModule(KotlinModule(nullisSameAsDefault = true))
+            register(ContentType.Application.Json, NexusJsonConverter())
+        }
+        install(Compression) {
+            gzip {
+                priority = 1.0
             }
+            deflate {
+                priority = 0.9
+            }
+            // Not worth the CPU for small bodies.
+            minimumSize(1024)
         }
         install(StatusPages) {
             exception<NexusError> { cause ->
@@ -258,6 +337,22 @@ fun serverMain(dbName: String, host: String) {
                 )
             }
         }
+        // Account for the database time of every request.
+        intercept(ApplicationCallPipeline.Setup) {
+            val timing = DbCallTiming()
+            try {
+                withContext(timing) { proceed() }
+            } finally {
+                if (timing.operations.get() > 0) {
+                    DbMetrics.recordCall(timing)
+                    logger.debug(
+                        "${call.request.httpMethod.value} ${call.request.path()}: " +
+                                "${timing.operations.get()} database operations, " +
+                                "waited ${timing.waitMicros.get()}us, ran ${timing.runMicros.get()}us"
+                    )
+                }
+            }
+        }
         intercept(ApplicationCallPipeline.Fallback) {
             if (this.call.response.status() == null) {
                 call.respondText("Not found (no route matched).\n", ContentType.Text.Plain, HttpStatusCode.NotFound)
@@ -277,6 +372,7 @@ fun serverMain(dbName: String, host: String) {
             proceed()
             return@intercept
         }
+        startNodeHeartbeat()
         startOperationScheduler(client)
         routing {
             get("/config") {
@@ -285,9 +381,42 @@ fun serverMain(dbName: String, host: String) {
                  )
                 return@get
             }
+            // Latency and error counters of the requests made to the banks.
+            get("/bank-http-metrics") {
+                dbTransaction {
+                    val currentUser = authenticateRequest(call.request)
+                    if (!currentUser.superuser) {
+                        throw NexusError(HttpStatusCode.Forbidden, "only superuser can do that")
+                    }
+                }
+                call.respond(BankHttpMetrics.snapshot())
+                return@get
+            }
+            // Queueing and run times of the database operations.
+            get("/db-metrics") {
+                dbTransaction {
+                    val currentUser = authenticateRequest(call.request)
+                    if (!currentUser.superuser) {
+                        throw NexusError(HttpStatusCode.Forbidden, "only superuser can do that")
+                    }
+                }
+                call.respond(DbMetrics.snapshot())
+                return@get
+            }
+            // Depth and refill rate of the pool of RSA key pairs.
+            get("/rsa-key-pool") {
+                dbTransaction {
+                    val currentUser = authenticateRequest(call.request)
+                    if (!currentUser.superuser) {
+                        throw NexusError(HttpStatusCode.Forbidden, "only superuser can do that")
+                    }
+                }
+                call.respond(RsaKeyPairs.pool.stats())
+                return@get
+            }
             // Shows information about the requesting user.
             get("/user") {
-                val ret = transaction {
+                val ret = dbTransaction {
                     val currentUser = authenticateRequest(call.request)
                     UserResponse(
                         username = currentUser.id.value,
@@ -299,11 +428,9 @@ fun serverMain(dbName: String, host: String) {
             }
 
             get("/users") {
-                val users = transaction {
-                    transaction {
-                        NexusUserEntity.all().map {
-                            UserInfo(it.id.value, it.superuser)
-                        }
+                val users = dbTransaction {
+                    NexusUserEntity.all().map {
+                        UserInfo(it.id.value, it.superuser)
                     }
                 }
                 val usersResp = UsersResponse(users)
@@ -314,7 +441,7 @@ fun serverMain(dbName: String, host: String) {
             // Add a new ordinary user in the system (requires superuser privileges)
             post("/users") {
                 val body = call.receiveJson<User>()
-                transaction {
+                dbWriteTransaction {
                     val currentUser = authenticateRequest(call.request)
                     if (!currentUser.superuser) {
                         throw NexusError(HttpStatusCode.Forbidden, "only superuser can do that")
@@ -347,7 +474,7 @@ fun serverMain(dbName: String, host: String) {
             // Shows the bank accounts belonging to the requesting user.
             get("/bank-accounts") {
                 val bankAccounts = BankAccounts()
-                transaction {
+                dbTransaction {
                     authenticateRequest(call.request)
                     // FIXME(dold): Only return accounts the user has at least read access to?
                     NexusBankAccountEntity.all().forEach {
@@ -369,7 +496,7 @@ fun serverMain(dbName: String, host: String) {
                 val ops = jacksonObjectMapper().createObjectNode()
                 val accountId = ensureNonNull(call.parameters["accountid"])
                 resp.set<JsonNode>("schedule", ops)
-                transaction {
+                dbTransaction {
                     val bankAccount = NexusBankAccountEntity.findById(accountId)
                     if (bankAccount == null) {
                         throw NexusError(HttpStatusCode.NotFound, "unknown bank account")
@@ -393,7 +520,7 @@ fun serverMain(dbName: String, host: String) {
             post("/bank-accounts/{accountid}/schedule") {
                 val schedSpec = call.receive<CreateAccountTaskRequest>()
                 val accountId = ensureNonNull(call.parameters["accountid"])
-                transaction {
+                dbWriteTransaction {
                     authenticateRequest(call.request)
                     val bankAccount = NexusBankAccountEntity.findById(accountId)
                     if (bankAccount == null) {
@@ -406,7 +533,11 @@ fun serverMain(dbName: String, host: String) {
                     }
                     when (schedSpec.type) {
                         "fetch" -> {
-                            val fetchSpec = jacksonObjectMapper().treeToValue(schedSpec.params, FetchSpecJson::class.java)
+                            val fetchSpec = try {
+                                parseScheduledFetchSpec(schedSpec.params)
+                            } catch (e: JsonProcessingException) {
+                                null
+                            }
                             if (fetchSpec == null) {
                                 throw NexusError(HttpStatusCode.BadRequest, "bad fetch spec")
                             }
@@ -444,7 +575,7 @@ fun serverMain(dbName: String, host: String) {
                 logger.info("schedule delete requested")
                 val accountId = ensureNonNull(call.parameters["accountId"])
                 val taskId = ensureNonNull(call.parameters["taskId"])
-                transaction {
+                dbWriteTransaction {
                     val bankAccount = NexusBankAccountEntity.findById(accountId)
                     if (bankAccount == null) {
                         throw NexusError(HttpStatusCode.NotFound, "unknown bank account")
@@ -464,14 +595,14 @@ fun serverMain(dbName: String, host: String) {
 
             get("/bank-accounts/{accountid}") {
                 val accountId = ensureNonNull(call.parameters["accountid"])
-                val res = transaction {
+                val res = dbTransaction {
                     val user = authenticateRequest(call.request)
                     val bankAccount = NexusBankAccountEntity.findById(accountId)
                     if (bankAccount == null) {
                         throw NexusError(HttpStatusCode.NotFound, "unknown bank account")
                     }
                     val holderEnc = URLEncoder.encode(bankAccount.accountHolder, "UTF-8")
-                    return@transaction object {
+                    return@dbTransaction object {
                         val defaultBankConnection = bankAccount.defaultBankConnection?.id?.value
                         val accountPaytoUri = "payto://iban/${bankAccount.iban}?receiver-name=$holderEnc"
                     }
@@ -483,7 +614,7 @@ fun serverMain(dbName: String, host: String) {
             post("/bank-accounts/{accountid}/payment-initiations/{uuid}/submit") {
                 val uuid = ensureLong(call.parameters["uuid"])
                 val accountId = ensureNonNull(call.parameters["accountid"])
-                val res = transaction {
+                val res = dbTransaction {
                     authenticateRequest(call.request)
                 }
                 submitPaymentInitiation(client, uuid)
@@ -491,60 +622,44 @@ fun serverMain(dbName: String, host: String) {
                 return@post
             }
 
+            // Lists the payment initiations of one bank account, one page at a time.
+            // Query parameters: submitted / confirmed (true or false), preparedFrom /
+            // preparedTo (dashed dates, the latter excluded), start (the id after
+            // which the page begins) and limit (page size).
             get("/bank-accounts/{accountid}/payment-initiations") {
-                val ret = InitiatedPayments()
-                transaction {
-                    val bankAccount = requireBankAccount(call, "accountid")
-                    PaymentInitiationEntity.find {
-                        PaymentInitiationsTable.bankAccount eq bankAccount.id.value
-                    }.forEach {
-                        val sd = it.submissionDate
-                        ret.initiatedPayments.add(
-                            PaymentStatus(
-                                paymentInitiationId = it.id.value.toString(),
-                                submitted = it.submitted,
-                                creditorIban = it.creditorIban,
-                                creditorName = it.creditorName,
-                                creditorBic = it.creditorBic,
-                                amount = "${it.currency}:${it.sum}",
-                                subject = it.subject,
-                                submissionDate = if (sd != null) {
-                                    importDateFromMillis(sd).toDashedDate()
-                                } else null,
-                                preparationDate = importDateFromMillis(it.preparationDate).toDashedDate()
-                            )
-                        )
+                val accountId = ensureNonNull(call.parameters["accountid"])
+                val filter = PaymentInitiationFilter(
+                    submitted = call.optionalBooleanParameter("submitted"),
+                    confirmed = call.optionalBooleanParameter("confirmed"),
+                    preparedFrom = call.request.queryParameters["preparedFrom"]?.let { parseDateParameter(it) },
+                    preparedTo = call.request.queryParameters["preparedTo"]?.let { parseDateParameter(it) },
+                    start = call.request.queryParameters["start"]?.let { ensureLong(it) },
+                    limit = ensurePageLimit(call.request.queryParameters["limit"], PAYMENT_INITIATIONS_MAX_PAGE)
+                )
+                dbTransaction {
+                    authenticateRequest(call.request)
+                    if (NexusBankAccountEntity.findById(accountId) == null) {
+                        throw NexusError(HttpStatusCode.NotFound, "unknown bank account")
+                    }
+                }
+                // Streamed form of InitiatedPayments.
+                call.respondJsonArrayStream("initiatedPayments") { gen ->
+                    transaction {
+                        findPaymentInitiations(accountId, filter).forEach {
+                            gen.writeObject(it.toPaymentStatus())
+                        }
                     }
                 }
-                call.respond(ret)
                 return@get
             }
 
             // Shows information about one particular payment initiation.
             get("/bank-accounts/{accountid}/payment-initiations/{uuid}") {
-                val res = transaction {
-                    val user = authenticateRequest(call.request)
-                    val paymentInitiation = getPaymentInitiation(ensureLong(call.parameters["uuid"]))
-                    return@transaction object {
-                        val paymentInitiation = paymentInitiation
-                    }
+                val paymentStatus = dbTransaction {
+                    authenticateRequest(call.request)
+                    getPaymentInitiation(ensureLong(call.parameters["uuid"])).toPaymentStatus()
                 }
-                val sd = res.paymentInitiation.submissionDate
-                call.respond(
-                    PaymentStatus(
-                        paymentInitiationId = res.paymentInitiation.id.value.toString(),
-                        submitted = res.paymentInitiation.submitted,
-                        creditorName = res.paymentInitiation.creditorName,
-                        creditorBic = res.paymentInitiation.creditorBic,
-                        creditorIban = res.paymentInitiation.creditorIban,
-                        amount = "${res.paymentInitiation.currency}:${res.paymentInitiation.sum}",
-                        subject = res.paymentInitiation.subject,
-                        submissionDate = if (sd != null) {
-                            importDateFromMillis(sd).toDashedDate()
-                        } else null,
-                        preparationDate = importDateFromMillis(res.paymentInitiation.preparationDate).toDashedDate()
-                    )
-                )
+                call.respond(paymentStatus)
                 return@get
             }
 
@@ -552,7 +667,7 @@ fun serverMain(dbName: String, host: String) {
             post("/bank-accounts/{accountid}/payment-initiations") {
                 val body = call.receive<CreatePaymentInitiationRequest>()
                 val accountId = ensureNonNull(call.parameters["accountid"])
-                val res = transaction {
+                val res = dbWriteTransaction {
                     authenticateRequest(call.request)
                     val bankAccount = NexusBankAccountEntity.findById(accountId)
                     if (bankAccount == null) {
@@ -570,7 +685,7 @@ fun serverMain(dbName: String, host: String) {
                         ),
                         bankAccount
                     )
-                    return@transaction object {
+                    return@dbWriteTransaction object {
                         val uuid = paymentEntity.id.value
                     }
                 }
@@ -581,6 +696,30 @@ fun serverMain(dbName: String, host: String) {
                 return@post
             }
 
+            // Downloads new transactions for all the accounts of the user.
+            post("/bank-accounts/fetch-all") {
+                val accountIds = dbTransaction {
+                    findUserBankAccountIds(authenticateRequest(call.request).id.value)
+                }
+                val body = if (call.request.hasBody()) {
+                    call.receiveJson<FetchAllRequestJson>()
+                } else {
+                    FetchAllRequestJson()
+                }
+                if (body.maxConcurrency < 1 || body.maxConcurrencyPerBankHost < 1) {
+                    throw NexusError(HttpStatusCode.BadRequest, "concurrency limits must be positive")
+                }
+                val results = fetchBankAccountsTransactions(
+                    client,
+                    body.fetchSpec ?: FetchSpecLatestJson(FetchLevel.ALL, null),
+                    accountIds,
+                    body.maxConcurrency,
+                    body.maxConcurrencyPerBankHost
+                )
+                call.respond(FetchAllResponseJson(results))
+                return@post
+            }
+
             // Downloads new transactions from the bank.
             post("/bank-accounts/{accountid}/fetch-transactions") {
                 val accountid = call.parameters["accountid"]
@@ -590,7 +729,7 @@ fun serverMain(dbName: String, host: String) {
                         "Account id missing"
                     )
                 }
-                val user = transaction { authenticateRequest(call.request) }
+                val user = dbTransaction { authenticateRequest(call.request) }
                 val fetchSpec = if (call.request.hasBody()) {
                     call.receive<FetchSpecJson>()
                 } else {
@@ -613,15 +752,20 @@ fun serverMain(dbName: String, host: String) {
                 val bankAccount = expectNonNull(call.parameters["accountid"])
                 val start = call.request.queryParameters["start"]
                 val end = call.request.queryParameters["end"]
-                val ret = Transactions()
-                transaction {
+                dbTransaction {
                     authenticateRequest(call.request).id.value
-                    NexusBankTransactionEntity.all().map {
-                        val tx = jacksonObjectMapper().readValue(it.transactionJson, CamtBankAccountEntry::class.java)
-                        ret.transactions.add(tx)
+                }
+                // Streamed form of Transactions.
+                call.respondJsonArrayStream("transactions") { gen ->
+                    transaction {
+                        NexusBankTransactionEntity.find {
+                            NexusBankTransactionsTable.bankAccount eq bankAccount
+                        }.forEach {
+                            val tx = nexusObjectMapper.readValue(it.transactionJson, CamtBankAccountEntry::class.java)
+                            gen.writeObject(tx)
+                        }
                     }
                 }
-                call.respond(ret)
                 return@get
             }
 
@@ -629,37 +773,40 @@ fun serverMain(dbName: String, host: String) {
             post("/bank-connections") {
                 // user exists and is authenticated.
                 val body = call.receive<CreateBankConnectionRequestJson>()
-                transaction {
-                    val user = authenticateRequest(call.request)
-                    when (body) {
-                        is CreateBankConnectionFromBackupRequestJson -> {
-                            val type = body.data.get("type")
-                            if (type == null || !type.isTextual) {
-                                throw NexusError(HttpStatusCode.BadRequest, "backup needs type")
-                            }
-                            when (type.textValue()) {
-                                "ebics" -> {
-                                    createEbicsBankConnectionFromBackup(body.name, user, body.passphrase, body.data)
+                // Takes RSA keys from the pool: run once, not in a group.
+                dbWriteWork {
+                    transaction {
+                        val user = authenticateRequest(call.request)
+                        when (body) {
+                            is CreateBankConnectionFromBackupRequestJson -> {
+                                val type = body.data.get("type")
+                                if (type == null || !type.isTextual) {
+                                    throw NexusError(HttpStatusCode.BadRequest, "backup needs type")
                                 }
-                                else -> {
-                                    throw NexusError(HttpStatusCode.BadRequest, "backup type not supported")
+                                when (type.textValue()) {
+                                    "ebics" -> {
+                                        createEbicsBankConnectionFromBackup(body.name, user, body.passphrase, body.data)
+                                    }
+                                    else -> {
+                                        throw NexusError(HttpStatusCode.BadRequest, "backup type not supported")
+                                    }
                                 }
                             }
-                        }
-                        is CreateBankConnectionFromNewRequestJson -> {
-                            when (body.type) {
-                                "ebics" -> {
-                                    createEbicsBankConnection(body.name, user, body.data)
-                                }
-                                "loopback" -> {
-                                    createLoopbackBankConnection(body.name, user, body.data)
+                            is CreateBankConnectionFromNewRequestJson -> {
+                                when (body.type) {
+                                    "ebics" -> {
+                                        createEbicsBankConnection(body.name, user, body.data)
+                                    }
+                                    "loopback" -> {
+                                        createLoopbackBankConnection(body.name, user, body.data)
 
-                                }
-                                else -> {
-                                    throw NexusError(
-                                        HttpStatusCode.BadRequest,
-                                        "connection type ${body.type} not supported"
-                                    )
+                                    }
+                                    else -> {
+                                        throw NexusError(
+                                            HttpStatusCode.BadRequest,
+                                            "connection type ${body.type} not supported"
+                                        )
+                                    }
                                 }
                             }
                         }
@@ -670,7 +817,7 @@ fun serverMain(dbName: String, host: String) {
 
             post("/bank-connections/delete-connection") {
                 val body = call.receive<BankConnectionDeletion>()
-                transaction {
+                dbWriteTransaction {
                     val conn = NexusBankConnectionEntity.findById(body.bankConnectionId) ?: throw NexusError(
                         HttpStatusCode.NotFound,
                         "Bank connection ${body.bankConnectionId}"
@@ -682,7 +829,7 @@ fun serverMain(dbName: String, host: String) {
 
             get("/bank-connections") {
                 val connList = BankConnectionsList()
-                transaction {
+                dbTransaction {
                     NexusBankConnectionEntity.all().forEach {
                         connList.bankConnections.add(
                             BankConnectionInfo(
@@ -696,7 +843,7 @@ fun serverMain(dbName: String, host: String) {
             }
 
             get("/bank-connections/{connid}") {
-                val resp = transaction {
+                val resp = dbTransaction {
                     val user = authenticateRequest(call.request)
                     val conn = requireBankConnection(call, "connid")
                     when (conn.type) {
@@ -714,11 +861,35 @@ fun serverMain(dbName: String, host: String) {
                 call.respond(resp)
             }
 
+            // Exports all the bank connections of the user, as one streamed archive.
+            post("/bank-connections/export-backups") {
+                val userId = dbTransaction { authenticateRequest(call.request).id.value }
+                val body = call.receiveJson<BackupRequestJson>()
+                call.response.headers.append("Content-Disposition", "attachment")
+                call.respondJsonArrayStream("bankConnections") { gen ->
+                    writeBankConnectionBackups(gen, userId, body.passphrase)
+                }
+                return@post
+            }
+
+            // Restores an archive made by export-backups.
+            post("/bank-connections/restore-backups") {
+                val userId = dbTransaction { authenticateRequest(call.request).id.value }
+                val body = call.receiveJson<RestoreBackupsRequestJson>()
+                if (body.parallelism < 1) {
+                    throw NexusError(HttpStatusCode.BadRequest, "parallelism must be positive")
+                }
+                call.respond(RestoreBackupsResponseJson(restoreBankConnectionBackups(userId, body)))
+                return@post
+            }
+
             post("/bank-connections/{connid}/export-backup") {
-                transaction { authenticateRequest(call.request) }
+                val conn = dbTransaction {
+                    authenticateRequest(call.request)
+                    requireBankConnection(call, "connid")
+                }
                 val body = call.receive<BackupRequestJson>()
-                val response = run {
-                    val conn = requireBankConnection(call, "connid")
+                val response = dbWork {
                     when (conn.type) {
                         "ebics" -> {
                             exportEbicsKeyBackup(conn.id.value, body.passphrase)
@@ -739,7 +910,7 @@ fun serverMain(dbName: String, host: String) {
             }
 
             post("/bank-connections/{connid}/connect") {
-                val conn = transaction {
+                val conn = dbTransaction {
                     authenticateRequest(call.request)
                     requireBankConnection(call, "connid")
                 }
@@ -752,52 +923,73 @@ fun serverMain(dbName: String, host: String) {
             }
 
             get("/bank-connections/{connid}/keyletter") {
-                val conn = transaction {
+                val conn = dbTransaction {
                     authenticateRequest(call.request)
                     requireBankConnection(call, "connid")
                 }
                 when (conn.type) {
                     "ebics" -> {
-                        val pdfBytes = getEbicsKeyLetterPdf(conn)
+                        val pdfBytes = dbWork { getEbicsKeyLetterPdf(conn) }
                         call.respondBytes(pdfBytes, ContentType("application", "pdf"))
                     }
                     else -> throw NexusError(HttpStatusCode.NotImplemented, "keyletter not supported for ${conn.type}")
                 }
             }
 
+            // Lists the messages of one bank connection, one page at a time,
+            // without reading the messages.  Query parameters: start (the id
+            // after which the page begins) and limit (page size).
             get("/bank-connections/{connid}/messages") {
-                val ret = transaction {
-                    val list = BankMessageList()
-                    val conn = requireBankConnection(call, "connid")
-                    NexusBankMessageEntity.find { NexusBankMessagesTable.bankConnection eq conn.id }.map {
-                        list.bankMessages.add(
-                            BankMessageInfo(
-                                it.messageId,
-                                it.code,
-                                it.message.bytes.size.toLong()
-                            )
-                        )
+                val start = call.request.queryParameters["start"]?.let { ensureLong(it) }
+                val limit = ensurePageLimit(call.request.queryParameters["limit"], BANK_MESSAGES_MAX_PAGE)
+                val connId = dbTransaction {
+                    requireBankConnection(call, "connid").id
+                }
+                // Streamed form of BankMessageList.
+                call.respondJsonArrayStream("bankMessages") { gen ->
+                    transaction {
+                        findBankMessageInfos(connId, start, limit).forEach {
+                            gen.writeObject(it)
+                        }
                     }
-                    list
                 }
-                call.respond(ret)
             }
 
             get("/bank-connections/{connid}/messages/{msgid}") {
-                val ret = transaction {
+                val ret = dbTransaction {
+                    val conn = requireBankConnection(call, "connid")
                     val msgid = call.parameters["msgid"]
                     if (msgid == null || msgid == "") {
                         throw NexusError(HttpStatusCode.BadRequest, "missing or invalid message ID")
                     }
-                    val msg = NexusBankMessageEntity.find { NexusBankMessagesTable.messageId eq msgid }.firstOrNull()
+                    val msg = NexusBankMessageEntity.find {
+                        (NexusBankMessagesTable.messageId eq msgid) and
+                                (NexusBankMessagesTable.bankConnection eq conn.id)
+                    }.firstOrNull()
                     if (msg == null) {
                         throw NexusError(HttpStatusCode.NotFound, "bank message not found")
                     }
-                    return@transaction object {
-                        val msgContent = msg.message.bytes
+                    return@dbTransaction object {
+                        val stored = msg.message.bytes
+                        val compression = msg.compression
                     }
                 }
-                call.respondBytes(ret.msgContent, ContentType("application", "xml"))
+                // Decompressed while it is sent.
+                call.respondOutputStream(ContentType("application", "xml")) {
+                    openBankMessage(ret.stored, ret.compression).use { it.copyTo(this) }
+                }
+            }
+
+            get("/facades") {
+                val ret = FacadesList()
+                dbTransaction {
+                    authenticateRequest(call.request)
+                    FacadeEntity.all().forEach {
+                        ret.facades.add(FacadeShowInfo(it.id.value, it.type, it.creator.id.value))
+                    }
+                }
+                call.respond(ret)
+                return@get
             }
 
             post("/facades") {
@@ -806,14 +998,14 @@ fun serverMain(dbName: String, host: String) {
                     HttpStatusCode.NotImplemented,
                     "Facade type '${body.type}' is not implemented"
                 )
-                val newFacade = transaction {
+                val newFacade = dbWriteTransaction {
                     val user = authenticateRequest(call.request)
                     FacadeEntity.new(body.name) {
                         type = body.type
                         creator = user
                     }
                 }
-                transaction {
+                dbWriteTransaction {
                     TalerFacadeStateEntity.new {
                         bankAccount = body.config.bankAccount
                         bankConnection = body.config.bankConnection
@@ -832,7 +1024,7 @@ fun serverMain(dbName: String, host: String) {
                     ebicsBankConnectionRoutes(client)
                 }
                 post("/fetch-accounts") {
-                    val conn = transaction {
+                    val conn = dbTransaction {
                         authenticateRequest(call.request)
                         requireBankConnection(call, "connid")
                     }
@@ -848,7 +1040,7 @@ fun serverMain(dbName: String, host: String) {
                 // show all the offered accounts (both imported and non)
                 get("/accounts") {
                     val ret = OfferedBankAccounts()
-                    transaction {
+                    dbTransaction {
                         val conn = requireBankConnection(call, "connid")
                         OfferedBankAccountsTable.select {
                             OfferedBankAccountsTable.bankConnection eq conn.id.value
@@ -869,7 +1061,7 @@ fun serverMain(dbName: String, host: String) {
                 // import one account into libeufin.
                 post("/import-account") {
                     val body = call.receive<ImportBankAccount>()
-                    importBankAccount(call, body.offeredAccountId, body.nexusBankAccountId)
+                    dbWriteWork { importBankAccount(call, body.offeredAccountId, body.nexusBankAccountId) }
                     call.respond(object {})
                 }
             }
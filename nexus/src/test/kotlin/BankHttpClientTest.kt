@@ -0,0 +1,29 @@
+package tech.libeufin.nexus
+
+import org.junit.Test
+import kotlin.random.Random
+import kotlin.test.assertEquals
+import kotlin.test.assertTrue
+
+class BankHttpClientTest {
+
+    @Test
+    fun backoffGrowsAndIsCapped() {
+        val config = BankHttpConfig(retryBaseDelay = 100, retryMaxDelay = 1000)
+        val random = Random(42)
+        for (i in 0 until 100) {
+            val first = bankRetryBackoff(1, config, random)
+            assertTrue(first in 50..100)
+            val third = bankRetryBackoff(3, config, random)
+            assertTrue(third in 200..400)
+            val late = bankRetryBackoff(40, config, random)
+            assertTrue(late in 500..1000)
+        }
+    }
+
+    @Test
+    fun hostOfEbicsUrl() {
+        assertEquals("localhost:5000", bankHostOf("http://localhost:5000/ebicsweb"))
+        assertEquals("bank.example.com", bankHostOf("https://bank.example.com/ebics"))
+    }
+}
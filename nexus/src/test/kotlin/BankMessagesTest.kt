@@ -0,0 +1,152 @@
+package tech.libeufin.nexus
+
+import org.jetbrains.exposed.dao.id.IntIdTable
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.deleteAll
+import org.jetbrains.exposed.sql.insert
+import org.jetbrains.exposed.sql.statements.api.ExposedBlob
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import tech.libeufin.nexus.bankaccount.ingestBankMessagesIntoAccount
+import tech.libeufin.nexus.server.BANK_MESSAGES_MAX_PAGE
+import tech.libeufin.nexus.server.ensurePageLimit
+import kotlin.test.assertEquals
+import kotlin.test.assertFailsWith
+import kotlin.test.assertNull
+import kotlin.test.assertTrue
+
+/**
+ * The bank messages table as older versions created it.
+ */
+private object UncompressedBankMessagesTable : IntIdTable("NexusBankMessages") {
+    val bankConnection = reference("bankConnection", NexusBankConnectionsTable)
+    val messageId = text("messageId")
+    val code = text("code")
+    val message = blob("message")
+}
+
+class BankMessagesTest {
+    private val document = ("<Document>" + "<Ntry>entry</Ntry>".repeat(200) + "</Document>").toByteArray()
+
+    @Test
+    fun migrateAndList() {
+        withTestDatabase {
+            val connId = transaction {
+                SchemaUtils.create(NexusUsersTable, NexusBankConnectionsTable, UncompressedBankMessagesTable)
+                val user = NexusUserEntity.new("u") {
+                    passwordHash = "x"
+                    superuser = true
+                }
+                val conn = NexusBankConnectionEntity.new("conn") {
+                    type = "ebics"
+                    owner = user
+                }
+                UncompressedBankMessagesTable.insert {
+                    it[bankConnection] = conn.id
+                    it[messageId] = "old"
+                    it[code] = "C53"
+                    it[message] = ExposedBlob(document)
+                }
+                conn.id
+            }
+            transaction {
+                SchemaUtils.createMissingTablesAndColumns(NexusBankMessagesTable)
+            }
+            migrateBankMessages()
+            transaction {
+                val conn = NexusBankConnectionEntity.findById(connId)!!
+                storeBankMessage(conn, "C52", "new", compressBankMessage(document))
+
+                val infos = findBankMessageInfos(connId, null, 10)
+                assertEquals(listOf("old", "new"), infos.map { it.messageId })
+                for (info in infos) {
+                    assertEquals(document.size.toLong(), info.length)
+                    assertTrue(info.storedLength < info.length)
+                    assertEquals(compressBankMessage(document).hash, info.hash)
+                }
+                assertNull(infos[0].creationTime)
+                assertEquals(listOf("new"), findBankMessageInfos(connId, infos[0].id, 10).map { it.messageId })
+
+                NexusBankMessageEntity.all().forEach { msg ->
+                    assertEquals(BANK_MESSAGE_DEFLATE, msg.compression)
+                    assertTrue(document.contentEquals(msg.openContent().use { it.readAllBytes() }))
+                }
+            }
+        }
+    }
+
+    @Test
+    fun ingestionWatermark() {
+        val statement = ClassLoader.getSystemClassLoader()
+            .getResource("iso20022-samples/camt.053/de.camt.053.001.02.xml")!!.readText()
+        withTestDatabase {
+            transaction {
+                SchemaUtils.create(
+                    NexusUsersTable,
+                    NexusBankConnectionsTable,
+                    NexusBankAccountsTable,
+                    NexusBankMessagesTable,
+                    NexusBankTransactionsTable,
+                    PaymentInitiationsTable
+                )
+                val user = NexusUserEntity.new("u") {
+                    passwordHash = "x"
+                    superuser = true
+                }
+                val conn = NexusBankConnectionEntity.new("conn") {
+                    type = "ebics"
+                    owner = user
+                }
+                NexusBankAccountEntity.new("acct") {
+                    iban = "DE54123456784713474163"
+                    bankCode = "TESTDEXX"
+                    accountHolder = "u"
+                    defaultBankConnection = conn
+                    highestSeenBankMessageId = 0
+                }
+            }
+            fun storeStatement(messageId: String, content: String): Int = transaction {
+                val conn = NexusBankConnectionEntity.findById("conn")!!
+                storeBankMessage(conn, "C53", messageId, compressBankMessage(content.toByteArray())).id.value
+            }
+            fun watermark(): Int = transaction {
+                NexusBankAccountEntity.findById("acct")!!.highestSeenBankMessageId
+            }
+            fun transactionIds(): List<String> = transaction {
+                NexusBankTransactionEntity.all().map { it.accountTransactionId }
+            }
+
+            storeStatement("first", statement)
+            val secondId = storeStatement("second", statement)
+            ingestBankMessagesIntoAccount("conn", "acct")
+            assertEquals(secondId, watermark())
+            val ingested = transactionIds()
+            assertTrue(ingested.isNotEmpty())
+            assertEquals(ingested.toSet().size, ingested.size)
+
+            // Messages below the watermark are not read again, so the
+            // removed transactions do not come back.
+            transaction { NexusBankTransactionsTable.deleteAll() }
+            ingestBankMessagesIntoAccount("conn", "acct")
+            assertEquals(secondId, watermark())
+            assertTrue(transactionIds().isEmpty())
+
+            val thirdId = storeStatement("third", statement.replace("acctsvcrref-", "later-"))
+            ingestBankMessagesIntoAccount("conn", "acct")
+            assertEquals(thirdId, watermark())
+            val later = transactionIds()
+            assertTrue(later.isNotEmpty())
+            assertTrue(later.none { it.contains("acctsvcrref-") })
+            assertTrue(later.any { it.contains("later-") })
+        }
+    }
+
+    @Test
+    fun pageLimit() {
+        assertEquals(100, ensurePageLimit(null, BANK_MESSAGES_MAX_PAGE))
+        assertEquals(5, ensurePageLimit("5", BANK_MESSAGES_MAX_PAGE))
+        assertFailsWith<NexusError> { ensurePageLimit("0", BANK_MESSAGES_MAX_PAGE) }
+        // Would be 100 once narrowed to an Int.
+        assertFailsWith<NexusError> { ensurePageLimit("4294967396", BANK_MESSAGES_MAX_PAGE) }
+    }
+}
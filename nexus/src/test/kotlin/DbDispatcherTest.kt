@@ -0,0 +1,137 @@
+package tech.libeufin.nexus
+
+import io.ktor.http.HttpStatusCode
+import kotlinx.coroutines.async
+import kotlinx.coroutines.awaitAll
+import kotlinx.coroutines.runBlocking
+import kotlinx.coroutines.withTimeout
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.insert
+import org.jetbrains.exposed.sql.select
+import org.jetbrains.exposed.sql.selectAll
+import org.junit.Test
+import java.util.concurrent.atomic.AtomicInteger
+import kotlin.test.assertEquals
+import kotlin.test.assertFailsWith
+import kotlin.test.assertTrue
+
+private class BrokenWriteError : Error("broken write")
+
+class DbDispatcherTest {
+    @Test
+    fun concurrencyIsCapped() {
+        val running = AtomicInteger()
+        val maxRunning = AtomicInteger()
+        runBlocking {
+            (1..20).map {
+                async {
+                    dbWork {
+                        maxRunning.accumulateAndGet(running.incrementAndGet()) { a, b -> maxOf(a, b) }
+                        Thread.sleep(20)
+                        running.decrementAndGet()
+                    }
+                }
+            }.awaitAll()
+        }
+        assertTrue(maxRunning.get() <= NexusDb.maxConcurrency)
+    }
+
+    @Test
+    fun transactionsAreTimedPerCall() {
+        withTestDatabase {
+            val timing = DbCallTiming()
+            val rows = runBlocking(timing) {
+                dbTransaction {
+                    assertTrue(Thread.currentThread().name.startsWith("nexus-db-"))
+                    SchemaUtils.create(NexusNodesTable)
+                }
+                dbTransaction {
+                    NexusNodesTable.insert {
+                        it[NexusNodesTable.id] = "a"
+                        it[lastSeenSec] = 1L
+                    }
+                }
+                dbTransaction { NexusNodesTable.selectAll().count() }
+            }
+            assertEquals(1L, rows)
+            assertEquals(3L, timing.operations.get())
+        }
+    }
+
+    @Test
+    fun groupedWritesFailAlone() {
+        withTestDatabase {
+            NexusDb.groupCommit = true
+            try {
+                runBlocking {
+                    dbWriteTransaction { SchemaUtils.create(NexusNodesTable) }
+                    val writes = (1..50).map { n ->
+                        async {
+                            runCatching {
+                                dbWriteTransaction {
+                                    NexusNodesTable.insert {
+                                        it[NexusNodesTable.id] = "node-$n"
+                                        it[lastSeenSec] = n.toLong()
+                                    }
+                                    if (n % 10 == 0) {
+                                        throw NexusError(HttpStatusCode.Conflict, "node $n refused")
+                                    }
+                                }
+                            }
+                        }
+                    }.awaitAll()
+                    assertEquals(5, writes.count { it.isFailure })
+                    assertFailsWith<NexusError> { writes[9].getOrThrow() }
+                    assertEquals(45L, dbTransaction { NexusNodesTable.selectAll().count() })
+                }
+            } finally {
+                NexusDb.groupCommit = false
+            }
+        }
+    }
+
+    @Test
+    fun writerSurvivesErrors() {
+        withTestDatabase {
+            NexusDb.groupCommit = true
+            try {
+                runBlocking {
+                    dbWriteTransaction { SchemaUtils.create(NexusNodesTable) }
+                    val writes = (1..20).map { n ->
+                        async {
+                            runCatching {
+                                dbWriteTransaction {
+                                    NexusNodesTable.insert {
+                                        it[NexusNodesTable.id] = "node-$n"
+                                        it[lastSeenSec] = n.toLong()
+                                    }
+                                    if (n == 5) {
+                                        throw BrokenWriteError()
+                                    }
+                                }
+                            }
+                        }
+                    }.awaitAll()
+                    assertFailsWith<BrokenWriteError> { writes[4].getOrThrow() }
+                    assertFailsWith<BrokenWriteError> {
+                        dbWriteTransaction { throw BrokenWriteError() }
+                    }
+                    // The writer still runs the writes queued after the errors.
+                    withTimeout(10000) {
+                        dbWriteTransaction {
+                            NexusNodesTable.insert {
+                                it[NexusNodesTable.id] = "after"
+                                it[lastSeenSec] = 0L
+                            }
+                        }
+                    }
+                    assertEquals(1L, dbTransaction {
+                        NexusNodesTable.select { NexusNodesTable.id eq "after" }.count()
+                    })
+                }
+            } finally {
+                NexusDb.groupCommit = false
+            }
+        }
+    }
+}
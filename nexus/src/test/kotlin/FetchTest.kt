@@ -0,0 +1,112 @@
+package tech.libeufin.nexus
+
+import io.ktor.http.HttpStatusCode
+import kotlinx.coroutines.CompletableDeferred
+import kotlinx.coroutines.runBlocking
+import kotlinx.coroutines.withTimeout
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import tech.libeufin.nexus.bankaccount.fetchBankAccountsTransactions
+import tech.libeufin.nexus.bankaccount.findUserBankAccountIds
+import tech.libeufin.nexus.ebics.downloadConcurrently
+import tech.libeufin.nexus.server.FetchLevel
+import tech.libeufin.nexus.server.FetchSpecLatestJson
+import kotlin.test.assertEquals
+import kotlin.test.assertNull
+import kotlin.test.assertTrue
+
+class FetchTest {
+
+    private fun addAccounts() {
+        transaction {
+            SchemaUtils.create(
+                NexusUsersTable,
+                NexusBankConnectionsTable,
+                NexusBankAccountsTable,
+                NexusBankTransactionsTable,
+                EbicsSubscribersTable
+            )
+            for (name in listOf("alice", "bob")) {
+                val user = NexusUserEntity.new(name) {
+                    passwordHash = ""
+                    superuser = false
+                }
+                val conn = NexusBankConnectionEntity.new("$name-connection") {
+                    owner = user
+                    type = "loopback"
+                }
+                for (n in 1..2) {
+                    NexusBankAccountEntity.new("$name-account-$n") {
+                        iban = "DE54123456784713474163"
+                        bankCode = "TESTDEXX"
+                        accountHolder = name
+                        defaultBankConnection = conn
+                        highestSeenBankMessageId = 0
+                    }
+                }
+            }
+            NexusBankAccountEntity.new("unconnected-account") {
+                iban = "DE54123456784713474163"
+                bankCode = "TESTDEXX"
+                accountHolder = "nobody"
+                highestSeenBankMessageId = 0
+            }
+        }
+    }
+
+    @Test
+    fun fetchAllSelectsTheUserAccounts() {
+        withTestDatabase {
+            addAccounts()
+            assertEquals(
+                listOf("alice-account-1", "alice-account-2"),
+                transaction { findUserBankAccountIds("alice") }
+            )
+        }
+    }
+
+    @Test
+    fun fetchAllReportsEveryAccount() {
+        withTestDatabase {
+            addAccounts()
+            val accountIds = transaction { findUserBankAccountIds("bob") }
+            val results = runBlocking {
+                fetchBankAccountsTransactions(
+                    makeBankHttpClient(),
+                    FetchSpecLatestJson(FetchLevel.ALL, null),
+                    accountIds,
+                    maxConcurrency = 4,
+                    maxConcurrencyPerBankHost = 1
+                )
+            }
+            assertEquals(accountIds, results.map { it.bankAccount })
+            // Loopback connections cannot be fetched: every account reports it.
+            assertTrue(results.all { !it.succeeded && it.errors.size == 1 })
+        }
+    }
+
+    @Test
+    fun failingOrderTypeIsReported() {
+        val c53Started = CompletableDeferred<Unit>()
+        val results = runBlocking {
+            downloadConcurrently(listOf("C52", "C53"), { it }) { orderType ->
+                when (orderType) {
+                    "C52" -> {
+                        // Only returns if C53 runs at the same time.
+                        withTimeout(5000) { c53Started.await() }
+                        throw NexusError(HttpStatusCode.BadGateway, "bank down")
+                    }
+                    else -> {
+                        c53Started.complete(Unit)
+                        "statement".toByteArray()
+                    }
+                }
+            }
+        }
+        assertNull(results[0].first)
+        assertEquals("C52: bank down", results[0].second)
+        assertEquals("statement", results[1].first?.toString(Charsets.UTF_8))
+        assertNull(results[1].second)
+    }
+}
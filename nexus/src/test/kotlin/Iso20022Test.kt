@@ -6,6 +6,7 @@ import tech.libeufin.nexus.iso20022.*
 import tech.libeufin.util.DestructionError
 import tech.libeufin.util.XMLUtil
 import tech.libeufin.util.destructXml
+import java.io.File
 import java.math.BigDecimal
 import kotlin.test.assertEquals
 import kotlin.test.assertNotNull
@@ -72,4 +73,19 @@ class Iso20022Test {
 
         println(jacksonObjectMapper().writerWithDefaultPrettyPrinter().writeValueAsString(r))
     }
+
+    @Test
+    fun testStreamingParserMatchesDom() {
+        val samples = ClassLoader.getSystemClassLoader().getResource("iso20022-samples")
+            ?: throw Exception("samples not found")
+        val files = File(samples.toURI()).walk().filter { it.isFile && it.name.endsWith(".xml") }.toList()
+        assertTrue(files.isNotEmpty())
+        for (f in files) {
+            val expected = parseCamtMessage(XMLUtil.parseStringIntoDom(f.readText()))
+            val streamed = CamtStreamReader(f.inputStream()).use { it.readAll() }
+            assertEquals(expected, streamed, "streamed parse differs for ${f.name}")
+            val entries = CamtStreamReader(f.inputStream()).use { it.entries().toList() }
+            assertEquals(expected.reports.flatMap { it.entries }, entries)
+        }
+    }
 }
@@ -0,0 +1,119 @@
+package tech.libeufin.nexus
+
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import tech.libeufin.nexus.bankaccount.addPaymentInitiation
+import tech.libeufin.nexus.server.Pain001Data
+import java.math.BigDecimal
+import kotlin.test.assertEquals
+import kotlin.test.assertFalse
+import kotlin.test.assertNull
+import kotlin.test.assertTrue
+
+class LeasingTest {
+
+    private fun asNode(id: String, f: () -> Unit) {
+        val previous = NexusNode.id
+        NexusNode.id = id
+        try {
+            f()
+        } finally {
+            NexusNode.id = previous
+        }
+    }
+
+    @Test
+    fun fairSharesAreDisjoint() {
+        val tasks = (1..10).toList()
+        val nodes = listOf("a", "b", "c")
+        val shares = nodes.map { pickFairShare(tasks, nodes, it) }
+        assertEquals(tasks, shares.flatten().sorted())
+        assertTrue(shares.all { it.size <= 4 })
+        // A node not registered yet takes part too.
+        assertEquals(5, pickFairShare(tasks, listOf("a"), "b").size)
+        assertEquals(listOf(), pickFairShare(listOf(), nodes, "a"))
+    }
+
+    @Test
+    fun tasksAreLeasedOnce() {
+        withTestDatabase {
+            transaction {
+                SchemaUtils.create(NexusScheduledTasksTable, NexusNodesTable)
+            }
+            val taskId = transaction {
+                NexusScheduledTaskEntity.new {
+                    resourceType = "bank-account"
+                    resourceId = "acct"
+                    taskName = "fetch"
+                    taskType = "fetch"
+                    taskCronspec = "* * *"
+                    taskParams = "{}"
+                    nextScheduledExecutionSec = 100
+                }.id.value
+            }
+            asNode("a") {
+                assertEquals(listOf(taskId), transaction { findTasksToClaim(100) })
+                assertTrue(transaction { claimScheduledTask(taskId, 100) })
+            }
+            asNode("b") {
+                assertEquals(listOf(), transaction { findTasksToClaim(101) })
+                assertFalse(transaction { claimScheduledTask(taskId, 101) })
+                // Not its lease.
+                completeScheduledTask(taskId, 100)
+                // Node "a" died, its lease expired.
+                val expired = 100 + NexusNode.leaseSeconds + 1
+                assertTrue(transaction { claimScheduledTask(taskId, expired) })
+            }
+            asNode("a") {
+                completeScheduledTask(taskId, 100)
+                assertEquals("b", transaction { NexusScheduledTaskEntity.findById(taskId)!!.leaseOwner })
+            }
+            asNode("b") {
+                completeScheduledTask(taskId, 100)
+                transaction {
+                    val task = NexusScheduledTaskEntity.findById(taskId)!!
+                    assertNull(task.leaseOwner)
+                    assertNull(task.nextScheduledExecutionSec)
+                    assertEquals(100L, task.prevScheduledExecutionSec)
+                }
+            }
+        }
+    }
+
+    @Test
+    fun paymentsAreSubmittedOnce() {
+        withTestDatabase {
+            val paymentId = transaction {
+                SchemaUtils.create(NexusBankAccountsTable, NexusBankConnectionsTable, NexusUsersTable)
+                SchemaUtils.create(NexusBankTransactionsTable, PaymentInitiationsTable)
+                val account = NexusBankAccountEntity.new("acct") {
+                    accountHolder = "Oliver Smith"
+                    iban = "GB33BUKB20201555555555"
+                    bankCode = "BUKBGB22"
+                    highestSeenBankMessageId = 0
+                }
+                addPaymentInitiation(
+                    Pain001Data("FR7630006000011234567890189", "AGRIFRPP", "Jacques La Fayette", BigDecimal.ONE, "EUR", "test"),
+                    account
+                ).id.value
+            }
+            asNode("a") {
+                assertTrue(claimPaymentSubmission(paymentId))
+                // Not even the same node submits it twice at once.
+                assertFalse(claimPaymentSubmission(paymentId))
+            }
+            asNode("b") {
+                assertFalse(claimPaymentSubmission(paymentId))
+                releasePaymentSubmission(paymentId)
+            }
+            asNode("a") {
+                releasePaymentSubmission(paymentId)
+                transaction { PaymentInitiationEntity.findById(paymentId)!!.submitted = true }
+            }
+            asNode("b") {
+                assertFalse(claimPaymentSubmission(paymentId))
+            }
+        }
+    }
+}
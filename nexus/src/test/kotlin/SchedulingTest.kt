@@ -0,0 +1,27 @@
+package tech.libeufin.nexus
+
+import com.fasterxml.jackson.module.kotlin.jacksonObjectMapper
+import org.junit.Test
+import tech.libeufin.nexus.server.FetchLevel
+import tech.libeufin.nexus.server.FetchSpecLatestJson
+import tech.libeufin.nexus.server.FetchSpecSinceLastJson
+import kotlin.test.assertEquals
+import kotlin.test.assertTrue
+
+class SchedulingTest {
+
+    @Test
+    fun scheduledFetchDefaultsToSinceLast() {
+        val spec = parseScheduledFetchSpec(jacksonObjectMapper().readTree("""{"level": "statement"}"""))
+        assertTrue(spec is FetchSpecSinceLastJson)
+        assertEquals(FetchLevel.STATEMENT, spec.level)
+    }
+
+    @Test
+    fun scheduledFetchKeepsExplicitRange() {
+        val spec = parseScheduledFetchSpec(
+            jacksonObjectMapper().readTree("""{"level": "all", "rangeType": "latest"}""")
+        )
+        assertTrue(spec is FetchSpecLatestJson)
+    }
+}
@@ -0,0 +1,77 @@
+package tech.libeufin.nexus
+
+import org.jetbrains.exposed.dao.id.LongIdTable
+import org.jetbrains.exposed.exceptions.ExposedSQLException
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.SortOrder
+import org.jetbrains.exposed.sql.insert
+import org.jetbrains.exposed.sql.selectAll
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import kotlin.test.assertEquals
+import kotlin.test.assertFailsWith
+
+/**
+ * The requested payments table as older versions created it: without
+ * the request hash, and without the unique request_uid index.
+ */
+private object OldTalerRequestedPayments : LongIdTable("TalerRequestedPayments") {
+    val preparedPayment = long("payment")
+    val requestUId = text("request_uid")
+    val amount = text("amount")
+    val exchangeBaseUrl = text("exchange_base_url")
+    val wtid = text("wtid")
+    val creditAccount = text("credit_account")
+}
+
+class TalerTest {
+    private fun request(uid: String) = TalerTransferRequest(
+        uid, "EUR:1", "https://exchange.example.com/", "WTID-$uid", "payto://iban/DE54123456784713474163"
+    )
+
+    @Test
+    fun migrateRequestedPayments() {
+        withTestDatabase {
+            transaction {
+                SchemaUtils.create(OldTalerRequestedPayments)
+                for (uid in listOf("a", "a", "b")) {
+                    val req = request(uid)
+                    OldTalerRequestedPayments.insert {
+                        it[preparedPayment] = 1
+                        it[requestUId] = req.request_uid
+                        it[amount] = req.amount
+                        it[exchangeBaseUrl] = req.exchange_base_url
+                        it[wtid] = req.wtid
+                        it[creditAccount] = req.credit_account
+                    }
+                }
+            }
+            transaction {
+                renameDuplicateTalerRequests()
+                SchemaUtils.createMissingTablesAndColumns(TalerRequestedPayments)
+            }
+            migrateTalerRequestedPayments()
+            transaction {
+                val t = TalerRequestedPayments
+                val rows = t.selectAll().orderBy(t.id to SortOrder.ASC).toList()
+                assertEquals(listOf("a", "a-duplicate-2", "b"), rows.map { it[t.requestUId] })
+                assertEquals(
+                    listOf("a", "a", "b").map { talerTransferRequestHash(request(it)) },
+                    rows.map { it[t.requestHash] }
+                )
+            }
+            assertFailsWith<ExposedSQLException> {
+                transaction {
+                    OldTalerRequestedPayments.insert {
+                        it[preparedPayment] = 1
+                        it[requestUId] = "b"
+                        it[amount] = "EUR:1"
+                        it[exchangeBaseUrl] = "https://exchange.example.com/"
+                        it[wtid] = "WTID-c"
+                        it[creditAccount] = "payto://iban/DE54123456784713474163"
+                    }
+                }
+            }
+        }
+    }
+}
@@ -29,6 +29,7 @@ import org.jetbrains.exposed.dao.id.IntIdTable
 import org.jetbrains.exposed.sql.*
 import org.jetbrains.exposed.sql.transactions.TransactionManager
 import org.jetbrains.exposed.sql.transactions.transaction
+import tech.libeufin.util.logger
 import java.sql.Connection
 
 /**
@@ -150,7 +151,8 @@ class EbicsSubscriberEntity(id: EntityID<Int>) : IntEntity(id) {
 }
 
 /**
- * Details of a download order.
+ * Details of a download order.  The encoded response is dropped
+ * once the receipt arrives; the row itself is left to the reaper.
  */
 object EbicsDownloadTransactionsTable : IdTable<String>() {
     override val id = text("transactionID").entityId()
@@ -162,6 +164,12 @@ object EbicsDownloadTransactionsTable : IdTable<String>() {
     val numSegments = integer("numSegments")
     val segmentSize = integer("segmentSize")
     val receiptReceived = bool("receiptReceived")
+
+    /**
+     * Zero for the transactions begun before the column existed,
+     * which the reaper then takes as abandoned.
+     */
+    val creationTime = long("creationTime").default(0L).index()
 }
 
 class EbicsDownloadTransactionEntity(id: EntityID<String>) : Entity<String>(id) {
@@ -175,10 +183,12 @@ class EbicsDownloadTransactionEntity(id: EntityID<String>) : Entity<String>(id)
     var transactionKeyEnc by EbicsDownloadTransactionsTable.transactionKeyEnc
     var segmentSize by EbicsDownloadTransactionsTable.segmentSize
     var receiptReceived by EbicsDownloadTransactionsTable.receiptReceived
+    var creationTime by EbicsDownloadTransactionsTable.creationTime
 }
 
 /**
- * Details of a upload order.
+ * Details of a upload order.  The upload is complete when
+ * the last segment has been seen.
  */
 object EbicsUploadTransactionsTable : IdTable<String>() {
     override val id = text("transactionID").entityId()
@@ -189,6 +199,11 @@ object EbicsUploadTransactionsTable : IdTable<String>() {
     val numSegments = integer("numSegments")
     val lastSeenSegment = integer("lastSeenSegment")
     val transactionKeyEnc = blob("transactionKeyEnc")
+
+    /**
+     * See EbicsDownloadTransactionsTable.creationTime.
+     */
+    val creationTime = long("creationTime").default(0L).index()
 }
 
 class EbicsUploadTransactionEntity(id: EntityID<String>) : Entity<String>(id) {
@@ -201,12 +216,19 @@ class EbicsUploadTransactionEntity(id: EntityID<String>) : Entity<String>(id) {
     var numSegments by EbicsUploadTransactionsTable.numSegments
     var lastSeenSegment by EbicsUploadTransactionsTable.lastSeenSegment
     var transactionKeyEnc by EbicsUploadTransactionsTable.transactionKeyEnc
+    var creationTime by EbicsUploadTransactionsTable.creationTime
 }
 
 /**
- * FIXME: document this.
+ * Signatures that came along an upload transaction, and
+ * are deleted together with it.
  */
 object EbicsOrderSignaturesTable : IntIdTable() {
+    /**
+     * Empty for the signatures stored before the column existed,
+     * see migrateEbicsUploads().
+     */
+    val transactionID = text("transactionID").default("").index()
     val orderID = text("orderID")
     val orderType = text("orderType")
     val partnerID = text("partnerID")
@@ -218,6 +240,7 @@ object EbicsOrderSignaturesTable : IntIdTable() {
 class EbicsOrderSignatureEntity(id: EntityID<Int>) : IntEntity(id) {
     companion object : IntEntityClass<EbicsOrderSignatureEntity>(EbicsOrderSignaturesTable)
 
+    var transactionID by EbicsOrderSignaturesTable.transactionID
     var orderID by EbicsOrderSignaturesTable.orderID
     var orderType by EbicsOrderSignaturesTable.orderType
     var partnerID by EbicsOrderSignaturesTable.partnerID
@@ -227,18 +250,24 @@ class EbicsOrderSignatureEntity(id: EntityID<Int>) : IntEntity(id) {
 }
 
 /**
- * FIXME: document this.
+ * Segments of the order data received by an upload transaction, as
+ * sent: Base64-encoded and encrypted.  They get decoded and decrypted
+ * together once the last segment arrives.
  */
-object EbicsUploadTransactionChunksTable : IdTable<String>() {
-    override val id =
-        text("transactionID").entityId()
+object EbicsUploadTransactionChunksTable : IntIdTable() {
+    val transactionID = text("transactionID")
     val chunkIndex = integer("chunkIndex")
     val chunkContent = blob("chunkContent")
+
+    init {
+        index(true, transactionID, chunkIndex)
+    }
 }
 
-class EbicsUploadTransactionChunkEntity(id: EntityID<String>) : Entity<String>(id) {
-    companion object : EntityClass<String, EbicsUploadTransactionChunkEntity>(EbicsUploadTransactionChunksTable)
+class EbicsUploadTransactionChunkEntity(id: EntityID<Int>) : IntEntity(id) {
+    companion object : IntEntityClass<EbicsUploadTransactionChunkEntity>(EbicsUploadTransactionChunksTable)
 
+    var transactionID by EbicsUploadTransactionChunksTable.transactionID
     var chunkIndex by EbicsUploadTransactionChunksTable.chunkIndex
     var chunkContent by EbicsUploadTransactionChunksTable.chunkContent
 }
@@ -256,7 +285,7 @@ object BankAccountTransactionsTable : IntIdTable() {
     val subject = text("subject")
     val amount = text("amount")
     val currency = text("currency")
-    val date = long("date")
+    val date = long("date").index()
     val pmtInfId = text("pmtInfId")
     val msgId = text("msgId")
     val account = reference("account", BankAccountsTable)
@@ -302,19 +331,39 @@ class BankAccountEntity(id: EntityID<Int>) : IntEntity(id) {
     var subscriber by EbicsSubscriberEntity referencedOn BankAccountsTable.subscriber
 }
 
+/**
+ * Statement of one closed period of a bank account, rendered once by
+ * the statement-closing job.  The period holds the bookings dated from
+ * periodStart (included) to periodEnd (excluded), in milliseconds.
+ */
 object BankAccountStatementsTable : IntIdTable() {
     val statementId = text("statementId")
     val creationTime = long("creationTime")
-    val xmlMessage = text("xmlMessage")
+    val periodStart = long("periodStart")
+    val periodEnd = long("periodEnd")
+    val numEntries = integer("numEntries")
+
+    /**
+     * ZIP archive of the camt.053 documents, as served to C53 requests.
+     */
+    val camtZip = blob("camtZip")
     val bankAccount = reference("bankAccount", BankAccountsTable)
+
+    init {
+        // One statement per closing: racing closings of one period fail here.
+        index(true, bankAccount, periodEnd)
+    }
 }
 
 class BankAccountStatementsEntity(id: EntityID<Int>) : IntEntity(id) {
     companion object : IntEntityClass<BankAccountStatementsEntity>(BankAccountStatementsTable)
 
     var statementId by BankAccountStatementsTable.statementId
-    var xmlMessage by BankAccountStatementsTable.xmlMessage
     var creationTime by BankAccountStatementsTable.creationTime
+    var periodStart by BankAccountStatementsTable.periodStart
+    var periodEnd by BankAccountStatementsTable.periodEnd
+    var numEntries by BankAccountStatementsTable.numEntries
+    var camtZip by BankAccountStatementsTable.camtZip
     var bankAccount by BankAccountEntity referencedOn BankAccountStatementsTable.bankAccount
 }
 
@@ -336,9 +385,64 @@ class BankAccountReportsTableEntity(id: EntityID<Int>) : IntEntity(id) {
 
 fun dbCreateTables(dbName: String) {
     Database.connect("jdbc:sqlite:${dbName}", "org.sqlite.JDBC")
+    dbCreateSchema()
+}
+
+/**
+ * Names of the columns 'table' has in the database, none if
+ * the table does not exist.  Needs to be called within a
+ * transaction block.
+ */
+private fun Transaction.columnsInDatabase(table: Table): List<String> {
+    return exec("SELECT name FROM pragma_table_info('${table.tableName}')") {
+        generateSequence { if (it.next()) it.getString(1) else null }.toList()
+    } ?: listOf()
+}
+
+/**
+ * Older versions stored the upload chunks under the transaction ID
+ * as primary key, already decoded, and did not tie the signatures to
+ * their transaction.  The uploads still running on such a database
+ * cannot complete anymore: drop them, so that the clients start over.
+ * Needs to be called within a transaction block, before the tables
+ * get created.
+ */
+private fun Transaction.migrateEbicsUploads() {
+    val chunkColumns = columnsInDatabase(EbicsUploadTransactionChunksTable)
+    if (chunkColumns.isEmpty() || chunkColumns.contains("id")) {
+        return
+    }
+    SchemaUtils.drop(EbicsUploadTransactionChunksTable)
+    val uploads = EbicsUploadTransactionsTable.deleteAll()
+    val signatures = EbicsOrderSignaturesTable.deleteAll()
+    logger.warn("Dropped $uploads EBICS upload transactions ($signatures signatures) stored by an older version")
+}
+
+/**
+ * Older versions kept one camt.053 message per statement, without its
+ * period.  The statement-closing job renders all the closed periods
+ * again from the bookings once the table is recreated.  Needs to be
+ * called within a transaction block, before the tables get created.
+ */
+private fun Transaction.migrateBankAccountStatements() {
+    val columns = columnsInDatabase(BankAccountStatementsTable)
+    if (columns.isEmpty() || columns.contains("periodEnd")) {
+        return
+    }
+    SchemaUtils.drop(BankAccountStatementsTable)
+    logger.warn("Dropped the statements stored by an older version, they get closed again")
+}
+
+/**
+ * Create the tables missing in the database connected last, and
+ * bring the tables of older versions up to date.
+ */
+fun dbCreateSchema() {
     TransactionManager.manager.defaultIsolationLevel = Connection.TRANSACTION_SERIALIZABLE
     transaction {
         addLogger(StdOutSqlLogger)
+        migrateEbicsUploads()
+        migrateBankAccountStatements()
         SchemaUtils.create(
             EbicsSubscribersTable,
             EbicsHostsTable,
@@ -351,5 +455,12 @@ fun dbCreateTables(dbName: String) {
             BankAccountReportsTable,
             BankAccountStatementsTable
         )
+        // Databases made before the reaper lack the creation times
+        // and the transaction of the signatures.
+        SchemaUtils.createMissingTablesAndColumns(
+            EbicsDownloadTransactionsTable,
+            EbicsUploadTransactionsTable,
+            EbicsOrderSignaturesTable
+        )
     }
 }
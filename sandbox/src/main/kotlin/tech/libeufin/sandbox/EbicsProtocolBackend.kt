@@ -52,6 +52,9 @@ import tech.libeufin.util.ebics_hev.HEVResponse
 import tech.libeufin.util.ebics_hev.SystemReturnCodeType
 import tech.libeufin.util.ebics_s001.SignatureTypes
 import tech.libeufin.util.ebics_s001.UserSignatureData
+import java.io.InputStream
+import java.io.SequenceInputStream
+import java.security.MessageDigest
 import java.security.interfaces.RSAPrivateCrtKey
 import java.security.interfaces.RSAPublicKey
 import java.sql.SQLException
@@ -108,6 +111,39 @@ private class EbicsInvalidOrderType : EbicsRequestError(
     "091005"
 )
 
+/**
+ * Thrown when a subscriber opens a new transaction while already
+ * having too many of them in flight.
+ */
+class EbicsMaxTransactionsExceededError : EbicsRequestError(
+    "[EBICS_MAX_TRANSACTIONS_EXCEEDED] Too many transactions in flight",
+    "091119"
+)
+
+/**
+ * Thrown when an upload sends more segments than announced
+ * in its initialization.
+ */
+class EbicsSegmentNumberExceededError : EbicsRequestError(
+    "[EBICS_TX_SEGMENT_NUMBER_EXCEEDED] Segment number exceeded",
+    "091104"
+)
+
+/**
+ * Header through which a test proxy asks for an EBICS error
+ * (see integration-tests/faultproxy.py).  It is honoured only when
+ * the sandbox runs with --allow-ebics-fault-injection.
+ */
+const val EBICS_FAULT_HEADER = "X-LibEuFin-Ebics-Fault"
+
+/**
+ * The error asked for through EBICS_FAULT_HEADER.
+ */
+class EbicsInjectedFaultError(errorCode: String) : EbicsRequestError(
+    "[EBICS_INJECTED_FAULT] Error injected by the test setup",
+    errorCode
+)
+
 private suspend fun ApplicationCall.respondEbicsKeyManagement(
     errorText: String,
     errorCode: String,
@@ -206,7 +242,8 @@ fun buildCamtString(type: Int, subscriberIban: String, history: MutableList<RawP
                     element("BkToCstmrStmt") {
                         element("GrpHdr") {
                             element("MsgId") {
-                                text("sandbox-${now.millis()}")
+                                // Many documents get built within the same millisecond.
+                                text("sandbox-${now.millis()}-${ret.size}")
                             }
                             element("CreDtTm") {
                                 text(zonedDateTime)
@@ -444,54 +481,82 @@ fun buildCamtString(type: Int, subscriberIban: String, history: MutableList<RawP
 }
 
 /**
- * Builds CAMT response.
- *
- * @param type 52 or 53.
+ * Date range of a C52 / C53 order, in milliseconds.  The range is
+ * made of whole days, both included.  Without range, the whole history.
  */
-private fun constructCamtResponse(
-    type: Int,
-    header: EbicsRequest.Header,
-    subscriber: EbicsSubscriberEntity
-): MutableList<String> {
-
+private fun requestedCamtRange(header: EbicsRequest.Header): Pair<Long, Long> {
     val dateRange = (header.static.orderDetails?.orderParams as EbicsRequest.StandardOrderParams).dateRange
-    val (start: LocalDateTime, end: LocalDateTime) = if (dateRange != null) {
+    return if (dateRange != null) {
         Pair(
-            importDateFromMillis(dateRange.start.toGregorianCalendar().timeInMillis),
-            importDateFromMillis(dateRange.end.toGregorianCalendar().timeInMillis)
+            dateRange.start.toGregorianCalendar().toZonedDateTime().toInstant().toEpochMilli(),
+            dateRange.end.toGregorianCalendar().toZonedDateTime().plusDays(1).toInstant().toEpochMilli() - 1
         )
-    } else Pair(parseDashedDate("1970-01-01"), LocalDateTime.now())
+    } else Pair(0L, Long.MAX_VALUE)
+}
+
+/**
+ * Bookings that involve 'iban', dated from 'start' to 'end' (both
+ * included, in milliseconds).  Needs to be called within a transaction block.
+ */
+fun getBankAccountHistory(iban: String, start: Long, end: Long): MutableList<RawPayment> {
+    logger.debug("Querying transactions involving: $iban")
     val history = mutableListOf<RawPayment>()
-    val bankAccount = getBankAccountFromSubscriber(subscriber)
-    transaction {
-        logger.debug("Querying transactions involving: ${bankAccount.iban}")
-        BankAccountTransactionsTable.select {
-            BankAccountTransactionsTable.creditorIban eq bankAccount.iban or
-                    (BankAccountTransactionsTable.debitorIban eq bankAccount.iban)
-            /**
-            FIXME: add the following condition too:
-            and (BankAccountTransactionsTable.date.between(start.millis, end.millis))
-             */
-        }.forEach {
-            history.add(
-                RawPayment(
-                    subject = it[subject],
-                    creditorIban = it[creditorIban],
-                    creditorBic = it[creditorBic],
-                    creditorName = it[creditorName],
-                    debitorIban = it[debitorIban],
-                    debitorBic = it[debitorBic],
-                    debitorName = it[debitorName],
-                    date = importDateFromMillis(it[date]).toDashedDate(),
-                    amount = it[amount],
-                    currency = it[currency],
-                    uid = "${it[pmtInfId]}-${it[msgId]}"
-                )
+    BankAccountTransactionsTable.select {
+        (BankAccountTransactionsTable.creditorIban eq iban or
+                (BankAccountTransactionsTable.debitorIban eq iban)) and
+                BankAccountTransactionsTable.date.between(start, end)
+    }.forEach {
+        history.add(
+            RawPayment(
+                subject = it[subject],
+                creditorIban = it[creditorIban],
+                creditorBic = it[creditorBic],
+                creditorName = it[creditorName],
+                debitorIban = it[debitorIban],
+                debitorBic = it[debitorBic],
+                debitorName = it[debitorName],
+                date = importDateFromMillis(it[date]).toDashedDate(),
+                amount = it[amount],
+                currency = it[currency],
+                uid = "${it[pmtInfId]}-${it[msgId]}"
             )
-        }
-        history
+        )
+    }
+    return history
+}
+
+/**
+ * Render the camt documents of a history, validated and zipped.
+ *
+ * @param type 52 or 53.
+ */
+fun renderCamtZip(type: Int, iban: String, history: MutableList<RawPayment>): ByteArray {
+    // FIXME: this function should be replaced with one that fills only
+    // *one* CAMT document with multiple "Ntry" elements.
+    val family = if (type == 52) XmlSchemaFamily.CAMT_052 else XmlSchemaFamily.CAMT_053
+    return buildCamtString(type, iban, history).map {
+        if (!XMLUtil.validateFromString(it, family)) throw SandboxError(
+            HttpStatusCode.InternalServerError,
+            "CAMT document was generated invalid"
+        )
+        it.toByteArray(Charsets.UTF_8)
+    }.zip()
+}
+
+/**
+ * Camt of the requested range that falls into the open period of the
+ * account, the only one that is generated on request.  Only the C52
+ * reports cover it.
+ */
+private fun generateOpenPeriodCamt(type: Int, bankAccount: BankAccountEntity, start: Long, end: Long): ByteArray? {
+    val liveStart = maxOf(start, openPeriodStart(bankAccount.id.value))
+    if (liveStart > end) {
+        return null
+    }
+    return logStageTiming("sandbox-camt-generation") {
+        val history = transaction { getBankAccountHistory(bankAccount.iban, liveStart, end) }
+        renderCamtZip(type, bankAccount.iban, history)
     }
-    return buildCamtString(type, bankAccount.iban, history)
 }
 
 /**
@@ -593,22 +658,25 @@ private fun handleCct(paymentRequest: String, initiatorName: String, ctx: Reques
     }
 }
 
+/**
+ * Reports cover the open period only: what the statements do not cover yet.
+ */
+private fun handleEbicsC52(requestContext: RequestContext): ByteArray {
+    logger.debug("Handling C52 request")
+    val (start, end) = requestedCamtRange(requestContext.requestObject.header)
+    val bankAccount = getBankAccountFromSubscriber(requestContext.subscriber)
+    return generateOpenPeriodCamt(52, bankAccount, start, end) ?: listOf<ByteArray>().zip()
+}
+
+/**
+ * Statements are served as stored by the statement-closing job.  The
+ * open period has no statement yet: its bookings are in the C52 reports.
+ */
 private fun handleEbicsC53(requestContext: RequestContext): ByteArray {
     logger.debug("Handling C53 request")
-    val camt = constructCamtResponse(
-        53,
-        requestContext.requestObject.header,
-        requestContext.subscriber
-    )
-    // FIXME: this function should be replaced with one that fills only
-    // *one* CAMT document with multiple "Ntry" elements.
-    return camt.map {
-        if (!XMLUtil.validateFromString(it)) throw SandboxError(
-            HttpStatusCode.InternalServerError,
-            "CAMT document was generated invalid"
-        )
-        it.toByteArray(Charsets.UTF_8)
-    }.zip()
+    val (start, end) = requestedCamtRange(requestContext.requestObject.header)
+    val bankAccount = getBankAccountFromSubscriber(requestContext.subscriber)
+    return getClosedStatements(bankAccount.id.value, start, end).mergeZips()
 }
 
 private suspend fun ApplicationCall.handleEbicsHia(header: EbicsUnsecuredRequest.Header, orderData: ByteArray) {
@@ -707,7 +775,7 @@ private suspend fun ApplicationCall.handleEbicsHpb(
     requestDocument: Document,
     header: EbicsNpkdRequest.Header
 ) {
-    val subscriberKeys = transaction {
+    val subscriberKeys = readTransaction {
         val ebicsSubscriber =
             findEbicsSubscriber(header.static.partnerID, header.static.userID, header.static.systemID)
         if (ebicsSubscriber == null) {
@@ -764,7 +832,7 @@ private suspend fun ApplicationCall.handleEbicsHpb(
  * Find the ebics host corresponding to the one specified in the header.
  */
 private fun ApplicationCall.ensureEbicsHost(requestHostID: String): EbicsHostPublicInfo {
-    return transaction {
+    return readTransaction {
         addLogger(StdOutSqlLogger)
         val ebicsHost =
             EbicsHostEntity.find { EbicsHostsTable.hostID.upperCase() eq requestHostID.toUpperCase() }.firstOrNull()
@@ -909,15 +977,33 @@ private data class RequestContext(
     val ebicsHost: EbicsHostEntity,
     val subscriber: EbicsSubscriberEntity,
     val clientEncPub: RSAPublicKey,
-    val clientAuthPub: RSAPublicKey,
     val clientSigPub: RSAPublicKey,
     val hostEncPriv: RSAPrivateCrtKey,
     val hostAuthPriv: RSAPrivateCrtKey,
     val requestObject: EbicsRequest,
     val uploadTransaction: EbicsUploadTransactionEntity?,
-    val downloadTransaction: EbicsDownloadTransactionEntity?
+    val downloadTransaction: EbicsDownloadTransactionEntity?,
+    val deriveTransactionIds: Boolean = false
 )
 
+/**
+ * ID for a transaction opened by the current request.  With
+ * 'deriveTransactionIds', it is a hash of the request's nonce: a
+ * replayed initialization then gets the same ID as the recorded one,
+ * and the replayed requests that follow it, signed with that ID, fit.
+ */
+private fun newTransactionId(requestContext: RequestContext): String {
+    if (!requestContext.deriveTransactionIds) {
+        return EbicsOrderUtil.generateTransactionId()
+    }
+    val static = requestContext.requestObject.header.static
+    val nonce = static.nonce ?: throw EbicsInvalidRequestError()
+    val digest = MessageDigest.getInstance("SHA-256")
+    digest.update(static.hostID.toByteArray(Charsets.UTF_8))
+    digest.update(nonce)
+    return digest.digest().copyOf(16).toHexString().toUpperCase()
+}
+
 private fun handleEbicsDownloadTransactionTransfer(requestContext: RequestContext): EbicsResponse {
     val segmentNumber =
         requestContext.requestObject.header.mutable.segmentNumber?.value ?: throw EbicsInvalidRequestError()
@@ -940,15 +1026,14 @@ private fun handleEbicsDownloadTransactionInitialization(requestContext: Request
     val response = when (orderType) {
         "HTD" -> handleEbicsHtd(requestContext)
         "HKD" -> handleEbicsHkd(requestContext)
-        /* Temporarily handling C52/C53 with same logic */
         "C53" -> handleEbicsC53(requestContext)
-        "C52" -> handleEbicsC53(requestContext) // why?
+        "C52" -> handleEbicsC52(requestContext)
         "TSD" -> handleEbicsTSD(requestContext)
         "PTK" -> handleEbicsPTK(requestContext)
         else -> throw EbicsInvalidXmlError()
     }
 
-    val transactionID = EbicsOrderUtil.generateTransactionId()
+    val transactionID = newTransactionId(requestContext)
 
     val compressedResponse = DeflaterInputStream(response.inputStream()).use {
         it.readAllBytes()
@@ -970,6 +1055,7 @@ private fun handleEbicsDownloadTransactionInitialization(requestContext: Request
         this.encodedResponse = encodedResponse
         this.numSegments = numSegments
         this.receiptReceived = false
+        this.creationTime = Instant.now().toEpochMilli()
     }
     return EbicsResponse.createForDownloadInitializationPhase(
         transactionID,
@@ -984,12 +1070,13 @@ private fun handleEbicsDownloadTransactionInitialization(requestContext: Request
 private fun handleEbicsUploadTransactionInitialization(requestContext: RequestContext): EbicsResponse {
     val orderType =
         requestContext.requestObject.header.static.orderDetails?.orderType ?: throw EbicsInvalidRequestError()
-    val transactionID = EbicsOrderUtil.generateTransactionId()
+    val transactionID = newTransactionId(requestContext)
     val oidn = requestContext.subscriber.nextOrderID++
     if (EbicsOrderUtil.checkOrderIDOverflow(oidn)) throw NotImplementedError()
     val orderID = EbicsOrderUtil.computeOrderIDFromNumber(oidn)
     val numSegments =
         requestContext.requestObject.header.static.numSegments ?: throw EbicsInvalidRequestError()
+    if (numSegments.signum() <= 0) throw EbicsInvalidRequestError()
     val transactionKeyEnc =
         requestContext.requestObject.body.dataTransfer?.dataEncryptionInfo?.transactionKey
             ?: throw EbicsInvalidRequestError()
@@ -1017,6 +1104,7 @@ private fun handleEbicsUploadTransactionInitialization(requestContext: RequestCo
         this.orderID = orderID
         this.numSegments = numSegments.toInt()
         this.transactionKeyEnc = ExposedBlob(transactionKeyEnc)
+        this.creationTime = Instant.now().toEpochMilli()
     }
     logger.debug("after SQL flush")
     val sigObj = XMLUtil.convertStringToJaxb<UserSignatureData>(plainSigData.toString(Charsets.UTF_8))
@@ -1024,6 +1112,7 @@ private fun handleEbicsUploadTransactionInitialization(requestContext: RequestCo
     for (sig in sigObj.value.orderSignatureList ?: listOf()) {
         logger.debug("inserting order signature for orderID $orderID and orderType $orderType")
         EbicsOrderSignatureEntity.new {
+            this.transactionID = transactionID
             this.orderID = orderID
             this.orderType = orderType
             this.partnerID = sig.partnerID
@@ -1035,72 +1124,124 @@ private fun handleEbicsUploadTransactionInitialization(requestContext: RequestCo
     return EbicsResponse.createForUploadInitializationPhase(transactionID, orderID)
 }
 
+/**
+ * The Base64-encoded order data of an upload transaction, read back
+ * from the stored segments one at a time.  The rows are selected
+ * without the DAO, so that no segment lingers in the entity cache.
+ */
+private fun uploadChunksStream(transactionID: String, numChunks: Int): InputStream {
+    val chunks = (1..numChunks).asSequence().map { chunkIndex ->
+        val row = EbicsUploadTransactionChunksTable.slice(EbicsUploadTransactionChunksTable.chunkContent).select {
+            (EbicsUploadTransactionChunksTable.transactionID eq transactionID) and
+                    (EbicsUploadTransactionChunksTable.chunkIndex eq chunkIndex)
+        }.firstOrNull() ?: throw EbicsInvalidRequestError()
+        row[EbicsUploadTransactionChunksTable.chunkContent].bytes.inputStream()
+    }.iterator()
+    return SequenceInputStream(object : Enumeration<InputStream> {
+        override fun hasMoreElements(): Boolean = chunks.hasNext()
+        override fun nextElement(): InputStream = chunks.next()
+    })
+}
+
 private fun handleEbicsUploadTransactionTransmission(requestContext: RequestContext): EbicsResponse {
     val uploadTransaction = requestContext.uploadTransaction ?: throw EbicsInvalidRequestError()
     val requestObject = requestContext.requestObject
-    val requestSegmentNumber =
-        requestContext.requestObject.header.mutable.segmentNumber?.value?.toInt() ?: throw EbicsInvalidRequestError()
+    val segmentNumber = requestObject.header.mutable.segmentNumber ?: throw EbicsInvalidRequestError()
+    val requestSegmentNumber = segmentNumber.value?.toInt() ?: throw EbicsInvalidRequestError()
     val requestTransactionID = requestObject.header.static.transactionID ?: throw EbicsInvalidRequestError()
-    if (requestSegmentNumber == 1 && uploadTransaction.numSegments == 1) {
-        val encOrderData =
-            requestObject.body.dataTransfer?.orderData ?: throw EbicsInvalidRequestError()
-        val zippedData = CryptoUtil.decryptEbicsE002(
-            uploadTransaction.transactionKeyEnc.bytes,
-            Base64.getDecoder().decode(encOrderData),
-            requestContext.hostEncPriv
+    if (requestSegmentNumber > uploadTransaction.numSegments) {
+        throw EbicsSegmentNumberExceededError()
+    }
+    // Segments come in order, and only once.
+    if (requestSegmentNumber != uploadTransaction.lastSeenSegment + 1) {
+        throw EbicsInvalidRequestError()
+    }
+    val isLastSegment = requestSegmentNumber == uploadTransaction.numSegments
+    if ((segmentNumber.lastSegment ?: false) != isLastSegment) {
+        throw EbicsInvalidRequestError()
+    }
+    val encOrderData =
+        requestObject.body.dataTransfer?.orderData ?: throw EbicsInvalidRequestError()
+    // The segments are cut from one Base64 encoding, and decoded
+    // together: only the last one may end with padding.
+    if (!isLastSegment && (encOrderData.length % 4 != 0 || encOrderData.contains('='))) {
+        throw EbicsInvalidRequestError()
+    }
+    EbicsUploadTransactionChunksTable.insert {
+        it[transactionID] = uploadTransaction.id.value
+        it[chunkIndex] = requestSegmentNumber
+        it[chunkContent] = ExposedBlob(encOrderData.toByteArray(Charsets.US_ASCII))
+    }
+    uploadTransaction.lastSeenSegment = requestSegmentNumber
+    if (!isLastSegment) {
+        return EbicsResponse.createForUploadTransferPhase(
+            requestTransactionID,
+            requestSegmentNumber,
+            false,
+            uploadTransaction.orderID
         )
-        val unzippedData =
-            InflaterInputStream(zippedData.inputStream()).use { it.readAllBytes() }
-        logger.debug("got upload data: ${unzippedData.toString(Charsets.UTF_8)}")
+    }
 
-        val sigs = EbicsOrderSignatureEntity.find {
-            (EbicsOrderSignaturesTable.orderID eq uploadTransaction.orderID) and
-                    (EbicsOrderSignaturesTable.orderType eq uploadTransaction.orderType)
-        }
-        if (sigs.count() == 0L) {
-            throw EbicsInvalidRequestError()
-        }
-        for (sig in sigs) {
-            if (sig.signatureAlgorithm == "A006") {
-
-                val signedData = CryptoUtil.digestEbicsOrderA006(unzippedData)
-                val res1 = CryptoUtil.verifyEbicsA006(
-                    sig.signatureValue.bytes,
-                    signedData,
-                    requestContext.clientSigPub
-                )
+    // All the segments are in: decrypt and inflate them while reading.
+    val zippedData = CryptoUtil.decryptEbicsE002Stream(
+        uploadTransaction.transactionKeyEnc.bytes,
+        Base64.getDecoder().wrap(uploadChunksStream(uploadTransaction.id.value, uploadTransaction.numSegments)),
+        requestContext.hostEncPriv
+    )
+    val unzippedData =
+        InflaterInputStream(zippedData).use { it.readAllBytes() }
+    logger.debug("got upload data: ${unzippedData.size} bytes in ${uploadTransaction.numSegments} segment(s)")
 
-                if (!res1) {
-                    throw EbicsInvalidRequestError()
-                }
+    // Order IDs are only unique per subscriber, the transaction ID is not.
+    val sigs = EbicsOrderSignatureEntity.find {
+        EbicsOrderSignaturesTable.transactionID eq uploadTransaction.id.value
+    }
+    if (sigs.count() == 0L) {
+        throw EbicsInvalidRequestError()
+    }
+    for (sig in sigs) {
+        if (sig.signatureAlgorithm == "A006") {
+
+            val signedData = CryptoUtil.digestEbicsOrderA006(unzippedData)
+            val res1 = CryptoUtil.verifyEbicsA006(
+                sig.signatureValue.bytes,
+                signedData,
+                requestContext.clientSigPub
+            )
 
-            } else {
-                throw NotImplementedError()
+            if (!res1) {
+                throw EbicsInvalidRequestError()
             }
+
+        } else {
+            throw NotImplementedError()
         }
-        if (getOrderTypeFromTransactionId(requestTransactionID) == "CCT") {
-            logger.debug("Attempting a payment.")
-            val involvedBankAccout = getBankAccountFromSubscriber(requestContext.subscriber)
-            handleCct(unzippedData.toString(Charsets.UTF_8), involvedBankAccout.name, requestContext)
-        }
-        return EbicsResponse.createForUploadTransferPhase(
-            requestTransactionID,
-            requestSegmentNumber,
-            true,
-            uploadTransaction.orderID
-        )
-    } else {
-        throw NotImplementedError()
     }
+    if (getOrderTypeFromTransactionId(requestTransactionID) == "CCT") {
+        logger.debug("Attempting a payment.")
+        val involvedBankAccout = getBankAccountFromSubscriber(requestContext.subscriber)
+        handleCct(unzippedData.toString(Charsets.UTF_8), involvedBankAccout.name, requestContext)
+    }
+    return EbicsResponse.createForUploadTransferPhase(
+        requestTransactionID,
+        requestSegmentNumber,
+        true,
+        uploadTransaction.orderID
+    )
 }
-// req.header.static.hostID.
-private fun makeReqestContext(requestObject: EbicsRequest): RequestContext {
+/**
+ * The subscriber that sent a request, found through the transaction
+ * the request continues, or else through the partner and user it names.
+ */
+private class RequestSubscriber(
+    val subscriber: EbicsSubscriberEntity,
+    val downloadTransaction: EbicsDownloadTransactionEntity?,
+    val uploadTransaction: EbicsUploadTransactionEntity?
+)
+
+private fun findRequestSubscriber(requestObject: EbicsRequest): RequestSubscriber {
     val staticHeader = requestObject.header.static
-    val requestedHostId = staticHeader.hostID
-    val ebicsHost =
-        EbicsHostEntity.find { EbicsHostsTable.hostID.upperCase() eq requestedHostId.toUpperCase() }
-            .firstOrNull()
-    val requestTransactionID = requestObject.header.static.transactionID
+    val requestTransactionID = staticHeader.transactionID
     var downloadTransaction: EbicsDownloadTransactionEntity? = null
     var uploadTransaction: EbicsUploadTransactionEntity? = null
     val subscriber = if (requestTransactionID != null) {
@@ -1118,14 +1259,36 @@ private fun makeReqestContext(requestObject: EbicsRequest): RequestContext {
         findEbicsSubscriber(partnerID, userID, staticHeader.systemID)
     }
 
-    if (ebicsHost == null) throw EbicsInvalidRequestError()
-
     /**
      * NOTE: production logic must check against READY state (the
      * one activated after the subscriber confirms their keys via post)
      */
     if (subscriber == null || subscriber.state != SubscriberState.INITIALIZED)
         throw EbicsSubscriberStateError()
+    return RequestSubscriber(subscriber, downloadTransaction, uploadTransaction)
+}
+
+/**
+ * Authentication key of the subscriber that sent a request, the
+ * only key needed to check its signature.
+ */
+private fun findRequestAuthenticationKey(requestObject: EbicsRequest): RSAPublicKey {
+    val subscriber = findRequestSubscriber(requestObject).subscriber
+    return CryptoUtil.loadRsaPublicKey(subscriber.authenticationKey!!.rsaPublicKey.bytes)
+}
+
+// req.header.static.hostID.
+private fun makeReqestContext(requestObject: EbicsRequest, deriveTransactionIds: Boolean): RequestContext {
+    val requestedHostId = requestObject.header.static.hostID
+    val ebicsHost =
+        EbicsHostEntity.find { EbicsHostsTable.hostID.upperCase() eq requestedHostId.toUpperCase() }
+            .firstOrNull()
+    val found = findRequestSubscriber(requestObject)
+    val subscriber = found.subscriber
+    val downloadTransaction = found.downloadTransaction
+    val uploadTransaction = found.uploadTransaction
+
+    if (ebicsHost == null) throw EbicsInvalidRequestError()
 
     val hostAuthPriv = CryptoUtil.loadRsaPrivateKey(
         ebicsHost.authenticationPrivateKey.bytes
@@ -1133,8 +1296,6 @@ private fun makeReqestContext(requestObject: EbicsRequest): RequestContext {
     val hostEncPriv = CryptoUtil.loadRsaPrivateKey(
         ebicsHost.encryptionPrivateKey.bytes
     )
-    val clientAuthPub =
-        CryptoUtil.loadRsaPublicKey(subscriber.authenticationKey!!.rsaPublicKey.bytes)
     val clientEncPub =
         CryptoUtil.loadRsaPublicKey(subscriber.encryptionKey!!.rsaPublicKey.bytes)
     val clientSigPub =
@@ -1143,18 +1304,34 @@ private fun makeReqestContext(requestObject: EbicsRequest): RequestContext {
     return RequestContext(
         hostAuthPriv = hostAuthPriv,
         hostEncPriv = hostEncPriv,
-        clientAuthPub = clientAuthPub,
         clientEncPub = clientEncPub,
         clientSigPub = clientSigPub,
         ebicsHost = ebicsHost,
         requestObject = requestObject,
         subscriber = subscriber,
         downloadTransaction = downloadTransaction,
-        uploadTransaction = uploadTransaction
+        uploadTransaction = uploadTransaction,
+        deriveTransactionIds = deriveTransactionIds
     )
 }
 
-suspend fun ApplicationCall.ebicsweb() {
+/**
+ * Serve one EBICS request.  Subscribers having 'maxInFlightTransactions'
+ * transactions in flight can not open new ones, until some complete
+ * or get reaped.  'deriveTransactionIds' is for replaying recorded
+ * traffic, see newTransactionId().  With 'allowFaultInjection', signed
+ * requests carrying EBICS_FAULT_HEADER fail with the EBICS return code
+ * it names, and leave the transaction state untouched.
+ */
+suspend fun ApplicationCall.ebicsweb(
+    maxInFlightTransactions: Int = DEFAULT_MAX_IN_FLIGHT_EBICS_TRANSACTIONS,
+    deriveTransactionIds: Boolean = false,
+    allowFaultInjection: Boolean = false
+) {
+    val injectedFault = if (allowFaultInjection) request.headers[EBICS_FAULT_HEADER] else null
+    if (injectedFault != null && !Regex("[0-9]{6}").matches(injectedFault)) {
+        throw SandboxError(HttpStatusCode.BadRequest, "$EBICS_FAULT_HEADER must be a six digits return code")
+    }
     val requestDocument = receiveEbicsXml()
 
     LOGGER.info("Processing ${requestDocument.documentElement.localName}")
@@ -1201,17 +1378,28 @@ suspend fun ApplicationCall.ebicsweb() {
         "ebicsRequest" -> {
             logger.debug("ebicsRequest ${XMLUtil.convertDomToString(requestDocument)}")
             val requestObject = requestDocument.toObject<EbicsRequest>()
-            val responseXmlStr = transaction {
-                // Step 1 of 3:  Get information about the host and subscriber
-                val requestContext = makeReqestContext(requestObject)
-                // Step 2 of 3:  Validate the signature
-                val verifyResult = XMLUtil.verifyEbicsDocument(requestDocument, requestContext.clientAuthPub)
-                if (!verifyResult) {
-                    throw EbicsInvalidRequestError()
-                }
-                // Step 3 of 3:  Generate response
+            // The signature is checked, and the response signed, outside
+            // of the database transactions.
+            // Step 1 of 4:  Get the authentication key of the subscriber
+            val clientAuthPub = readTransaction { findRequestAuthenticationKey(requestObject) }
+            // Step 2 of 4:  Validate the signature
+            val verifyResult = XMLUtil.verifyEbicsDocument(requestDocument, clientAuthPub)
+            if (!verifyResult) {
+                throw EbicsInvalidRequestError()
+            }
+            if (injectedFault != null) {
+                throw EbicsInjectedFaultError(injectedFault)
+            }
+            val (ebicsResponse, hostAuthPriv) = transaction {
+                // Step 3 of 4:  Get information about the host and subscriber,
+                // in the transaction that updates them.
+                val requestContext = makeReqestContext(requestObject, deriveTransactionIds)
+                // Step 4 of 4:  Generate response
                 val ebicsResponse: EbicsResponse = when (requestObject.header.mutable.transactionPhase) {
                     EbicsTypes.TransactionPhaseType.INITIALISATION -> {
+                        if (countInFlightEbicsTransactions(requestContext.subscriber) >= maxInFlightTransactions) {
+                            throw EbicsMaxTransactionsExceededError()
+                        }
                         if (requestObject.header.static.numSegments == null) {
                             handleEbicsDownloadTransactionInitialization(requestContext)
                         } else {
@@ -1234,11 +1422,15 @@ suspend fun ApplicationCall.ebicsweb() {
                             throw EbicsInvalidRequestError()
                         val receiptCode =
                             requestObject.body.transferReceipt?.receiptCode ?: throw EbicsInvalidRequestError()
+                        // The response won't be asked again; the row goes at the next reaper run.
+                        requestContext.downloadTransaction.receiptReceived = true
+                        requestContext.downloadTransaction.encodedResponse = ""
                         EbicsResponse.createForDownloadReceiptPhase(requestTransactionID, receiptCode == 0)
                     }
                 }
-                signEbicsResponse(ebicsResponse, requestContext.hostAuthPriv)
+                Pair(ebicsResponse, requestContext.hostAuthPriv)
             }
+            val responseXmlStr = signEbicsResponse(ebicsResponse, hostAuthPriv)
             if (!XMLUtil.validateFromString(responseXmlStr)) throw SandboxError(
                 HttpStatusCode.InternalServerError,
                 "Outgoing EBICS XML is invalid"
@@ -0,0 +1,194 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Lifetime of the EBICS transactions: completed transactions, and
+ * the ones the client walked away from, are reaped periodically,
+ * and every subscriber may only have a few of them in flight.
+ */
+package tech.libeufin.sandbox
+
+import kotlinx.coroutines.GlobalScope
+import kotlinx.coroutines.delay
+import kotlinx.coroutines.launch
+import org.jetbrains.exposed.dao.id.EntityID
+import org.jetbrains.exposed.sql.*
+import org.jetbrains.exposed.sql.transactions.transaction
+import tech.libeufin.util.logger
+import java.time.Instant
+
+const val DEFAULT_MAX_IN_FLIGHT_EBICS_TRANSACTIONS = 10
+
+/**
+ * How long EBICS transactions are kept, and how many of them one
+ * subscriber may have open.  Durations in milliseconds.
+ */
+data class EbicsTransactionLimits(
+    val ttl: Long = 3600 * 1000,
+    val reaperInterval: Long = 0,
+    val maxInFlightPerSubscriber: Int = DEFAULT_MAX_IN_FLIGHT_EBICS_TRANSACTIONS
+)
+
+/**
+ * Transactions deleted in one go.  Stays below the SQLite
+ * limit of 999 query parameters.
+ */
+private const val REAPER_BATCH_SIZE = 500
+
+/**
+ * Number of transactions of 'subscriber' that were opened
+ * and neither completed nor reaped yet.
+ */
+fun countInFlightEbicsTransactions(subscriber: EbicsSubscriberEntity): Long {
+    return transaction {
+        val downloads = EbicsDownloadTransactionsTable.select {
+            (EbicsDownloadTransactionsTable.subscriber eq subscriber.id) and
+                    (EbicsDownloadTransactionsTable.receiptReceived eq false)
+        }.count()
+        val uploads = EbicsUploadTransactionsTable.select {
+            (EbicsUploadTransactionsTable.subscriber eq subscriber.id) and
+                    (EbicsUploadTransactionsTable.lastSeenSegment less EbicsUploadTransactionsTable.numSegments)
+        }.count()
+        downloads + uploads
+    }
+}
+
+data class EbicsReaperRun(
+    val downloadTransactions: Int,
+    val uploadTransactions: Int,
+    val orderSignatures: Int,
+    val uploadChunks: Int
+)
+
+/**
+ * What the reaper did since startup.
+ */
+object EbicsReaperStats {
+    private var runs = 0L
+    private var lastRunTime: Long? = null
+    private var downloadTransactions = 0L
+    private var uploadTransactions = 0L
+    private var orderSignatures = 0L
+    private var uploadChunks = 0L
+
+    @Synchronized
+    fun record(run: EbicsReaperRun, time: Long) {
+        runs++
+        lastRunTime = time
+        downloadTransactions += run.downloadTransactions
+        uploadTransactions += run.uploadTransactions
+        orderSignatures += run.orderSignatures
+        uploadChunks += run.uploadChunks
+    }
+
+    @Synchronized
+    fun snapshot(): EbicsReaperStatsJson {
+        return EbicsReaperStatsJson(
+            runs = runs,
+            lastRunTime = lastRunTime,
+            reapedDownloadTransactions = downloadTransactions,
+            reapedUploadTransactions = uploadTransactions,
+            reapedOrderSignatures = orderSignatures,
+            reapedUploadChunks = uploadChunks,
+            tableSizes = getEbicsTransactionTableSizes()
+        )
+    }
+}
+
+fun getEbicsTransactionTableSizes(): EbicsTransactionTableSizesJson {
+    return transaction {
+        EbicsTransactionTableSizesJson(
+            downloadTransactions = EbicsDownloadTransactionsTable.selectAll().count(),
+            uploadTransactions = EbicsUploadTransactionsTable.selectAll().count(),
+            uploadChunks = EbicsUploadTransactionChunksTable.selectAll().count(),
+            orderSignatures = EbicsOrderSignaturesTable.selectAll().count()
+        )
+    }
+}
+
+/**
+ * Delete the completed transactions, and those created more than
+ * 'ttlMillis' before 'now', along with their signatures and chunks.
+ */
+fun reapEbicsTransactions(ttlMillis: Long, now: Long = Instant.now().toEpochMilli()): EbicsReaperRun {
+    val expired = now - ttlMillis
+    var downloads = 0
+    var uploads = 0
+    var signatures = 0
+    var chunks = 0
+    while (true) {
+        val ids = transaction {
+            val ids = EbicsDownloadTransactionsTable.slice(EbicsDownloadTransactionsTable.id).select {
+                (EbicsDownloadTransactionsTable.receiptReceived eq true) or
+                        (EbicsDownloadTransactionsTable.creationTime less expired)
+            }.limit(REAPER_BATCH_SIZE).map { it[EbicsDownloadTransactionsTable.id] }
+            if (ids.isNotEmpty()) {
+                downloads += EbicsDownloadTransactionsTable.deleteWhere { EbicsDownloadTransactionsTable.id inList ids }
+            }
+            ids
+        }
+        if (ids.size < REAPER_BATCH_SIZE) break
+    }
+    while (true) {
+        val ids = transaction {
+            val ids = EbicsUploadTransactionsTable.slice(EbicsUploadTransactionsTable.id).select {
+                (EbicsUploadTransactionsTable.lastSeenSegment greaterEq EbicsUploadTransactionsTable.numSegments) or
+                        (EbicsUploadTransactionsTable.creationTime less expired)
+            }.limit(REAPER_BATCH_SIZE).map { it[EbicsUploadTransactionsTable.id].value }
+            if (ids.isNotEmpty()) {
+                signatures += EbicsOrderSignaturesTable.deleteWhere {
+                    EbicsOrderSignaturesTable.transactionID inList ids
+                }
+                chunks += EbicsUploadTransactionChunksTable.deleteWhere {
+                    EbicsUploadTransactionChunksTable.transactionID inList ids
+                }
+                uploads += EbicsUploadTransactionsTable.deleteWhere {
+                    EbicsUploadTransactionsTable.id inList ids.map { EntityID(it, EbicsUploadTransactionsTable) }
+                }
+            }
+            ids
+        }
+        if (ids.size < REAPER_BATCH_SIZE) break
+    }
+    val run = EbicsReaperRun(downloads, uploads, signatures, chunks)
+    EbicsReaperStats.record(run, now)
+    if (downloads + uploads > 0) {
+        logger.info(
+            "Reaped $downloads download and $uploads upload EBICS transactions" +
+                    " ($signatures signatures, $chunks chunks)"
+        )
+    }
+    return run
+}
+
+/**
+ * Reap the EBICS transactions now, and then every 'intervalMillis'.
+ */
+fun startEbicsTransactionReaper(intervalMillis: Long, ttlMillis: Long) {
+    GlobalScope.launch {
+        while (true) {
+            try {
+                reapEbicsTransactions(ttlMillis)
+            } catch (e: Exception) {
+                logger.error("Reaping the EBICS transactions failed", e)
+            }
+            delay(intervalMillis)
+        }
+    }
+}
@@ -72,6 +72,10 @@ data class BankAccountRequest(
     val label: String
 )
 
+data class AdminGetBankAccounts(
+    var bankAccounts: MutableList<BankAccountRequest> = mutableListOf()
+)
+
 data class DateRange(
     val startDate: Long,
     val endDate: Long
@@ -96,3 +100,26 @@ data class BankAccountReport(
     var creationTime: Long,
     val message: String
 )
+
+/**
+ * Rows currently held by the EBICS transaction tables.
+ */
+data class EbicsTransactionTableSizesJson(
+    val downloadTransactions: Long,
+    val uploadTransactions: Long,
+    val uploadChunks: Long,
+    val orderSignatures: Long
+)
+
+/**
+ * Rows deleted by the EBICS transaction reaper since startup.
+ */
+data class EbicsReaperStatsJson(
+    val runs: Long,
+    val lastRunTime: Long?,
+    val reapedDownloadTransactions: Long,
+    val reapedUploadTransactions: Long,
+    val reapedOrderSignatures: Long,
+    val reapedUploadChunks: Long,
+    val tableSizes: EbicsTransactionTableSizesJson
+)
@@ -60,8 +60,13 @@ import java.time.Instant
 import com.github.ajalt.clikt.core.CliktCommand
 import com.github.ajalt.clikt.core.subcommands
 import com.github.ajalt.clikt.parameters.options.default
+import com.github.ajalt.clikt.parameters.options.flag
 import com.github.ajalt.clikt.parameters.options.option
+import com.github.ajalt.clikt.parameters.types.choice
+import com.github.ajalt.clikt.parameters.types.int
+import com.github.ajalt.clikt.parameters.types.long
 import io.ktor.util.AttributeKey
+import kotlinx.coroutines.delay
 import tech.libeufin.sandbox.BankAccountTransactionsTable
 import tech.libeufin.sandbox.BankAccountTransactionsTable.amount
 import tech.libeufin.sandbox.BankAccountTransactionsTable.creditorBic
@@ -94,11 +99,61 @@ class SandboxCommand : CliktCommand() {
 
 class Serve : CliktCommand("Run sandbox HTTP server") {
     private val dbName by option().default("libeufin-sandbox.sqlite3")
+    private val storage by option(
+        help = "'memory' keeps all the data in the process, for load tests; --db-name is then ignored"
+    ).choice("sqlite" to SandboxStorage.SQLITE, "memory" to SandboxStorage.MEMORY).default(SandboxStorage.SQLITE)
+    private val dumpOnShutdown by option(
+        help = "with --storage=memory, write the data to this SQLite file on shutdown"
+    )
     private val logLevel by option()
+    private val ebicsDelay by option(
+        help = "milliseconds to wait before serving each EBICS request, to emulate a slow bank"
+    ).long().default(0)
+    private val statementClosingInterval by option(
+        help = "seconds between two runs of the statement-closing job, 0 to disable it"
+    ).long().default(3600)
+    private val ebicsTransactionTtl by option(
+        help = "seconds after which an EBICS transaction that did not complete is reaped"
+    ).long().default(3600)
+    private val ebicsReaperInterval by option(
+        help = "seconds between two runs of the EBICS transaction reaper, 0 to disable it"
+    ).long().default(300)
+    private val maxEbicsTransactionsPerSubscriber by option(
+        help = "EBICS transactions one subscriber may have in flight"
+    ).int().default(DEFAULT_MAX_IN_FLIGHT_EBICS_TRANSACTIONS)
+    private val rsaKeyPoolSize by option(
+        help = "RSA key pairs generated in advance, for new EBICS hosts"
+    ).int().default(6)
+    private val rsaKeyPoolThreads by option(
+        help = "background threads generating the RSA key pairs"
+    ).int().default(maxOf(1, Runtime.getRuntime().availableProcessors() / 2))
+    private val rsaKeySeed by option(
+        help = "generate the RSA key pairs deterministically from this seed, only for tests"
+    ).long()
+    private val deriveEbicsTransactionIds by option(
+        help = "derive the EBICS transaction IDs from the request nonces, to replay recorded traffic"
+    ).flag()
+    private val allowEbicsFaultInjection by option(
+        help = "fail EBICS requests with the return code given in their $EBICS_FAULT_HEADER header, only for tests"
+    ).flag()
     override fun run() {
         LOGGER = LoggerFactory.getLogger("tech.libeufin.sandbox")
         setLogLevel(logLevel)
-        serverMain(dbName)
+        RsaKeyPairs.pool = RsaKeyPairPool(rsaKeyPoolSize, rsaKeyPoolThreads, seed = rsaKeySeed)
+        serverMain(
+            dbName,
+            ebicsDelay,
+            statementClosingInterval * 1000,
+            EbicsTransactionLimits(
+                ttl = ebicsTransactionTtl * 1000,
+                reaperInterval = ebicsReaperInterval * 1000,
+                maxInFlightPerSubscriber = maxEbicsTransactionsPerSubscriber
+            ),
+            storage,
+            dumpOnShutdown,
+            deriveEbicsTransactionIds,
+            allowEbicsFaultInjection
+        )
     }
 }
 
@@ -152,8 +207,26 @@ fun main(args: Array<String>) {
         .main(args)
 }
 
-fun serverMain(dbName: String) {
-    dbCreateTables(dbName)
+fun serverMain(
+    dbName: String,
+    ebicsDelay: Long = 0,
+    statementClosingInterval: Long = 0,
+    ebicsTransactionLimits: EbicsTransactionLimits = EbicsTransactionLimits(),
+    storage: SandboxStorage = SandboxStorage.SQLITE,
+    dumpOnShutdown: String? = null,
+    deriveEbicsTransactionIds: Boolean = false,
+    allowEbicsFaultInjection: Boolean = false
+) {
+    when (storage) {
+        SandboxStorage.SQLITE -> dbCreateTables(dbName)
+        SandboxStorage.MEMORY -> dbCreateInMemoryTables(dumpOnShutdown)
+    }
+    if (statementClosingInterval > 0) {
+        startStatementClosingJob(statementClosingInterval)
+    }
+    if (ebicsTransactionLimits.reaperInterval > 0) {
+        startEbicsTransactionReaper(ebicsTransactionLimits.reaperInterval, ebicsTransactionLimits.ttl)
+    }
     val server = embeddedServer(Netty, port = 5000) {
         install(CallLogging) {
             this.level = Level.DEBUG
@@ -302,6 +375,31 @@ fun serverMain(dbName: String) {
                 call.respondText("Bank account created")
                 return@post
             }
+            /**
+             * Shows all the bank accounts, along with their subscriber.
+             */
+            get("/admin/ebics/bank-accounts") {
+                val ret = AdminGetBankAccounts()
+                transaction {
+                    BankAccountEntity.all().forEach {
+                        ret.bankAccounts.add(
+                            BankAccountRequest(
+                                subscriber = EbicsSubscriberElement(
+                                    hostID = it.subscriber.hostId,
+                                    partnerID = it.subscriber.partnerId,
+                                    userID = it.subscriber.userId
+                                ),
+                                iban = it.iban,
+                                bic = it.bic,
+                                name = it.name,
+                                label = it.label
+                            )
+                        )
+                    }
+                }
+                call.respond(ret)
+                return@get
+            }
             /**
              * Creates a new Ebics subscriber.
              */
@@ -347,9 +445,9 @@ fun serverMain(dbName: String) {
              */
             post("/admin/ebics/host") {
                 val req = call.receive<EbicsHostCreateRequest>()
-                val pairA = CryptoUtil.generateRsaKeyPair(2048)
-                val pairB = CryptoUtil.generateRsaKeyPair(2048)
-                val pairC = CryptoUtil.generateRsaKeyPair(2048)
+                val pairA = RsaKeyPairs.take()
+                val pairB = RsaKeyPairs.take()
+                val pairC = RsaKeyPairs.take()
                 transaction {
                     addLogger(StdOutSqlLogger)
                     EbicsHostEntity.new {
@@ -381,53 +479,47 @@ fun serverMain(dbName: String) {
              * Serves all the Ebics requests.
              */
             post("/ebicsweb") {
-                call.ebicsweb()
+                if (ebicsDelay > 0) {
+                    delay(ebicsDelay)
+                }
+                call.ebicsweb(
+                    ebicsTransactionLimits.maxInFlightPerSubscriber,
+                    deriveEbicsTransactionIds,
+                    allowEbicsFaultInjection
+                )
             }
             /**
-             * Shows all bank account statements.
+             * Shows what the EBICS transaction reaper did, and
+             * how big the transaction tables are.
              */
-            /*
-              FIXME: Heng Yeow.
-
-            get("/admin/statements") {
-                var ret = BankAccountStatement()
-                ret.creationTime = Instant.now().toEpochMilli()
-                ret.statementId = "C52-" + Instant.now().toEpochMilli().toHttpDateString() + "-" + UUID.randomUUID().toString()
-                ret.message = mutableListOf<String>()
-                transaction {
-                    BankAccountTransactionsTable.selectAll().forEach {
-                        ret.message.add(
-                            constructXml(indent = true) {
-                                root("Document") {
-                                    attribute("xmlns", "urn:iso:std:iso:20022:tech:xsd:camt.053.001.02")
-                                    attribute("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
-                                    attribute(
-                                        "xsi:schemaLocation",
-                                        "urn:iso:std:iso:20022:tech:xsd:camt.053.001.02 camt.053.001.02.xsd"
-                                    )
-                                    element("Ntry") {
-                                        element("Amt") {
-                                            attribute("Ccy", it.currency)
-                                            text(it.amount)
-                                        }
-                                    }
-                                }
-                            }
-                        )
-                    }
-                }
-                transaction {
-                    BankAccountStatementsTable.insert {
-                        it[statementId] = ret.statementId
-                        it[creationTime] = ret.creationTime
-                        it[xmlMessage] = ret.message.toString()
-                    }
-                }
-                call.respond(ret)
+            get("/admin/ebics/transactions/stats") {
+                call.respond(EbicsReaperStats.snapshot())
                 return@get
             }
-
+            /**
+             * Shows depth and refill rate of the pool of RSA key pairs.
              */
+            get("/admin/rsa-key-pool") {
+                call.respond(RsaKeyPairs.pool.stats())
+                return@get
+            }
+            /**
+             * Runs the EBICS transaction reaper right now.
+             */
+            post("/admin/ebics/transactions/reap") {
+                reapEbicsTransactions(ebicsTransactionLimits.ttl)
+                call.respond(EbicsReaperStats.snapshot())
+                return@post
+            }
+            /**
+             * Closes the open statement period of all the bank accounts
+             * right now, instead of waiting for the next midnight.
+             */
+            post("/admin/statements/close") {
+                closeStatements(Instant.now().toEpochMilli())
+                call.respondText("Statements closed")
+                return@post
+            }
             /**
              * Shows all bank account reports.
              */
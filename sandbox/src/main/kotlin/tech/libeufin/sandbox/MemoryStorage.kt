@@ -0,0 +1,199 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Storage for the sandbox standing in for a bank in load tests:
+ * the very same SQLite schema and queries, but kept in the process
+ * memory, so that no request ever waits for the disk.
+ */
+package tech.libeufin.sandbox
+
+import org.jetbrains.exposed.sql.Database
+import org.jetbrains.exposed.sql.Transaction
+import org.jetbrains.exposed.sql.transactions.TransactionManager
+import org.jetbrains.exposed.sql.transactions.transaction
+import tech.libeufin.util.logger
+import java.io.File
+import java.lang.reflect.InvocationTargetException
+import java.lang.reflect.Proxy
+import java.nio.file.Files
+import java.nio.file.StandardCopyOption
+import java.sql.Connection
+import java.sql.DriverManager
+import java.util.UUID
+import java.util.concurrent.ArrayBlockingQueue
+import java.util.concurrent.Semaphore
+import java.util.concurrent.atomic.AtomicBoolean
+
+enum class SandboxStorage {
+    SQLITE,
+    MEMORY
+}
+
+private val readOnlyTransaction = ThreadLocal<Boolean>()
+
+/**
+ * Like transaction(), for a statement that only reads.  With the
+ * memory storage, such transactions run concurrently; with the
+ * SQLite file, this is just transaction().  Inside of another
+ * transaction, the statement joins it.
+ */
+fun <T> readTransaction(statement: Transaction.() -> T): T {
+    val current = TransactionManager.currentOrNull()
+    if (current != null) {
+        return current.statement()
+    }
+    readOnlyTransaction.set(true)
+    try {
+        return transaction { statement() }
+    } finally {
+        readOnlyTransaction.remove()
+    }
+}
+
+/**
+ * SQLite database that lives as long as the process.
+ *
+ * The database is a named in-memory one in shared-cache mode, so
+ * that a pool of connections can open it, and every transaction runs
+ * on its own connection.  A transaction takes its turn when it begins,
+ * as a SQLite file does for BEGIN IMMEDIATE: the ones that may write
+ * run alone, and the ones opened by readTransaction() run together.
+ * Readers thus never see uncommitted data, and concurrent
+ * read-modify-write transactions are serialized.
+ */
+class InMemoryDatabase(private val connections: Int = maxOf(4, Runtime.getRuntime().availableProcessors())) {
+    private val url = "jdbc:sqlite:file:sandbox-${UUID.randomUUID()}?mode=memory&cache=shared"
+    // The database is dropped once its last connection is closed.
+    private val anchor: Connection = DriverManager.getConnection(url)
+    private val pool = ArrayBlockingQueue<Connection>(connections)
+    // A reader holds one permit, a writer all of them.  The semaphore
+    // is fair, so that a waiting writer holds back the new readers.
+    private val turns = Semaphore(connections, true)
+    val database: Database
+
+    init {
+        repeat(connections) {
+            pool.add(DriverManager.getConnection(url))
+        }
+        database = Database.connect({ lease() })
+    }
+
+    /**
+     * Hand out a connection of the pool until the borrower closes it.
+     * Work the borrower left uncommitted is rolled back at that point.
+     */
+    private fun lease(): Connection {
+        val readOnly = readOnlyTransaction.get() == true
+        val permits = if (readOnly) 1 else connections
+        turns.acquire(permits)
+        val connection = pool.take()
+        val returned = AtomicBoolean(false)
+        return Proxy.newProxyInstance(
+            Connection::class.java.classLoader,
+            arrayOf(Connection::class.java)
+        ) { _, method, args ->
+            when (method.name) {
+                "close" -> {
+                    if (returned.compareAndSet(false, true)) {
+                        try {
+                            if (!connection.autoCommit) {
+                                connection.rollback()
+                                connection.autoCommit = true
+                            }
+                        } finally {
+                            pool.add(connection)
+                            turns.release(permits)
+                        }
+                    }
+                    null
+                }
+                "isClosed" -> returned.get()
+                else -> {
+                    if (returned.get()) throw IllegalStateException("connection was already returned")
+                    if (readOnly && isWrite(method.name, args)) {
+                        throw IllegalStateException("readTransaction() may not write")
+                    }
+                    try {
+                        method.invoke(connection, *(args ?: emptyArray<Any>()))
+                    } catch (e: InvocationTargetException) {
+                        throw e.targetException
+                    }
+                }
+            }
+        } as Connection
+    }
+
+    /**
+     * Whether a connection call may write.  Statements created without
+     * their SQL may run anything.
+     */
+    private fun isWrite(method: String, args: Array<Any?>?): Boolean {
+        return when (method) {
+            "createStatement" -> true
+            "prepareStatement", "prepareCall" -> {
+                val sql = args?.firstOrNull() as? String ?: return true
+                !sql.trimStart().startsWith("SELECT", ignoreCase = true)
+            }
+            else -> false
+        }
+    }
+
+    /**
+     * Write a consistent copy of the database to a SQLite file, which
+     * 'serve --db-name' can then open.  Writers in flight are waited
+     * for, and the file is replaced only once it is complete.
+     */
+    fun dumpTo(path: String) {
+        val target = File(path).absoluteFile
+        val tmp = File(target.parentFile, target.name + ".tmp")
+        tmp.delete()
+        turns.acquire()
+        try {
+            anchor.prepareStatement("VACUUM INTO ?").use {
+                it.setString(1, tmp.path)
+                it.execute()
+            }
+        } finally {
+            turns.release()
+        }
+        Files.move(tmp.toPath(), target.toPath(), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+        logger.info("Sandbox database dumped to ${target.path}")
+    }
+}
+
+/**
+ * Connect to a fresh in-memory database and create the sandbox
+ * tables in it.  If 'dumpOnShutdown' is given, the database is
+ * written to that file when the JVM shuts down.
+ */
+fun dbCreateInMemoryTables(dumpOnShutdown: String? = null): InMemoryDatabase {
+    val db = InMemoryDatabase()
+    dbCreateSchema()
+    if (dumpOnShutdown != null) {
+        Runtime.getRuntime().addShutdownHook(Thread {
+            try {
+                db.dumpTo(dumpOnShutdown)
+            } catch (e: Exception) {
+                logger.error("Could not dump the sandbox database to $dumpOnShutdown", e)
+            }
+        })
+    }
+    return db
+}
@@ -0,0 +1,116 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+/**
+ * Statement closing: the camt.053 of every closed period is rendered
+ * once, and served from the database afterwards.  Periods close at
+ * midnight (UTC); the period still open is generated on request.
+ */
+package tech.libeufin.sandbox
+
+import kotlinx.coroutines.GlobalScope
+import kotlinx.coroutines.delay
+import kotlinx.coroutines.launch
+import org.jetbrains.exposed.sql.SortOrder
+import org.jetbrains.exposed.sql.and
+import org.jetbrains.exposed.sql.statements.api.ExposedBlob
+import org.jetbrains.exposed.sql.transactions.transaction
+import tech.libeufin.util.logStageTiming
+import tech.libeufin.util.logger
+import java.time.Instant
+import java.time.temporal.ChronoUnit
+import java.util.UUID
+
+/**
+ * Start of the period of 'bankAccountId' that is not closed yet.
+ */
+fun openPeriodStart(bankAccountId: Int): Long {
+    return transaction {
+        BankAccountStatementsEntity.find {
+            BankAccountStatementsTable.bankAccount eq bankAccountId
+        }.orderBy(BankAccountStatementsTable.periodEnd to SortOrder.DESC).limit(1).firstOrNull()?.periodEnd ?: 0L
+    }
+}
+
+/**
+ * Stored camt ZIPs of the closed periods that overlap [start, end],
+ * oldest first.  Statements cover whole periods, so they may hold
+ * bookings outside of the range.
+ */
+fun getClosedStatements(bankAccountId: Int, start: Long, end: Long): List<ByteArray> {
+    return transaction {
+        BankAccountStatementsEntity.find {
+            (BankAccountStatementsTable.bankAccount eq bankAccountId) and
+                    (BankAccountStatementsTable.periodEnd greater start) and
+                    (BankAccountStatementsTable.periodStart lessEq end)
+        }.orderBy(BankAccountStatementsTable.periodStart to SortOrder.ASC).map { it.camtZip.bytes }
+    }
+}
+
+/**
+ * Close the open period of every bank account at 'closingTime', by
+ * default the last midnight.  Accounts closed already up to there
+ * are left alone.
+ */
+fun closeStatements(closingTime: Long = Instant.now().truncatedTo(ChronoUnit.DAYS).toEpochMilli()) {
+    val bankAccountIds = transaction { BankAccountEntity.all().map { it.id.value } }
+    for (bankAccountId in bankAccountIds) {
+        closeStatement(bankAccountId, closingTime)
+    }
+}
+
+private fun closeStatement(bankAccountId: Int, closingTime: Long) {
+    transaction {
+        val bankAccount = BankAccountEntity.findById(bankAccountId) ?: return@transaction
+        val periodStart = openPeriodStart(bankAccountId)
+        if (periodStart >= closingTime) {
+            return@transaction
+        }
+        val history = getBankAccountHistory(bankAccount.iban, periodStart, closingTime - 1)
+        val camtZip = logStageTiming("sandbox-statement-closing") {
+            renderCamtZip(53, bankAccount.iban, history)
+        }
+        BankAccountStatementsEntity.new {
+            statementId = "C53-$closingTime-${UUID.randomUUID()}"
+            creationTime = Instant.now().toEpochMilli()
+            this.periodStart = periodStart
+            periodEnd = closingTime
+            numEntries = history.size
+            this.camtZip = ExposedBlob(camtZip)
+            this.bankAccount = bankAccount
+        }
+        logger.info("Closed statement of '${bankAccount.label}' with ${history.size} entries")
+    }
+}
+
+/**
+ * Close the statements now, and then every 'intervalMillis'.
+ */
+fun startStatementClosingJob(intervalMillis: Long) {
+    GlobalScope.launch {
+        while (true) {
+            try {
+                closeStatements()
+            } catch (e: Exception) {
+                logger.error("Closing the statements failed", e)
+            }
+            delay(intervalMillis)
+        }
+    }
+}
@@ -0,0 +1,117 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.statements.api.ExposedBlob
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import tech.libeufin.sandbox.*
+import kotlin.test.assertEquals
+
+class EbicsTransactionsTest {
+    private val now = 1_000_000_000L
+    private val ttl = 60_000L
+
+    private fun download(id: String, subscriber: EbicsSubscriberEntity, host: EbicsHostEntity, created: Long, done: Boolean) {
+        EbicsDownloadTransactionEntity.new(id) {
+            this.subscriber = subscriber
+            this.host = host
+            orderType = "C53"
+            segmentSize = 4096
+            transactionKeyEnc = ExposedBlob(ByteArray(1))
+            encodedResponse = "response"
+            numSegments = 1
+            receiptReceived = done
+            creationTime = created
+        }
+    }
+
+    private fun upload(id: String, subscriber: EbicsSubscriberEntity, host: EbicsHostEntity, created: Long, done: Boolean) {
+        EbicsUploadTransactionEntity.new(id) {
+            this.subscriber = subscriber
+            this.host = host
+            orderType = "CCT"
+            orderID = "OR$id"
+            numSegments = 1
+            lastSeenSegment = if (done) 1 else 0
+            transactionKeyEnc = ExposedBlob(ByteArray(1))
+            creationTime = created
+        }
+        EbicsOrderSignatureEntity.new {
+            transactionID = id
+            orderID = "OR$id"
+            orderType = "CCT"
+            partnerID = "PARTNER1"
+            userID = "USER1"
+            signatureAlgorithm = "A006"
+            signatureValue = ExposedBlob(ByteArray(1))
+        }
+    }
+
+    @Test
+    fun reapCompletedAndAbandoned() {
+        withTestDatabase {
+            val subscriber = transaction {
+                SchemaUtils.create(
+                    EbicsSubscriberPublicKeysTable,
+                    EbicsSubscribersTable,
+                    EbicsHostsTable,
+                    EbicsDownloadTransactionsTable,
+                    EbicsUploadTransactionsTable,
+                    EbicsUploadTransactionChunksTable,
+                    EbicsOrderSignaturesTable
+                )
+                val host = EbicsHostEntity.new {
+                    hostId = "HOST1"
+                    ebicsVersion = "H004"
+                    signaturePrivateKey = ExposedBlob(ByteArray(1))
+                    encryptionPrivateKey = ExposedBlob(ByteArray(1))
+                    authenticationPrivateKey = ExposedBlob(ByteArray(1))
+                }
+                val subscriber = EbicsSubscriberEntity.new {
+                    userId = "USER1"
+                    partnerId = "PARTNER1"
+                    systemId = null
+                    hostId = "HOST1"
+                    nextOrderID = 1
+                    state = SubscriberState.INITIALIZED
+                }
+                download("D1", subscriber, host, now, done = true)
+                download("D2", subscriber, host, now - 2 * ttl, done = false)
+                download("D3", subscriber, host, now, done = false)
+                upload("U1", subscriber, host, now, done = true)
+                upload("U2", subscriber, host, now - 2 * ttl, done = false)
+                upload("U3", subscriber, host, now, done = false)
+                subscriber
+            }
+            assertEquals(4L, countInFlightEbicsTransactions(subscriber))
+            val run = reapEbicsTransactions(ttl, now)
+            assertEquals(EbicsReaperRun(2, 2, 2, 0), run)
+            assertEquals(2L, countInFlightEbicsTransactions(subscriber))
+            val sizes = getEbicsTransactionTableSizes()
+            assertEquals(1L, sizes.downloadTransactions)
+            assertEquals(1L, sizes.uploadTransactions)
+            assertEquals(1L, sizes.orderSignatures)
+            transaction {
+                assertEquals("D3", EbicsDownloadTransactionEntity.all().single().id.value)
+                assertEquals("U3", EbicsUploadTransactionEntity.all().single().id.value)
+            }
+        }
+    }
+}
@@ -0,0 +1,127 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+import org.jetbrains.exposed.sql.Database
+import org.jetbrains.exposed.sql.insert
+import org.jetbrains.exposed.sql.selectAll
+import org.jetbrains.exposed.sql.statements.api.ExposedBlob
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import tech.libeufin.sandbox.EbicsHostEntity
+import tech.libeufin.sandbox.EbicsHostsTable
+import tech.libeufin.sandbox.EbicsSubscriberEntity
+import tech.libeufin.sandbox.SubscriberState
+import tech.libeufin.sandbox.dbCreateInMemoryTables
+import tech.libeufin.sandbox.readTransaction
+import java.io.File
+import java.util.concurrent.CountDownLatch
+import java.util.concurrent.TimeUnit
+import kotlin.concurrent.thread
+import kotlin.test.assertEquals
+import kotlin.test.assertFailsWith
+import kotlin.test.assertTrue
+
+class MemoryStorageTest {
+    @Test
+    fun concurrentWritesAndDump() {
+        val db = dbCreateInMemoryTables()
+        val writers = (1..4).map { t ->
+            thread {
+                repeat(25) { i ->
+                    transaction(db.database) {
+                        EbicsHostEntity.new {
+                            hostId = "HOST-$t-$i"
+                            ebicsVersion = "H004"
+                            signaturePrivateKey = ExposedBlob(ByteArray(1))
+                            encryptionPrivateKey = ExposedBlob(ByteArray(1))
+                            authenticationPrivateKey = ExposedBlob(ByteArray(1))
+                        }
+                    }
+                }
+            }
+        }
+        writers.forEach { it.join() }
+        assertEquals(100L, transaction(db.database) { EbicsHostsTable.selectAll().count() })
+
+        val dump = File("sandbox-memory-dump.sqlite3")
+        dump.delete()
+        try {
+            db.dumpTo(dump.path)
+            val copy = Database.connect("jdbc:sqlite:${dump.path}", "org.sqlite.JDBC")
+            assertEquals(100L, transaction(copy) { EbicsHostsTable.selectAll().count() })
+        } finally {
+            dump.delete()
+        }
+    }
+
+    @Test
+    fun readersRunTogether() {
+        val db = dbCreateInMemoryTables()
+        val read = CountDownLatch(1)
+        val together = readTransaction {
+            EbicsHostsTable.selectAll().count()
+            thread {
+                readTransaction { EbicsHostsTable.selectAll().count() }
+                read.countDown()
+            }
+            read.await(10, TimeUnit.SECONDS)
+        }
+        assertTrue(together)
+        assertFailsWith<IllegalStateException> {
+            readTransaction {
+                EbicsHostsTable.insert {
+                    it[hostID] = "HOST"
+                    it[ebicsVersion] = "H004"
+                    it[signaturePrivateKey] = ExposedBlob(ByteArray(1))
+                    it[encryptionPrivateKey] = ExposedBlob(ByteArray(1))
+                    it[authenticationPrivateKey] = ExposedBlob(ByteArray(1))
+                }
+            }
+        }
+        assertEquals(0L, transaction(db.database) { EbicsHostsTable.selectAll().count() })
+    }
+
+    @Test
+    fun concurrentIncrementsAreSerialized() {
+        val db = dbCreateInMemoryTables()
+        val subscriberId = transaction(db.database) {
+            EbicsSubscriberEntity.new {
+                userId = "USER"
+                partnerId = "PARTNER"
+                hostId = "HOST"
+                nextOrderID = 0
+                state = SubscriberState.NEW
+            }.id
+        }
+        val workers = (1..4).map {
+            thread {
+                repeat(25) {
+                    transaction(db.database) {
+                        val subscriber = EbicsSubscriberEntity[subscriberId]
+                        val next = subscriber.nextOrderID
+                        Thread.yield()
+                        subscriber.nextOrderID = next + 1
+                    }
+                }
+            }
+        }
+        workers.forEach { it.join() }
+        assertEquals(100, transaction(db.database) { EbicsSubscriberEntity[subscriberId].nextOrderID })
+    }
+}
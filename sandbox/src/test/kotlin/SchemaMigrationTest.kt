@@ -0,0 +1,137 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+import org.jetbrains.exposed.dao.id.IdTable
+import org.jetbrains.exposed.dao.id.IntIdTable
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.insert
+import org.jetbrains.exposed.sql.selectAll
+import org.jetbrains.exposed.sql.statements.api.ExposedBlob
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import tech.libeufin.sandbox.*
+import kotlin.test.assertEquals
+
+/**
+ * The tables as older versions created them.
+ */
+private object OldUploadTransactionsTable : IdTable<String>("EbicsUploadTransactions") {
+    override val id = text("transactionID").entityId()
+    val orderType = text("orderType")
+    val orderID = text("orderID")
+    val host = integer("host")
+    val subscriber = integer("subscriber")
+    val numSegments = integer("numSegments")
+    val lastSeenSegment = integer("lastSeenSegment")
+    val transactionKeyEnc = blob("transactionKeyEnc")
+}
+
+private object OldOrderSignaturesTable : IntIdTable("EbicsOrderSignatures") {
+    val orderID = text("orderID")
+    val orderType = text("orderType")
+    val partnerID = text("partnerID")
+    val userID = text("userID")
+    val signatureAlgorithm = text("signatureAlgorithm")
+    val signatureValue = blob("signatureValue")
+}
+
+private object OldUploadTransactionChunksTable : IdTable<String>("EbicsUploadTransactionChunks") {
+    override val id = text("transactionID").entityId()
+    val chunkIndex = integer("chunkIndex")
+    val chunkContent = blob("chunkContent")
+}
+
+private object OldBankAccountStatementsTable : IntIdTable("BankAccountStatements") {
+    val statementId = text("statementId")
+    val creationTime = long("creationTime")
+    val xmlMessage = text("xmlMessage")
+    val bankAccount = integer("bankAccount")
+}
+
+class SchemaMigrationTest {
+    @Test
+    fun upgradeOldSchema() {
+        withTestDatabase {
+            transaction {
+                SchemaUtils.create(
+                    OldUploadTransactionsTable,
+                    OldOrderSignaturesTable,
+                    OldUploadTransactionChunksTable,
+                    OldBankAccountStatementsTable
+                )
+                OldUploadTransactionsTable.insert {
+                    it[id] = "TX1"
+                    it[orderType] = "CCT"
+                    it[orderID] = "OR01"
+                    it[host] = 1
+                    it[subscriber] = 1
+                    it[numSegments] = 2
+                    it[lastSeenSegment] = 1
+                    it[transactionKeyEnc] = ExposedBlob(ByteArray(1))
+                }
+                OldOrderSignaturesTable.insert {
+                    it[orderID] = "OR01"
+                    it[orderType] = "CCT"
+                    it[partnerID] = "PARTNER1"
+                    it[userID] = "USER1"
+                    it[signatureAlgorithm] = "A006"
+                    it[signatureValue] = ExposedBlob(ByteArray(1))
+                }
+                OldUploadTransactionChunksTable.insert {
+                    it[id] = "TX1"
+                    it[chunkIndex] = 1
+                    it[chunkContent] = ExposedBlob(ByteArray(1))
+                }
+                OldBankAccountStatementsTable.insert {
+                    it[statementId] = "C53-1"
+                    it[creationTime] = 1L
+                    it[xmlMessage] = "<Document/>"
+                    it[bankAccount] = 1
+                }
+            }
+            dbCreateSchema()
+            transaction {
+                assertEquals(0L, EbicsUploadTransactionsTable.selectAll().count())
+                assertEquals(0L, EbicsOrderSignaturesTable.selectAll().count())
+                assertEquals(0L, BankAccountStatementsTable.selectAll().count())
+                EbicsUploadTransactionChunksTable.insert {
+                    it[transactionID] = "TX2"
+                    it[chunkIndex] = 1
+                    it[chunkContent] = ExposedBlob(ByteArray(1))
+                }
+                EbicsOrderSignaturesTable.insert {
+                    it[transactionID] = "TX2"
+                    it[orderID] = "OR02"
+                    it[orderType] = "CCT"
+                    it[partnerID] = "PARTNER1"
+                    it[userID] = "USER1"
+                    it[signatureAlgorithm] = "A006"
+                    it[signatureValue] = ExposedBlob(ByteArray(1))
+                }
+                assertEquals(1L, EbicsUploadTransactionChunksTable.selectAll().count())
+            }
+            // Upgrading twice leaves the new tables alone.
+            dbCreateSchema()
+            transaction {
+                assertEquals(1L, EbicsUploadTransactionChunksTable.selectAll().count())
+                assertEquals(1L, EbicsOrderSignaturesTable.selectAll().count())
+            }
+        }
+    }
+}
@@ -0,0 +1,89 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+import org.jetbrains.exposed.sql.SchemaUtils
+import org.jetbrains.exposed.sql.insert
+import org.jetbrains.exposed.sql.transactions.transaction
+import org.junit.Test
+import tech.libeufin.sandbox.*
+import tech.libeufin.util.unzipWithLambda
+import java.time.Instant
+import kotlin.test.assertEquals
+
+class StatementsTest {
+    private fun book(account: BankAccountEntity, date: String, uid: String) {
+        BankAccountTransactionsTable.insert {
+            it[creditorIban] = account.iban
+            it[creditorName] = "Creditor Name"
+            it[debitorIban] = "FR7630006000011234567890189"
+            it[debitorName] = "Debitor Name"
+            it[subject] = "payment $uid"
+            it[amount] = "1.00"
+            it[currency] = "EUR"
+            it[this.date] = Instant.parse(date).toEpochMilli()
+            it[pmtInfId] = uid
+            it[msgId] = uid
+            it[this.account] = account.id
+        }
+    }
+
+    @Test
+    fun closedPeriodsAreRenderedOnce() {
+        withTestDatabase {
+            val accountId = transaction {
+                SchemaUtils.create(
+                    EbicsSubscriberPublicKeysTable,
+                    EbicsSubscribersTable,
+                    BankAccountsTable,
+                    BankAccountTransactionsTable,
+                    BankAccountStatementsTable
+                )
+                val account = BankAccountEntity.new {
+                    iban = "DE89370400440532013000"
+                    bic = "COBADEFFXXX"
+                    name = "Owner"
+                    label = "account"
+                    subscriber = EbicsSubscriberEntity.new {
+                        userId = "USER1"
+                        partnerId = "PARTNER1"
+                        systemId = null
+                        hostId = "HOST1"
+                        nextOrderID = 1
+                        state = SubscriberState.NEW
+                    }
+                }
+                book(account, "2020-01-01T10:00:00Z", "closed")
+                book(account, "2020-01-03T10:00:00Z", "open")
+                account.id.value
+            }
+            val midnight = Instant.parse("2020-01-02T00:00:00Z").toEpochMilli()
+            closeStatements(midnight)
+            closeStatements(midnight)
+            assertEquals(midnight, openPeriodStart(accountId))
+            val statements = getClosedStatements(accountId, 0, Long.MAX_VALUE)
+            assertEquals(1, statements.size)
+            val documents = mutableListOf<String>()
+            statements[0].unzipWithLambda { documents.add(it.second) }
+            assertEquals(1, documents.size)
+            assert(documents[0].contains("payment closed"))
+            // Ranges within the open period are not served from the store.
+            assertEquals(0, getClosedStatements(accountId, midnight, Long.MAX_VALUE).size)
+        }
+    }
+}
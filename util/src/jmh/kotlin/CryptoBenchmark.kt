@@ -0,0 +1,80 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.util
+
+import org.openjdk.jmh.annotations.*
+import java.util.concurrent.TimeUnit
+import kotlin.random.Random
+
+/**
+ * Benchmarks for the EBICS E002 encryption and A006 signature schemes.
+ * Order data sizes go from a small key management payload up to a
+ * multi-MB camt.053 ZIP archive.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.AverageTime)
+@OutputTimeUnit(TimeUnit.MICROSECONDS)
+@Warmup(iterations = 3, time = 2)
+@Measurement(iterations = 5, time = 2)
+@Fork(1)
+open class CryptoBenchmark {
+    @Param("1024", "1048576", "4194304")
+    @JvmField
+    var payloadSize: Int = 0
+
+    private lateinit var keyPair: CryptoUtil.RsaCrtKeyPair
+    private lateinit var payload: ByteArray
+    private lateinit var encrypted: CryptoUtil.EncryptionResult
+    private lateinit var digest: ByteArray
+    private lateinit var signature: ByteArray
+
+    @Setup
+    fun setup() {
+        keyPair = CryptoUtil.generateRsaKeyPair(2048)
+        payload = Random(42).nextBytes(payloadSize)
+        encrypted = CryptoUtil.encryptEbicsE002(payload, keyPair.public)
+        digest = CryptoUtil.digestEbicsOrderA006(payload)
+        signature = CryptoUtil.signEbicsA006(digest, keyPair.private)
+    }
+
+    @Benchmark
+    fun encryptE002(): CryptoUtil.EncryptionResult {
+        return CryptoUtil.encryptEbicsE002(payload, keyPair.public)
+    }
+
+    @Benchmark
+    fun decryptE002(): ByteArray {
+        return CryptoUtil.decryptEbicsE002(encrypted, keyPair.private)
+    }
+
+    /**
+     * Order data is always digested before being signed,
+     * so the digest is measured together with the signature.
+     */
+    @Benchmark
+    fun signA006(): ByteArray {
+        return CryptoUtil.signEbicsA006(CryptoUtil.digestEbicsOrderA006(payload), keyPair.private)
+    }
+
+    @Benchmark
+    fun verifyA006(): Boolean {
+        return CryptoUtil.verifyEbicsA006(signature, CryptoUtil.digestEbicsOrderA006(payload), keyPair.public)
+    }
+}
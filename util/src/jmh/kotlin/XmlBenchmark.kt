@@ -0,0 +1,130 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.util
+
+import org.openjdk.jmh.annotations.*
+import org.w3c.dom.Document
+import tech.libeufin.util.ebics_h004.EbicsRequest
+import java.io.ByteArrayInputStream
+import java.util.concurrent.TimeUnit
+
+/**
+ * Benchmarks for the XML signature and schema validation helpers,
+ * run against a real EBICS request as produced by nexus.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.AverageTime)
+@OutputTimeUnit(TimeUnit.MICROSECONDS)
+@Warmup(iterations = 3, time = 2)
+@Measurement(iterations = 5, time = 2)
+@Fork(1)
+open class XmlBenchmark {
+    private lateinit var keyPair: CryptoUtil.RsaCrtKeyPair
+    private lateinit var unsignedRequest: String
+    private lateinit var signedRequest: String
+    private lateinit var signedDoc: Document
+
+    /**
+     * Fresh document for every signing, as signing modifies
+     * the document in place.
+     */
+    private lateinit var docToSign: Document
+
+    @Setup(Level.Trial)
+    fun setup() {
+        keyPair = CryptoUtil.generateRsaKeyPair(2048)
+        val req = EbicsRequest.createForDownloadTransferPhase(
+            "LIBEUFIN-BENCH",
+            "7BA4A02EFE9A4E3B0AEFA7A4BE0B8C4A",
+            2,
+            3
+        )
+        unsignedRequest = XMLUtil.convertDomToString(XMLUtil.convertJaxbToDocument(req))
+        signedDoc = XMLUtil.parseStringIntoDom(unsignedRequest)
+        XMLUtil.signEbicsDocument(signedDoc, keyPair.private)
+        signedRequest = XMLUtil.convertDomToString(signedDoc)
+    }
+
+    @Setup(Level.Invocation)
+    fun prepareDocToSign() {
+        docToSign = XMLUtil.parseStringIntoDom(unsignedRequest)
+    }
+
+    @Benchmark
+    fun signEbicsDocument(): Document {
+        XMLUtil.signEbicsDocument(docToSign, keyPair.private)
+        return docToSign
+    }
+
+    @Benchmark
+    fun verifyEbicsDocument(): Boolean {
+        return XMLUtil.verifyEbicsDocument(signedDoc, keyPair.public)
+    }
+
+    @Benchmark
+    fun validateFromString(): Boolean {
+        return XMLUtil.validateFromString(signedRequest)
+    }
+
+    @Benchmark
+    fun parseStringIntoDom(): Document {
+        return XMLUtil.parseStringIntoDom(signedRequest)
+    }
+}
+
+/**
+ * Schema validation with every core validating at the same
+ * time, as the request threads of nexus and sandbox do.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.Throughput)
+@OutputTimeUnit(TimeUnit.SECONDS)
+@Warmup(iterations = 3, time = 2)
+@Measurement(iterations = 5, time = 2)
+@Threads(Threads.MAX)
+@Fork(1)
+open class ConcurrentValidationBenchmark {
+    private lateinit var signedRequest: String
+    private lateinit var signedRequestBytes: ByteArray
+
+    @Setup(Level.Trial)
+    fun setup() {
+        val req = EbicsRequest.createForDownloadTransferPhase(
+            "LIBEUFIN-BENCH",
+            "7BA4A02EFE9A4E3B0AEFA7A4BE0B8C4A",
+            2,
+            3
+        )
+        val doc = XMLUtil.convertJaxbToDocument(req)
+        XMLUtil.signEbicsDocument(doc, CryptoUtil.generateRsaKeyPair(2048).private)
+        signedRequest = XMLUtil.convertDomToString(doc)
+        signedRequestBytes = signedRequest.toByteArray(Charsets.UTF_8)
+    }
+
+    @Benchmark
+    fun validateFromString(): Boolean {
+        return XMLUtil.validateFromString(signedRequest)
+    }
+
+    @Benchmark
+    fun validateFromStream(): Boolean {
+        return XMLUtil.validateFromStream(ByteArrayInputStream(signedRequestBytes))
+    }
+}
@@ -0,0 +1,65 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.util
+
+import org.openjdk.jmh.annotations.*
+import org.openjdk.jmh.infra.Blackhole
+import java.util.concurrent.TimeUnit
+
+/**
+ * Benchmarks for the ZIP helpers used to pack and unpack
+ * C52/C53 order data.  Each entry is a camt-sized XML text.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.AverageTime)
+@OutputTimeUnit(TimeUnit.MICROSECONDS)
+@Warmup(iterations = 3, time = 2)
+@Measurement(iterations = 5, time = 2)
+@Fork(1)
+open class ZipBenchmark {
+    @Param("1", "100", "1000")
+    @JvmField
+    var numEntries: Int = 0
+
+    private lateinit var entries: List<ByteArray>
+    private lateinit var archive: ByteArray
+
+    @Setup
+    fun setup() {
+        entries = (0 until numEntries).map { idx ->
+            val s = StringBuilder()
+            s.append("<Document><BkToCstmrStmt><GrpHdr><MsgId>msg-$idx</MsgId></GrpHdr>")
+            repeat(20) { s.append("<Ntry><Amt Ccy=\"EUR\">$it.00</Amt><Sts>BOOK</Sts></Ntry>") }
+            s.append("</BkToCstmrStmt></Document>")
+            s.toString().toByteArray(Charsets.UTF_8)
+        }
+        archive = entries.zip()
+    }
+
+    @Benchmark
+    fun zip(): ByteArray {
+        return entries.zip()
+    }
+
+    @Benchmark
+    fun unzipWithLambda(bh: Blackhole) {
+        archive.unzipWithLambda { bh.consume(it) }
+    }
+}
@@ -24,6 +24,7 @@ import org.bouncycastle.jce.provider.BouncyCastleProvider
 import org.slf4j.Logger
 import org.slf4j.LoggerFactory
 import java.io.ByteArrayOutputStream
+import java.io.InputStream
 import java.math.BigInteger
 import java.security.*
 import java.security.interfaces.RSAPrivateCrtKey
@@ -95,10 +96,11 @@ object CryptoUtil {
      * Generate a fresh RSA key pair.
      *
      * @param nbits size of the modulus in bits
+     * @param random source of randomness; the default one when null
      */
-    fun generateRsaKeyPair(nbits: Int): RsaCrtKeyPair {
+    fun generateRsaKeyPair(nbits: Int, random: SecureRandom? = null): RsaCrtKeyPair {
         val gen = KeyPairGenerator.getInstance("RSA")
-        gen.initialize(nbits)
+        if (random == null) gen.initialize(nbits) else gen.initialize(nbits, random)
         val pair = gen.genKeyPair()
         val priv = pair.private
         val pub = pair.public
@@ -191,6 +193,28 @@ object CryptoUtil {
         encryptedData: ByteArray,
         privateKey: RSAPrivateCrtKey
     ): ByteArray {
+        val symmetricCipher = makeEbicsE002DecryptionCipher(encryptedTransactionKey, privateKey)
+        val data = symmetricCipher.doFinal(encryptedData)
+        return data
+    }
+
+    /**
+     * Like decryptEbicsE002(), but decrypts the data while it is read,
+     * so that it never needs to be held in memory as a whole.
+     */
+    fun decryptEbicsE002Stream(
+        encryptedTransactionKey: ByteArray,
+        encryptedData: InputStream,
+        privateKey: RSAPrivateCrtKey
+    ): InputStream {
+        val symmetricCipher = makeEbicsE002DecryptionCipher(encryptedTransactionKey, privateKey)
+        return CipherInputStream(encryptedData, symmetricCipher)
+    }
+
+    private fun makeEbicsE002DecryptionCipher(
+        encryptedTransactionKey: ByteArray,
+        privateKey: RSAPrivateCrtKey
+    ): Cipher {
         val asymmetricCipher = Cipher.getInstance(
             "RSA/None/PKCS1Padding",
             bouncyCastleProvider
@@ -204,8 +228,7 @@ object CryptoUtil {
         )
         val ivParameterSpec = IvParameterSpec(ByteArray(16))
         symmetricCipher.init(Cipher.DECRYPT_MODE, secretKeySpec, ivParameterSpec)
-        val data = symmetricCipher.doFinal(encryptedData)
-        return data
+        return symmetricCipher
     }
 
     /**
@@ -157,11 +157,48 @@ fun createEbicsRequestForDownloadReceipt(
     return XMLUtil.convertDomToString(doc)
 }
 
+/**
+ * Largest order data segment allowed by EBICS: 1 MB of Base64-encoded
+ * data.
+ */
+const val EBICS_MAX_SEGMENT_SIZE = 1024 * 1024
+
+/**
+ * Compressed and encrypted order data, ready to be uploaded.  EBICS
+ * segments the Base64 encoding of the encrypted payload, in segments
+ * of at most 'segmentSize' characters.  Every segment is encoded only
+ * when it gets sent: it encodes a multiple of 3 payload bytes, so that
+ * the segments put together are the encoding of the whole payload.
+ */
 data class PreparedUploadData(
     val transactionKey: ByteArray,
     val userSignatureDataEncrypted: ByteArray,
-    val encryptedPayloadChunks: List<String>
+    val encryptedPayload: ByteArray,
+    val segmentSize: Int = EBICS_MAX_SEGMENT_SIZE
 ) {
+    init {
+        require(segmentSize in 4..EBICS_MAX_SEGMENT_SIZE) { "invalid segment size $segmentSize" }
+    }
+
+    // Payload bytes encoded in one segment.
+    private val segmentPayloadSize: Int
+        get() = segmentSize / 4 * 3
+
+    val numSegments: Int
+        get() = maxOf(1, (encryptedPayload.size + segmentPayloadSize - 1) / segmentPayloadSize)
+
+    /**
+     * Base64 encoding of the segment 'index' (0-based).
+     */
+    fun encodeSegment(index: Int): String {
+        if (index < 0 || index >= numSegments) {
+            throw IndexOutOfBoundsException("segment $index of $numSegments")
+        }
+        val start = index * segmentPayloadSize
+        val len = minOf(segmentPayloadSize, encryptedPayload.size - start)
+        return Base64.getEncoder().encodeToString(encryptedPayload.copyOfRange(start, start + len))
+    }
+
     override fun equals(other: Any?): Boolean {
         if (this === other) return true
         if (javaClass != other?.javaClass) return false
@@ -170,7 +207,8 @@ data class PreparedUploadData(
 
         if (!transactionKey.contentEquals(other.transactionKey)) return false
         if (!userSignatureDataEncrypted.contentEquals(other.userSignatureDataEncrypted)) return false
-        if (encryptedPayloadChunks != other.encryptedPayloadChunks) return false
+        if (!encryptedPayload.contentEquals(other.encryptedPayload)) return false
+        if (segmentSize != other.segmentSize) return false
 
         return true
     }
@@ -178,12 +216,17 @@ data class PreparedUploadData(
     override fun hashCode(): Int {
         var result = transactionKey.contentHashCode()
         result = 31 * result + userSignatureDataEncrypted.contentHashCode()
-        result = 31 * result + encryptedPayloadChunks.hashCode()
+        result = 31 * result + encryptedPayload.contentHashCode()
+        result = 31 * result + segmentSize
         return result
     }
 }
 
-fun prepareUploadPayload(subscriberDetails: EbicsClientSubscriberDetails, payload: ByteArray): PreparedUploadData {
+fun prepareUploadPayload(
+    subscriberDetails: EbicsClientSubscriberDetails,
+    payload: ByteArray,
+    segmentSize: Int = EBICS_MAX_SEGMENT_SIZE
+): PreparedUploadData {
     val userSignatureDataEncrypted = CryptoUtil.encryptEbicsE002(
         EbicsOrderUtil.encodeOrderDataXml(
             signOrder(
@@ -203,11 +246,11 @@ fun prepareUploadPayload(subscriberDetails: EbicsClientSubscriberDetails, payloa
         subscriberDetails.bankEncPub!!,
         userSignatureDataEncrypted.plainTransactionKey!!
     )
-    val encodedEncryptedPayload = Base64.getEncoder().encodeToString(encryptedPayload.encryptedData)
     return PreparedUploadData(
         userSignatureDataEncrypted.encryptedTransactionKey,
         userSignatureDataEncrypted.encryptedData,
-        listOf(encodedEncryptedPayload)
+        encryptedPayload.encryptedData,
+        segmentSize
     )
 }
 
@@ -232,7 +275,7 @@ fun createEbicsRequestForUploadInitialization(
         DatatypeFactory.newInstance().newXMLGregorianCalendar(GregorianCalendar()),
         subscriberDetails.bankAuthPub!!,
         subscriberDetails.bankEncPub!!,
-        BigInteger.ONE,
+        BigInteger.valueOf(preparedUploadData.numSegments.toLong()),
         orderType,
         makeOrderParams(orderParams)
     )
@@ -298,7 +341,8 @@ fun createEbicsRequestForUploadTransferPhase(
         transactionID,
         // chunks are 1-indexed
         BigInteger.valueOf(chunkIndex.toLong() + 1),
-        preparedUploadData.encryptedPayloadChunks[chunkIndex]
+        chunkIndex + 1 == preparedUploadData.numSegments,
+        preparedUploadData.encodeSegment(chunkIndex)
     )
     val doc = XMLUtil.convertJaxbToDocument(req)
     XMLUtil.signEbicsDocument(doc, subscriberDetails.customerAuthPriv)
@@ -0,0 +1,143 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+package tech.libeufin.util
+
+import java.security.SecureRandom
+import java.util.concurrent.LinkedBlockingQueue
+import java.util.concurrent.Semaphore
+import java.util.concurrent.atomic.AtomicLong
+
+/**
+ * Counters of a key pair pool.  'refillRate' is how many pairs per
+ * second the background threads produce while the pool is not full.
+ */
+data class RsaKeyPairPoolStats(
+    val depth: Int,
+    val targetDepth: Int,
+    val generated: Long,
+    val handedOut: Long,
+    val generatedOnRequest: Long,
+    val meanGenerationMillis: Double,
+    val refillRate: Double
+)
+
+/**
+ * Keeps up to 'targetDepth' RSA key pairs generated in advance, so
+ * that making a key pair costs nothing to the request that needs it.
+ * 'threads' low-priority background threads keep the pool full; when
+ * it is empty, the pair is generated on the spot.
+ *
+ * With a 'seed', every pair is generated on the spot from a random
+ * source seeded with it: the same sequence of pairs comes out of every
+ * run (on the same JVM), which is only meant for tests.
+ */
+class RsaKeyPairPool(
+    val targetDepth: Int = 0,
+    val threads: Int = 1,
+    val nbits: Int = 2048,
+    seed: Long? = null
+) {
+    private val pairs = LinkedBlockingQueue<CryptoUtil.RsaCrtKeyPair>()
+    // One permit for every free place in the pool.
+    private val freeSlots = Semaphore(targetDepth)
+    private val deterministicRandom = seed?.let {
+        SecureRandom.getInstance("SHA1PRNG").apply { setSeed(it) }
+    }
+    private val generated = AtomicLong()
+    private val handedOut = AtomicLong()
+    private val generatedOnRequest = AtomicLong()
+    private val generationMicros = AtomicLong()
+
+    init {
+        if (deterministicRandom == null && targetDepth > 0) {
+            repeat(maxOf(1, threads)) { i ->
+                val t = Thread({ refill() }, "rsa-key-pool-$i")
+                t.isDaemon = true
+                t.priority = Thread.MIN_PRIORITY
+                t.start()
+            }
+        }
+    }
+
+    private fun generate(random: SecureRandom? = null): CryptoUtil.RsaCrtKeyPair {
+        val start = System.nanoTime()
+        val pair = CryptoUtil.generateRsaKeyPair(nbits, random)
+        generationMicros.addAndGet((System.nanoTime() - start) / 1000)
+        generated.incrementAndGet()
+        return pair
+    }
+
+    private fun refill() {
+        while (true) {
+            freeSlots.acquire()
+            try {
+                pairs.put(generate())
+            } catch (e: Exception) {
+                freeSlots.release()
+                logger.error("Pre-generating a RSA key pair failed", e)
+                Thread.sleep(1000)
+            }
+        }
+    }
+
+    /**
+     * Hand out a key pair, from the pool when there is one.
+     */
+    fun take(): CryptoUtil.RsaCrtKeyPair {
+        handedOut.incrementAndGet()
+        if (deterministicRandom != null) {
+            return synchronized(deterministicRandom) { generate(deterministicRandom) }
+        }
+        val pair = pairs.poll()
+        if (pair != null) {
+            freeSlots.release()
+            return pair
+        }
+        generatedOnRequest.incrementAndGet()
+        return generate()
+    }
+
+    fun stats(): RsaKeyPairPoolStats {
+        val count = generated.get()
+        val meanMillis = if (count == 0L) 0.0 else generationMicros.get() / 1000.0 / count
+        val refillThreads = if (deterministicRandom == null && targetDepth > 0) maxOf(1, threads) else 0
+        return RsaKeyPairPoolStats(
+            depth = pairs.size,
+            targetDepth = targetDepth,
+            generated = count,
+            handedOut = handedOut.get(),
+            generatedOnRequest = generatedOnRequest.get(),
+            meanGenerationMillis = meanMillis,
+            refillRate = if (meanMillis == 0.0) 0.0 else refillThreads * 1000.0 / meanMillis
+        )
+    }
+}
+
+/**
+ * The pool that the services take their key pairs from.  Empty
+ * until the service configures it, then every pair is generated
+ * on request.
+ */
+object RsaKeyPairs {
+    @Volatile
+    var pool = RsaKeyPairPool()
+
+    fun take(): CryptoUtil.RsaCrtKeyPair = pool.take()
+}
@@ -38,6 +38,7 @@ import java.io.*
 import java.security.PrivateKey
 import java.security.PublicKey
 import java.security.interfaces.RSAPrivateCrtKey
+import java.util.concurrent.ConcurrentHashMap
 import javax.xml.XMLConstants
 import javax.xml.bind.JAXBContext
 import javax.xml.bind.JAXBElement
@@ -52,11 +53,14 @@ import javax.xml.crypto.dsig.spec.TransformParameterSpec
 import javax.xml.namespace.NamespaceContext
 import javax.xml.parsers.DocumentBuilderFactory
 import javax.xml.transform.OutputKeys
-import javax.xml.transform.Source
 import javax.xml.transform.TransformerFactory
 import javax.xml.transform.dom.DOMSource
 import javax.xml.transform.stream.StreamResult
 import javax.xml.transform.stream.StreamSource
+import javax.xml.stream.XMLInputFactory
+import javax.xml.stream.XMLStreamConstants
+import javax.xml.stream.XMLStreamReader
+import javax.xml.validation.Schema
 import javax.xml.validation.SchemaFactory
 import javax.xml.validation.Validator
 import javax.xml.xpath.XPath
@@ -72,6 +76,25 @@ class DefaultNamespaces : NamespacePrefixMapper() {
 }
 
 
+/**
+ * The kinds of documents that get validated, along with
+ * the XSD of their namespace.
+ */
+enum class XmlSchemaFamily(val namespace: String, val xsd: String) {
+    EBICS_H004("urn:org:ebics:H004", "xsd/ebics_H004.xsd"),
+    EBICS_HEV("http://www.ebics.org/H000", "xsd/ebics_hev.xsd"),
+    CAMT_052("urn:iso:std:iso:20022:tech:xsd:camt.052.001.02", "xsd/camt.052.001.02.xsd"),
+    CAMT_053("urn:iso:std:iso:20022:tech:xsd:camt.053.001.02", "xsd/camt.053.001.02.xsd"),
+    CAMT_054("urn:iso:std:iso:20022:tech:xsd:camt.054.001.02", "xsd/camt.054.001.02.xsd"),
+    PAIN_001("urn:iso:std:iso:20022:tech:xsd:pain.001.001.03", "xsd/pain.001.001.03.xsd");
+
+    companion object {
+        fun fromNamespace(namespace: String?): XmlSchemaFamily? {
+            return values().find { it.namespace == namespace }
+        }
+    }
+}
+
 /**
  * Helpers for dealing with XML in EBICS.
  */
@@ -115,11 +138,21 @@ class XMLUtil private constructor() {
     }
 
     companion object {
-        private var cachedEbicsValidator: Validator? = null
-        private fun getEbicsValidator(): Validator {
-            val currentValidator = cachedEbicsValidator
-            if (currentValidator != null)
-                return currentValidator
+        private val schemas = ConcurrentHashMap<XmlSchemaFamily, Schema>()
+        // Validators are not thread-safe: every thread gets its own, for every family.
+        private val validators = ConcurrentHashMap<XmlSchemaFamily, ThreadLocal<Validator>>()
+        private val rootPeekFactory = XMLInputFactory.newInstance().apply {
+            setProperty(XMLInputFactory.SUPPORT_DTD, false)
+            setProperty(XMLInputFactory.IS_SUPPORTING_EXTERNAL_ENTITIES, false)
+        }
+
+        /**
+         * Bytes that may be read to find the root element of a
+         * streamed document, before going back to its start.
+         */
+        private const val ROOT_PEEK_LIMIT = 1 shl 16
+
+        private fun compileSchema(family: XmlSchemaFamily): Schema {
             val classLoader = ClassLoader.getSystemClassLoader()
             val sf = SchemaFactory.newInstance(XMLConstants.W3C_XML_SCHEMA_NS_URI)
             sf.setProperty(XMLConstants.ACCESS_EXTERNAL_SCHEMA, "file")
@@ -153,32 +186,83 @@ class XMLUtil private constructor() {
                     return DOMInputImpl(publicId, systemId, baseUri, res, "UTF-8")
                 }
             }
-            val schemaInputs: Array<Source> = listOf(
-                "xsd/ebics_H004.xsd",
-                "xsd/ebics_hev.xsd",
-                "xsd/camt.052.001.02.xsd",
-                "xsd/camt.053.001.02.xsd",
-                "xsd/camt.054.001.02.xsd",
-                "xsd/pain.001.001.03.xsd"
-            ).map {
-                val stream =
-                    classLoader.getResourceAsStream(it) ?: throw FileNotFoundException("Schema file $it not found.")
-                StreamSource(stream)
-            }.toTypedArray()
-            val bundle = sf.newSchema(schemaInputs)
-            val newValidator = bundle.newValidator()
-            cachedEbicsValidator = newValidator
-            return newValidator
+            val stream = classLoader.getResourceAsStream(family.xsd)
+                ?: throw FileNotFoundException("Schema file ${family.xsd} not found.")
+            return stream.use { sf.newSchema(StreamSource(it)) }
+        }
+
+        /**
+         * Schema of a document family, compiled at the first use.
+         * Schemas are immutable, and shared by all the threads.
+         */
+        fun getSchema(family: XmlSchemaFamily): Schema {
+            return schemas.computeIfAbsent(family) { compileSchema(it) }
+        }
+
+        private fun getValidator(family: XmlSchemaFamily): Validator {
+            return validators.computeIfAbsent(family) {
+                ThreadLocal.withInitial { getSchema(family).newValidator() }
+            }.get()
+        }
+
+        /**
+         * Namespace of the root element, read from the start of the
+         * document.  The document can be read again afterwards.
+         */
+        private fun peekRootNamespace(reader: XMLStreamReader): String? {
+            return try {
+                while (reader.hasNext()) {
+                    if (reader.next() == XMLStreamConstants.START_ELEMENT) {
+                        return reader.namespaceURI
+                    }
+                }
+                null
+            } finally {
+                reader.close()
+            }
+        }
+
+        /**
+         * Make 'xmlDoc' readable twice (once to find its family, once
+         * to validate it) without copying the whole document.
+         */
+        private fun detectFamily(xmlDoc: StreamSource): Pair<XmlSchemaFamily?, StreamSource> {
+            val inputStream = xmlDoc.inputStream
+            val reader = xmlDoc.reader
+            return when {
+                inputStream != null -> {
+                    val buffered = if (inputStream.markSupported()) inputStream else BufferedInputStream(inputStream)
+                    buffered.mark(ROOT_PEEK_LIMIT)
+                    val ns = peekRootNamespace(rootPeekFactory.createXMLStreamReader(buffered))
+                    buffered.reset()
+                    Pair(XmlSchemaFamily.fromNamespace(ns), StreamSource(buffered, xmlDoc.systemId))
+                }
+                reader != null -> {
+                    val buffered = if (reader.markSupported()) reader else BufferedReader(reader)
+                    buffered.mark(ROOT_PEEK_LIMIT)
+                    val ns = peekRootNamespace(rootPeekFactory.createXMLStreamReader(buffered))
+                    buffered.reset()
+                    Pair(XmlSchemaFamily.fromNamespace(ns), StreamSource(buffered, xmlDoc.systemId))
+                }
+                else -> Pair(null, xmlDoc)
+            }
         }
 
         /**
          *
          * @param xmlDoc the XML document to validate
+         * @param family schema to validate against; found from
+         *        the namespace of the root element when null.
          * @return true when validation passes, false otherwise
          */
-        fun validate(xmlDoc: StreamSource): Boolean {
+        fun validate(xmlDoc: StreamSource, family: XmlSchemaFamily? = null): Boolean {
             try {
-                getEbicsValidator().validate(xmlDoc)
+                val (docFamily, source) = if (family != null) Pair(family, xmlDoc) else detectFamily(xmlDoc)
+                if (docFamily == null) {
+                    logger.warn("Validation failed: no schema for the document")
+                    return false
+                }
+                getValidator(docFamily).validate(source)
             } catch (e: Exception) {
                 logger.warn("Validation failed: ${e}")
                 return false
@@ -191,9 +275,14 @@ class XMLUtil private constructor() {
          * @param domDocument DOM to validate
          * @return true/false if the document is valid/invalid
          */
-        fun validateFromDom(domDocument: Document): Boolean {
+        fun validateFromDom(domDocument: Document, family: XmlSchemaFamily? = null): Boolean {
+            val docFamily = family ?: XmlSchemaFamily.fromNamespace(domDocument.documentElement?.namespaceURI)
+            if (docFamily == null) {
+                logger.warn("Validation failed: no schema for the document")
+                return false
+            }
             try {
-                getEbicsValidator().validate(DOMSource(domDocument))
+                getValidator(docFamily).validate(DOMSource(domDocument))
             } catch (e: SAXException) {
                 e.printStackTrace()
                 return false
@@ -202,14 +291,18 @@ class XMLUtil private constructor() {
         }
 
         /**
-         * Craft object to be passed to the XML validator.
-         * @param xmlString XML body, as read from the POST body.
-         * @return InputStream object, as wanted by the validator.
+         * Validate a document as it is read from 'xmlStream'.
+         */
+        fun validateFromStream(xmlStream: InputStream, family: XmlSchemaFamily? = null): Boolean {
+            return validate(StreamSource(xmlStream), family)
+        }
+
+        /**
+         * Validate a document held in a string; the string is read
+         * in place, not copied into bytes.
          */
-        fun validateFromString(xmlString: String): Boolean {
-            val xmlInputStream: InputStream = ByteArrayInputStream(xmlString.toByteArray())
-            val xmlSource = StreamSource(xmlInputStream)
-            return validate(xmlSource)
+        fun validateFromString(xmlString: String, family: XmlSchemaFamily? = null): Boolean {
+            return validate(StreamSource(StringReader(xmlString)), family)
         }
 
         inline fun <reified T> convertJaxbToString(obj: T): String {
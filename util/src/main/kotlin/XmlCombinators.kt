@@ -182,3 +182,11 @@ class XmlDocumentDestructor internal constructor(val d: Document) {
 fun <T> destructXml(d: Document, f: XmlDocumentDestructor.() -> T): T {
     return f(XmlDocumentDestructor(d))
 }
+
+/**
+ * Destruct a single element, for example a subtree
+ * that was cut out of a streamed document.
+ */
+fun <T> destructXmlElement(e: Element, f: XmlElementDestructor.() -> T): T {
+    return f(XmlElementDestructor(e))
+}
@@ -446,6 +446,7 @@ class EbicsRequest {
             hostId: String,
             transactionId: String,
             segNumber: BigInteger,
+            isLastSegment: Boolean,
             encryptedData: String
         ): EbicsRequest {
             return EbicsRequest().apply {
@@ -460,7 +461,7 @@ class EbicsRequest {
                     mutable = MutableHeader().apply {
                         transactionPhase = EbicsTypes.TransactionPhaseType.TRANSFER
                         segmentNumber = EbicsTypes.SegmentNumber().apply {
-                            lastSegment = true
+                            lastSegment = isLastSegment
                             value = segNumber
                         }
                     }
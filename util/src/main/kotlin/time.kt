@@ -19,9 +19,14 @@
 
 package tech.libeufin.util
 
+import org.slf4j.Logger
+import org.slf4j.LoggerFactory
 import java.time.*
 import java.time.format.DateTimeFormatter
 
+@PublishedApi
+internal val timingLogger: Logger = LoggerFactory.getLogger("tech.libeufin.timing")
+
 fun LocalDateTime.toZonedString(): String {
     return DateTimeFormatter.ISO_OFFSET_DATE_TIME.format(this.atZone(ZoneId.systemDefault()))
 }
@@ -46,4 +51,18 @@ fun importDateFromMillis(millis: Long): LocalDateTime {
 fun LocalDateTime.millis(): Long {
     val instant = Instant.from(this.atZone(ZoneId.systemDefault()))
     return instant.toEpochMilli()
-}
\ No newline at end of file
+}
+
+/**
+ * Run [block] and log its wall-clock duration as "stage=<stage> micros=<n>".
+ * The timing logger is silent by default, and gets enabled by "--log-level=INFO".
+ * Used by the benchmarks under integration-tests/ to break down request latency.
+ */
+inline fun <T> logStageTiming(stage: String, block: () -> T): T {
+    val start = System.nanoTime()
+    try {
+        return block()
+    } finally {
+        timingLogger.info("stage=$stage micros=${(System.nanoTime() - start) / 1000}")
+    }
+}
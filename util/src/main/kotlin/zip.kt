@@ -23,6 +23,7 @@ import java.io.ByteArrayInputStream
 import java.io.ByteArrayOutputStream
 import org.apache.commons.compress.archivers.ArchiveStreamFactory
 import org.apache.commons.compress.archivers.zip.ZipArchiveEntry
+import org.apache.commons.compress.archivers.zip.ZipArchiveOutputStream
 import org.apache.commons.compress.archivers.zip.ZipFile
 import org.apache.commons.compress.utils.IOUtils
 import org.apache.commons.compress.utils.SeekableInMemoryByteChannel
@@ -66,4 +67,42 @@ fun ByteArray.unzipWithLambda(process: (Pair<String, String>) -> Unit) {
             Pair(it.name, zipFile.getInputStream(it).readAllBytes().toString(Charsets.UTF_8))
         )
     }
-}
\ No newline at end of file
+}
+
+/**
+ * Like unzipWithLambda(), but hands over the raw bytes of each entry.
+ */
+fun ByteArray.unzipBytesWithLambda(process: (Pair<String, ByteArray>) -> Unit) {
+    val mem = SeekableInMemoryByteChannel(this)
+    val zipFile = ZipFile(mem)
+    zipFile.getEntriesInPhysicalOrder().iterator().forEach {
+        process(Pair(it.name, zipFile.getInputStream(it).readAllBytes()))
+    }
+}
+
+/**
+ * Join the entries of several ZIP archives into one, named like those of
+ * zip().  The entries are copied in their compressed form: nothing gets
+ * inflated nor deflated again.
+ */
+fun List<ByteArray>.mergeZips(): ByteArray {
+    val baos = ByteArrayOutputStream()
+    val out = ZipArchiveOutputStream(baos)
+    var fileIndex = 0
+    for (archive in this) {
+        val zipFile = ZipFile(SeekableInMemoryByteChannel(archive))
+        zipFile.getEntriesInPhysicalOrder().iterator().forEach { entry ->
+            val copy = ZipArchiveEntry("File ${fileIndex++}")
+            copy.method = entry.method
+            copy.crc = entry.crc
+            copy.compressedSize = entry.compressedSize
+            copy.size = entry.size
+            copy.time = entry.time
+            zipFile.getRawInputStream(entry).use { out.addRawArchiveEntry(copy, it) }
+        }
+        zipFile.close()
+    }
+    out.finish()
+    baos.close()
+    return baos.toByteArray()
+}
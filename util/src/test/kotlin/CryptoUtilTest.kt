@@ -28,6 +28,7 @@ import java.security.KeyPairGenerator
 import java.security.interfaces.RSAPrivateCrtKey
 import java.security.spec.KeySpec
 import java.security.spec.X509EncodedKeySpec
+import java.util.*
 import javax.crypto.EncryptedPrivateKeyInfo
 import kotlin.test.assertEquals
 import kotlin.test.assertFalse
@@ -74,6 +75,29 @@ class CryptoUtilTest {
         assertTrue(data.contentEquals(dec))
     }
 
+    @Test
+    fun testEbicsE002Segmented() {
+        val data = ByteArray(100000) { (it % 251).toByte() }
+        val keyPair = CryptoUtil.generateRsaKeyPair(1024)
+        val enc = CryptoUtil.encryptEbicsE002(data, keyPair.public)
+        val prepared = PreparedUploadData(enc.encryptedTransactionKey, ByteArray(0), enc.encryptedData, 4096)
+        assertEquals((enc.encryptedData.size + 3071) / 3072, prepared.numSegments)
+        val segments = (0 until prepared.numSegments).map { prepared.encodeSegment(it) }
+        for (segment in segments.dropLast(1)) {
+            assertEquals(4096, segment.length)
+        }
+        assertTrue(segments.last().length <= 4096)
+        // The segments are cut from one encoding, as a bank decodes them.
+        val encoded = segments.joinToString("")
+        assertEquals(Base64.getEncoder().encodeToString(enc.encryptedData), encoded)
+        val dec = CryptoUtil.decryptEbicsE002Stream(
+            enc.encryptedTransactionKey,
+            Base64.getDecoder().decode(encoded).inputStream(),
+            keyPair.private
+        ).use { it.readAllBytes() }
+        assertTrue(data.contentEquals(dec))
+    }
+
     @Test
     fun testEbicsA006() {
         val keyPair = CryptoUtil.generateRsaKeyPair(1024)
@@ -0,0 +1,49 @@
+/*
+ * This file is part of LibEuFin.
+ * Copyright (C) 2020 Taler Systems S.A.
+ *
+ * LibEuFin is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation; either version 3, or
+ * (at your option) any later version.
+ *
+ * LibEuFin is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public
+ * License along with LibEuFin; see the file COPYING.  If not, see
+ * <http://www.gnu.org/licenses/>
+ */
+
+import org.junit.Test
+import tech.libeufin.util.RsaKeyPairPool
+import kotlin.test.assertEquals
+import kotlin.test.assertNotEquals
+
+class RsaKeyPairPoolTest {
+    @Test
+    fun seededPoolsAreDeterministic() {
+        val a = RsaKeyPairPool(nbits = 1024, seed = 42)
+        val b = RsaKeyPairPool(nbits = 1024, seed = 42)
+        val first = a.take()
+        assertEquals(first, b.take())
+        assertNotEquals(first, a.take())
+    }
+
+    @Test
+    fun backgroundRefill() {
+        val pool = RsaKeyPairPool(targetDepth = 2, threads = 1, nbits = 1024)
+        val deadline = System.currentTimeMillis() + 60000
+        while (pool.stats().depth < 2 && System.currentTimeMillis() < deadline) {
+            Thread.sleep(50)
+        }
+        assertEquals(2, pool.stats().depth)
+        pool.take()
+        pool.take()
+        val stats = pool.stats()
+        assertEquals(2L, stats.handedOut)
+        assertEquals(0L, stats.generatedOnRequest)
+    }
+}
@@ -9,8 +9,11 @@ import tech.libeufin.util.ebics_h004.EbicsTypes
 import tech.libeufin.util.ebics_h004.HTDResponseOrderData
 import tech.libeufin.util.CryptoUtil
 import tech.libeufin.util.XMLUtil
+import tech.libeufin.util.XmlSchemaFamily
 import java.security.KeyPairGenerator
 import java.util.*
+import java.util.concurrent.Callable
+import java.util.concurrent.Executors
 import javax.xml.transform.stream.StreamSource
 import tech.libeufin.util.XMLUtil.Companion.signEbicsResponse
 
@@ -97,6 +100,32 @@ class XmlUtilTest {
         assertTrue(XMLUtil.validate(StreamSource(ini)))
     }
 
+    @Test
+    fun validationFamilies() {
+        val classLoader = ClassLoader.getSystemClassLoader()
+        val hev = classLoader.getResourceAsStream("ebics_hev.xml").readAllBytes().toString(Charsets.UTF_8)
+        assertTrue(XMLUtil.validateFromString(hev, XmlSchemaFamily.EBICS_HEV))
+        assertFalse(XMLUtil.validateFromString(hev, XmlSchemaFamily.EBICS_H004))
+        assertFalse(XMLUtil.validateFromString("<unknown xmlns=\"urn:example\"/>"))
+        assertTrue(XMLUtil.validateFromStream(classLoader.getResourceAsStream("ebics_ini_request_sample.xml")))
+    }
+
+    @Test
+    fun concurrentValidation() {
+        val classLoader = ClassLoader.getSystemClassLoader()
+        val ini = classLoader.getResourceAsStream("ebics_ini_request_sample.xml").readAllBytes().toString(Charsets.UTF_8)
+        val hev = classLoader.getResourceAsStream("ebics_hev.xml").readAllBytes().toString(Charsets.UTF_8)
+        val pool = Executors.newFixedThreadPool(8)
+        try {
+            val results = (0 until 200).map { i ->
+                pool.submit(Callable { XMLUtil.validateFromString(if (i % 2 == 0) ini else hev) })
+            }.map { it.get() }
+            assertTrue(results.all { it })
+        } finally {
+            pool.shutdown()
+        }
+    }
+
     @Test
     fun basicSigningTest() {
         val doc = XMLUtil.parseStringIntoDom("""
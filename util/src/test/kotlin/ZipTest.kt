@@ -0,0 +1,19 @@
+import org.junit.Test
+import tech.libeufin.util.mergeZips
+import tech.libeufin.util.unzipWithLambda
+import tech.libeufin.util.zip
+import kotlin.test.assertEquals
+
+class ZipTest {
+    @Test
+    fun mergeKeepsAllEntries() {
+        val first = listOf("a".repeat(1000).toByteArray(), "b".toByteArray()).zip()
+        val second = listOf("c".toByteArray()).zip()
+        val entries = mutableListOf<Pair<String, String>>()
+        listOf(first, listOf<ByteArray>().zip(), second).mergeZips().unzipWithLambda { entries.add(it) }
+        assertEquals(
+            listOf(Pair("File 0", "a".repeat(1000)), Pair("File 1", "b"), Pair("File 2", "c")),
+            entries
+        )
+    }
+}